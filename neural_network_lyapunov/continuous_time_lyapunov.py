@@ -63,6 +63,34 @@ class LyapunovContinuousTimeSystem(lyapunov.LyapunovHybridLinearSystem):
         return dVdx @ xdot + epsilon * self.lyapunov_value(
             x, x_equilibrium, V_lambda, R=R)
 
+    def lyapunov_derivative_batch(self,
+                                  x,
+                                  x_equilibrium,
+                                  V_lambda,
+                                  epsilon,
+                                  *,
+                                  R,
+                                  zero_tol=0.):
+        """
+        The batched version of lyapunov_derivative(). Compute all the possible
+        V̇(x) + εV(x) for a batch of states x.
+        @return (Vdot, offsets) The values at x[i] are
+        Vdot[offsets[i]:offsets[i+1]].
+        """
+        assert (len(x.shape) == 2)
+        dVdx, offsets = self._lyapunov_all_gradients_batch(x,
+                                                           x_equilibrium,
+                                                           V_lambda,
+                                                           R,
+                                                           zero_tol=zero_tol)
+        owner = torch.repeat_interleave(
+            torch.arange(x.shape[0], device=x.device),
+            offsets[1:] - offsets[:-1])
+        xdot = self.system.step_forward(x)
+        V = self.lyapunov_value(x, x_equilibrium, V_lambda, R=R)
+        return torch.sum(dVdx * xdot[owner], dim=1) + epsilon * V[owner],\
+            offsets
+
     def lyapunov_derivative_as_milp(self,
                                     x_equilibrium,
                                     V_lambda,
@@ -127,8 +155,9 @@ class LyapunovContinuousTimeSystem(lyapunov.LyapunovHybridLinearSystem):
                             sense=gurobipy.GRB.LESS_EQUAL,
                             rhs=lyapunov_upper - V_constant)
         # Adds the mixed-integer constraint that formulates ∂ϕ/∂x * ẋ
-        if self.network_bound_propagate_method == \
-                mip_utils.PropagateBoundsMethod.IA:
+        if self.network_bound_propagate_method in (
+                mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN):
             relu_z_lo, relu_z_up, relu_Wz_lo, relu_Wz_up = \
                 self.lyapunov_relu_free_pattern._compute_Wz_bounds_IA(
                     system_constraint_return.x_next_lb_IA,
@@ -194,8 +223,9 @@ class LyapunovContinuousTimeSystem(lyapunov.LyapunovHybridLinearSystem):
         # equals to λ*(2 * b(i)-1)*R[i,:]ẋ, where b(i) is the i'th term in
         # l1_binary
         # First compute the bounds R[i, :]*ẋ
-        if self.network_bound_propagate_method == \
-                mip_utils.PropagateBoundsMethod.IA:
+        if self.network_bound_propagate_method in (
+                mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN):
             Rxdot_lb, Rxdot_ub = mip_utils.compute_range_by_IA(
                 R, torch.zeros((R.shape[0], ), dtype=self.system.dtype),
                 system_constraint_return.x_next_lb_IA,
@@ -271,7 +301,7 @@ class LyapunovContinuousTimeSystem(lyapunov.LyapunovHybridLinearSystem):
         assert (isinstance(eps_type, lyapunov.ConvergenceEps))
 
         assert (eps_type == lyapunov.ConvergenceEps.ExpLower)
-        assert (reduction in {"mean", "max", "4norm"})
+        assert (reduction in {"mean", "max", "4norm", "none"})
         assert (isinstance(zero_tol, float) and zero_tol >= 0.)
         R = lyapunov._get_R(R, self.system.x_dim, state_samples.device)
         V = self.lyapunov_value(state_samples, x_equilibrium, V_lambda, R=R)
@@ -300,6 +330,8 @@ class LyapunovContinuousTimeSystem(lyapunov.LyapunovHybridLinearSystem):
             return torch.max(hinge_loss_all)
         elif reduction == "4norm":
             return torch.norm(hinge_loss_all, p=4)
+        elif reduction == "none":
+            return hinge_loss_all
 
 
 class LyapunovContinuousTimeHybridSystem(lyapunov.LyapunovHybridLinearSystem):
@@ -1,5 +1,8 @@
 import neural_network_lyapunov.feedback_system as feedback_system
+import copy
 import gurobipy
+import numpy as np
+import torch
 import neural_network_lyapunov.hybrid_linear_system as hybrid_linear_system
 import neural_network_lyapunov.relu_system as relu_system
 import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
@@ -51,3 +54,37 @@ def _add_system_constraint(system,
         return ret
     else:
         raise (NotImplementedError)
+
+
+def _restrict_system_box(system, x_lo: torch.Tensor, x_up: torch.Tensor):
+    """
+    Return a shallow copy of the system, whose state box is the intersection
+    of the system box with [x_lo, x_up]. The dynamics (and the networks) are
+    shared with the original system. The mixed-integer constraints of the
+    returned system are formulated on the smaller box, hence they have
+    tighter big-M coefficients.
+    @param x_lo The lower bound of the state box.
+    @param x_up The upper bound of the state box.
+    """
+    assert (x_lo.shape == (system.x_dim, ))
+    assert (x_up.shape == (system.x_dim, ))
+    restricted = copy.copy(system)
+    if isinstance(system, feedback_system.FeedbackSystem):
+        restricted.forward_system = _restrict_system_box(
+            system.forward_system, x_lo, x_up)
+        restricted.x_lo_all = restricted.forward_system.x_lo_all
+        restricted.x_up_all = restricted.forward_system.x_up_all
+    elif isinstance(system, hybrid_linear_system.AutonomousHybridLinearSystem)\
+            or isinstance(system, hybrid_linear_system.HybridLinearSystem):
+        restricted.x_lo_all = np.maximum(system.x_lo_all,
+                                         x_lo.detach().numpy())
+        restricted.x_up_all = np.minimum(system.x_up_all,
+                                         x_up.detach().numpy())
+    elif isinstance(getattr(system, "x_lo", None), torch.Tensor):
+        # The ReLU systems store the box as the tensors x_lo and x_up.
+        restricted.x_lo = torch.maximum(system.x_lo, x_lo)
+        restricted.x_up = torch.minimum(system.x_up, x_up)
+    else:
+        raise NotImplementedError
+    assert (np.all(restricted.x_lo_all <= restricted.x_up_all))
+    return restricted
@@ -120,18 +120,10 @@ class DynamicsLearning:
         else:
             lyap_pos_mip.gurobi_model.optimize(
                 utils.get_gurobi_terminate_if_callback())
-        num_sol = lyap_pos_mip.gurobi_model.solCount
-        z_adv_pos = []
-        for i in range(num_sol):
-            lyap_pos_mip.gurobi_model.setParam(
-                gurobipy.GRB.Param.SolutionNumber, i)
-            obj = lyap_pos_mip.gurobi_model.PoolObjVal
-            if obj > 0:
-                z_adv_pos.append(
-                    torch.tensor([r.xn for r in x_var],
-                                 dtype=self.opt.dtype).unsqueeze(0))
-        if len(z_adv_pos) > 0:
-            z_adv_pos = torch.cat(z_adv_pos, dim=0)
+        z_adv_pos, pool_obj = lyap_pos_mip.get_pool_solutions(x_var)
+        z_adv_pos = z_adv_pos[pool_obj > 0].to(self.opt.dtype)
+        if z_adv_pos.shape[0] == 0:
+            z_adv_pos = []
 
         lyap_der_mip_ = self.lyap.lyapunov_derivative_as_milp(
             self.lyap.system.x_equilibrium,
@@ -148,18 +140,10 @@ class DynamicsLearning:
         else:
             lyap_der_mip.gurobi_model.optimize(
                 utils.get_gurobi_terminate_if_callback())
-        num_sol = lyap_der_mip.gurobi_model.solCount
-        z_adv_der = []
-        for i in range(num_sol):
-            lyap_der_mip.gurobi_model.setParam(
-                gurobipy.GRB.Param.SolutionNumber, i)
-            obj = lyap_der_mip.gurobi_model.PoolObjVal
-            if obj > 0:
-                z_adv_der.append(
-                    torch.tensor([r.xn for r in x_var],
-                                 dtype=self.opt.dtype).unsqueeze(0))
-        if len(z_adv_der) > 0:
-            z_adv_der_lo = torch.cat(z_adv_der, dim=0)
+        z_adv_der, pool_obj = lyap_der_mip.get_pool_solutions(x_var)
+        z_adv_der = z_adv_der[pool_obj > 0].to(self.opt.dtype)
+        if z_adv_der.shape[0] > 0:
+            z_adv_der_lo = z_adv_der
 
         lyap_der_mip_ = self.lyap.lyapunov_derivative_as_milp(
             self.lyap.system.x_equilibrium,
@@ -176,18 +160,10 @@ class DynamicsLearning:
         else:
             lyap_der_mip.gurobi_model.optimize(
                 utils.get_gurobi_terminate_if_callback())
-        num_sol = lyap_der_mip.gurobi_model.solCount
-        z_adv_der = []
-        for i in range(num_sol):
-            lyap_der_mip.gurobi_model.setParam(
-                gurobipy.GRB.Param.SolutionNumber, i)
-            obj = lyap_der_mip.gurobi_model.PoolObjVal
-            if obj > 0:
-                z_adv_der.append(
-                    torch.tensor([r.xn for r in x_var],
-                                 dtype=self.opt.dtype).unsqueeze(0))
-        if len(z_adv_der) > 0:
-            z_adv_der_up = torch.cat(z_adv_der, dim=0)
+        z_adv_der, pool_obj = lyap_der_mip.get_pool_solutions(x_var)
+        z_adv_der = z_adv_der[pool_obj > 0].to(self.opt.dtype)
+        if z_adv_der.shape[0] > 0:
+            z_adv_der_up = z_adv_der
 
         return z_adv_pos, z_adv_der_lo, z_adv_der_up
 
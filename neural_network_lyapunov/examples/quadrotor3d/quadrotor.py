@@ -536,7 +536,8 @@ class QuadrotorReLUSystem:
                                 additional_u_up: torch.Tensor = None,
                                 create_lp_prog_callback=None,
                                 binary_var_type=gurobipy.GRB.BINARY,
-                                u_input_prog=None):
+                                u_input_prog=None,
+                                cache_tag=None):
         """
         Add the dynamics constraints
         pos[n+1] = pos[n] + (pos_dot[n] + pos_dot[n+1]) / 2 * dt
@@ -549,6 +550,10 @@ class QuadrotorReLUSystem:
         additional constraints to the LP. The additional constraints include
         those from the feedback system when connecting this forward system with
         a controller.
+        @param cache_tag Only used when
+        self.dynamics_relu_free_pattern.bound_cache is set. A hashable tag
+        that changes whenever the constraints added by create_lp_prog_callback
+        change, refer to relu_to_optimization.ReLUBoundCache.
         """
         u_lo = self.u_lo if additional_u_lo is None else torch.max(
             self.u_lo, additional_u_lo)
@@ -562,7 +567,8 @@ class QuadrotorReLUSystem:
             self.dynamics_relu_free_pattern._compute_layer_bound(
                 network_input_lo, network_input_up,
                 self.network_bound_propagate_method,
-                create_prog_callback=create_lp_prog_callback)
+                create_prog_callback=create_lp_prog_callback,
+                cache_tag=cache_tag)
 
         return self._add_dynamics_constraint_given_relu_bounds(
             mip, x_var, x_next_var, u_var, slack_var_name, binary_var_name,
@@ -3,6 +3,7 @@ import neural_network_lyapunov.examples.quadrotor3d.quadrotor as quadrotor
 import neural_network_lyapunov.mip_utils as mip_utils
 import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
 import neural_network_lyapunov.relu_system as relu_system
+import neural_network_lyapunov.mip_cache as mip_cache
 
 import gurobipy
 import torch
@@ -34,10 +35,12 @@ class QuadrotorFeedbackSystem(feedback_system.FeedbackSystem):
         the linear constraints in both the controller network and the
         forward network.
         """
-        if self.forward_system.network_bound_propagate_method ==\
-            mip_utils.PropagateBoundsMethod.IA or\
-            self.controller_network_bound_propagate_method ==\
-                mip_utils.PropagateBoundsMethod.IA:
+        if self.forward_system.network_bound_propagate_method in (
+                mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN) or\
+                self.controller_network_bound_propagate_method in (
+                mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN):
             return super(QuadrotorFeedbackSystem,
                          self).add_dynamics_mip_constraint(
                              mip, x_var, x_next_var, u_var_name,
@@ -99,8 +102,9 @@ class QuadrotorFeedbackSystem(feedback_system.FeedbackSystem):
                 self.x_dim, lb=-gurobipy.GRB.INFINITY)
             control_bound_prog.u_var = control_bound_prog.prog.addVars(
                 self.forward_system.u_dim, lb=-gurobipy.GRB.INFINITY)
-            if self.controller_network_bound_propagate_method !=\
-                    mip_utils.PropagateBoundsMethod.IA:
+            if self.controller_network_bound_propagate_method not in (
+                    mip_utils.PropagateBoundsMethod.IA,
+                    mip_utils.PropagateBoundsMethod.CROWN):
                 self._add_network_controller_mip_constraint_given_relu_bound(
                     control_bound_prog.prog,
                     control_bound_prog.x_var,
@@ -164,11 +168,23 @@ class QuadrotorFeedbackSystem(feedback_system.FeedbackSystem):
                     9:12] + u_var_lp
                 return prog, forward_network_input_var
 
+            # The constraints in create_prog_callback encode the controller,
+            # so the cached bounds of the dynamics network can only be reused
+            # for the same controller (refer to
+            # relu_to_optimization.ReLUBoundCache).
+            cache_tag = mip_cache.compute_fingerprint(
+                self.controller_network,
+                self.controller_network_bound_propagate_method,
+                controller_relu_input_lo, controller_relu_input_up,
+                controller_network_output_lo, controller_network_output_up,
+                forward_network_u_lo, forward_network_u_up,
+                self.u_lower_limit, self.u_upper_limit)
             forward_dynamics_return = \
                 self.forward_system.add_dynamics_constraint(
                     mip, x_var, x_next_var, u_var, forward_slack_var_name,
                     forward_binary_var_name, additional_u_lo=u_lower_bound,
                     additional_u_up=u_upper_bound,
                     create_lp_prog_callback=create_prog_callback,
-                    binary_var_type=binary_var_type)
+                    binary_var_type=binary_var_type,
+                    cache_tag=cache_tag)
             return u_var, forward_dynamics_return, controller_mip_cnstr_return
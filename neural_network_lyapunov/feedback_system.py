@@ -168,16 +168,18 @@ class FeedbackSystem:
                                                binary_var_type):
         network_input_lo = torch.from_numpy(self.forward_system.x_lo_all)
         network_input_up = torch.from_numpy(self.forward_system.x_up_all)
-        controller_pre_relu_lo, controller_pre_relu_up,\
-            controller_post_relu_lo, controller_post_relu_up, =\
-            self.controller_relu_free_pattern._compute_layer_bound(
-                network_input_lo, network_input_up,
-                self.controller_network_bound_propagate_method)
-        network_output_lo, network_output_up =\
-            self.controller_relu_free_pattern._compute_network_output_bounds(
-                controller_pre_relu_lo, controller_pre_relu_up,
-                network_input_lo, network_input_up,
-                self.controller_network_bound_propagate_method)
+        with self.controller_relu_free_pattern.bound_tightening_pool():
+            controller_pre_relu_lo, controller_pre_relu_up,\
+                controller_post_relu_lo, controller_post_relu_up, =\
+                self.controller_relu_free_pattern._compute_layer_bound(
+                    network_input_lo, network_input_up,
+                    self.controller_network_bound_propagate_method)
+            network_output_lo, network_output_up =\
+                self.controller_relu_free_pattern.\
+                _compute_network_output_bounds(
+                    controller_pre_relu_lo, controller_pre_relu_up,
+                    network_input_lo, network_input_up,
+                    self.controller_network_bound_propagate_method)
 
         controller_slack, controller_binary, u_lower_bound, u_upper_bound,\
             controller_pre_relu_lo, controller_pre_relu_up =\
@@ -189,7 +191,9 @@ class FeedbackSystem:
                 binary_var_type)
 
         control_bound_prog = relu_system.ControlBoundProg(None, None, None)
-        control_bound_prog.prog = gurobi_torch_mip.GurobiTorchMILP(self.dtype)
+        # The bound program is always solved with gurobi.
+        control_bound_prog.prog = gurobi_torch_mip.GurobiTorchMILP(
+            self.dtype, backend=gurobi_torch_mip.GurobiSolverBackend())
         control_bound_prog.prog.gurobi_model.setParam(
             gurobipy.GRB.Param.OutputFlag, False)
         control_bound_prog.x_var = control_bound_prog.prog.addVars(
@@ -197,8 +201,9 @@ class FeedbackSystem:
         control_bound_prog.u_var = control_bound_prog.prog.addVars(
             self.forward_system.u_dim, lb=-gurobipy.GRB.INFINITY)
 
-        if self.controller_network_bound_propagate_method != \
-                mip_utils.PropagateBoundsMethod.IA:
+        if self.controller_network_bound_propagate_method not in (
+                mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN):
             self._add_network_controller_mip_constraint_given_relu_bound(
                 control_bound_prog.prog, control_bound_prog.x_var,
                 control_bound_prog.u_var, controller_pre_relu_lo,
@@ -275,15 +280,16 @@ class FeedbackSystem:
                     mip, x_var, u_var, binary_var_type)
             control_bound_prog = relu_system.ControlBoundProg(None, None, None)
             control_bound_prog.prog = gurobi_torch_mip.GurobiTorchMILP(
-                self.dtype)
+                self.dtype, backend=gurobi_torch_mip.GurobiSolverBackend())
             control_bound_prog.prog.gurobi_model.setParam(
                 gurobipy.GRB.Param.OutputFlag, False)
             control_bound_prog.x_var = control_bound_prog.prog.addVars(
                 self.x_dim, lb=-gurobipy.GRB.INFINITY)
             control_bound_prog.u_var = control_bound_prog.prog.addVars(
                 self.forward_system.u_dim, lb=-gurobipy.GRB.INFINITY)
-            if self.controller_network_bound_propagate_method != \
-                    mip_utils.PropagateBoundsMethod.IA:
+            if self.controller_network_bound_propagate_method not in (
+                    mip_utils.PropagateBoundsMethod.IA,
+                    mip_utils.PropagateBoundsMethod.CROWN):
                 self._add_linear_controller_mip_constraint(
                     control_bound_prog.prog, control_bound_prog.x_var,
                     control_bound_prog.u_var,
@@ -313,20 +319,19 @@ class FeedbackSystem:
         x_var, controller_slack and controller_binary.
         Note that after calling this function, @param mip might get changed, it
         will contain the strengthened constraint if that constraint is violated
-        at the values in x_var, controller_slack, controller_binary.
+        at the values in x_var, controller_slack, controller_binary. mip can
+        also be a gurobi_torch_mip.MIPNodeCutAdder.
         """
         assert (isinstance(self.controller_network, torch.nn.Sequential))
-        assert (isinstance(mip, gurobi_torch_mip.GurobiTorchMIP))
+        assert (isinstance(mip, (gurobi_torch_mip.GurobiTorchMIP,
+                                 gurobi_torch_mip.MIPNodeCutAdder)))
         assert (isinstance(x_var, list))
         assert (isinstance(controller_slack, list))
         assert (isinstance(controller_binary, list))
         assert (isinstance(controller_post_relu_lo, torch.Tensor))
         assert (isinstance(controller_post_relu_up, torch.Tensor))
-        linear_inputs = torch.tensor([v.x for v in x_var] +
-                                     [v.x for v in controller_slack],
-                                     dtype=mip.dtype)
-        relu_activations = torch.tensor([v.x for v in controller_binary],
-                                        dtype=mip.dtype)
+        linear_inputs = mip.get_solution(x_var + controller_slack)
+        relu_activations = mip.get_solution(controller_binary)
         linear_inputs_lo = torch.cat(
             (torch.from_numpy(self.forward_system.x_lo_all),
              controller_post_relu_lo))
@@ -392,8 +397,12 @@ class FeedbackSystem:
         add_dynamics_mip_constraint()
         @param controller_mip_cnstr_return: Returned from
         add_dynamics_mip_constraint()
+        @param mip Either a GurobiTorchMIP, or a
+        gurobi_torch_mip.MIPNodeCutAdder to add the constraints as user cuts
+        at a branch-and-bound node.
         """
-        assert (isinstance(mip, gurobi_torch_mip.GurobiTorchMIP))
+        assert (isinstance(mip, (gurobi_torch_mip.GurobiTorchMIP,
+                                 gurobi_torch_mip.MIPNodeCutAdder)))
         assert (isinstance(forward_dynamics_return,
                            hybrid_linear_system.DynamicsConstraintReturn))
         assert (isinstance(controller_mip_cnstr_return,
@@ -402,12 +411,11 @@ class FeedbackSystem:
                        relu_system.ReLUDynamicsConstraintReturn)):
             # Value of the inputs to each linear layer in the forward dynamics
             # network.
-            forward_nn_linear_inputs = torch.tensor(
-                [v.x for v in forward_dynamics_return.nn_input] +
-                [v.x for v in forward_dynamics_return.slack],
-                dtype=mip.dtype)
-            forward_relu_activations = torch.tensor(
-                [v.x for v in forward_dynamics_return.binary], dtype=mip.dtype)
+            forward_nn_linear_inputs = mip.get_solution(
+                forward_dynamics_return.nn_input +
+                forward_dynamics_return.slack)
+            forward_relu_activations = mip.get_solution(
+                forward_dynamics_return.binary)
             forward_nn_linear_inputs_lo = torch.cat(
                 (forward_dynamics_return.nn_input_lo,
                  forward_dynamics_return.relu_output_lo))
@@ -1,6 +1,13 @@
 import gurobipy
 import torch
 import numpy as np
+import os
+import tempfile
+import contextlib
+import threading
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.linalg
 
 
 class IncorrectActiveConstraint(Exception):
@@ -22,6 +29,11 @@ class MixedIntegerConstraintsReturn:
     Ain_slack, Ain_binary, rhs_in, Aeq_input, Aeq_slack, Aeq_binary, rhs_eq.
     If the mixed integer constraints doesn't contain some terms, then we set
     that term to None.
+    The matrices Aout_*, Ain_* and Aeq_* can be either dense torch tensors or
+    sparse torch tensors in the COO layout. The sparse matrices are kept
+    sparse in transform_input(), concatenate_mixed_integer_constraints() and
+    GurobiTorchMIP.add_mixed_integer_linear_constraints(), hence the zero
+    blocks are never materialized.
     """
     def __init__(self):
         self.Aout_input = None
@@ -135,24 +147,64 @@ class MixedIntegerConstraintsReturn:
         The output is
         Aout_input * A * x + Aout_slack * s + Aout_binary * binary +
             Aout_input * b + Cout.
+        If Ain_input (Aeq_input, Aout_input) is sparse, then the transformed
+        matrix is also sparse.
         """
+        def transform_matrix(mat):
+            if mat.is_sparse:
+                return torch.sparse.mm(mat, A.to_sparse()).coalesce()
+            return mat @ A
+
         if self.Ain_input is not None:
             self.rhs_in -= self.Ain_input @ b
-            self.Ain_input = self.Ain_input @ A
+            self.Ain_input = transform_matrix(self.Ain_input)
         if self.Aeq_input is not None:
             self.rhs_eq -= self.Aeq_input @ b
-            self.Aeq_input = self.Aeq_input @ A
+            self.Aeq_input = transform_matrix(self.Aeq_input)
         if self.Aout_input is not None:
             if self.Cout is not None:
                 self.Cout += self.Aout_input @ b
             else:
                 self.Cout = self.Aout_input @ b
-            self.Aout_input = self.Aout_input @ A
+            self.Aout_input = transform_matrix(self.Aout_input)
         if self.input_lo is not None or self.input_up is not None:
             assert ("transform_input(): cannot handle non-empty input_lo or " +
                     "input_up")
 
 
+def sparse_block_matrix(blocks, shape, dtype):
+    """
+    Assemble a sparse matrix from blocks, without allocating the zero entries
+    between the blocks.
+    @param blocks A list of tuples (mat, row_offset, col_offset). mat is a
+    dense or sparse (COO) torch tensor, or None (an empty block). The
+    entries of mat are placed at
+    result[row_offset:row_offset + mat.shape[0],
+           col_offset:col_offset + mat.shape[1]].
+    A dense block is converted to sparse, namely its zero entries are not
+    stored in the result.
+    @param shape The shape of the result.
+    @param dtype The data type of the result.
+    @return result A coalesced sparse torch tensor in the COO layout.
+    """
+    indices = [torch.empty((2, 0), dtype=torch.int64)]
+    values = [torch.empty((0, ), dtype=dtype)]
+    for (mat, row_offset, col_offset) in blocks:
+        if mat is None:
+            continue
+        assert (len(mat.shape) == 2)
+        assert (row_offset + mat.shape[0] <= shape[0])
+        assert (col_offset + mat.shape[1] <= shape[1])
+        mat_sparse = (mat if mat.is_sparse else mat.to_sparse()).coalesce()
+        indices.append(mat_sparse.indices() + torch.tensor(
+            [[row_offset], [col_offset]], dtype=torch.int64))
+        values.append(mat_sparse.values().to(dtype))
+    return torch.sparse_coo_tensor(torch.cat(indices, dim=1),
+                                   torch.cat(values),
+                                   shape,
+                                   dtype=dtype).coalesce()
+
+
 def concatenate_mixed_integer_constraints(
         cnstr1: MixedIntegerConstraintsReturn,
         cnstr2: MixedIntegerConstraintsReturn, same_slack: bool,
@@ -168,6 +220,8 @@ def concatenate_mixed_integer_constraints(
       stack_output: Set to True if we stack the output of cnstr1 and cnstr2.
       Set to False then we will leave the output of the returned
       MixedIntegerConstraintsReturn object to be empty.
+    If either of the two matrices being stacked is sparse, then the stacked
+    matrix is sparse.
     """
     assert (cnstr1.num_input() == cnstr2.num_input())
     ret = MixedIntegerConstraintsReturn()
@@ -181,9 +235,18 @@ def concatenate_mixed_integer_constraints(
             return rhs1
         return torch.cat((rhs1, rhs2))
 
+    def is_sparse(mat1, mat2):
+        return (mat1 is not None and mat1.is_sparse) or (mat2 is not None
+                                                         and mat2.is_sparse)
+
     def stack_matrix(mat1, mat2, mat1_size, mat2_size):
         if mat1 is None and mat2 is None:
             return None
+        if is_sparse(mat1, mat2):
+            dtype = mat1.dtype if mat1 is not None else mat2.dtype
+            return sparse_block_matrix(
+                [(mat1, 0, 0), (mat2, mat1_size[0], 0)],
+                (mat1_size[0] + mat2_size[0], mat1_size[1]), dtype)
         if mat1 is not None and mat2 is None:
             return torch.cat((mat1, torch.zeros(mat2_size, dtype=mat1.dtype)),
                              dim=0)
@@ -197,6 +260,13 @@ def concatenate_mixed_integer_constraints(
                              num_var2):
         if mat1 is None and mat2 is None:
             return None
+        if is_sparse(mat1, mat2):
+            assert (mat1 is None or mat1.shape == (num_cnstr1, num_var1))
+            assert (mat2 is None or mat2.shape == (num_cnstr2, num_var2))
+            dtype = mat1.dtype if mat1 is not None else mat2.dtype
+            return sparse_block_matrix(
+                [(mat1, 0, 0), (mat2, num_cnstr1, num_var1)],
+                (num_cnstr1 + num_cnstr2, num_var1 + num_var2), dtype)
         if mat1 is not None and mat2 is None:
             assert (mat1.shape == (num_cnstr1, num_var1))
             return torch.block_diag(
@@ -359,6 +429,803 @@ variable to solve the MIP.
 BINARYRELAX = 'BR'
 
 
+class COOMatrixStorage:
+    """
+    Stores a sparse matrix in the coordinate (COO) format, which grows by
+    appending blocks of entries.
+    The row and column indices are stored in contiguous numpy buffers. When a
+    buffer is full we double its capacity, so appending is amortized O(1) per
+    entry. The values are stored as a list of 1D torch tensors, one tensor for
+    each appended block (for example one block for each addMConstr call). Each
+    block remains connected to the autograd graph, so that we can
+    differentiate through the values.
+    """
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self._row = np.empty((0, ), dtype=np.int64)
+        self._col = np.empty((0, ), dtype=np.int64)
+        self._val_blocks = []
+        self.nnz = 0
+        # Data derived from the stored entries, such as the index tensor and
+        # the CSR structure. It is cleared whenever we append new entries.
+        self._cache = {}
+
+    def __len__(self):
+        return self.nnz
+
+    def _reserve(self, capacity):
+        if capacity > self._row.shape[0]:
+            new_capacity = max(capacity, 2 * self._row.shape[0], 16)
+            row = np.empty((new_capacity, ), dtype=np.int64)
+            col = np.empty((new_capacity, ), dtype=np.int64)
+            row[:self.nnz] = self._row[:self.nnz]
+            col[:self.nnz] = self._col[:self.nnz]
+            self._row = row
+            self._col = col
+
+    def append(self, row, col, val):
+        """
+        Append the entries A[row[i], col[i]] = val[i]
+        @param row A 1D array of row indices.
+        @param col A 1D array of column indices.
+        @param val A 1D torch tensor of entry values.
+        """
+        row = np.asarray(row, dtype=np.int64).reshape((-1, ))
+        col = np.asarray(col, dtype=np.int64).reshape((-1, ))
+        assert (isinstance(val, torch.Tensor))
+        num_new = row.shape[0]
+        assert (col.shape == (num_new, ))
+        assert (val.shape == (num_new, ))
+        if num_new == 0:
+            return
+        self._reserve(self.nnz + num_new)
+        self._row[self.nnz:self.nnz + num_new] = row
+        self._col[self.nnz:self.nnz + num_new] = col
+        self._val_blocks.append(val.to(self.dtype))
+        self.nnz += num_new
+        self._cache = {}
+
+    @property
+    def row(self):
+        return self._row[:self.nnz]
+
+    @property
+    def col(self):
+        return self._col[:self.nnz]
+
+    @property
+    def val(self):
+        """
+        Return all the entry values as a single 1D tensor.
+        The blocks are merged into one tensor the first time we call this
+        function after appending new entries. We always merge with gradient
+        tracking enabled, as we might be inside a torch.no_grad() context, and
+        the merged tensor replaces the original blocks.
+        """
+        if len(self._val_blocks) == 0:
+            return torch.zeros((0, ), dtype=self.dtype)
+        if len(self._val_blocks) > 1:
+            with torch.enable_grad():
+                self._val_blocks = [torch.cat(self._val_blocks)]
+        return self._val_blocks[0]
+
+    def indices(self):
+        """
+        Return the row and column indices as a torch tensor of shape
+        (2, nnz).
+        """
+        if "indices" not in self._cache:
+            self._cache["indices"] = torch.from_numpy(
+                np.stack((self.row, self.col)))
+        return self._cache["indices"]
+
+    def _csr_structure(self, num_rows):
+        """
+        Return (order, indptr), such that the entries in row i are
+        order[indptr[i]:indptr[i+1]].
+        """
+        key = ("csr_structure", num_rows)
+        if key not in self._cache:
+            order = np.argsort(self.row, kind="stable")
+            indptr = np.zeros((num_rows + 1, ), dtype=np.int64)
+            np.cumsum(np.bincount(self.row, minlength=num_rows),
+                      out=indptr[1:])
+            self._cache[key] = (order, indptr)
+        return self._cache[key]
+
+    def to_dense(self, num_rows, num_cols, rows=None):
+        """
+        Return the matrix as a dense torch tensor of shape
+        (num_rows, num_cols). Duplicated entries are summed up.
+        @param rows If not None, then we only return the rows A[rows, :]
+        (in the same order as in @p rows).
+        """
+        if rows is None:
+            mat = torch.zeros((num_rows, num_cols), dtype=self.dtype)
+            if self.nnz == 0:
+                return mat
+            return mat.index_put((self.indices()[0], self.indices()[1]),
+                                 self.val,
+                                 accumulate=True)
+        rows = np.asarray(rows, dtype=np.int64).reshape((-1, ))
+        mat = torch.zeros((rows.shape[0], num_cols), dtype=self.dtype)
+        new_row, col, val = self.select_rows(num_rows, rows)
+        if new_row.shape[0] == 0:
+            return mat
+        return mat.index_put(
+            (torch.from_numpy(new_row), torch.from_numpy(col)),
+            val,
+            accumulate=True)
+
+    def select_rows(self, num_rows, rows):
+        """
+        Return the entries in the rows A[rows, :] in the COO format.
+        @param num_rows The number of rows in A.
+        @param rows A 1D array of row indices.
+        @return (new_row, col, val) new_row[i] is the index of the entry in
+        @p rows (namely the row index in A[rows, :]), col[i] is the column
+        index. new_row and col are numpy arrays, val is a torch tensor
+        connected to the autograd graph.
+        """
+        rows = np.asarray(rows, dtype=np.int64).reshape((-1, ))
+        if self.nnz == 0 or rows.shape[0] == 0:
+            return (np.zeros((0, ), dtype=np.int64),
+                    np.zeros((0, ), dtype=np.int64),
+                    torch.zeros((0, ), dtype=self.dtype))
+        order, indptr = self._csr_structure(num_rows)
+        counts = indptr[rows + 1] - indptr[rows]
+        # For each selected entry, its position in the CSR order.
+        csr_position = np.repeat(indptr[rows] - (np.cumsum(counts) - counts),
+                                 counts) + np.arange(np.sum(counts))
+        entries = order[csr_position]
+        new_row = np.repeat(np.arange(rows.shape[0]), counts)
+        return (new_row, self.col[entries],
+                self.val[torch.from_numpy(entries)])
+
+    def to_sparse(self, num_rows, num_cols):
+        """
+        Return the matrix as a torch sparse COO tensor. The gradient can flow
+        back to the values.
+        """
+        return torch.sparse_coo_tensor(self.indices(),
+                                       self.val, (num_rows, num_cols),
+                                       dtype=self.dtype)
+
+    def to_scipy_csr(self, num_rows, num_cols):
+        """
+        Return the matrix (with detached values) as a scipy CSR matrix. The
+        matrix is cached until we append new entries, use it for fast
+        evaluations that don't need the gradient.
+        """
+        key = ("scipy_csr", num_rows, num_cols)
+        if key not in self._cache:
+            self._cache[key] = scipy.sparse.csr_matrix(
+                (self.val.detach().numpy(), (self.row, self.col)),
+                shape=(num_rows, num_cols))
+        return self._cache[key]
+
+
+class BlockVectorStorage:
+    """
+    Stores a 1D vector (for example the right-hand side of the constraints),
+    which grows by appending blocks. Each block is a 1D torch tensor connected
+    to the autograd graph.
+    """
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self._blocks = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, block):
+        """
+        @param block A torch tensor. It will be flattened to 1D.
+        """
+        assert (isinstance(block, torch.Tensor))
+        block = block.reshape((-1, ))
+        if block.shape[0] == 0:
+            return
+        self._blocks.append(block.to(self.dtype))
+        self.size += block.shape[0]
+
+    @property
+    def val(self):
+        """
+        Return the vector as a single 1D tensor. Refer to
+        COOMatrixStorage.val for how the blocks are merged.
+        """
+        if len(self._blocks) == 0:
+            return torch.zeros((0, ), dtype=self.dtype)
+        if len(self._blocks) > 1:
+            with torch.enable_grad():
+                self._blocks = [torch.cat(self._blocks)]
+        return self._blocks[0]
+
+
+def factorize_sparse_matrix(row, col, val, size):
+    """
+    Compute the sparse LU factorization of the square matrix M, where
+    M[row[i], col[i]] = val[i] (duplicated entries are summed up).
+    Besides the factorization, we also return a cheap estimate of the
+    reciprocal condition number, as the ratio between the smallest and the
+    largest magnitude of the pivots in U. This is much cheaper than computing
+    the condition number through the singular value decomposition.
+    @param row A 1D numpy array of row indices.
+    @param col A 1D numpy array of column indices.
+    @param val A 1D torch tensor or numpy array of entry values.
+    @param size The number of rows (and columns) of M.
+    @return (lu, rcond) lu is a scipy SuperLU object, rcond is the estimated
+    reciprocal condition number. If M is exactly singular, then returns
+    (None, 0.)
+    """
+    if isinstance(val, torch.Tensor):
+        val = val.detach().numpy()
+    if size == 0:
+        return (None, 0.)
+    M = scipy.sparse.csc_matrix((val, (row, col)), shape=(size, size))
+    try:
+        lu = scipy.sparse.linalg.splu(M)
+    except RuntimeError:
+        # splu throws when the matrix is exactly singular.
+        return (None, 0.)
+    pivots = np.abs(lu.U.diagonal())
+    if np.max(pivots) == 0 or not np.all(np.isfinite(pivots)):
+        return (None, 0.)
+    return (lu, np.min(pivots) / np.max(pivots))
+
+
+class SparseLinearSolve(torch.autograd.Function):
+    """
+    Solves M * x = b for a sparse square matrix M with a precomputed LU
+    factorization. The gradient flows back to both the non-zero entries of M
+    and b. In the backward pass, we reuse the factorization to solve
+    Mᵀ * y = dL/dx, then dL/db = y and dL/dM = -y * xᵀ (only evaluated at the
+    non-zero entries of M).
+    Use it as SparseLinearSolve.apply(val, b, row, col, lu), where lu is
+    computed from factorize_sparse_matrix(row, col, val, len(b)).
+    """
+    @staticmethod
+    def forward(ctx, val, b, row, col, lu):
+        x = torch.from_numpy(lu.solve(b.detach().numpy())).to(b.dtype)
+        ctx.row = row
+        ctx.col = col
+        ctx.lu = lu
+        ctx.save_for_backward(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_x):
+        x, = ctx.saved_tensors
+        y = ctx.lu.solve(grad_x.detach().numpy(), trans="T")
+        grad_val = -y[ctx.row] * x.numpy()[ctx.col]
+        return (torch.from_numpy(grad_val).to(x.dtype),
+                torch.from_numpy(y).to(x.dtype), None, None, None)
+
+
+class GurobiSolveResult:
+    """
+    The result of solving the MIP with gurobi. The status, objective and the
+    solutions are read from the gurobi model when queried.
+    """
+    def __init__(self, gurobi_model):
+        self.gurobi_model = gurobi_model
+
+    @property
+    def status(self):
+        return self.gurobi_model.status
+
+    @property
+    def objective(self):
+        return self.gurobi_model.ObjVal
+
+    @property
+    def num_solutions(self):
+        return self.gurobi_model.solCount
+
+    def values(self, variables, solution_number=None):
+        """
+        @param variables A list of gurobi variables.
+        @param solution_number If None, then return the value in the current
+        solution (attribute X). Otherwise return the value in the
+        solution_number'th solution in the solution pool (attribute Xn).
+        @return values A list of floats.
+        """
+        if solution_number is None:
+            attr = gurobipy.GRB.Attr.X
+        else:
+            assert (solution_number >= 0
+                    and solution_number < self.gurobi_model.solCount)
+            self.gurobi_model.setParam(gurobipy.GRB.Param.SolutionNumber,
+                                       solution_number)
+            attr = gurobipy.GRB.Attr.Xn
+        if len(variables) == 0:
+            return []
+        return self.gurobi_model.getAttr(attr, variables)
+
+    def pool_objective(self, solution_number):
+        self.gurobi_model.setParam(gurobipy.GRB.Param.SolutionNumber,
+                                   solution_number)
+        return self.gurobi_model.PoolObjVal
+
+
+class ArraySolveResult:
+    """
+    The result of solving the MIP with a solver other than gurobi, stored as
+    arrays. The status is a gurobipy.GRB.Status code.
+    solutions[i, j] is the value of the variable with index j (namely
+    var.index == j) in the i'th solution, objectives[i] is the objective of
+    the i'th solution.
+    """
+    def __init__(self, status, solutions, objectives):
+        self.status = status
+        self.solutions = solutions
+        self.objectives = objectives
+
+    @property
+    def objective(self):
+        if self.num_solutions == 0:
+            raise Exception("ArraySolveResult: no solution is found.")
+        return self.objectives[0]
+
+    @property
+    def num_solutions(self):
+        return self.solutions.shape[0]
+
+    def values(self, variables, solution_number=None):
+        if solution_number is None:
+            solution_number = 0
+        assert (solution_number >= 0
+                and solution_number < self.num_solutions)
+        return self.solutions[solution_number,
+                              [v.index for v in variables]].tolist()
+
+    def pool_objective(self, solution_number):
+        return self.objectives[solution_number]
+
+
+class MIPVar:
+    """
+    A variable of a GurobiTorchMIP constructed with a solver backend other
+    than gurobi. It has the same attributes as gurobipy.Var that we use
+    (index, VarName, lb, ub, vtype, start), the bounds, the type and the
+    start value are only stored in this object.
+    """
+    __slots__ = ("index", "VarName", "LB", "UB", "VType", "Start")
+
+    def __init__(self, index, name, lb, ub, vtype):
+        self.index = index
+        self.VarName = name
+        self.LB = lb
+        self.UB = ub
+        self.VType = vtype
+        self.Start = gurobipy.GRB.UNDEFINED
+
+    @property
+    def lb(self):
+        return self.LB
+
+    @lb.setter
+    def lb(self, val):
+        self.LB = val
+
+    @property
+    def ub(self):
+        return self.UB
+
+    @ub.setter
+    def ub(self, val):
+        self.UB = val
+
+    @property
+    def vtype(self):
+        return self.VType
+
+    @vtype.setter
+    def vtype(self, val):
+        self.VType = val
+
+    @property
+    def start(self):
+        return self.Start
+
+    @start.setter
+    def start(self, val):
+        self.Start = val
+
+
+class GurobiSolverBackend:
+    """
+    Constructs and solves GurobiTorchMIP with gurobi. This is the default
+    backend of GurobiTorchMIP. The variables and the constraints are added to
+    the gurobi model of the MIP, besides the torch data.
+    """
+    def add_vars(self, mip, num_vars, lb, ub, vtype, name):
+        """
+        Add @p num_vars variables with the bounds @p lb, @p ub (1D torch
+        tensors) and the type @p vtype (gurobipy.GRB.CONTINUOUS or
+        gurobipy.GRB.BINARY) to the solver model of @p mip.
+        @return new_vars A list of the new variables.
+        """
+        new_vars = mip.gurobi_model.addVars(num_vars,
+                                            lb=lb,
+                                            ub=ub,
+                                            vtype=vtype,
+                                            name=name)
+        mip.gurobi_model.update()
+        return [new_vars[i] for i in range(num_vars)]
+
+    def add_linear_constraint(self, mip, coeffs, variables, sense, rhs,
+                              name):
+        """
+        Add the constraint ∑ᵢ coeffs[i]ᵀ * variables[i] <=, == or >= rhs to
+        the solver model of @p mip, refer to GurobiTorchMIP.addLConstr().
+        @param rhs A float.
+        """
+        expr = 0
+        for coeff, var in zip(coeffs, variables):
+            expr += gurobipy.LinExpr(coeff.tolist(), var)
+        return mip.gurobi_model.addLConstr(expr,
+                                           sense=sense,
+                                           rhs=rhs,
+                                           name=name)
+
+    def add_matrix_constraints(self, mip, A, variables, sense, b, name):
+        """
+        Add the constraints A * variables <=, == or >= b to the solver model
+        of @p mip.
+        @param A A numpy array or a scipy sparse matrix.
+        @param variables A list of variables.
+        @param b A numpy array.
+        """
+        return mip.gurobi_model.addMConstr(A,
+                                           variables,
+                                           sense=sense,
+                                           b=b,
+                                           name=name)
+
+    def set_objective(self, mip):
+        """
+        Set the objective of the solver model from the cost stored in @p mip
+        (c_r, c_zeta, c_constant, sense, and Q_r, Q_zeta, Q_rzeta for
+        GurobiTorchMIQP).
+        """
+        obj = gurobipy.LinExpr(mip.c_r, mip.r) +\
+            gurobipy.LinExpr(mip.c_zeta, mip.zeta) + mip.c_constant
+        if isinstance(mip, GurobiTorchMIQP):
+            quad_obj = gurobipy.QuadExpr()
+            for Q, vars_left, vars_right in ((mip.Q_r, mip.r, mip.r),
+                                             (mip.Q_zeta, mip.zeta, mip.zeta),
+                                             (mip.Q_rzeta, mip.r, mip.zeta)):
+                Q_np = Q.detach().numpy()
+                nonzero_row, nonzero_col = np.nonzero(Q_np)
+                if nonzero_row.shape[0] > 0:
+                    quad_obj.addTerms(
+                        Q_np[nonzero_row, nonzero_col].tolist(),
+                        [vars_left[i] for i in nonzero_row],
+                        [vars_right[j] for j in nonzero_col])
+            obj = quad_obj + obj
+        mip.gurobi_model.setObjective(obj, sense=mip.sense)
+
+    def get_var_attr(self, mip, attr, variables):
+        """
+        Return the attribute @p attr (gurobipy.GRB.Attr.LB, UB or VType) of
+        each variable in @p variables.
+        """
+        mip.gurobi_model.update()
+        return mip.gurobi_model.getAttr(attr, variables)
+
+    def update(self, mip):
+        """
+        Apply the pending changes (for example the variable bounds) to the
+        solver model.
+        """
+        mip.gurobi_model.update()
+
+    def solve(self, mip):
+        mip.gurobi_model.optimize()
+        return GurobiSolveResult(mip.gurobi_model)
+
+
+class TorchDataBackend:
+    """
+    Constructs GurobiTorchMIP with only the torch data, without any solver
+    model. The variables are MIPVar objects, and the constraints and the cost
+    are only stored in the torch data. Such a MIP can't be solved, but its
+    data can be copied into a MIP constructed with gurobi through
+    GurobiTorchMIP.update_from().
+    """
+    def add_vars(self, mip, num_vars, lb, ub, vtype, name):
+        first_index = len(mip._variables)
+        return [
+            MIPVar(first_index + i, f"{name}[{i}]", lb[i].item(),
+                   ub[i].item(), vtype) for i in range(num_vars)
+        ]
+
+    def add_linear_constraint(self, mip, coeffs, variables, sense, rhs,
+                              name):
+        # The constraint is only stored in the torch data of mip.
+        return None
+
+    def add_matrix_constraints(self, mip, A, variables, sense, b, name):
+        return None
+
+    def set_objective(self, mip):
+        pass
+
+    def get_var_attr(self, mip, attr, variables):
+        return [getattr(v, attr) for v in variables]
+
+    def update(self, mip):
+        pass
+
+    def solve(self, mip):
+        raise Exception("TorchDataBackend: the MIP can't be solved.")
+
+
+class ScipyMILPSolverBackend(TorchDataBackend):
+    """
+    Constructs and solves GurobiTorchMILP with scipy.optimize.milp, which
+    calls the open source solver HiGHS. A MILP constructed with this backend
+    (GurobiTorchMILP(dtype, backend=ScipyMILPSolverBackend())) has no gurobi
+    model, its variables are MIPVar objects, and the constraints and the cost
+    are only stored in the torch data. Hence it doesn't need a gurobi license
+    token, and many small MILPs/LPs can be constructed and solved in parallel
+    processes on all the cores.
+    This backend can also solve a MILP constructed with gurobi
+    (mip.solve(ScipyMILPSolverBackend())), then the variable bounds are read
+    from the gurobi model, and the gurobi model is not solved.
+    Only the optimal solution is returned, there is no solution pool.
+    """
+    def __init__(self, time_limit=None, mip_rel_gap=None):
+        """
+        @param time_limit The time limit (in seconds) of the solve.
+        @param mip_rel_gap The relative optimality gap of the MILP.
+        """
+        self.options = {}
+        if time_limit is not None:
+            self.options["time_limit"] = time_limit
+        if mip_rel_gap is not None:
+            self.options["mip_rel_gap"] = mip_rel_gap
+
+    def solve(self, mip):
+        if not isinstance(mip, GurobiTorchMILP):
+            raise Exception(
+                "ScipyMILPSolverBackend: only supports GurobiTorchMILP.")
+        if mip.has_gurobi_model():
+            model = mip.gurobi_model
+            model.update()
+            if model.NumQConstrs > 0 or model.NumGenConstrs > 0 or\
+                    model.NumSOS > 0 or model.NumConstrs != len(
+                        mip.rhs_in) + len(mip.rhs_eq) -\
+                    mip._num_bound_rows or\
+                    model.NumVars != len(mip.r) + len(mip.zeta):
+                raise Exception(
+                    "ScipyMILPSolverBackend: the gurobi model contains " +
+                    "variables or constraints not stored in the torch data.")
+        num_vars = len(mip._variables)
+        num_r = len(mip.r)
+        variables = mip.r + mip.zeta
+        if mip.c_r is None:
+            c = np.zeros((len(variables), ))
+            constant = 0.
+        else:
+            c = torch.cat((mip.c_r, mip.c_zeta)).detach().numpy()
+            constant = float(mip.c_constant)
+        sign = -1. if mip.sense == gurobipy.GRB.MAXIMIZE else 1.
+        constraints = []
+        if len(mip.rhs_in) > 0:
+            constraints.append(
+                scipy.optimize.LinearConstraint(
+                    scipy.sparse.hstack(
+                        (mip.Ain_r_coo.to_scipy_csr(len(mip.rhs_in), num_r),
+                         mip.Ain_zeta_coo.to_scipy_csr(
+                             len(mip.rhs_in), len(mip.zeta)))).tocsr(),
+                    -np.inf, mip.rhs_in.val.detach().numpy()))
+        if len(mip.rhs_eq) > 0:
+            rhs_eq = mip.rhs_eq.val.detach().numpy()
+            constraints.append(
+                scipy.optimize.LinearConstraint(
+                    scipy.sparse.hstack(
+                        (mip.Aeq_r_coo.to_scipy_csr(len(mip.rhs_eq), num_r),
+                         mip.Aeq_zeta_coo.to_scipy_csr(
+                             len(mip.rhs_eq), len(mip.zeta)))).tocsr(),
+                    rhs_eq, rhs_eq))
+        lb = np.array(mip.get_var_attr(gurobipy.GRB.Attr.LB, variables),
+                      dtype=float)
+        ub = np.array(mip.get_var_attr(gurobipy.GRB.Attr.UB, variables),
+                      dtype=float)
+        lb[lb <= -gurobipy.GRB.INFINITY] = -np.inf
+        ub[ub >= gurobipy.GRB.INFINITY] = np.inf
+        # The binary relaxed variables are continuous.
+        integrality = np.array([
+            vtype != gurobipy.GRB.CONTINUOUS
+            for vtype in mip.get_var_attr(gurobipy.GRB.Attr.VType, variables)
+        ],
+                               dtype=int)
+        res = scipy.optimize.milp(sign * c,
+                                  constraints=constraints,
+                                  integrality=integrality,
+                                  bounds=scipy.optimize.Bounds(lb, ub),
+                                  options=self.options)
+        status = {
+            0: gurobipy.GRB.Status.OPTIMAL,
+            1: gurobipy.GRB.Status.TIME_LIMIT,
+            2: gurobipy.GRB.Status.INFEASIBLE,
+            3: gurobipy.GRB.Status.UNBOUNDED
+        }.get(res.status, gurobipy.GRB.Status.NUMERIC)
+        if res.x is None:
+            return ArraySolveResult(status, np.zeros((0, num_vars)),
+                                    np.zeros((0, )))
+        solutions = np.zeros((1, num_vars))
+        solutions[0, [v.index for v in variables]] = res.x
+        return ArraySolveResult(status, solutions,
+                                np.array([c @ res.x + constant]))
+
+
+class MIPNodeCutAdder:
+    """
+    Inside a gurobi callback, at a branch-and-bound node whose LP relaxation
+    has been solved to optimality, this object provides the same
+    get_solution() and addMConstr() as GurobiTorchMIP. Hence the functions
+    that strengthen a MIP at its solution (for example
+    ReLUFreePattern.strengthen_relu_mip_at_solution()) can be called with this
+    object instead, they then read the node relaxation solution, and add the
+    constraints as user cuts at this node.
+    The variables are looked up by their index in the model being solved, so
+    they can also belong to another MIP with the same variables (for example
+    the MIP copied into a template by GurobiTorchMIP.update_from()).
+    """
+    def __init__(self,
+                 model: gurobipy.Model,
+                 all_variables: list,
+                 dtype,
+                 added_cuts: set = None,
+                 max_cuts: int = None):
+        """
+        @param model The model passed to the gurobi callback.
+        @param all_variables All the variables of the model being solved.
+        @param dtype The torch dtype of the returned solution.
+        @param added_cuts The cuts added so far (at this node and the previous
+        nodes). A cut already in this set is skipped, and each new cut is
+        inserted into this set. None means the cuts are not deduplicated.
+        @param max_cuts Add at most this many cuts. None means no limit.
+        """
+        self.model = model
+        self.all_variables = all_variables
+        self.dtype = dtype
+        self.added_cuts = added_cuts
+        self.max_cuts = max_cuts
+        self.num_cuts = 0
+
+    def _lookup(self, variables):
+        return [self.all_variables[v.index] for v in variables]
+
+    def get_solution(self, variables):
+        """
+        Return the value of the variables in the node relaxation solution.
+        """
+        if len(variables) == 0:
+            return torch.zeros((0, ), dtype=self.dtype)
+        return torch.tensor(self.model.cbGetNodeRel(self._lookup(variables)),
+                            dtype=self.dtype)
+
+    def addMConstr(self, A, x, sense, b, name=""):
+        """
+        Add the user cuts sum_i A[i] * x[i] <=, == or >= b. Refer to
+        GurobiTorchMIP.addMConstr() for the arguments. The name is ignored.
+        """
+        assert (isinstance(b, torch.Tensor))
+        assert (len(A) == len(x))
+
+        def to_scipy(Ai):
+            if Ai.is_sparse:
+                Ai = Ai.coalesce()
+                indices = Ai.indices().numpy()
+                return scipy.sparse.coo_matrix(
+                    (Ai.values().detach().numpy(), (indices[0], indices[1])),
+                    shape=Ai.shape)
+            return scipy.sparse.coo_matrix(Ai.detach().numpy())
+
+        A_csr = scipy.sparse.hstack([to_scipy(Ai) for Ai in A]).tocsr()
+        x_flat = self._lookup([v for xi in x for v in xi])
+        rhs = b.detach().numpy()
+        for i in range(A_csr.shape[0]):
+            if self.max_cuts is not None and self.num_cuts >= self.max_cuts:
+                break
+            row = slice(A_csr.indptr[i], A_csr.indptr[i + 1])
+            coeffs = A_csr.data[row].tolist()
+            cut_vars = [x_flat[j] for j in A_csr.indices[row]]
+            if self.added_cuts is not None:
+                cut = (tuple(v.index for v in cut_vars),
+                       tuple(np.round(coeffs, 9).tolist()), sense,
+                       round(float(rhs[i]), 9))
+                if cut in self.added_cuts:
+                    continue
+                self.added_cuts.add(cut)
+            self.model.cbCut(gurobipy.LinExpr(coeffs, cut_vars), sense,
+                             rhs[i])
+            self.num_cuts += 1
+
+
+def get_node_cut_callback(mip, add_cuts, *, max_node_count=None,
+                          max_cuts=None):
+    """
+    Returns a gurobi callback, which adds user cuts at the branch-and-bound
+    nodes. When the relaxation at a node is solved to optimality, we call
+    add_cuts(node), where node is a MIPNodeCutAdder object. The same cut is
+    added only once during the solve.
+    The PreCrush parameter of the model should be set to 1 when solving with
+    this callback, so that the cuts can be translated to the presolved model.
+    @param mip The GurobiTorchMIP being solved.
+    @param add_cuts A function with a MIPNodeCutAdder as the argument.
+    @param max_node_count Only add cuts at the nodes explored before this
+    many nodes, for example 1 means only at the root node. None means all
+    the nodes.
+    @param max_cuts Add at most this many cuts in total. None means no limit.
+    """
+    all_variables = mip.gurobi_model.getVars()
+    added_cuts = set()
+
+    def node_cut_callback(model, where):
+        if where == gurobipy.GRB.Callback.MIPNODE:
+            if max_node_count is not None and model.cbGet(
+                    gurobipy.GRB.Callback.MIPNODE_NODCNT) >= max_node_count:
+                return
+            if max_cuts is not None and len(added_cuts) >= max_cuts:
+                return
+            status = model.cbGet(gurobipy.GRB.Callback.MIPNODE_STATUS)
+            if status == gurobipy.GRB.Status.OPTIMAL:
+                add_cuts(
+                    MIPNodeCutAdder(
+                        model, all_variables, mip.dtype, added_cuts,
+                        None if max_cuts is None else max_cuts -
+                        len(added_cuts)))
+
+    return node_cut_callback
+
+
+# Refer to gurobi_env().
+_thread_local = threading.local()
+
+
+@contextlib.contextmanager
+def gurobi_env(env: gurobipy.Env):
+    """
+    Within this context, the GurobiTorchMIP objects constructed in the current
+    thread use the gurobi environment @p env instead of the default
+    environment. A gurobi environment cannot be shared between threads, so
+    each thread that constructs and solves MIPs concurrently should enter this
+    context with its own environment. The parameters set on @p env (such as
+    Threads) are inherited by the models.
+    """
+    previous_env = getattr(_thread_local, "env", None)
+    _thread_local.env = env
+    try:
+        yield env
+    finally:
+        _thread_local.env = previous_env
+
+
+@contextlib.contextmanager
+def solver_backend(backend):
+    """
+    Within this context, the GurobiTorchMIP objects constructed in the current
+    thread without an explicit backend use @p backend (for example
+    ScipyMILPSolverBackend() or TorchDataBackend()) instead of
+    GurobiSolverBackend(). This selects the backend of the MIPs constructed
+    inside functions such as
+    LyapunovHybridLinearSystem.lyapunov_derivative_as_milp().
+    """
+    previous_backend = getattr(_thread_local, "backend", None)
+    _thread_local.backend = backend
+    try:
+        yield backend
+    finally:
+        _thread_local.backend = previous_backend
+
+
 class GurobiTorchMIP:
     """
     This class will be used in computing the gradient of an MIP optimal cost
@@ -372,32 +1239,187 @@ class GurobiTorchMIP:
         Aeq_r * r + Aeq_zeta * ζ = rhs_eq
     where r includes all continuous variables, and ζ includes all binary
     variables.
+    The matrices Ain_r, Ain_zeta, Aeq_r, Aeq_zeta are stored in the COO format
+    as COOMatrixStorage objects, and rhs_in, rhs_eq are stored as
+    BlockVectorStorage objects.
+    The variables and the constraints are also added to the model of the
+    solver backend. With GurobiSolverBackend (the default), this is the gurobi
+    model (self.gurobi_model), which is created on its first use. With
+    ScipyMILPSolverBackend or TorchDataBackend there is no gurobi model.
     """
-    def __init__(self, dtype):
+    def __init__(self, dtype, backend=None):
+        """
+        @param backend The solver backend used to construct and solve this
+        MIP, GurobiSolverBackend, ScipyMILPSolverBackend or TorchDataBackend.
+        If None, then we
+        use the backend of the enclosing solver_backend() context, or
+        GurobiSolverBackend() if there is no such context.
+        """
         self.dtype = dtype
-        self.gurobi_model = gurobipy.Model()
+        if backend is None:
+            backend = getattr(_thread_local, "backend", None)
+        self.backend = GurobiSolverBackend() if backend is None else backend
+        # The gurobi environment of the gurobi_env() context when this MIP is
+        # constructed.
+        self._gurobi_env = getattr(_thread_local, "env", None)
+        self._gurobi_model = None
+        # All the variables in the order of their index, namely
+        # self._variables[var.index] = var.
+        self._variables = []
         self.r = []
         self.zeta = []
-        self.Ain_r_row = []
-        self.Ain_r_col = []
-        self.Ain_r_val = []
-        self.Ain_zeta_row = []
-        self.Ain_zeta_col = []
-        self.Ain_zeta_val = []
-        self.rhs_in = []
-        self.Aeq_r_row = []
-        self.Aeq_r_col = []
-        self.Aeq_r_val = []
-        self.Aeq_zeta_row = []
-        self.Aeq_zeta_col = []
-        self.Aeq_zeta_val = []
-        self.rhs_eq = []
+        self.Ain_r_coo = COOMatrixStorage(dtype)
+        self.Ain_zeta_coo = COOMatrixStorage(dtype)
+        self.rhs_in = BlockVectorStorage(dtype)
+        self.Aeq_r_coo = COOMatrixStorage(dtype)
+        self.Aeq_zeta_coo = COOMatrixStorage(dtype)
+        self.rhs_eq = BlockVectorStorage(dtype)
         # r_indices[var] maps a gurobi continuous variable to its index in r.
         # Namely self.r[r_indices[var]] = var
         self.r_indices = {}
         # zeta_indices[var] maps a gurobi binary variable to its index in zeta.
         # Namely self.zeta[zeta_indices[var]] = var
         self.zeta_indices = {}
+        # Dense lookup tables keyed by the gurobi variable index (var.index).
+        # _r_column[var.index] is the index of var in r, or -1 if var is not
+        # in r. Similarly _zeta_column[var.index] is the index of var in zeta.
+        # We use them to resolve a list of variables in one vectorized step.
+        self._r_column = np.empty((0, ), dtype=np.int64)
+        self._zeta_column = np.empty((0, ), dtype=np.int64)
+        # The number of rows in the torch constraints that come from the
+        # variable bounds in addVars(). They are not gurobi constraints.
+        self._num_bound_rows = 0
+        # _in_row_constr[i] is the index of the solver constraint of the i'th
+        # row in rhs_in (-1 for the rows of the variable bounds), and
+        # _in_row_sign[i] is -1 if this row is a negated >= constraint.
+        # Similarly _eq_row_constr for the rows in rhs_eq. update_from() uses
+        # them to refresh the solver model from the torch data.
+        self._in_row_constr = []
+        self._in_row_sign = []
+        self._eq_row_constr = []
+        # The number of linear constraints in the solver model.
+        self._num_constrs = 0
+        # The result of the last call to solve(). If None, then we read the
+        # solution from the gurobi model.
+        self.solve_result = None
+
+    @property
+    def gurobi_model(self):
+        """
+        The gurobi model of this MIP. It is created on the first access.
+        @throw Exception if this MIP is not constructed with
+        GurobiSolverBackend.
+        """
+        if self._gurobi_model is None:
+            if not isinstance(self.backend, GurobiSolverBackend):
+                raise Exception("GurobiTorchMIP: the MIP is constructed " +
+                                f"with {type(self.backend).__name__}, it " +
+                                "has no gurobi model.")
+            self._gurobi_model = gurobipy.Model() if self._gurobi_env is\
+                None else gurobipy.Model(env=self._gurobi_env)
+        return self._gurobi_model
+
+    @gurobi_model.setter
+    def gurobi_model(self, model):
+        self._gurobi_model = model
+
+    def has_gurobi_model(self):
+        return self._gurobi_model is not None
+
+    def get_var_attr(self, attr, variables):
+        """
+        Return the attribute @p attr (gurobipy.GRB.Attr.LB, UB or VType) of
+        each variable in @p variables, read from the solver backend.
+        """
+        return self.backend.get_var_attr(self, attr, variables)
+
+    def _record_rows(self, sense, num_rows, is_constraint=True):
+        """
+        Record the solver constraints of the @p num_rows rows that are
+        appended to the torch constraints with @p sense. If @p is_constraint
+        is False, then these rows are the variable bounds.
+        """
+        if is_constraint:
+            constr = list(
+                range(self._num_constrs, self._num_constrs + num_rows))
+            self._num_constrs += num_rows
+        else:
+            constr = [-1] * num_rows
+        if sense == gurobipy.GRB.EQUAL:
+            self._eq_row_constr.extend(constr)
+        else:
+            self._in_row_constr.extend(constr)
+            self._in_row_sign.extend(
+                [-1. if sense == gurobipy.GRB.GREATER_EQUAL else 1.] *
+                num_rows)
+
+    def _register_columns(self, new_vars, first_column, is_binary):
+        """
+        Record in the lookup tables that new_vars[i] is r[first_column + i]
+        (or zeta[first_column + i] if is_binary is True).
+        """
+        var_index = np.fromiter((v.index for v in new_vars),
+                                dtype=np.int64,
+                                count=len(new_vars))
+        if var_index.shape[0] == 0:
+            return
+        size = np.max(var_index) + 1
+        if size > self._r_column.shape[0]:
+            new_size = max(size, 2 * self._r_column.shape[0])
+            for name in ("_r_column", "_zeta_column"):
+                column = np.full((new_size, ), -1, dtype=np.int64)
+                column[:getattr(self, name).shape[0]] = getattr(self, name)
+                setattr(self, name, column)
+        column = self._zeta_column if is_binary else self._r_column
+        column[var_index] = np.arange(first_column,
+                                      first_column + len(new_vars))
+
+    def _lookup_columns(self, variables):
+        """
+        For each gurobi variable in @p variables, find its index in r and its
+        index in zeta.
+        @param variables A list of gurobi variables.
+        @return (r_column, zeta_column) Two numpy arrays of the same length as
+        @p variables. r_column[i] is the index of variables[i] in r, or -1 if
+        variables[i] is not in r. Similarly for zeta_column.
+        @throw Exception if some variable is neither in r nor in zeta.
+        """
+        var_index = np.fromiter((v.index for v in variables),
+                                dtype=np.int64,
+                                count=len(variables))
+        r_column = np.full(var_index.shape, -1, dtype=np.int64)
+        zeta_column = np.full(var_index.shape, -1, dtype=np.int64)
+        valid = np.logical_and(var_index >= 0,
+                               var_index < self._r_column.shape[0])
+        r_column[valid] = self._r_column[var_index[valid]]
+        zeta_column[valid] = self._zeta_column[var_index[valid]]
+        unknown = np.nonzero(np.logical_and(r_column < 0, zeta_column < 0))[0]
+        if unknown.shape[0] > 0:
+            raise Exception("unknown variable " +
+                            variables[unknown[0]].VarName)
+        return (r_column, zeta_column)
+
+    def _combined_columns(self, variables):
+        """
+        Return the index of each variable in the stacked vector [r; zeta].
+        """
+        r_column, zeta_column = self._lookup_columns(variables)
+        return np.where(r_column >= 0, r_column, len(self.r) + zeta_column)
+
+    def resolve_variables(self, variables):
+        """
+        Find the continuous variables and the binary variables in a list of
+        gurobi variables.
+        @param variables A list of gurobi variables.
+        @return (r_pos, r_cols, zeta_pos, zeta_cols) Numpy arrays such that
+        variables[r_pos[i]] is self.r[r_cols[i]], and variables[zeta_pos[i]]
+        is self.zeta[zeta_cols[i]].
+        @throw Exception if some variable is neither in r nor in zeta.
+        """
+        r_column, zeta_column = self._lookup_columns(variables)
+        r_pos = np.nonzero(r_column >= 0)[0]
+        zeta_pos = np.nonzero(zeta_column >= 0)[0]
+        return (r_pos, r_column[r_pos], zeta_pos, zeta_column[zeta_pos])
 
     def addVars(self,
                 num_vars,
@@ -416,56 +1438,57 @@ class GurobiTorchMIP:
         assert (isinstance(ub, torch.Tensor))
         assert (lb.shape == (num_vars, ))
         assert (ub.shape == (num_vars, ))
-        if vtype == gurobipy.GRB.BINARY and torch.all(lb == torch.zeros(
-            (num_vars, ), dtype=self.dtype)) and torch.all(
-                ub == torch.ones((num_vars, ), dtype=self.dtype)):
-            new_vars = self.gurobi_model.addVars(num_vars,
-                                                 vtype=gurobipy.GRB.BINARY,
-                                                 name=name)
+        if vtype == BINARYRELAX:
+            # Register the variable in the solver as a continuous variable in
+            # the range of [0, 1]
+            var_lb = torch.max(torch.tensor(0., dtype=self.dtype), lb)
+            var_ub = torch.min(torch.tensor(1., dtype=self.dtype), ub)
+            solver_vtype = gurobipy.GRB.CONTINUOUS
         else:
-            if vtype == BINARYRELAX:
-                # Register the variable in gurobi as a continuous variable in
-                # the range of [0, 1]
-                var_lb = torch.max(torch.tensor(0., dtype=self.dtype), lb)
-                var_ub = torch.min(torch.tensor(1., dtype=self.dtype), ub)
-                gurobi_vtype = gurobipy.GRB.CONTINUOUS
-            else:
-                var_lb = lb
-                var_ub = ub
-                gurobi_vtype = vtype
-            new_vars = self.gurobi_model.addVars(num_vars,
-                                                 lb=var_lb,
-                                                 ub=var_ub,
-                                                 vtype=gurobi_vtype,
-                                                 name=name)
-        self.gurobi_model.update()
+            var_lb = lb
+            var_ub = ub
+            solver_vtype = vtype
+        new_vars = self.backend.add_vars(self, num_vars, var_lb.detach(),
+                                         var_ub.detach(), solver_vtype, name)
+        self._variables.extend(new_vars)
         if vtype == gurobipy.GRB.CONTINUOUS:
             num_existing_r = len(self.r_indices)
             self.r.extend([new_vars[i] for i in range(num_vars)])
             for i in range(num_vars):
                 self.r_indices[new_vars[i]] = num_existing_r + i
+            self._register_columns(self.r[num_existing_r:], num_existing_r,
+                                   False)
+            lb_np = lb.detach().numpy()
+            ub_np = ub.detach().numpy()
+            var_indices = np.arange(num_existing_r, num_existing_r + num_vars)
+
+            def add_bound_rows(A_coo, rhs, flag, coeff, rhs_val):
+                # Add the constraint coeff * r[var_indices[i]] <= (or =)
+                # rhs_val[i] for every i with flag[i] = True.
+                num_rows = int(np.sum(flag))
+                if num_rows == 0:
+                    return
+                A_coo.append(np.arange(len(rhs),
+                                       len(rhs) + num_rows), var_indices[flag],
+                             torch.full((num_rows, ), coeff, dtype=self.dtype))
+                rhs.append(rhs_val[torch.from_numpy(flag)])
+                self._num_bound_rows += num_rows
+                self._record_rows(
+                    gurobipy.GRB.EQUAL
+                    if rhs is self.rhs_eq else gurobipy.GRB.LESS_EQUAL,
+                    num_rows, False)
+
             # If lower bound is not -inf, then add the inequality constraint
             # x>lb
-            for i in range(num_vars):
-                if lb[i].item() > -gurobipy.GRB.INFINITY and lb[i].item(
-                ) < ub[i].item():
-                    self.Ain_r_row.append(len(self.rhs_in))
-                    self.Ain_r_col.append(num_existing_r + i)
-                    self.Ain_r_val.append(torch.tensor(-1, dtype=self.dtype))
-                    self.rhs_in.append(-lb[i])
-            for i in range(num_vars):
-                if ub[i] < gurobipy.GRB.INFINITY and lb[i].item() < ub[i].item(
-                ):
-                    self.Ain_r_row.append(len(self.rhs_in))
-                    self.Ain_r_col.append(num_existing_r + i)
-                    self.Ain_r_val.append(torch.tensor(1, dtype=self.dtype))
-                    self.rhs_in.append(ub[i])
-            for i in range(num_vars):
-                if lb[i].item() == ub[i].item():
-                    self.Aeq_r_row.append(len(self.rhs_eq))
-                    self.Aeq_r_col.append(num_existing_r + i)
-                    self.Aeq_r_val.append(torch.tensor(1, dtype=self.dtype))
-                    self.rhs_eq.append(lb[i])
+            add_bound_rows(
+                self.Ain_r_coo, self.rhs_in,
+                np.logical_and(lb_np > -gurobipy.GRB.INFINITY, lb_np < ub_np),
+                -1., -lb)
+            add_bound_rows(
+                self.Ain_r_coo, self.rhs_in,
+                np.logical_and(ub_np < gurobipy.GRB.INFINITY, lb_np < ub_np),
+                1., ub)
+            add_bound_rows(self.Aeq_r_coo, self.rhs_eq, lb_np == ub_np, 1., lb)
         elif vtype == gurobipy.GRB.BINARY or vtype == BINARYRELAX:
             # If the variable is binary_relax, then we append it to zeta,
             # which records its coefficient so that later we will
@@ -474,6 +1497,8 @@ class GurobiTorchMIP:
             self.zeta.extend([new_vars[i] for i in range(num_vars)])
             for i in range(num_vars):
                 self.zeta_indices[new_vars[i]] = num_existing_zeta + i
+            self._register_columns(self.zeta[num_existing_zeta:],
+                                   num_existing_zeta, True)
         else:
             raise Exception("Only support continuous or binary variables")
         return [new_vars[i] for i in range(num_vars)]
@@ -495,108 +1520,59 @@ class GurobiTorchMIP:
         else:
             assert (isinstance(rhs, float))
             rhs_tensor = torch.tensor(rhs, dtype=self.dtype)
-        expr = 0
         assert (isinstance(coeffs, list))
         assert (len(coeffs) == len(variables))
         num_vars = 0
         for coeff, var in zip(coeffs, variables):
             assert (isinstance(coeff, torch.Tensor))
-            expr += gurobipy.LinExpr(coeff.tolist(), var)
             num_vars += len(var)
-        constr = self.gurobi_model.addLConstr(expr,
-                                              sense=sense,
-                                              rhs=rhs_tensor,
-                                              name=name)
-        # r_used_flag[i] records if r[i] has appeared in @p variables.
-        r_used_flag = [False] * len(self.r)
-        zeta_used_flag = [False] * len(self.zeta)
-        # First allocate memory
+        constr = self.backend.add_linear_constraint(self, coeffs, variables,
+                                                    sense, rhs_tensor.item(),
+                                                    name)
+        # The coefficients and the variables in one flat list.
+        coeff_flat = torch.cat([coeff.reshape((-1, )) for coeff in coeffs])\
+            if num_vars > 0 else torch.zeros((0, ), dtype=self.dtype)
+        var_flat = [v for var in variables for v in var]
+        # r_cols are the indices in r of the continuous variables in this
+        # linear constraint, r_pos are their positions in var_flat. Similarly
+        # for zeta_cols and zeta_pos.
+        try:
+            r_pos, r_cols, zeta_pos, zeta_cols = self.resolve_variables(
+                var_flat)
+        except Exception as e:
+            raise Exception("addLConstr: " + str(e))
+        if np.unique(r_cols).shape[0] != r_cols.shape[0] or\
+                np.unique(zeta_cols).shape[0] != zeta_cols.shape[0]:
+            raise Exception("addLConstr: variables are duplicated.")
+        r_val = coeff_flat[torch.from_numpy(r_pos)]
+        zeta_val = coeff_flat[torch.from_numpy(zeta_pos)]
+        rhs_tensor = rhs_tensor.reshape((-1, ))
+        assert (rhs_tensor.shape == (1, ))
         if sense == gurobipy.GRB.EQUAL:
-            new_Aeq_r_row = [None] * num_vars
-            new_Aeq_r_col = [None] * num_vars
-            new_Aeq_r_val = [None] * num_vars
-            new_Aeq_zeta_row = [None] * num_vars
-            new_Aeq_zeta_col = [None] * num_vars
-            new_Aeq_zeta_val = [None] * num_vars
+            A_r_coo, A_zeta_coo, rhs_storage = \
+                self.Aeq_r_coo, self.Aeq_zeta_coo, self.rhs_eq
         else:
-            new_Ain_r_row = [None] * num_vars
-            new_Ain_r_col = [None] * num_vars
-            new_Ain_r_val = [None] * num_vars
-            new_Ain_zeta_row = [None] * num_vars
-            new_Ain_zeta_col = [None] * num_vars
-            new_Ain_zeta_val = [None] * num_vars
-
-        # num_cont_vars is the number of continuous variables in this linear
-        # constraint.
-        num_cont_vars = 0
-        # num_bin_vars is the number of binary variables in this linear
-        # constraint.
-        num_bin_vars = 0
-        for coeff, var in zip(coeffs, variables):
-            for i in range(len(var)):
-                if var[i] in self.r_indices.keys():
-                    r_index = self.r_indices[var[i]]
-                    if r_used_flag[r_index]:
-                        raise Exception("addLConstr: variable " +
-                                        var[i].VarName + " is duplicated.")
-                    r_used_flag[r_index] = True
-                    if sense == gurobipy.GRB.EQUAL:
-                        new_Aeq_r_row[num_cont_vars] = len(self.rhs_eq)
-                        new_Aeq_r_col[num_cont_vars] = r_index
-                        new_Aeq_r_val[num_cont_vars] = coeff[i]
-                    else:
-                        new_Ain_r_row[num_cont_vars] = len(self.rhs_in)
-                        new_Ain_r_col[num_cont_vars] = r_index
-                        new_Ain_r_val[num_cont_vars] = coeff[i] if\
-                            sense == gurobipy.GRB.LESS_EQUAL else -coeff[i]
-                    num_cont_vars += 1
-                elif var[i] in self.zeta_indices.keys():
-                    zeta_index = self.zeta_indices[var[i]]
-                    if zeta_used_flag[zeta_index]:
-                        raise Exception("addLConstr: variable " +
-                                        var[i].VarName + " is duplicated.")
-                    zeta_used_flag[zeta_index] = True
-                    if sense == gurobipy.GRB.EQUAL:
-                        new_Aeq_zeta_row[num_bin_vars] = len(self.rhs_eq)
-                        new_Aeq_zeta_col[num_bin_vars] = zeta_index
-                        new_Aeq_zeta_val[num_bin_vars] = coeff[i]
-                    else:
-                        new_Ain_zeta_row[num_bin_vars] = len(self.rhs_in)
-                        new_Ain_zeta_col[num_bin_vars] = zeta_index
-                        new_Ain_zeta_val[num_bin_vars] = coeff[i] if\
-                            sense == gurobipy.GRB.LESS_EQUAL else -coeff[i]
-                    num_bin_vars += 1
-                else:
-                    raise Exception("addLConstr: unknown variable " +
-                                    var[i].VarName)
-        if sense == gurobipy.GRB.EQUAL:
-            if num_cont_vars > 0:
-                self.Aeq_r_row.extend(new_Aeq_r_row[:num_cont_vars])
-                self.Aeq_r_col.extend(new_Aeq_r_col[:num_cont_vars])
-                self.Aeq_r_val.extend(new_Aeq_r_val[:num_cont_vars])
-            if num_bin_vars > 0:
-                self.Aeq_zeta_row.extend(new_Aeq_zeta_row[:num_bin_vars])
-                self.Aeq_zeta_col.extend(new_Aeq_zeta_col[:num_bin_vars])
-                self.Aeq_zeta_val.extend(new_Aeq_zeta_val[:num_bin_vars])
-            self.rhs_eq.append(rhs_tensor)
-        else:
-            if num_cont_vars > 0:
-                self.Ain_r_row.extend(new_Ain_r_row[:num_cont_vars])
-                self.Ain_r_col.extend(new_Ain_r_col[:num_cont_vars])
-                self.Ain_r_val.extend(new_Ain_r_val[:num_cont_vars])
-            if num_bin_vars > 0:
-                self.Ain_zeta_row.extend(new_Ain_zeta_row[:num_bin_vars])
-                self.Ain_zeta_col.extend(new_Ain_zeta_col[:num_bin_vars])
-                self.Ain_zeta_val.extend(new_Ain_zeta_val[:num_bin_vars])
-            self.rhs_in.append(rhs_tensor if sense ==
-                               gurobipy.GRB.LESS_EQUAL else -rhs_tensor)
+            A_r_coo, A_zeta_coo, rhs_storage = \
+                self.Ain_r_coo, self.Ain_zeta_coo, self.rhs_in
+            if sense == gurobipy.GRB.GREATER_EQUAL:
+                r_val = -r_val
+                zeta_val = -zeta_val
+                rhs_tensor = -rhs_tensor
+        row = len(rhs_storage)
+        A_r_coo.append(np.full((len(r_cols), ), row), r_cols, r_val)
+        A_zeta_coo.append(np.full((len(zeta_cols), ), row), zeta_cols,
+                          zeta_val)
+        rhs_storage.append(rhs_tensor)
+        self._record_rows(sense, 1)
 
         return constr
 
     def addMConstr(self, A, x, sense, b, name=""):
         """
         Add linear constraints sum_i A[i] * x[i] <=, == or >= b
-        @param A. A list of pytorch tensors.
+        @param A. A list of pytorch tensors. If any A[i] is a sparse (COO)
+        tensor, then we only store the nonzero entries of A (the entries of
+        the sparse tensors, and the nonzero entries of the dense tensors).
         @param x A list of lists. x[i] is a list of gurobi variables.
         @param sense GRB.EQUAL, GRB.LESS_EQUAL or GRB.GREATER_EQUAL
         @param b A torch tensor. THe right-hand side of the constraint.
@@ -610,72 +1586,95 @@ class GurobiTorchMIP:
         assert (isinstance(x, list))
         assert (len(A) == len(x))
         assert (all([len(Ai.shape) == 2 for Ai in A]))
-        A_flat = torch.cat(A, dim=1)
         x_flat = [v for xi in x for v in xi]
-        constr = self.gurobi_model.addMConstr(A_flat.detach().numpy(),
-                                              x_flat,
-                                              sense=sense,
-                                              b=b,
-                                              name=name)
-        continuous_var_flag = \
-            [xi in self.r_indices.keys() for xi in x_flat]
-        binary_var_flag = [xi in self.zeta_indices.keys() for xi in x_flat]
-        num_continuous_vars = np.sum(continuous_var_flag)
-        num_binary_vars = np.sum(binary_var_flag)
-        num_vars = num_continuous_vars + num_binary_vars
-        continuous_var_indices = [
-            self.r_indices[x_flat[i]] for i in range(num_vars)
-            if continuous_var_flag[i]
-        ]
-        binary_var_indices = [
-            self.zeta_indices[x_flat[i]] for i in range(num_vars)
-            if binary_var_flag[i]
-        ]
+        if any([Ai.is_sparse for Ai in A]):
+            return self._add_sparse_mconstr(A, x_flat, sense, b, name)
+        A_flat = torch.cat(A, dim=1)
+        constr = self.backend.add_matrix_constraints(self,
+                                                     A_flat.detach().numpy(),
+                                                     x_flat, sense,
+                                                     b.detach().numpy(), name)
+        try:
+            (continuous_var_pos, continuous_var_indices, binary_var_pos,
+             binary_var_indices) = self.resolve_variables(x_flat)
+        except Exception as e:
+            raise Exception("addMConstr: " + str(e))
 
-        num_existing_constraints = len(self.rhs_in) if \
-            sense == gurobipy.GRB.LESS_EQUAL or \
-            sense == gurobipy.GRB.GREATER_EQUAL else len(self.rhs_eq)
-
-        A_r_row = list(
-            np.repeat(
-                range(num_existing_constraints,
-                      num_existing_constraints + num_constraints),
-                num_continuous_vars))
-        A_r_col = list(
-            np.repeat([continuous_var_indices], num_constraints,
-                      axis=0).reshape((-1, )))
-        A_r_val = list(A_flat[:, continuous_var_flag].reshape((-1, )))
-
-        A_zeta_row = list(
-            np.repeat(
-                range(num_existing_constraints,
-                      num_existing_constraints + num_constraints),
-                num_binary_vars))
-        A_zeta_col = list(
-            np.repeat([binary_var_indices], num_constraints, axis=0).reshape(
-                (-1, )))
-        A_zeta_val = list(A_flat[:, binary_var_flag].reshape((-1, )))
         if sense == gurobipy.GRB.EQUAL:
-            self.Aeq_r_row.extend(A_r_row)
-            self.Aeq_r_col.extend(A_r_col)
-            self.Aeq_r_val.extend(A_r_val)
-            self.Aeq_zeta_row.extend(A_zeta_row)
-            self.Aeq_zeta_col.extend(A_zeta_col)
-            self.Aeq_zeta_val.extend(A_zeta_val)
-            self.rhs_eq.extend(list(b))
+            A_r_coo, A_zeta_coo, rhs_storage = \
+                self.Aeq_r_coo, self.Aeq_zeta_coo, self.rhs_eq
         else:
-            self.Ain_r_row.extend(A_r_row)
-            self.Ain_r_col.extend(A_r_col)
-            self.Ain_zeta_row.extend(A_zeta_row)
-            self.Ain_zeta_col.extend(A_zeta_col)
-            if sense == gurobipy.GRB.LESS_EQUAL:
-                self.Ain_r_val.extend(A_r_val)
-                self.Ain_zeta_val.extend(A_zeta_val)
-                self.rhs_in.extend(list(b))
-            else:
-                self.Ain_r_val.extend([-val for val in A_r_val])
-                self.Ain_zeta_val.extend([-val for val in A_zeta_val])
-                self.rhs_in.extend([-b[i] for i in range(num_constraints)])
+            A_r_coo, A_zeta_coo, rhs_storage = \
+                self.Ain_r_coo, self.Ain_zeta_coo, self.rhs_in
+        # Store the constraint as A * x <= b, we negate both sides for
+        # the >= constraint.
+        if sense == gurobipy.GRB.GREATER_EQUAL:
+            A_flat = -A_flat
+            b = -b
+        rows = np.arange(len(rhs_storage),
+                         len(rhs_storage) + num_constraints)
+        A_r_coo.append(
+            np.repeat(rows, continuous_var_indices.shape[0]),
+            np.tile(continuous_var_indices, num_constraints),
+            A_flat[:, torch.from_numpy(continuous_var_pos)].reshape((-1, )))
+        A_zeta_coo.append(
+            np.repeat(rows, binary_var_indices.shape[0]),
+            np.tile(binary_var_indices, num_constraints),
+            A_flat[:, torch.from_numpy(binary_var_pos)].reshape((-1, )))
+        rhs_storage.append(b)
+        self._record_rows(sense, num_constraints)
+        return constr
+
+    def _add_sparse_mconstr(self, A, x_flat, sense, b, name):
+        """
+        addMConstr() when some of the matrices in A are sparse.
+        """
+        num_constraints = b.shape[0]
+        col_offsets = np.cumsum([0] + [Ai.shape[1] for Ai in A])
+        assert (col_offsets[-1] == len(x_flat))
+        A_flat = sparse_block_matrix(
+            [(A[i], 0, col_offsets[i]) for i in range(len(A))],
+            (num_constraints, len(x_flat)), self.dtype)
+        A_row, A_col = A_flat.indices().numpy()
+        A_val = A_flat.values()
+        A_solver = scipy.sparse.csr_matrix(
+            (A_val.detach().numpy(), (A_row, A_col)),
+            shape=(num_constraints, len(x_flat)))
+        constr = self.backend.add_matrix_constraints(self, A_solver, x_flat,
+                                                     sense,
+                                                     b.detach().numpy(), name)
+        try:
+            (continuous_var_pos, continuous_var_indices, binary_var_pos,
+             binary_var_indices) = self.resolve_variables(x_flat)
+        except Exception as e:
+            raise Exception("addMConstr: " + str(e))
+        # var_column[j] is the column of x_flat[j] in either r or zeta.
+        var_column = np.empty((len(x_flat), ), dtype=np.int64)
+        var_column[continuous_var_pos] = continuous_var_indices
+        var_column[binary_var_pos] = binary_var_indices
+        is_binary = np.zeros((len(x_flat), ), dtype=bool)
+        is_binary[binary_var_pos] = True
+
+        if sense == gurobipy.GRB.EQUAL:
+            A_r_coo, A_zeta_coo, rhs_storage = \
+                self.Aeq_r_coo, self.Aeq_zeta_coo, self.rhs_eq
+        else:
+            A_r_coo, A_zeta_coo, rhs_storage = \
+                self.Ain_r_coo, self.Ain_zeta_coo, self.rhs_in
+        if sense == gurobipy.GRB.GREATER_EQUAL:
+            A_val = -A_val
+            b = -b
+        rows = A_row + len(rhs_storage)
+        entry_is_binary = is_binary[A_col]
+        r_entries = np.nonzero(~entry_is_binary)[0]
+        zeta_entries = np.nonzero(entry_is_binary)[0]
+        A_r_coo.append(rows[r_entries], var_column[A_col[r_entries]],
+                       A_val[torch.from_numpy(r_entries)])
+        A_zeta_coo.append(rows[zeta_entries],
+                          var_column[A_col[zeta_entries]],
+                          A_val[torch.from_numpy(zeta_entries)])
+        rhs_storage.append(b)
+        self._record_rows(sense, num_constraints)
         return constr
 
     def add_mixed_integer_linear_constraints(
@@ -724,7 +1723,7 @@ class GurobiTorchMIP:
                     if variables[i].ub > var_up[i].item():
                         variables[i].ub = var_up[i].item()
             if var_lo is not None or var_up is not None:
-                self.gurobi_model.update()
+                self.backend.update(self)
 
         # Enforce the lower and upper bound on the input variable if it exists.
         set_var_bound(input_vars, mip_cnstr_return.input_lo,
@@ -770,7 +1769,8 @@ class GurobiTorchMIP:
                 set_var_bound(binary, mip_cnstr_return.binary_lo,
                               mip_cnstr_return.binary_up)
             elif isinstance(binary_var_name, list) and all(
-                    (isinstance(v, gurobipy.Var) for v in binary_var_name)):
+                    (isinstance(v, (gurobipy.Var, MIPVar))
+                     for v in binary_var_name)):
                 binary = binary_var_name
                 assert (len(binary) == binary_size)
                 assert (all((v.vtype == binary_var_type for v in binary)))
@@ -844,6 +1844,45 @@ class GurobiTorchMIP:
                             name=out_constr_name)
         return (slack, binary)
 
+    def _linear_cost_coefficients(self, coeffs, variables, cost_name):
+        """
+        Compute the coefficients c_r, c_zeta of the linear cost
+        ∑ᵢ coeffs[i]ᵀ * variables[i] = c_rᵀ * r + c_zetaᵀ * zeta
+        @param coeffs A list of 1D pytorch tensors.
+        @param variables A list of lists of gurobi variables.
+        @param cost_name Used in the error message.
+        @return (c_r, c_zeta)
+        """
+        for coeff in coeffs:
+            assert (isinstance(coeff, torch.Tensor))
+        c_r = torch.zeros((len(self.r), ), dtype=self.dtype)
+        c_zeta = torch.zeros((len(self.zeta), ), dtype=self.dtype)
+        var_flat = [v for var in variables for v in var]
+        if len(var_flat) == 0:
+            return (c_r, c_zeta)
+        coeff_flat = torch.cat([
+            coeff.reshape((-1, ))[:len(var)]
+            for coeff, var in zip(coeffs, variables)
+        ]).to(self.dtype)
+        try:
+            r_pos, r_cols, zeta_pos, zeta_cols = self.resolve_variables(
+                var_flat)
+        except Exception as e:
+            raise Exception("setObjective: " + str(e))
+        for pos, cols in ((r_pos, r_cols), (zeta_pos, zeta_cols)):
+            unique_cols, counts = np.unique(cols, return_counts=True)
+            if np.any(counts > 1):
+                duplicate = pos[np.nonzero(cols == unique_cols[np.argmax(
+                    counts > 1)])[0][0]]
+                raise Exception("setObjective: variable " +
+                                var_flat[duplicate].VarName +
+                                " is duplicated" + cost_name + ".")
+        c_r = c_r.index_put((torch.from_numpy(r_cols), ),
+                            coeff_flat[torch.from_numpy(r_pos)])
+        c_zeta = c_zeta.index_put((torch.from_numpy(zeta_cols), ),
+                                  coeff_flat[torch.from_numpy(zeta_pos)])
+        return (c_r, c_zeta)
+
     def get_active_constraints(self, active_ineq_row_indices, zeta_sol):
         """
         Pick out the active constraints on the continuous variables as
@@ -859,73 +1898,225 @@ class GurobiTorchMIP:
         # First fill in the equality constraints
         # The equality constraints are Aeq_r * r + Aeq_zeta * zeta_sol = beq,
         # equivalent to Aeq_r * r = beq - Aeq_zeta * zeta_sol
-        if len(self.Aeq_r_row) != 0:
-            A_act1 = torch.sparse.DoubleTensor(
-                torch.LongTensor([self.Aeq_r_row, self.Aeq_r_col]),
-                torch.stack(self.Aeq_r_val).type(torch.float64),
-                torch.Size([len(self.rhs_eq), len(self.r)])).type(self.dtype).\
-                to_dense()
-        else:
-            A_act1 = torch.zeros((len(self.rhs_eq), len(self.r)),
-                                 dtype=self.dtype)
-        if len(self.Aeq_zeta_row) != 0:
-            Aeq_zeta = torch.sparse.DoubleTensor(
-                torch.LongTensor([self.Aeq_zeta_row, self.Aeq_zeta_col]),
-                torch.stack(self.Aeq_zeta_val).type(torch.float64),
-                torch.Size([len(self.rhs_eq), len(self.zeta)]))\
-                .type(self.dtype).to_dense()
-        else:
-            Aeq_zeta = torch.zeros((len(self.rhs_eq), len(self.zeta)),
-                                   dtype=self.dtype)
-        if len(self.rhs_eq) != 0:
-            b_act1 = torch.stack([s.squeeze() for s in self.rhs_eq]) -\
-                Aeq_zeta @ zeta_sol
-        else:
-            b_act1 = torch.zeros(len(self.rhs_eq), dtype=self.dtype)
-
-        # Now fill in the active inequality constraints
-        if len(active_ineq_row_indices) != 0:
-            (Ain_r, Ain_zeta, rhs_in) = self.get_inequality_constraints()
-            active_ineq_row_indices_list = list(active_ineq_row_indices)
-            Ain_active_r = Ain_r[active_ineq_row_indices_list]
-            Ain_active_zeta = Ain_zeta[active_ineq_row_indices_list]
-            rhs_in_active = rhs_in[active_ineq_row_indices_list]
-            b_act2 = rhs_in_active - Ain_active_zeta @ zeta_sol
-        else:
-            Ain_active_r = torch.zeros((0, len(self.r)), dtype=self.dtype)
-            b_act2 = torch.zeros(0, dtype=self.dtype)
+        A_act1 = self.Aeq_r_coo.to_dense(len(self.rhs_eq), len(self.r))
+        Aeq_zeta = self.Aeq_zeta_coo.to_dense(len(self.rhs_eq), len(self.zeta))
+        b_act1 = self.rhs_eq.val - Aeq_zeta @ zeta_sol
+
+        # Now fill in the active inequality constraints. We only assemble the
+        # active rows of Ain_r and Ain_zeta.
+        active_ineq_row_indices_list = sorted(active_ineq_row_indices)
+        Ain_active_r = self.Ain_r_coo.to_dense(
+            len(self.rhs_in), len(self.r), rows=active_ineq_row_indices_list)
+        Ain_active_zeta = self.Ain_zeta_coo.to_dense(
+            len(self.rhs_in),
+            len(self.zeta),
+            rows=active_ineq_row_indices_list)
+        rhs_in_active = self.rhs_in.val[active_ineq_row_indices_list]
+        b_act2 = rhs_in_active - Ain_active_zeta @ zeta_sol
         A_act = torch.cat((A_act1, Ain_active_r), dim=0)
         b_act = torch.cat((b_act1, b_act2))
         return (A_act, b_act)
 
-    def get_inequality_constraints(self):
+    def get_active_constraints_coo(self, active_ineq_row_indices, zeta_sol):
+        """
+        Same as get_active_constraints(), but returns A_act in the COO format,
+        without assembling the dense matrix.
+        @param active_ineq_row_indices A set of indices for the active
+        inequality constraints.
+        @param zeta_sol The solution to the binary variables. A torch array of
+        0/1.
+        @return (A_act_row, A_act_col, A_act_val, b_act) A_act_row and
+        A_act_col are numpy arrays, A_act_val and b_act are torch tensors. The
+        rows of A_act are in the same order as in get_active_constraints().
+        """
+        assert (isinstance(active_ineq_row_indices, set))
+        assert (isinstance(zeta_sol, torch.Tensor))
+        num_eq = len(self.rhs_eq)
+        active_ineq_row_indices_list = sorted(active_ineq_row_indices)
+        b_act1 = self.rhs_eq.val - self.Aeq_zeta_coo.to_dense(
+            num_eq, len(self.zeta)) @ zeta_sol
+        Ain_active_row, Ain_active_col, Ain_active_val = \
+            self.Ain_r_coo.select_rows(len(self.rhs_in),
+                                       active_ineq_row_indices_list)
+        b_act2 = self.rhs_in.val[active_ineq_row_indices_list] - \
+            self.Ain_zeta_coo.to_dense(
+                len(self.rhs_in),
+                len(self.zeta),
+                rows=active_ineq_row_indices_list) @ zeta_sol
+        A_act_row = np.concatenate((self.Aeq_r_coo.row,
+                                    Ain_active_row + num_eq))
+        A_act_col = np.concatenate((self.Aeq_r_coo.col, Ain_active_col))
+        A_act_val = torch.cat((self.Aeq_r_coo.val, Ain_active_val))
+        return (A_act_row, A_act_col, A_act_val, torch.cat((b_act1, b_act2)))
+
+    def get_inequality_constraints(self, sparse=False):
         """
         Return the matrices Ain_r, Ain_zeta, rhs_in as torch tensors.
+        @param sparse If set to True, then Ain_r and Ain_zeta are returned as
+        torch sparse COO tensors, otherwise they are dense tensors.
         """
-        if len(self.Ain_r_row) != 0:
-            Ain_r = torch.sparse.DoubleTensor(torch.LongTensor(
-                [self.Ain_r_row, self.Ain_r_col]),
-                torch.stack(self.Ain_r_val).type(torch.float64),
-                torch.Size([len(self.rhs_in), len(self.r)])).type(self.dtype).\
-                to_dense()
-        else:
-            Ain_r = torch.zeros((len(self.rhs_in), len(self.r)),
-                                dtype=self.dtype)
-        if len(self.Ain_zeta_row) != 0:
-            Ain_zeta = torch.sparse.DoubleTensor(torch.LongTensor(
-                [self.Ain_zeta_row, self.Ain_zeta_col]),
-                torch.stack(self.Ain_zeta_val).type(torch.float64),
-                torch.Size([len(self.rhs_in), len(self.zeta)])).\
-                type(self.dtype).to_dense()
-        else:
-            Ain_zeta = torch.zeros((len(self.rhs_in), len(self.zeta)),
-                                   dtype=self.dtype)
-        if len(self.rhs_in) != 0:
-            rhs_in = torch.stack([s.squeeze() for s in self.rhs_in])
+        if sparse:
+            Ain_r = self.Ain_r_coo.to_sparse(len(self.rhs_in), len(self.r))
+            Ain_zeta = self.Ain_zeta_coo.to_sparse(len(self.rhs_in),
+                                                   len(self.zeta))
         else:
-            rhs_in = torch.zeros(len(self.rhs_in), dtype=self.dtype)
+            Ain_r = self.Ain_r_coo.to_dense(len(self.rhs_in), len(self.r))
+            Ain_zeta = self.Ain_zeta_coo.to_dense(len(self.rhs_in),
+                                                  len(self.zeta))
+        rhs_in = self.rhs_in.val
         return (Ain_r, Ain_zeta, rhs_in)
 
+    def get_equality_constraints(self, sparse=False):
+        """
+        Return the matrices Aeq_r, Aeq_zeta, rhs_eq as torch tensors.
+        @param sparse If set to True, then Aeq_r and Aeq_zeta are returned as
+        torch sparse COO tensors, otherwise they are dense tensors.
+        """
+        if sparse:
+            Aeq_r = self.Aeq_r_coo.to_sparse(len(self.rhs_eq), len(self.r))
+            Aeq_zeta = self.Aeq_zeta_coo.to_sparse(len(self.rhs_eq),
+                                                   len(self.zeta))
+        else:
+            Aeq_r = self.Aeq_r_coo.to_dense(len(self.rhs_eq), len(self.r))
+            Aeq_zeta = self.Aeq_zeta_coo.to_dense(len(self.rhs_eq),
+                                                  len(self.zeta))
+        rhs_eq = self.rhs_eq.val
+        return (Aeq_r, Aeq_zeta, rhs_eq)
+
+    def _compute_inequality_slack(self, r_sol, zeta_sol):
+        """
+        Compute rhs_in - Ain_r * r_sol - Ain_zeta * zeta_sol as a numpy array.
+        This doesn't track the gradient, and uses the cached scipy CSR
+        matrices, which are only rebuilt after new constraints are added.
+        r_sol and zeta_sol can also be 2D arrays, with one solution per row,
+        then the returned slack is also 2D, with one row per solution.
+        """
+        Ain_r = self.Ain_r_coo.to_scipy_csr(len(self.rhs_in), len(self.r))
+        Ain_zeta = self.Ain_zeta_coo.to_scipy_csr(len(self.rhs_in),
+                                                  len(self.zeta))
+        r_sol = r_sol.detach().numpy() if isinstance(
+            r_sol, torch.Tensor) else np.asarray(r_sol)
+        zeta_sol = zeta_sol.detach().numpy() if isinstance(
+            zeta_sol, torch.Tensor) else np.asarray(zeta_sol)
+        return self.rhs_in.val.detach().numpy() - (Ain_r @ r_sol.T).T -\
+            (Ain_zeta @ zeta_sol.T).T
+
+    def solve(self, backend=None):
+        """
+        Solve the MIP with a solver backend. The solution is then read by
+        get_solution(), get_pool_solutions(),
+        compute_objective_from_mip_data_and_solution(), etc.
+        Note that if we call gurobi_model.optimize() directly after solving
+        with a backend other than gurobi, then we should call
+        solve(GurobiSolverBackend()) instead, or set solve_result to None,
+        so that the solution is read from gurobi.
+        @param backend GurobiSolverBackend or ScipyMILPSolverBackend. If None,
+        then we use the backend that constructs this MIP.
+        @return result The solve result, with fields status (a
+        gurobipy.GRB.Status code), objective and num_solutions.
+        """
+        if backend is None:
+            backend = self.backend
+        self.solve_result = backend.solve(self)
+        return self.solve_result
+
+    def _get_solve_result(self):
+        if self.solve_result is None:
+            return GurobiSolveResult(self.gurobi_model)
+        return self.solve_result
+
+    def get_solution(self, variables, solution_number=None):
+        """
+        Return the value of the gurobi variables in a solution. The values
+        are queried from gurobi in one bulk attribute call.
+        @param variables A list of gurobi variables.
+        @param solution_number If None, then return the value in the current
+        solution (attribute X). Otherwise return the value in the
+        solution_number'th solution in the solution pool (attribute Xn).
+        @return sol A 1D torch tensor, sol[i] is the value of variables[i].
+        """
+        if len(variables) == 0:
+            return torch.zeros((0, ), dtype=self.dtype)
+        return torch.tensor(self._get_solve_result().values(
+            variables, solution_number),
+                            dtype=self.dtype)
+
+    def get_pool_solutions(self, variables, max_solutions=None):
+        """
+        Return the value of the gurobi variables in all the solutions of the
+        solution pool, together with the objective values of these solutions.
+        For each solution we make one bulk attribute query on all the
+        variables.
+        @param variables A list of gurobi variables.
+        @param max_solutions If not None, then only return the first
+        max_solutions solutions in the pool.
+        @return (solutions, objectives) solutions is a torch tensor of shape
+        (num_solutions, len(variables)), where num_solutions =
+        min(solCount, max_solutions). solutions[i, j] is the value of
+        variables[j] in the i'th solution. objectives[i] is the objective
+        value of the i'th solution.
+        """
+        result = self._get_solve_result()
+        num_solutions = result.num_solutions
+        if max_solutions is not None:
+            num_solutions = min(num_solutions, max_solutions)
+        solutions = np.empty((num_solutions, len(variables)))
+        objectives = np.empty((num_solutions, ))
+        for i in range(num_solutions):
+            if len(variables) > 0:
+                solutions[i] = result.values(variables, i)
+            objectives[i] = result.pool_objective(i)
+        return (torch.from_numpy(solutions).to(self.dtype),
+                torch.from_numpy(objectives).to(self.dtype))
+
+    def complete_solution(self, variables, values):
+        """
+        Complete a partial assignment into a feasible assignment of all the
+        variables in this MIP. We fix @p variables to @p values in a copy of
+        the gurobi model, drop the objective, and find a feasible solution.
+        When the fixed variables determine the others (for example when the
+        inputs of the ReLU networks are fixed), gurobi finds this solution in
+        presolve.
+        @param variables A list of gurobi variables in this MIP.
+        @param values A list of values, the same length as @p variables.
+        @return solution A list of values, solution[i] is the value of the
+        i'th variable in gurobi_model.getVars(). None if the fixed values
+        are infeasible.
+        """
+        assert (len(variables) == len(values))
+        self.gurobi_model.update()
+        model = self.gurobi_model.copy()
+        model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+        model_vars = model.getVars()
+        fixed_vars = [model_vars[v.index] for v in variables]
+        model.setAttr(gurobipy.GRB.Attr.LB, fixed_vars, values)
+        model.setAttr(gurobipy.GRB.Attr.UB, fixed_vars, values)
+        model.setObjective(gurobipy.LinExpr())
+        model.optimize()
+        if model.SolCount == 0:
+            return None
+        return model.getAttr(gurobipy.GRB.Attr.X, model_vars)
+
+    def set_mip_starts(self, starts):
+        """
+        Load several MIP starts into the gurobi model. Gurobi tries each of
+        them as an initial incumbent.
+        @param starts A list of complete assignments, each is a list of
+        values of all the variables in gurobi_model.getVars() (for example
+        returned from complete_solution()).
+        """
+        self.gurobi_model.update()
+        all_variables = self.gurobi_model.getVars()
+        self.gurobi_model.NumStart = len(starts)
+        for i, start in enumerate(starts):
+            assert (len(start) == len(all_variables))
+            self.gurobi_model.setParam(gurobipy.GRB.Param.StartNumber, i)
+            self.gurobi_model.setAttr(gurobipy.GRB.Attr.Start, all_variables,
+                                      start)
+        # Later changes to the Start attribute (for example in update_from())
+        # go to the first start.
+        self.gurobi_model.setParam(gurobipy.GRB.Param.StartNumber, 0)
+
     def get_active_constraint_indices_and_binary_val(
             self, solution_number=0, active_constraint_tolerance=1e-6):
         """
@@ -938,21 +2129,15 @@ class GurobiTorchMIP:
         than this tolerance at the solution, then we think this constraint is
         active at the solution.
         """
+        result = self._get_solve_result()
         assert (solution_number >= 0
-                and solution_number < self.gurobi_model.solCount)
-        assert (self.gurobi_model.status == gurobipy.GRB.Status.OPTIMAL)
-        self.gurobi_model.setParam(gurobipy.GRB.Param.SolutionNumber,
-                                   solution_number)
-        r_sol = torch.tensor([var.xn for var in self.r], dtype=self.dtype)
-        zeta_sol = torch.tensor([round(var.xn) for var in self.zeta],
-                                dtype=self.dtype)
-        with torch.no_grad():
-            (Ain_r, Ain_zeta, rhs_in) = self.get_inequality_constraints()
-            lhs_in = Ain_r @ r_sol + Ain_zeta @ zeta_sol
-        active_ineq_row_indices = np.arange(len(self.rhs_in))
-        active_ineq_row_indices = set(active_ineq_row_indices[
-            np.abs(lhs_in.detach().numpy() -
-                   rhs_in.detach().numpy()) < active_constraint_tolerance])
+                and solution_number < result.num_solutions)
+        assert (result.status == gurobipy.GRB.Status.OPTIMAL)
+        r_sol = self.get_solution(self.r, solution_number)
+        zeta_sol = torch.round(self.get_solution(self.zeta, solution_number))
+        slack_in = self._compute_inequality_slack(r_sol, zeta_sol)
+        active_ineq_row_indices = set(
+            np.nonzero(np.abs(slack_in) < active_constraint_tolerance)[0])
         return active_ineq_row_indices, zeta_sol
 
     def compute_objective_from_mip_data_and_solution(
@@ -989,21 +2174,17 @@ class GurobiTorchMIP:
         throw an exception.
         """
         # Each variable in zeta should be a binary variable.
-        for v in self.zeta:
-            assert (v.vtype == gurobipy.GRB.BINARY)
+        assert (all(vtype == gurobipy.GRB.BINARY for vtype in
+                    self.get_var_attr(gurobipy.GRB.Attr.VType, self.zeta)))
+        result = self._get_solve_result()
         assert (solution_number >= 0
-                and solution_number < self.gurobi_model.solCount)
-        assert (self.gurobi_model.status == gurobipy.GRB.Status.OPTIMAL
-                or self.gurobi_model.status == gurobipy.GRB.Status.INTERRUPTED
-                or self.gurobi_model.status == gurobipy.GRB.Status.TIME_LIMIT)
-        self.gurobi_model.setParam(gurobipy.GRB.Param.SolutionNumber,
-                                   solution_number)
-        r_sol = torch.tensor([var.xn for var in self.r], dtype=self.dtype)
-        zeta_sol = torch.tensor([round(var.xn) for var in self.zeta],
-                                dtype=self.dtype)
-        with torch.no_grad():
-            (Ain_r, Ain_zeta, rhs_in) = self.get_inequality_constraints()
-            lhs_in = Ain_r @ r_sol + Ain_zeta @ zeta_sol
+                and solution_number < result.num_solutions)
+        assert (result.status == gurobipy.GRB.Status.OPTIMAL
+                or result.status == gurobipy.GRB.Status.INTERRUPTED
+                or result.status == gurobipy.GRB.Status.TIME_LIMIT)
+        r_sol = self.get_solution(self.r, solution_number)
+        zeta_sol = torch.round(self.get_solution(self.zeta, solution_number))
+        slack_in = self._compute_inequality_slack(r_sol, zeta_sol)
 
         # The boolean flag to indicate that the objective computed by us
         # matches with the objective in Gurobi.
@@ -1014,13 +2195,12 @@ class GurobiTorchMIP:
         max_num_trials = 10
 
         while not objective_match:
-            active_ineq_row_indices = np.arange(len(self.rhs_in))
-            active_ineq_row_indices = set(active_ineq_row_indices[
-                np.abs(lhs_in.detach().numpy() -
-                       rhs_in.detach().numpy()) < active_constraint_tolerance])
+            active_ineq_row_indices = set(
+                np.nonzero(np.abs(slack_in) < active_constraint_tolerance)[0])
             objective = self.compute_objective_from_mip_data(
                 active_ineq_row_indices, zeta_sol, penalty)
-            if (np.abs(objective.item() - self.gurobi_model.PoolObjVal) >
+            if (np.abs(objective.item() -
+                       result.pool_objective(solution_number)) >
                     objective_tol):
                 active_constraint_tolerance += active_constraint_tolerance
                 num_trials += 1
@@ -1032,6 +2212,82 @@ class GurobiTorchMIP:
                 objective_match = True
                 return objective
 
+    def compute_objective_from_mip_data_and_all_solutions(
+            self,
+            max_solutions=None,
+            active_constraint_tolerance=1e-6,
+            penalty=0.,
+            objective_tol=1e-3):
+        """
+        The batched version of compute_objective_from_mip_data_and_solution()
+        for all the solutions in the solution pool. The solutions that share
+        the same active constraints and binary variable values have the same
+        objective as a function of the MIP data, so we only call
+        compute_objective_from_mip_data() (and factorize the active
+        constraints) once for each group of such solutions.
+        @param max_solutions If not None, then only use the first
+        max_solutions solutions in the pool.
+        @param active_constraint_tolerance, penalty, objective_tol Refer to
+        compute_objective_from_mip_data_and_solution(). The tolerance on the
+        active constraints is increased separately for each solution whose
+        objective doesn't match with Gurobi.
+        @return objectives A 1D torch tensor, objectives[i] is the objective
+        of the i'th solution in the pool, as a function of the MIP data.
+        """
+        assert (all(vtype == gurobipy.GRB.BINARY for vtype in
+                    self.get_var_attr(gurobipy.GRB.Attr.VType, self.zeta)))
+        status = self._get_solve_result().status
+        assert (status == gurobipy.GRB.Status.OPTIMAL
+                or status == gurobipy.GRB.Status.INTERRUPTED
+                or status == gurobipy.GRB.Status.TIME_LIMIT)
+        solutions, pool_obj = self.get_pool_solutions(self.r + self.zeta,
+                                                      max_solutions)
+        num_solutions = solutions.shape[0]
+        r_sol = solutions[:, :len(self.r)].numpy()
+        zeta_sol = np.round(solutions[:, len(self.r):].numpy())
+        slack_in = np.abs(self._compute_inequality_slack(r_sol, zeta_sol))
+        pool_obj = pool_obj.numpy()
+
+        objectives = [None] * num_solutions
+        # The indices of the solutions whose objective is not computed yet.
+        remaining = np.arange(num_solutions)
+        num_trials = 0
+        max_num_trials = 10
+        while remaining.shape[0] > 0:
+            active_flag = slack_in[remaining] < active_constraint_tolerance
+            # Group the remaining solutions by their active constraints and
+            # binary variable values.
+            groups = {}
+            for i, sol_index in enumerate(remaining):
+                key = (active_flag[i].tobytes(), zeta_sol[sol_index].tobytes())
+                groups.setdefault(key, []).append(sol_index)
+            unmatched = []
+            for group in groups.values():
+                active_ineq_row_indices = set(
+                    np.nonzero(slack_in[group[0]] <
+                               active_constraint_tolerance)[0])
+                objective = self.compute_objective_from_mip_data(
+                    active_ineq_row_indices,
+                    torch.from_numpy(zeta_sol[group[0]]).to(self.dtype),
+                    penalty)
+                for sol_index in group:
+                    if np.abs(objective.item() -
+                              pool_obj[sol_index]) > objective_tol:
+                        unmatched.append(sol_index)
+                    else:
+                        objectives[sol_index] = objective
+            remaining = np.array(sorted(unmatched), dtype=np.int64)
+            if remaining.shape[0] > 0:
+                active_constraint_tolerance += active_constraint_tolerance
+                num_trials += 1
+                if num_trials == max_num_trials:
+                    raise IncorrectActiveConstraint(
+                        "compute_objective_from_mip_data_and_all_solutions()"
+                        + " cannot find good active constraint.")
+        if num_solutions == 0:
+            return torch.zeros((0, ), dtype=self.dtype)
+        return torch.stack(objectives)
+
     def remove_binary_relaxation(self):
         """
         Loop through all the variables in self.zeta, if the variable is not
@@ -1041,7 +2297,218 @@ class GurobiTorchMIP:
         for v in self.zeta:
             if v.vtype == gurobipy.GRB.CONTINUOUS:
                 v.vtype = gurobipy.GRB.BINARY
+        self.backend.update(self)
+
+    def _has_same_structure(self, other):
+        """
+        Return True if @p other has the same variables and the same sparsity
+        pattern in its constraints as this MIP, and the gurobi model of this
+        MIP only contains the variables and the constraints in the torch data.
+        Refer to update_from().
+        """
+        if type(self) is not type(other) or len(self.r) != len(other.r) or\
+                len(self.zeta) != len(other.zeta) or\
+                len(self._variables) != len(other._variables) or\
+                len(self.rhs_in) != len(other.rhs_in) or\
+                len(self.rhs_eq) != len(other.rhs_eq) or\
+                self._num_constrs != other._num_constrs:
+            return False
+        for name in ("Ain_r_coo", "Ain_zeta_coo", "Aeq_r_coo",
+                     "Aeq_zeta_coo"):
+            if not np.array_equal(getattr(self, name).row,
+                                  getattr(other, name).row) or\
+                    not np.array_equal(getattr(self, name).col,
+                                       getattr(other, name).col):
+                return False
+        # The constraint senses.
+        for name in ("_in_row_constr", "_in_row_sign", "_eq_row_constr"):
+            if getattr(self, name) != getattr(other, name):
+                return False
+        for variables, other_variables in ((self.r, other.r),
+                                           (self.zeta, other.zeta)):
+            if [v.index for v in variables] !=\
+                    [v.index for v in other_variables]:
+                return False
+        if self.get_var_attr(gurobipy.GRB.Attr.VType, self._variables) !=\
+                other.get_var_attr(gurobipy.GRB.Attr.VType,
+                                   other._variables):
+            return False
+        model = self.gurobi_model
+        return model.NumVars == len(self._variables) and\
+            model.NumConstrs == self._num_constrs and\
+            model.NumQConstrs == 0 and model.NumGenConstrs == 0 and\
+            model.NumSOS == 0
+
+    def _solver_constraint_data(self):
+        """
+        Compute the linear constraints of the solver model from the torch
+        data (without the rows of the variable bounds).
+        @return (A, rhs) A is a scipy csr matrix, A[i, var.index] is the
+        coefficient of var in the i'th solver constraint. rhs is a numpy
+        array, rhs[i] is the right-hand side of the i'th solver constraint.
+        """
+        var_index = np.array([v.index for v in self.r + self.zeta],
+                             dtype=np.int64)
+        rows = []
+        cols = []
+        vals = []
+        rhs = np.zeros((self._num_constrs, ))
+        for A_r_coo, A_zeta_coo, rhs_storage, row_constr, row_sign in (
+            (self.Ain_r_coo, self.Ain_zeta_coo, self.rhs_in,
+             self._in_row_constr, self._in_row_sign),
+            (self.Aeq_r_coo, self.Aeq_zeta_coo, self.rhs_eq,
+             self._eq_row_constr, [1.] * len(self._eq_row_constr))):
+            row_constr = np.array(row_constr, dtype=np.int64)
+            row_sign = np.array(row_sign, dtype=float)
+            is_constraint = row_constr >= 0
+            rhs[row_constr[is_constraint]] = row_sign[is_constraint] *\
+                rhs_storage.val.detach().numpy()[is_constraint]
+            for A_coo, col_offset in ((A_r_coo, 0), (A_zeta_coo, len(self.r))):
+                keep = is_constraint[A_coo.row]
+                rows.append(row_constr[A_coo.row[keep]])
+                cols.append(var_index[A_coo.col[keep] + col_offset])
+                vals.append(row_sign[A_coo.row[keep]] *
+                            A_coo.val.detach().numpy()[keep])
+        A = scipy.sparse.csr_matrix(
+            (np.concatenate(vals),
+             (np.concatenate(rows), np.concatenate(cols))),
+            shape=(self._num_constrs, len(self._variables)))
+        return A, rhs
+
+    def update_from(self, other):
+        """
+        Use this MIP as a template, and refresh its data from @p other. @p
+        other is constructed by the same code as this MIP (hence it has the
+        same variables and the same constraint structure), but with different
+        numerical data, for example after the network weights are updated in
+        an iteration of the training. @p other should be constructed with
+        TorchDataBackend, so that no second gurobi model is built.
+        The torch data (the constraint and cost coefficients, which carry the
+        gradient w.r.t the new network parameters) are taken from @p other.
+        The gurobi model of this MIP is modified in place: the variable
+        bounds, right-hand sides and the objective are updated through bulk
+        attribute calls, and we only call chgCoeff on the constraint
+        coefficients that differ between the torch data of the two MIPs. The
+        start values of @p other are discarded. Instead the incumbent of the
+        previous solve of this MIP (if any) becomes the MIP start, together
+        with the other information gurobi reuses from the previous solve.
+        @param other A GurobiTorchMIP of the same type as this MIP.
+        @return success If @p other doesn't have the same structure as this
+        MIP, then return False, and this MIP is not changed.
+        """
+        assert (isinstance(other, GurobiTorchMIP))
+        self.gurobi_model.update()
+        if not self._has_same_structure(other):
+            return False
+        variables = self.gurobi_model.getVars()
+        # The incumbent is discarded once the model is modified, read it
+        # first.
+        incumbent = self.gurobi_model.getAttr(gurobipy.GRB.Attr.X, variables)\
+            if self.gurobi_model.SolCount > 0 else None
+        for attr in (gurobipy.GRB.Attr.LB, gurobipy.GRB.Attr.UB):
+            self.gurobi_model.setAttr(
+                attr, variables, other.get_var_attr(attr, other._variables))
+        if incumbent is not None:
+            # Discard the MIP starts loaded by set_mip_starts() in the
+            # previous solve.
+            self.gurobi_model.NumStart = 1
+            self.gurobi_model.setParam(gurobipy.GRB.Param.StartNumber, 0)
+            self.gurobi_model.setAttr(gurobipy.GRB.Attr.Start, variables,
+                                      incumbent)
+        if self._num_constrs > 0:
+            A, rhs = self._solver_constraint_data()
+            A_other, rhs_other = other._solver_constraint_data()
+            constraints = self.gurobi_model.getConstrs()
+            changed_row, changed_col = (A != A_other).nonzero()
+            changed_val = np.asarray(A_other[changed_row,
+                                             changed_col]).reshape((-1, ))
+            for i in range(changed_row.shape[0]):
+                self.gurobi_model.chgCoeff(constraints[changed_row[i]],
+                                           variables[changed_col[i]],
+                                           changed_val[i])
+            changed_rhs = np.nonzero(rhs != rhs_other)[0]
+            if changed_rhs.shape[0] > 0:
+                self.gurobi_model.setAttr(
+                    gurobipy.GRB.Attr.RHS,
+                    [constraints[i] for i in changed_rhs],
+                    rhs_other[changed_rhs].tolist())
+
+        # Now copy the torch data, and set the objective from it.
+        for name in ("Ain_r_coo", "Ain_zeta_coo", "rhs_in", "Aeq_r_coo",
+                     "Aeq_zeta_coo", "rhs_eq", "c_r", "c_zeta", "c_constant",
+                     "Q_r", "Q_zeta", "Q_rzeta", "sense"):
+            if hasattr(other, name):
+                setattr(self, name, getattr(other, name))
+        if getattr(self, "c_r", None) is not None:
+            self.backend.set_objective(self)
+        self.solve_result = None
+        self.gurobi_model.update()
+        return True
+
+    def get_template_variables(self, variables):
+        """
+        After calling update_from(other), find the variables in this MIP that
+        correspond to the variables of other.
+        @param variables A list of gurobi variables in other.
+        @return template_variables A list of gurobi variables in this MIP.
+        """
+        all_variables = self.gurobi_model.getVars()
+        return [all_variables[v.index] for v in variables]
+
+    def save(self, filename, variables=None):
+        """
+        Save this MIP to a file, such that it can be loaded by load_mip()
+        without constructing the MIP again. The gurobi model is stored in the
+        MPS format, together with the torch data (constraints, cost) of this
+        MIP. The torch data is saved detached, namely the loaded MIP doesn't
+        carry the gradient w.r.t the parameters (such as the network
+        weights) used in constructing this MIP.
+        @param filename The name of the file.
+        @param variables A dict mapping a name to a list of gurobi variables
+        in this MIP. These variables are returned by load_mip(), for example
+        the variables of the state x.
+        """
         self.gurobi_model.update()
+        all_variables = self.gurobi_model.getVars()
+        constraints = self.gurobi_model.getConstrs()
+        data = {
+            "class": type(self),
+            "r": [v.index for v in self.r],
+            "zeta": [v.index for v in self.zeta],
+            "variables": {} if variables is None else
+            {key: [v.index for v in val]
+             for key, val in variables.items()},
+            # MPS doesn't store the start values, and it renames the
+            # variables or constraints with duplicate names.
+            "Start": self.gurobi_model.getAttr(gurobipy.GRB.Attr.Start,
+                                               all_variables),
+            "VarName": self.gurobi_model.getAttr(gurobipy.GRB.Attr.VarName,
+                                                 all_variables),
+            "ConstrName": self.gurobi_model.getAttr(
+                gurobipy.GRB.Attr.ConstrName, constraints),
+            "attributes": {}
+        }
+        for name, val in self.__dict__.items():
+            if name in ("_gurobi_model", "_gurobi_env", "backend",
+                        "_variables", "r", "zeta", "r_indices",
+                        "zeta_indices", "solve_result"):
+                continue
+            if isinstance(val, COOMatrixStorage):
+                data["attributes"][name] = (COOMatrixStorage, val.row,
+                                            val.col, val.val.detach())
+            elif isinstance(val, BlockVectorStorage):
+                data["attributes"][name] = (BlockVectorStorage,
+                                            val.val.detach())
+            elif isinstance(val, torch.Tensor):
+                data["attributes"][name] = val.detach()
+            else:
+                data["attributes"][name] = val
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mps_file = os.path.join(tmp_dir, "model.mps")
+            self.gurobi_model.write(mps_file)
+            with open(mps_file, "rb") as f:
+                data["mps"] = f.read()
+        torch.save(data, filename)
 
 
 class GurobiTorchMILP(GurobiTorchMIP):
@@ -1052,8 +2519,8 @@ class GurobiTorchMILP(GurobiTorchMIP):
     s.t Ain_r * r + Ain_zeta * ζ <= rhs_in
         Aeq_r * r + Aeq_zeta * ζ = rhs_eq
     """
-    def __init__(self, dtype):
-        GurobiTorchMIP.__init__(self, dtype)
+    def __init__(self, dtype, backend=None):
+        GurobiTorchMIP.__init__(self, dtype, backend)
         self.c_r = None
         self.c_zeta = None
         self.c_constant = None
@@ -1070,34 +2537,14 @@ class GurobiTorchMILP(GurobiTorchMIP):
         variables. Note that the variables cannot overlap.
         @param sense GRB.MAXIMIZE or GRB.MINIMIZE
         """
-        # r_used_flag[i] records if r[i] has appeared in @p variables.
         assert (isinstance(coeffs, list))
         assert (isinstance(variables, list))
         assert (len(coeffs) == len(variables))
         assert (sense == gurobipy.GRB.MAXIMIZE
                 or sense == gurobipy.GRB.MINIMIZE)
         self.sense = sense
-        r_used_flag = [False] * len(self.r)
-        zeta_used_flag = [False] * len(self.zeta)
-        self.c_r = torch.zeros((len(self.r), ), dtype=self.dtype)
-        self.c_zeta = torch.zeros((len(self.zeta), ), dtype=self.dtype)
-        for coeff, var in zip(coeffs, variables):
-            assert (isinstance(coeff, torch.Tensor))
-            for i in range(len(var)):
-                if var[i] in self.r_indices.keys():
-                    r_index = self.r_indices[var[i]]
-                    if r_used_flag[r_index]:
-                        raise Exception("setObjective: variable " +
-                                        var[i].VarName + " is duplicated.")
-                    r_used_flag[r_index] = True
-                    self.c_r[r_index] = coeff[i]
-                elif var[i] in self.zeta_indices.keys():
-                    zeta_index = self.zeta_indices[var[i]]
-                    if zeta_used_flag[zeta_index]:
-                        raise Exception("setObjective: variable " +
-                                        var[i].VarName + " is duplicated.")
-                    zeta_used_flag[zeta_index] = True
-                    self.c_zeta[zeta_index] = coeff[i]
+        self.c_r, self.c_zeta = self._linear_cost_coefficients(
+            coeffs, variables, "")
         if isinstance(constant, float):
             self.c_constant = torch.tensor(constant, dtype=self.dtype)
         elif isinstance(constant, torch.Tensor):
@@ -1106,15 +2553,13 @@ class GurobiTorchMILP(GurobiTorchMIP):
         else:
             raise Exception("setObjective: constant must be either a float" +
                             " or a torch tensor.")
-        self.gurobi_model.setObjective(
-            gurobipy.LinExpr(self.c_r, self.r) +
-            gurobipy.LinExpr(self.c_zeta, self.zeta) + self.c_constant,
-            sense=sense)
+        self.backend.set_objective(self)
 
     def compute_objective_from_mip_data(self,
                                         active_ineq_row_indices,
                                         zeta_sol,
-                                        penalty=0.):
+                                        penalty=0.,
+                                        rcond_tol=1E-14):
         """
         Given the active inequality constraints and the value for binary
         variables, compute the objective as a function of the MIP constraint
@@ -1123,20 +2568,52 @@ class GurobiTorchMILP(GurobiTorchMIP):
         where A_act, b_act are computed from get_active_constraints
         @param penalty The matrix A_act is not always invertible. We use a
         penalized version of least square problem to compute its pseudo inverse
-        as (A_actᵀ * A_act + penalty * I)⁻¹ * A_actᵀ
+        as (A_actᵀ * A_act + penalty * I)⁻¹ * A_actᵀ. If the estimated
+        reciprocal condition number (see factorize_sparse_matrix()) is smaller
+        than @p rcond_tol, then we use penalty = 1E-10 instead.
+        @param rcond_tol The tolerance on the estimated reciprocal condition
+        number.
         @return objective cᵣᵀ * A_act⁻¹ * b_act + c_zetaᵀ * ζ + c_constant
         """
-        (A_act, b_act) = self.get_active_constraints(active_ineq_row_indices,
-                                                     zeta_sol)
+        (A_act_row, A_act_col, A_act_val,
+         b_act) = self.get_active_constraints_coo(active_ineq_row_indices,
+                                                  zeta_sol)
         # Now compute A_act⁻¹ * b_act. A_act may not be invertible, so we
         # use its pseudo-inverse
-        # (A_actᵀ * A_act + penalty * I)⁻¹ * A_actᵀ * b_act
-        if np.linalg.cond((A_act.T @ A_act).detach().numpy()) > 1e15:
-            penalty = 1e-10
-        return self.c_r @ torch.inverse(
-            A_act.T @ A_act +
-            penalty * torch.eye(len(self.r), dtype=self.dtype)) @ (A_act.T) @\
-            b_act + self.c_zeta @ zeta_sol + self.c_constant
+        # x = (A_actᵀ * A_act + penalty * I)⁻¹ * A_actᵀ * b_act
+        # Instead of inverting the dense matrix A_actᵀ * A_act, we solve the
+        # equivalent sparse augmented system
+        # [I       A_act    ] * [s] = [b_act]
+        # [A_actᵀ  -penalty*I]   [x]   [0    ]
+        # where s = b_act - A_act * x is the residual.
+        num_act = len(b_act)
+        num_r = len(self.r)
+        size = num_act + num_r
+        diag_act = np.arange(num_act)
+        diag_r = np.arange(num_act, size)
+        M_row = np.concatenate(
+            (diag_act, A_act_row, A_act_col + num_act, diag_r))
+        M_col = np.concatenate(
+            (diag_act, A_act_col + num_act, A_act_row, diag_r))
+
+        def get_M_val(penalty):
+            return torch.cat(
+                (torch.ones((num_act, ), dtype=self.dtype), A_act_val,
+                 A_act_val, torch.full((num_r, ), -penalty,
+                                       dtype=self.dtype)))
+
+        if num_r == 0:
+            return self.c_zeta @ zeta_sol + self.c_constant
+        M_val = get_M_val(penalty)
+        lu, rcond = factorize_sparse_matrix(M_row, M_col, M_val, size)
+        # The matrix is (nearly) singular when A_act doesn't have full column
+        # rank, we then add a small penalty.
+        if rcond < rcond_tol:
+            M_val = get_M_val(1E-10)
+            lu, rcond = factorize_sparse_matrix(M_row, M_col, M_val, size)
+        rhs = torch.cat((b_act, torch.zeros((num_r, ), dtype=self.dtype)))
+        x = SparseLinearSolve.apply(M_val, rhs, M_row, M_col, lu)[num_act:]
+        return self.c_r @ x + self.c_zeta @ zeta_sol + self.c_constant
 
 
 class GurobiTorchMIQP(GurobiTorchMIP):
@@ -1150,8 +2627,8 @@ class GurobiTorchMIQP(GurobiTorchMIP):
     s.t Ain_r * r + Ain_zeta * ζ <= rhs_in
         Aeq_r * r + Aeq_zeta * ζ = rhs_eq
     """
-    def __init__(self, dtype):
-        GurobiTorchMIP.__init__(self, dtype)
+    def __init__(self, dtype, backend=None):
+        GurobiTorchMIP.__init__(self, dtype, backend)
         self.Q_r = None
         self.Q_zeta = None
         self.Q_rzeta = None
@@ -1189,85 +2666,64 @@ class GurobiTorchMIQP(GurobiTorchMIP):
         assert (sense == gurobipy.GRB.MAXIMIZE
                 or sense == gurobipy.GRB.MINIMIZE)
         self.sense = sense
-        lin_r_used_flag = [False] * len(self.r)
-        lin_zeta_used_flag = [False] * len(self.zeta)
-        quad_r_used_flag = [[False] * len(self.r) for j in range(len(self.r))]
-        quad_zeta_used_flag = [[False] * len(self.zeta)
-                               for j in range(len(self.zeta))]
-        quad_rzeta_used_flag = [[False] * len(self.zeta)
-                                for j in range(len(self.r))]
-        self.c_r = torch.zeros((len(self.r), ), dtype=self.dtype)
-        self.c_zeta = torch.zeros((len(self.zeta), ), dtype=self.dtype)
-        self.Q_r = torch.zeros((len(self.r), len(self.r)), dtype=self.dtype)
-        self.Q_zeta = torch.zeros((len(self.zeta), len(self.zeta)),
-                                  dtype=self.dtype)
-        self.Q_rzeta = torch.zeros((len(self.r), len(self.zeta)),
-                                   dtype=self.dtype)
-        for coeff, var in zip(lin_coeffs, lin_variables):
-            assert (isinstance(coeff, torch.Tensor))
-            for i in range(len(var)):
-                if var[i] in self.r_indices.keys():
-                    r_index = self.r_indices[var[i]]
-                    if lin_r_used_flag[r_index]:
-                        raise Exception("setObjective: variable " +
-                                        var[i].VarName +
-                                        " is duplicated in linear cost.")
-                    lin_r_used_flag[r_index] = True
-                    self.c_r[r_index] = coeff[i]
-                elif var[i] in self.zeta_indices.keys():
-                    zeta_index = self.zeta_indices[var[i]]
-                    if lin_zeta_used_flag[zeta_index]:
-                        raise Exception("setObjective: variable " +
-                                        var[i].VarName +
-                                        " is duplicated in linear cost.")
-                    lin_zeta_used_flag[zeta_index] = True
-                    self.c_zeta[zeta_index] = coeff[i]
+        self.c_r, self.c_zeta = self._linear_cost_coefficients(
+            lin_coeffs, lin_variables, " in linear cost")
+        num_r = len(self.r)
+        num_zeta = len(self.zeta)
+        # Q_all is the Hessian of the quadratic cost w.r.t [r; zeta], we
+        # store the upper-left block as Q_r, the upper-right block as Q_rzeta
+        # and the lower-right block as Q_zeta.
+        Q_all_index = []
+        Q_all_val = []
         for coeff, (var_left, var_right) in zip(quad_coeffs, quad_variables):
             assert (isinstance(coeff, torch.Tensor))
             assert (coeff.shape == (len(var_left), len(var_right)))
-            for i in range(len(var_left)):
-                for j in range(len(var_right)):
-                    if var_left[i] in self.r_indices.keys()\
-                            and var_right[j] in self.r_indices.keys():
-                        # in Q_r
-                        r_index_l = self.r_indices[var_left[i]]
-                        r_index_r = self.r_indices[var_right[j]]
-                        if quad_r_used_flag[r_index_l][r_index_r]:
-                            raise Exception("setObjective: variable (" +
-                                            var_left[i].VarName + "," +
-                                            var_right[j].VarName +
-                                            ") is duplicated in quad cost.")
-                        quad_r_used_flag[r_index_l][r_index_r] = True
-                        self.Q_r[r_index_l, r_index_r] = coeff[i, j]
-                    elif var_left[i] in self.zeta_indices.keys()\
-                            and var_right[j] in self.zeta_indices.keys():
-                        # in Q_zeta
-                        zeta_index_l = self.zeta_indices[var_left[i]]
-                        zeta_index_r = self.zeta_indices[var_right[j]]
-                        if quad_zeta_used_flag[zeta_index_l][zeta_index_r]:
-                            raise Exception("setObjective: variable (" +
-                                            var_left[i].VarName + "," +
-                                            var_right[j].VarName +
-                                            ") is duplicated in quad cost.")
-                        quad_zeta_used_flag[zeta_index_l][zeta_index_r] = True
-                        self.Q_zeta[zeta_index_l, zeta_index_r] = coeff[i, j]
-                    else:
-                        # in Q_rzeta
-                        if var_left[i] in self.r_indices.keys():
-                            r_index_l = self.r_indices[var_left[i]]
-                        else:
-                            zeta_index_r = self.zeta_indices[var_left[i]]
-                        if var_right[j] in self.r_indices.keys():
-                            r_index_l = self.r_indices[var_right[j]]
-                        else:
-                            zeta_index_r = self.zeta_indices[var_right[j]]
-                        if quad_rzeta_used_flag[r_index_l][zeta_index_r]:
-                            raise Exception("setObjective: variable (" +
-                                            var_left[i].VarName + "," +
-                                            var_right[j].VarName +
-                                            ") is duplicated in quad cost.")
-                        quad_rzeta_used_flag[r_index_l][zeta_index_r] = True
-                        self.Q_rzeta[r_index_l, zeta_index_r] = coeff[i, j]
+            if len(var_left) == 0 or len(var_right) == 0:
+                continue
+            try:
+                index_left = self._combined_columns(var_left)
+                index_right = self._combined_columns(var_right)
+            except Exception as e:
+                raise Exception("setObjective: " + str(e))
+            # A cross term between a continuous variable and a binary
+            # variable is stored in Q_rzeta, with the continuous variable as
+            # the row.
+            row = np.minimum(index_left.reshape((-1, 1)),
+                             index_right.reshape((1, -1)))
+            col = np.maximum(index_left.reshape((-1, 1)),
+                             index_right.reshape((1, -1)))
+            cross = np.logical_and(row < num_r, col >= num_r)
+            row = np.where(cross, row,
+                           np.repeat(index_left.reshape((-1, 1)),
+                                     len(var_right),
+                                     axis=1))
+            col = np.where(cross, col,
+                           np.repeat(index_right.reshape((1, -1)),
+                                     len(var_left),
+                                     axis=0))
+            Q_all_index.append(row.reshape((-1, )) * (num_r + num_zeta) +
+                               col.reshape((-1, )))
+            Q_all_val.append(coeff.reshape((-1, )).to(self.dtype))
+        Q_all = torch.zeros((num_r + num_zeta, num_r + num_zeta),
+                            dtype=self.dtype)
+        if len(Q_all_index) > 0:
+            Q_all_index = np.concatenate(Q_all_index)
+            unique_index, counts = np.unique(Q_all_index, return_counts=True)
+            if np.any(counts > 1):
+                duplicate_row, duplicate_col = np.unravel_index(
+                    unique_index[np.argmax(counts > 1)],
+                    (num_r + num_zeta, num_r + num_zeta))
+                all_vars = self.r + self.zeta
+                raise Exception("setObjective: variable (" +
+                                all_vars[duplicate_row].VarName + "," +
+                                all_vars[duplicate_col].VarName +
+                                ") is duplicated in quad cost.")
+            Q_all = Q_all.reshape((-1, )).index_put(
+                (torch.from_numpy(Q_all_index), ),
+                torch.cat(Q_all_val)).reshape(Q_all.shape)
+        self.Q_r = Q_all[:num_r, :num_r]
+        self.Q_zeta = Q_all[num_r:, num_r:]
+        self.Q_rzeta = Q_all[:num_r, num_r:]
         if isinstance(constant, float):
             self.c_constant = torch.tensor(constant, dtype=self.dtype)
         elif isinstance(constant, torch.Tensor):
@@ -1276,25 +2732,7 @@ class GurobiTorchMIQP(GurobiTorchMIP):
         else:
             raise Exception("setObjective: constant must be either a float" +
                             " or a torch tensor.")
-        quad_obj = gurobipy.QuadExpr()
-        for i in range(len(self.r)):
-            for j in range(len(self.r)):
-                if self.Q_r[i, j] != 0:
-                    quad_obj.add(self.r[i] * self.r[j], self.Q_r[i, j].item())
-        for i in range(len(self.zeta)):
-            for j in range(len(self.zeta)):
-                if self.Q_zeta[i, j] != 0:
-                    quad_obj.add(self.zeta[i] * self.zeta[j],
-                                 self.Q_zeta[i, j].item())
-        for i in range(len(self.r)):
-            for j in range(len(self.zeta)):
-                if self.Q_rzeta[i, j] != 0:
-                    quad_obj.add(self.r[i] * self.zeta[j],
-                                 self.Q_rzeta[i, j].item())
-        self.gurobi_model.setObjective(
-            quad_obj + gurobipy.LinExpr(self.c_r, self.r) +
-            gurobipy.LinExpr(self.c_zeta, self.zeta) + self.c_constant,
-            sense=sense)
+        self.backend.set_objective(self)
 
     def compute_objective_from_mip_data(self,
                                         active_ineq_row_indices,
@@ -1325,19 +2763,95 @@ class GurobiTorchMIQP(GurobiTorchMIP):
         @param penalty The small ε used to make sure the matrix is invertible.
         @return The cost of MIQP computed from problem data.
         """
-        (A_act, b_act) = self.get_active_constraints(active_ineq_row_indices,
-                                                     zeta_sol)
-        M = torch.zeros((len(self.r) + len(b_act), len(self.r) + len(b_act)),
-                        dtype=self.dtype)
-        M[:len(self.r), :len(self.r)] =\
-            2 * self.Q_r + penalty * torch.eye(len(self.r), dtype=self.dtype)
-        M[:len(self.r), len(self.r):] = A_act.T
-        M[len(self.r):, :len(self.r)] = A_act
-        M[len(self.r):, len(self.r):] =\
-            penalty * torch.eye(len(b_act), dtype=self.dtype)
-
-        primal_dual = torch.inverse(M) @ torch.cat((-self.c_r, b_act), axis=0)
+        (A_act_row, A_act_col, A_act_val,
+         b_act) = self.get_active_constraints_coo(active_ineq_row_indices,
+                                                  zeta_sol)
+        num_r = len(self.r)
+        size = num_r + len(b_act)
+        # Assemble the KKT matrix in the COO format. We only keep the non-zero
+        # entries of Qᵣ, unless Qᵣ requires gradient, in which case all its
+        # entries are kept so that the gradient w.r.t every entry of Qᵣ is
+        # computed.
+        if self.Q_r.requires_grad:
+            Q_row, Q_col = np.unravel_index(np.arange(num_r * num_r),
+                                            (num_r, num_r))
+        else:
+            Q_row, Q_col = np.nonzero(self.Q_r.detach().numpy())
+        Q_val = 2 * self.Q_r[torch.from_numpy(Q_row), torch.from_numpy(Q_col)]
+        diag = np.arange(size)
+        M_row = np.concatenate((Q_row, A_act_col, A_act_row + num_r, diag))
+        M_col = np.concatenate((Q_col, A_act_row + num_r, A_act_col, diag))
+        M_val = torch.cat((Q_val, A_act_val, A_act_val,
+                           torch.full((size, ), penalty, dtype=self.dtype)))
+        lu, rcond = factorize_sparse_matrix(M_row, M_col, M_val, size)
+        if lu is None:
+            raise Exception("compute_objective_from_mip_data: the KKT " +
+                            "matrix is singular, increase the penalty.")
+        primal_dual = SparseLinearSolve.apply(
+            M_val, torch.cat((-self.c_r, b_act), axis=0), M_row, M_col, lu)
         r = primal_dual[:len(self.r)]
         return r @ (self.Q_r @ r) + zeta_sol @ (self.Q_zeta @ zeta_sol) +\
             r @ (self.Q_rzeta @ zeta_sol) + self.c_r @ r +\
             self.c_zeta @ zeta_sol + self.c_constant
+
+
+def load_mip(filename):
+    """
+    Load the MIP saved by GurobiTorchMIP.save().
+    @param filename The name of the file.
+    @return (mip, variables) mip is a GurobiTorchMIP object (or of its
+    subclass, the same type as the saved MIP). variables is a dict mapping
+    a name to a list of gurobi variables in mip, refer to the argument
+    `variables` in GurobiTorchMIP.save().
+    """
+    try:
+        # The saved data contains python objects (the MIP class). The
+        # argument weights_only is added in torch 1.13, and defaults to True
+        # since torch 2.6.
+        data = torch.load(filename, weights_only=False)
+    except TypeError:
+        data = torch.load(filename)
+    mip = data["class"].__new__(data["class"])
+    mip.dtype = data["attributes"]["dtype"]
+    mip.backend = GurobiSolverBackend()
+    mip._gurobi_env = None
+    mip.solve_result = None
+    for name, val in data["attributes"].items():
+        if isinstance(val, tuple) and len(val) > 0 and\
+                val[0] is COOMatrixStorage:
+            storage = COOMatrixStorage(mip.dtype)
+            storage.append(val[1], val[2], val[3])
+            setattr(mip, name, storage)
+        elif isinstance(val, tuple) and len(val) > 0 and\
+                val[0] is BlockVectorStorage:
+            storage = BlockVectorStorage(mip.dtype)
+            storage.append(val[1])
+            setattr(mip, name, storage)
+        else:
+            setattr(mip, name, val)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mps_file = os.path.join(tmp_dir, "model.mps")
+        with open(mps_file, "wb") as f:
+            f.write(data["mps"])
+        mip.gurobi_model = gurobipy.read(mps_file)
+    all_variables = mip.gurobi_model.getVars()
+    if len(all_variables) > 0:
+        mip.gurobi_model.setAttr(gurobipy.GRB.Attr.Start, all_variables,
+                                 data["Start"])
+        mip.gurobi_model.setAttr(gurobipy.GRB.Attr.VarName, all_variables,
+                                 data["VarName"])
+    if len(data["ConstrName"]) > 0:
+        mip.gurobi_model.setAttr(gurobipy.GRB.Attr.ConstrName,
+                                 mip.gurobi_model.getConstrs(),
+                                 data["ConstrName"])
+    mip.gurobi_model.update()
+    mip._variables = all_variables
+    mip.r = [all_variables[i] for i in data["r"]]
+    mip.zeta = [all_variables[i] for i in data["zeta"]]
+    mip.r_indices = {v: i for i, v in enumerate(mip.r)}
+    mip.zeta_indices = {v: i for i, v in enumerate(mip.zeta)}
+    variables = {
+        key: [all_variables[i] for i in val]
+        for key, val in data["variables"].items()
+    }
+    return mip, variables
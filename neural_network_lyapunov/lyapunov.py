@@ -67,11 +67,15 @@ class LyapunovHybridLinearSystem:
                                         slack_name="relu_z",
                                         binary_var_name="relu_beta",
                                         *,
-                                        binary_var_type=gurobipy.GRB.BINARY):
+                                        binary_var_type=gurobipy.GRB.BINARY,
+                                        x_lo=None,
+                                        x_up=None):
         """
         This function is intended for internal usage only (but I expose it
         as a public function for unit test).
         Add the Lyapunov relu output as mixed-integer linear constraint.
+        @param x_lo, x_up The box of x. If set to None, then we use the box
+        of the system x_lo_all <= x <= x_up_all.
         @return (z, beta, a_out, b_out) z is the continuous slack variable.
         beta is the binary variable indicating whether a (leaky) ReLU unit is
         active or not. The output of the network can be written as
@@ -80,8 +84,8 @@ class LyapunovHybridLinearSystem:
         assert (isinstance(milp, gurobi_torch_mip.GurobiTorchMIP))
         assert (isinstance(x, list))
         mip_constr_return = self.lyapunov_relu_free_pattern.output_constraint(
-            torch.from_numpy(self.system.x_lo_all),
-            torch.from_numpy(self.system.x_up_all),
+            torch.from_numpy(self.system.x_lo_all) if x_lo is None else x_lo,
+            torch.from_numpy(self.system.x_up_all) if x_up is None else x_up,
             self.network_bound_propagate_method)
         relu_z, relu_beta = milp.add_mixed_integer_linear_constraints(
             mip_constr_return, x, None, slack_name, binary_var_name,
@@ -98,7 +102,9 @@ class LyapunovHybridLinearSystem:
                                       slack_name="s",
                                       binary_var_name="alpha",
                                       binary_var_type=gurobipy.GRB.BINARY,
-                                      binary_for_zero_input=False):
+                                      binary_for_zero_input=False,
+                                      x_lo=None,
+                                      x_up=None):
         """
         This function is intended for internal usage only (but I expose it
         as a public function for unit test).
@@ -118,11 +124,18 @@ class LyapunovHybridLinearSystem:
         alpha[i][0] + alpha[i][1] + alpha[i][2] = 1
         @param R A matrix. We want this matrix to have full column rank. If
         R=None, then we use identity as R.
+        @param x_lo, x_up The box of x. If set to None, then we use the box
+        of the system x_lo_all <= x <= x_up_all, which has to contain
+        x_equilibrium. A given box (for example a sub-box of the system box)
+        doesn't need to contain x_equilibrium.
         """
-        if not torch.all(torch.from_numpy(self.system.x_lo_all)
-                         <= x_equilibrium) or\
-            not torch.all(torch.from_numpy(self.system.x_up_all)
-                          >= x_equilibrium):
+        system_box = x_lo is None and x_up is None
+        if x_lo is None:
+            x_lo = torch.from_numpy(self.system.x_lo_all)
+        if x_up is None:
+            x_up = torch.from_numpy(self.system.x_up_all)
+        if system_box and (not torch.all(x_lo <= x_equilibrium)
+                           or not torch.all(x_up >= x_equilibrium)):
             raise Exception("add_state_error_l1_constraint: we currently " +
                             "require that x_lo <= x_equilibrium <= x_up")
         R = _get_R(R, self.system.x_dim, x_equilibrium.device)
@@ -130,9 +143,8 @@ class LyapunovHybridLinearSystem:
         assert (R.shape[0] >= R.shape[1])
         s_dim = R.shape[0]
         # The lower and upper bound of R*(x-x*)
-        Rx_lb, Rx_ub = mip_utils.compute_range_by_IA(
-            R, -R @ x_equilibrium, torch.from_numpy(self.system.x_lo_all),
-            torch.from_numpy(self.system.x_up_all))
+        Rx_lb, Rx_ub = mip_utils.compute_range_by_IA(R, -R @ x_equilibrium,
+                                                     x_lo, x_up)
         s = [None] * s_dim
         alpha = [None] * s_dim
         for i in range(s_dim):
@@ -226,7 +238,9 @@ class LyapunovHybridLinearSystem:
                                     V_epsilon,
                                     *,
                                     R,
-                                    x_warmstart=None):
+                                    x_warmstart=None,
+                                    x_lo=None,
+                                    x_up=None):
         """
         For a ReLU network, in order to determine if the function
         V(x) = ReLU(x) - ReLU(x*) + λ * |R * (x - x*)|₁
@@ -253,6 +267,9 @@ class LyapunovHybridLinearSystem:
         the previous iteration, we choose to recompute beta using the previous
         adversarial state `x` in the current neural network, so as to make
         sure that this initial guess of beta is always a feasible solution.
+        @param x_lo, x_up If set, then we only verify the condition within
+        the box x_lo <= x <= x_up (which should be inside the system box),
+        with the big-M coefficients computed from this box.
         @return (milp, x) milp is a GurobiTorchMILP instance, x is the decision
         variable for state.
         """
@@ -273,7 +290,7 @@ class LyapunovHybridLinearSystem:
         # z is the slack variable to write the output of ReLU network as mixed
         # integer constraints.
         z, beta, a_out, b_out, _ = self.add_lyap_relu_output_constraint(
-            milp, x)
+            milp, x, x_lo=x_lo, x_up=x_up)
 
         # warmstart the binary variables
         if x_warmstart is not None:
@@ -288,7 +305,9 @@ class LyapunovHybridLinearSystem:
                                                      x,
                                                      R=R,
                                                      slack_name="s",
-                                                     binary_var_name="gamma")
+                                                     binary_var_name="gamma",
+                                                     x_lo=x_lo,
+                                                     x_up=x_up)
 
         relu_at_equilibrium = self.lyapunov_relu.forward(x_equilibrium)
         # Now set the objective as -ϕ(x) + ϕ(x*) + (ε-λ)*|R(x−x*)|₁
@@ -504,6 +523,24 @@ class LyapunovHybridLinearSystem:
         dVdx = utils.minkowski_sum(dphidx, dl1dx)
         return dVdx
 
+    def _lyapunov_all_gradients_batch(self, x, x_equilibrium, V_lambda, R,
+                                      zero_tol):
+        """
+        Compute all the left and right gradients ∂V/∂x for a batch of states.
+        This is the batched version of _lyapunov_gradient(). The gradients at
+        x[i] are dVdx[offsets[i]:offsets[i+1]].
+        @return (dVdx, offsets) dVdx is of shape (num_gradients, x_dim),
+        offsets is of shape (x.shape[0]+1,).
+        """
+        assert (x.shape[1] == self.system.x_dim)
+        dphidx, phi_offsets = utils.relu_network_gradient_batch(
+            self.lyapunov_relu, x, zero_tol=zero_tol)
+        l1_grad, l1_offsets = utils.l1_gradient_batch(
+            (x - x_equilibrium) @ R.T, zero_tol=zero_tol)
+        dl1dx = V_lambda * l1_grad @ R
+        return utils.minkowski_sum_batch(dphidx.squeeze(1), phi_offsets,
+                                         dl1dx, l1_offsets)
+
     def _lyapunov_gradient_batch(self, x, x_equilibrium, V_lambda, R,
                                  create_graph):
         """
@@ -582,7 +619,9 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
                                     lyapunov_lower=None,
                                     lyapunov_upper=None,
                                     x_warmstart=None,
-                                    binary_var_type=gurobipy.GRB.BINARY):
+                                    binary_var_type=gurobipy.GRB.BINARY,
+                                    x_lo=None,
+                                    x_up=None):
         """
         We assume that the Lyapunov function
         V(x) = ReLU(x) - ReLU(x*) + λ|R*(x-x*)|₁, where x* is the equilibrium
@@ -624,6 +663,10 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
         the previous iteration, we choose to recompute beta using the previous
         adversarial state `x` in the current neural network, so as to make
         sure that this initial guess of beta is always a feasible solution.
+        @param x_lo, x_up If set, then we only verify the condition for x[n]
+        within the box x_lo <= x[n] <= x_up (which should be inside the system
+        box). The big-M coefficients of the dynamics and of V(x[n]) are
+        computed from this box, while x[n+1] still uses the system box.
         @return (milp, x, x_next, s, gamma, z, z_next, beta, beta_next)
         where milp is a GurobiTorchMILP object.
         The decision variables of the MILP are
@@ -654,8 +697,15 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
                          name="x")
 
         # x is the variable x[n]
+        system = self.system if x_lo is None and x_up is None else\
+            dynamic_system._restrict_system_box(
+                self.system,
+                torch.from_numpy(self.system.x_lo_all)
+                if x_lo is None else x_lo,
+                torch.from_numpy(self.system.x_up_all)
+                if x_up is None else x_up)
         system_constraint_return = dynamic_system._add_system_constraint(
-            self.system, milp, x, x_next, binary_var_type=binary_var_type)
+            system, milp, x, x_next, binary_var_type=binary_var_type)
         s = system_constraint_return.slack
         gamma = system_constraint_return.binary
         # warmstart the binary variables
@@ -675,7 +725,8 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
         # integer linear constraints.
         z, beta, a_out, b_out, lyap_relu_x_mip_cnstr_ret = \
             self.add_lyap_relu_output_constraint(
-                milp, x, binary_var_type=binary_var_type)
+                milp, x, binary_var_type=binary_var_type, x_lo=x_lo,
+                x_up=x_up)
 
         # warmstart the binary variables
         if x_warmstart is not None:
@@ -696,7 +747,9 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
             R=R,
             slack_name="|x[n]-x*|",
             binary_var_name="beta_x_norm",
-            binary_var_type=binary_var_type)
+            binary_var_type=binary_var_type,
+            x_lo=x_lo,
+            x_up=x_up)
         # Now add the mixed-integer linear constraint to represent
         # |R*(x[n+1] - x*)|₁. To do so, we introduce the slack variable
         # s_x_next_norm, beta_x_next_norm.
@@ -904,28 +957,116 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
             lyap_deriv_lp_return.milp.gurobi_model.optimize()
             assert (lyap_deriv_lp_return.milp.gurobi_model.status ==
                     gurobipy.GRB.Status.OPTIMAL)
-            # Step 4, strengthen each neural network:
-            # Strengthen the ReLU network in lyapunov function.
-            self.lyapunov_relu_free_pattern.strengthen_relu_mip_at_solution(
-                lyap_deriv_lp_return.milp, lyap_deriv_lp_return.x,
-                lyap_deriv_lp_return.z, lyap_deriv_lp_return.beta,
-                lyap_deriv_lp_return.lyap_relu_x_mip_cnstr_ret)
-            self.lyapunov_relu_free_pattern.strengthen_relu_mip_at_solution(
-                lyap_deriv_lp_return.milp, lyap_deriv_lp_return.x_next,
-                lyap_deriv_lp_return.z_next, lyap_deriv_lp_return.beta_next,
-                lyap_deriv_lp_return.lyap_relu_x_next_mip_cnstr_ret)
-            # Strengthen the ReLU network in dynamics constraint.
-            if (isinstance(self.system, feedback_system.FeedbackSystem)):
-                self.system.strengthen_dynamics_constraint(
-                    lyap_deriv_lp_return.milp, lyap_deriv_lp_return.
-                    system_constraint_return.forward_dynamics_return,
-                    lyap_deriv_lp_return.system_constraint_return.
-                    controller_mip_cnstr_return)
+            # Step 4, strengthen each neural network.
+            self._strengthen_lyapunov_derivative_at_solution(
+                lyap_deriv_lp_return.milp, lyap_deriv_lp_return)
 
         # Step 5 remove binary relaxation.
         lyap_deriv_lp_return.milp.remove_binary_relaxation()
         return lyap_deriv_lp_return
 
+    def _strengthen_lyapunov_derivative_at_solution(self, mip,
+                                                    lyap_deriv_milp_return):
+        """
+        Strengthen each neural network in the Lyapunov derivative MILP with
+        the most violated ideal constraint evaluated at the solution.
+        @param mip Either lyap_deriv_milp_return.milp (after it is solved), or
+        a gurobi_torch_mip.MIPNodeCutAdder.
+        """
+        # Strengthen the ReLU network in lyapunov function.
+        self.lyapunov_relu_free_pattern.strengthen_relu_mip_at_solution(
+            mip, lyap_deriv_milp_return.x, lyap_deriv_milp_return.z,
+            lyap_deriv_milp_return.beta,
+            lyap_deriv_milp_return.lyap_relu_x_mip_cnstr_ret)
+        self.lyapunov_relu_free_pattern.strengthen_relu_mip_at_solution(
+            mip, lyap_deriv_milp_return.x_next, lyap_deriv_milp_return.z_next,
+            lyap_deriv_milp_return.beta_next,
+            lyap_deriv_milp_return.lyap_relu_x_next_mip_cnstr_ret)
+        # Strengthen the ReLU network in dynamics constraint.
+        if (isinstance(self.system, feedback_system.FeedbackSystem)):
+            self.system.strengthen_dynamics_constraint(
+                mip, lyap_deriv_milp_return.system_constraint_return.
+                forward_dynamics_return,
+                lyap_deriv_milp_return.system_constraint_return.
+                controller_mip_cnstr_return)
+
+    def lyapunov_derivative_cut_callback(self,
+                                         lyap_deriv_milp_return,
+                                         mip=None,
+                                         *,
+                                         max_node_count=None,
+                                         max_cuts=None):
+        """
+        Instead of strengthening the LP relaxation before the MILP solve (as
+        in strengthen_lyapunov_derivative_as_milp()), returns a gurobi
+        callback that adds the most violated ideal constraints of each neural
+        network as user cuts, at the branch-and-bound nodes during the MILP
+        solve. Set the PreCrush parameter to 1 when solving with this
+        callback.
+        @param lyap_deriv_milp_return Returned from
+        lyapunov_derivative_as_milp() with binary variables.
+        @param mip The MIP being solved. If None, then it is
+        lyap_deriv_milp_return.milp. It can also be a MIP template updated
+        from lyap_deriv_milp_return.milp.
+        @param max_node_count, max_cuts Refer to
+        gurobi_torch_mip.get_node_cut_callback().
+        """
+        return gurobi_torch_mip.get_node_cut_callback(
+            lyap_deriv_milp_return.milp if mip is None else mip,
+            lambda node: self._strengthen_lyapunov_derivative_at_solution(
+                node, lyap_deriv_milp_return),
+            max_node_count=max_node_count,
+            max_cuts=max_cuts)
+
+    def lyapunov_derivative_milp_starts(self, lyap_deriv_milp_return,
+                                        x_starts: torch.Tensor):
+        """
+        Construct complete MIP starts of the MILP in
+        lyapunov_derivative_as_milp() from the states x_starts (for example
+        the counterexamples in the previous training iteration). Unlike
+        x_warmstart in lyapunov_derivative_as_milp(), which only initializes
+        the binary variables of the networks, here we assign all the
+        continuous and binary variables. We evaluate x[n+1] = f(x[n]) and the
+        Lyapunov network at x[n] and x[n+1] forward to get x[n+1], z, β,
+        z[n+1], β[n+1]. With these variables fixed, the remaining variables
+        (the slack and binary variables of the dynamics, of the controller and
+        of the l1 norms) are determined, and we complete them through
+        GurobiTorchMIP.complete_solution().
+        @param lyap_deriv_milp_return Returned from
+        lyapunov_derivative_as_milp().
+        @param x_starts A batch of states of shape (num_starts, x_dim).
+        @return starts A list of complete assignments of
+        lyap_deriv_milp_return.milp, to be loaded through
+        GurobiTorchMIP.set_mip_starts(). The states without a feasible
+        assignment (for example when x[n+1] is outside of the box) are
+        skipped.
+        """
+        assert (len(x_starts.shape) == 2
+                and x_starts.shape[1] == self.system.x_dim)
+        starts = []
+        with torch.no_grad():
+            x_next_starts = self.system.step_forward(x_starts)
+            for i in range(x_starts.shape[0]):
+                variables = lyap_deriv_milp_return.x +\
+                    lyap_deriv_milp_return.x_next
+                values = x_starts[i].tolist() + x_next_starts[i].tolist()
+                for (x_val, z, beta) in ((x_starts[i],
+                                          lyap_deriv_milp_return.z,
+                                          lyap_deriv_milp_return.beta),
+                                         (x_next_starts[i],
+                                          lyap_deriv_milp_return.z_next,
+                                          lyap_deriv_milp_return.beta_next)):
+                    z_val, beta_val, _ = self.lyapunov_relu_free_pattern.\
+                        compute_relu_unit_outputs_and_activation(x_val)
+                    variables = variables + z + beta
+                    values = values + z_val.squeeze(1).tolist() +\
+                        beta_val.squeeze(1).tolist()
+                start = lyap_deriv_milp_return.milp.complete_solution(
+                    variables, values)
+                if start is not None:
+                    starts.append(start)
+        return starts
+
     def lyapunov_derivative_loss_at_samples(self,
                                             V_lambda,
                                             epsilon,
@@ -1030,6 +1171,9 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
         every sample. Otherwise weight should be a vector of the same length
         as the number of samples, whereh weight[i] is the weight of
         state_samples[i].
+        @param reduction "mean", "max" or "4norm" of the per-sample losses.
+        If reduction="none", then return the per-sample losses
+        max(l(xⁱ) + margin, 0) as a vector.
         @return loss The loss
         mean(max(V(xⁱ[n+1]) - V(xⁱ[n]) + ε*V(xⁱ[n]) + margin, 0))
         """
@@ -1041,7 +1185,7 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
         assert (state_next.shape[1] == self.system.x_dim)
         assert (state_samples.shape[0] == state_next.shape[0])
         assert (isinstance(eps_type, ConvergenceEps))
-        assert (reduction in {"mean", "max", "4norm"})
+        assert (reduction in {"mean", "max", "4norm", "none"})
         R = _get_R(R, self.system.x_dim, state_samples.device)
         v1 = self.lyapunov_value(state_samples, x_equilibrium, V_lambda, R=R)
         v2 = self.lyapunov_value(state_next, x_equilibrium, V_lambda, R=R)
@@ -1074,6 +1218,8 @@ class LyapunovDiscreteTimeHybridSystem(LyapunovHybridLinearSystem):
             return torch.max(hinge_loss_all)
         elif reduction == "4norm":
             return torch.norm(hinge_loss_all, p=4)
+        elif reduction == "none":
+            return hinge_loss_all
 
     def compute_region_of_attraction(self, V_lambda, R, x_equilibrium,
                                      V_upper_bound, x_lo_larger, x_up_larger):
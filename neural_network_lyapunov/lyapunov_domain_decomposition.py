@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+
+import gurobipy
+import torch
+
+import neural_network_lyapunov.lyapunov as lyapunov
+import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
+import neural_network_lyapunov.mip_utils as mip_utils
+import neural_network_lyapunov.mip_cache as mip_cache
+
+# The outcome of verifying the condition on a single box.
+BOX_CERTIFIED = "certified"
+BOX_VIOLATED = "violated"
+BOX_TIMEOUT = "timeout"
+
+
+class DomainDecompositionResult:
+    """
+    The result of LyapunovDomainDecomposition.verify_positivity() and
+    LyapunovDomainDecomposition.verify_derivative().
+    """
+    def __init__(self):
+        # certified_boxes[i] = (x_lo, x_up), a box on which the condition is
+        # proved.
+        self.certified_boxes = []
+        # counterexamples[i] = (x, obj), a state x that violates the
+        # condition, with obj > tolerance being the MILP objective at x.
+        self.counterexamples = []
+        # unknown_boxes[i] = (x_lo, x_up), a box whose MILP still times out
+        # after max_depth refinements.
+        self.unknown_boxes = []
+        # The total number of boxes for which we solved an MILP.
+        self.num_milps = 0
+
+    @property
+    def verified(self):
+        """
+        The condition holds on the whole box when no counterexample is found
+        and every box is certified.
+        """
+        return len(self.counterexamples) == 0 and len(self.unknown_boxes) == 0
+
+
+def _solve_box(lyapunov_hybrid_system,
+               condition_kwargs: dict,
+               x_lo: torch.Tensor,
+               x_up: torch.Tensor,
+               time_limit,
+               tolerance: float,
+               lp_relaxation_first: bool,
+               mip_cache_dir: str = None):
+    """
+    Verify the Lyapunov condition on the box x_lo <= x <= x_up. This is a
+    module level function, so that it can be sent to the worker processes.
+    When condition_kwargs contains "eps_type", we verify the derivative
+    condition through lyapunov_derivative_as_milp(), otherwise we verify the
+    positivity condition through lyapunov_positivity_as_milp().
+    @param lp_relaxation_first If True, then we first solve the LP relaxation
+    (only for the derivative condition), and skip the MILP if the LP
+    relaxation already certifies the box.
+    @param mip_cache_dir If not None, the MILPs are loaded from (and saved
+    to) the mip_cache.MIPCache in this directory.
+    @return (status, obj, x) status is one of BOX_CERTIFIED, BOX_VIOLATED and
+    BOX_TIMEOUT. When status is BOX_VIOLATED, x is the counterexample and obj
+    is its objective, otherwise obj and x are None.
+    """
+    def build(binary_var_type):
+        def build_mip():
+            if "eps_type" in condition_kwargs:
+                milp_return = lyapunov_hybrid_system.\
+                    lyapunov_derivative_as_milp(
+                        **condition_kwargs,
+                        binary_var_type=binary_var_type,
+                        x_lo=x_lo,
+                        x_up=x_up)
+                return milp_return.milp, {"x": milp_return.x}
+            milp, x = lyapunov_hybrid_system.lyapunov_positivity_as_milp(
+                **condition_kwargs, x_lo=x_lo, x_up=x_up)
+            return milp, {"x": x}
+
+        if mip_cache_dir is None:
+            milp, variables = build_mip()
+        else:
+            key = mip_cache.compute_lyapunov_fingerprint(
+                lyapunov_hybrid_system, condition_kwargs, x_lo, x_up,
+                binary_var_type)
+            milp, variables = mip_cache.MIPCache(mip_cache_dir).get_or_build(
+                key, build_mip)
+        return milp, variables["x"]
+
+    if lp_relaxation_first and "eps_type" in condition_kwargs:
+        lp, _ = build(gurobi_torch_mip.BINARYRELAX)
+        lp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+        lp.gurobi_model.optimize()
+        if lp.gurobi_model.status == gurobipy.GRB.Status.INFEASIBLE or (
+                lp.gurobi_model.status == gurobipy.GRB.Status.OPTIMAL
+                and lp.gurobi_model.ObjVal <= tolerance):
+            return BOX_CERTIFIED, None, None
+    milp, x = build(gurobipy.GRB.BINARY)
+    milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+    if time_limit is not None:
+        milp.gurobi_model.setParam(gurobipy.GRB.Param.TimeLimit, time_limit)
+    milp.gurobi_model.optimize()
+    status = milp.gurobi_model.status
+    if status == gurobipy.GRB.Status.INFEASIBLE:
+        # x_lo <= x <= x_up doesn't intersect with the constraints (for
+        # example the sublevel set lyapunov_lower <= V(x) <= lyapunov_upper).
+        return BOX_CERTIFIED, None, None
+    if milp.gurobi_model.SolCount > 0 and milp.gurobi_model.ObjVal > tolerance:
+        return BOX_VIOLATED, milp.gurobi_model.ObjVal, torch.tensor(
+            [v.x for v in x], dtype=lyapunov_hybrid_system.system.dtype)
+    if status == gurobipy.GRB.Status.OPTIMAL or \
+            milp.gurobi_model.ObjBound <= tolerance:
+        return BOX_CERTIFIED, None, None
+    return BOX_TIMEOUT, None, None
+
+
+class LyapunovDomainDecomposition:
+    """
+    Verify the Lyapunov conditions by recursively splitting the state box
+    x_lo_all <= x <= x_up_all into sub-boxes, instead of solving one MILP on
+    the whole box. On each sub-box
+    1. We first try to certify the box through the interval bounds of V(x).
+    2. Otherwise we solve the MILP restricted to this box, whose big-M
+       coefficients are computed from the (smaller) box. The MILPs of the
+       boxes are solved in parallel worker processes.
+    3. If the MILP hits the time limit without certifying or falsifying the
+       condition, we bisect the box along its longest edge (relative to the
+       system box), and verify the two halves.
+    """
+    def __init__(self,
+                 lyapunov_hybrid_system: lyapunov.LyapunovHybridLinearSystem,
+                 *,
+                 num_workers: int = 1,
+                 box_time_limit: float = None,
+                 max_depth: int = 10,
+                 tolerance: float = 0.,
+                 lp_relaxation_first: bool = True,
+                 mip_cache_dir: str = None):
+        """
+        @param num_workers The number of processes to solve the box MILPs.
+        When num_workers > 1, lyapunov_hybrid_system has to be picklable.
+        @param box_time_limit The time limit (in seconds) of each box MILP.
+        None means no time limit.
+        @param max_depth A box is not bisected more than max_depth times.
+        @param tolerance The condition holds on a box if the maximal MILP
+        objective is no larger than tolerance.
+        @param lp_relaxation_first Solve the LP relaxation before the MILP for
+        the derivative condition.
+        @param mip_cache_dir If not None, the box MILPs are stored in a
+        mip_cache.MIPCache in this directory, so that verifying the same
+        network again (for example with a different tolerance or time limit)
+        loads the MILPs instead of constructing them.
+        """
+        assert (isinstance(lyapunov_hybrid_system,
+                           lyapunov.LyapunovHybridLinearSystem))
+        assert (num_workers >= 1)
+        assert (max_depth >= 0)
+        self.lyapunov_hybrid_system = lyapunov_hybrid_system
+        self.num_workers = num_workers
+        self.box_time_limit = box_time_limit
+        self.max_depth = max_depth
+        self.tolerance = tolerance
+        self.lp_relaxation_first = lp_relaxation_first
+        self.mip_cache_dir = mip_cache_dir
+
+    def _lyapunov_bounds(self, x_lo, x_up, x_equilibrium, R):
+        """
+        Compute the bounds on ϕ(x) − ϕ(x*) and |R(x−x*)|₁ over a batch of
+        boxes through interval arithmetics.
+        @param x_lo, x_up Of shape (num_boxes, x_dim).
+        @return (phi_lo, phi_up, l1_lo, l1_up) Each of shape (num_boxes,).
+        """
+        relu = self.lyapunov_hybrid_system.lyapunov_relu
+        layer_lo, layer_up = mip_utils.propagate_bounds_IA(relu, x_lo, x_up)
+        phi_equilibrium = relu(x_equilibrium)
+        R_pos = torch.clamp(R, min=0)
+        R_neg = torch.clamp(R, max=0)
+        Rx_lo = (x_lo - x_equilibrium) @ R_pos.T +\
+            (x_up - x_equilibrium) @ R_neg.T
+        Rx_up = (x_up - x_equilibrium) @ R_pos.T +\
+            (x_lo - x_equilibrium) @ R_neg.T
+        abs_lo = torch.clamp(Rx_lo, min=0) + torch.clamp(-Rx_up, min=0)
+        abs_up = torch.maximum(torch.abs(Rx_lo), torch.abs(Rx_up))
+        return (layer_lo[-1] - phi_equilibrium).squeeze(1), (
+            layer_up[-1] - phi_equilibrium).squeeze(1), torch.sum(
+                abs_lo, dim=1), torch.sum(abs_up, dim=1)
+
+    def _bisect(self, x_lo, x_up):
+        """
+        Split the box into two halves along its longest edge, relative to the
+        system box. The dimensions in which the system box has zero width
+        are not split.
+        """
+        system = self.lyapunov_hybrid_system.system
+        system_width = torch.from_numpy(system.x_up_all - system.x_lo_all)
+        splittable = system_width > 0
+        assert (torch.any(splittable))
+        relative_width = torch.zeros_like(system_width)
+        relative_width[splittable] = (x_up - x_lo)[splittable] / system_width[
+            splittable]
+        dim = torch.argmax(relative_width).item()
+        x_mid = (x_lo[dim] + x_up[dim]) / 2
+        x_up_left = x_up.clone()
+        x_up_left[dim] = x_mid
+        x_lo_right = x_lo.clone()
+        x_lo_right[dim] = x_mid
+        return [(x_lo, x_up_left), (x_lo_right, x_up)]
+
+    def _verify(self, condition_kwargs: dict, certify_by_bounds):
+        """
+        @param certify_by_bounds A function that takes a batch of boxes
+        (x_lo, x_up) of shape (num_boxes, x_dim), and returns a boolean tensor
+        of shape (num_boxes,), which is True if the box is certified by the
+        interval bounds alone.
+        """
+        result = DomainDecompositionResult()
+        system = self.lyapunov_hybrid_system.system
+        boxes = [(torch.from_numpy(system.x_lo_all),
+                  torch.from_numpy(system.x_up_all))]
+        # Gurobi environments cannot be shared with a forked child process, so
+        # we spawn the workers.
+        pool = multiprocessing.get_context("spawn").Pool(
+            self.num_workers) if self.num_workers > 1 else None
+        try:
+            for depth in range(self.max_depth + 1):
+                if len(boxes) == 0:
+                    break
+                with torch.no_grad():
+                    certified = certify_by_bounds(
+                        torch.stack([box[0] for box in boxes]),
+                        torch.stack([box[1] for box in boxes]))
+                unresolved = []
+                for box, box_certified in zip(boxes, certified.tolist()):
+                    if box_certified:
+                        result.certified_boxes.append(box)
+                    else:
+                        unresolved.append(box)
+                args = [(self.lyapunov_hybrid_system, condition_kwargs,
+                         box[0], box[1], self.box_time_limit, self.tolerance,
+                         self.lp_relaxation_first, self.mip_cache_dir)
+                        for box in unresolved]
+                box_results = pool.starmap(_solve_box, args) if pool is not\
+                    None else [_solve_box(*arg) for arg in args]
+                result.num_milps += len(unresolved)
+                boxes = []
+                for box, (status, obj, x) in zip(unresolved, box_results):
+                    if status == BOX_CERTIFIED:
+                        result.certified_boxes.append(box)
+                    elif status == BOX_VIOLATED:
+                        result.counterexamples.append((x, obj))
+                    elif depth < self.max_depth:
+                        boxes.extend(self._bisect(*box))
+                    else:
+                        result.unknown_boxes.append(box)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return result
+
+    def verify_positivity(self, x_equilibrium: torch.Tensor, V_lambda: float,
+                          V_epsilon: float, *,
+                          R) -> DomainDecompositionResult:
+        """
+        Verify V(x) ≥ ε |R*(x - x*)|₁ on the system box, namely the maximal
+        objective of lyapunov_positivity_as_milp() is no larger than the
+        tolerance on every sub-box.
+        """
+        R = lyapunov._get_R(R, self.lyapunov_hybrid_system.system.x_dim,
+                            x_equilibrium.device)
+
+        def certify_by_bounds(x_lo, x_up):
+            phi_lo, _, l1_lo, l1_up = self._lyapunov_bounds(
+                x_lo, x_up, x_equilibrium, R)
+            # The objective is −ϕ(x) + ϕ(x*) + (ε−λ)|R(x−x*)|₁
+            l1_coeff = V_epsilon - V_lambda
+            obj_up = -phi_lo + (l1_coeff * l1_up
+                                if l1_coeff > 0 else l1_coeff * l1_lo)
+            return obj_up <= self.tolerance
+
+        return self._verify(
+            dict(x_equilibrium=x_equilibrium,
+                 V_lambda=V_lambda,
+                 V_epsilon=V_epsilon,
+                 R=R), certify_by_bounds)
+
+    def verify_derivative(self,
+                          x_equilibrium: torch.Tensor,
+                          V_lambda: float,
+                          epsilon: float,
+                          eps_type: lyapunov.ConvergenceEps,
+                          *,
+                          R,
+                          lyapunov_lower: float = None,
+                          lyapunov_upper: float = None
+                          ) -> DomainDecompositionResult:
+        """
+        Verify the derivative condition of lyapunov_derivative_as_milp() on
+        the system box, namely the maximal objective of
+        lyapunov_derivative_as_milp() is no larger than the tolerance on every
+        sub-box. A box is certified by bounds if it doesn't intersect with the
+        set lyapunov_lower <= V(x) <= lyapunov_upper. Only the discrete time
+        system is supported.
+        """
+        assert (isinstance(self.lyapunov_hybrid_system,
+                           lyapunov.LyapunovDiscreteTimeHybridSystem))
+        R = lyapunov._get_R(R, self.lyapunov_hybrid_system.system.x_dim,
+                            x_equilibrium.device)
+
+        def certify_by_bounds(x_lo, x_up):
+            phi_lo, phi_up, l1_lo, l1_up = self._lyapunov_bounds(
+                x_lo, x_up, x_equilibrium, R)
+            certified = torch.zeros((x_lo.shape[0], ), dtype=torch.bool)
+            if lyapunov_lower is not None:
+                certified = torch.logical_or(
+                    certified, phi_up + V_lambda * l1_up < lyapunov_lower)
+            if lyapunov_upper is not None:
+                certified = torch.logical_or(
+                    certified, phi_lo + V_lambda * l1_lo > lyapunov_upper)
+            return certified
+
+        return self._verify(
+            dict(x_equilibrium=x_equilibrium,
+                 V_lambda=V_lambda,
+                 epsilon=epsilon,
+                 eps_type=eps_type,
+                 R=R,
+                 lyapunov_lower=lyapunov_lower,
+                 lyapunov_upper=lyapunov_upper), certify_by_bounds)
@@ -0,0 +1,189 @@
+"""
+Cache the GurobiTorchMIP on the disk. When we verify the same network many
+times (for example computing the region of attraction, or sweeping through
+different epsilon), we can load the MIP constructed previously instead of
+running the ReLU encoding again.
+The saved MIP is looked up by a fingerprint, which is a hash of everything
+that determines the MIP, such as the network parameters, the bounds on the
+state and the options in formulating the MIP.
+"""
+import enum
+import hashlib
+import os
+import tempfile
+
+import torch
+import numpy as np
+
+import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
+
+
+def _update_hash(h, item):
+    if item is None or isinstance(
+            item, (bool, int, float, str, enum.Enum, torch.dtype)):
+        h.update((type(item).__name__ + ":" + repr(item) + ";").encode())
+    elif isinstance(item, torch.nn.Module):
+        # The string representation includes the architecture (layer sizes,
+        # activation functions), and the state dict includes the parameters.
+        h.update(("module:" + str(item) + ";").encode())
+        _update_hash(h, item.state_dict())
+    elif isinstance(item, torch.Tensor):
+        _update_hash(h, item.detach().cpu().numpy())
+    elif isinstance(item, np.ndarray):
+        h.update(("array:" + str(item.dtype) + str(item.shape) +
+                  ";").encode())
+        h.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, dict):
+        h.update(("dict:" + str(len(item)) + ";").encode())
+        for key in sorted(item.keys(), key=repr):
+            _update_hash(h, key)
+            _update_hash(h, item[key])
+    elif isinstance(item, (list, tuple)):
+        h.update((type(item).__name__ + ":" + str(len(item)) + ";").encode())
+        for val in item:
+            _update_hash(h, val)
+    else:
+        raise Exception("compute_fingerprint(): unsupported type " +
+                        str(type(item)))
+
+
+def compute_fingerprint(*items) -> str:
+    """
+    Compute a hash of the items that determine an MIP.
+    @param items Each item can be a network (torch.nn.Module), a torch tensor,
+    a numpy array, a number, a string, an enum, None, or a list/tuple/dict of
+    these types. For a network we hash both its architecture and its
+    parameters.
+    @return fingerprint A hex string.
+    """
+    h = hashlib.sha256()
+    _update_hash(h, items)
+    return h.hexdigest()
+
+
+def _is_supported(item):
+    """
+    Return True if compute_fingerprint() supports @p item.
+    """
+    if item is None or isinstance(
+            item, (bool, int, float, str, enum.Enum, torch.dtype,
+                   torch.nn.Module, torch.Tensor, np.ndarray)):
+        return True
+    if isinstance(item, dict):
+        return all(
+            _is_supported(key) and _is_supported(val)
+            for key, val in item.items())
+    if isinstance(item, (list, tuple)):
+        return all(_is_supported(val) for val in item)
+    return False
+
+
+# The attributes that don't determine the constructed MIPs. bound_cache
+# (ReLUFreePattern.bound_cache) holds the bounds of the previous calls.
+_EXCLUDED_ATTRIBUTES = ("bound_cache", )
+
+
+def _formulation_items(obj, visited):
+    """
+    Collect the attributes of @p obj that determine the MIPs it constructs,
+    as a dict. The objects of this package referred to by @p obj (such as the
+    system of a LyapunovHybridLinearSystem, or a ReLUFreePattern) are
+    collected recursively.
+    """
+    items = {}
+    if id(obj) in visited:
+        return items
+    visited.add(id(obj))
+    for name, val in vars(obj).items():
+        if name.startswith("_") or name in _EXCLUDED_ATTRIBUTES:
+            continue
+        if _is_supported(val):
+            items[name] = val
+        elif type(val).__module__.startswith(__package__ + ".") and\
+                hasattr(val, "__dict__"):
+            items[name] = _formulation_items(val, visited)
+    return items
+
+
+def compute_lyapunov_fingerprint(lyapunov_hybrid_system, *items) -> str:
+    """
+    Compute the fingerprint of an MIP constructed by a
+    LyapunovHybridLinearSystem, for example
+    compute_lyapunov_fingerprint(lyapunov_hybrid_system, "derivative",
+    x_equilibrium, V_lambda, epsilon, eps_type, R).
+    Besides @p items (the arguments of the MIP), we hash the attributes of
+    @p lyapunov_hybrid_system and of its system, which include the networks
+    (both the architecture and the state dict), the state/control boxes and
+    the options in formulating the MIP (such as the bound propagation
+    methods). The attributes that compute_fingerprint() doesn't support (for
+    example functions) and the private attributes are not hashed, include
+    them in @p items if they change the MIP.
+    """
+    return compute_fingerprint(
+        type(lyapunov_hybrid_system).__name__,
+        _formulation_items(lyapunov_hybrid_system, set()), items)
+
+
+class MIPCache:
+    """
+    Stores the MIPs in a directory, one file for each fingerprint. Usage
+
+    cache = MIPCache(directory)
+    key = compute_fingerprint(lyapunov_relu, x_lo, x_up, V_lambda, ...)
+    mip, variables = cache.get_or_build(key, build_mip)
+
+    where build_mip() constructs the MIP and returns (mip, variables),
+    variables is a dict mapping a name to a list of gurobi variables in mip.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".mip")
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self.filename(key))
+
+    def save(self, key: str, mip, variables=None):
+        """
+        Save the MIP with the fingerprint @p key. We first write to a
+        temporary file and then rename it, so that another job reading the
+        cache never sees a partially written file.
+        """
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory,
+                                            suffix=".tmp")
+        os.close(fd)
+        try:
+            mip.save(tmp_filename, variables)
+            os.replace(tmp_filename, self.filename(key))
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def load(self, key: str):
+        """
+        @return (mip, variables) The MIP with the fingerprint @p key, refer to
+        gurobi_torch_mip.load_mip(). Return None if the MIP is not in the
+        cache.
+        """
+        if not self.contains(key):
+            return None
+        return gurobi_torch_mip.load_mip(self.filename(key))
+
+    def get_or_build(self, key: str, build_mip):
+        """
+        Load the MIP with the fingerprint @p key if it is in the cache.
+        Otherwise construct the MIP by calling build_mip(), and save it in
+        the cache.
+        Note that the loaded MIP doesn't carry the gradient w.r.t the network
+        parameters, use it for verification, not for training.
+        @param build_mip A function that returns (mip, variables).
+        @return (mip, variables)
+        """
+        loaded = self.load(key)
+        if loaded is not None:
+            return loaded
+        mip, variables = build_mip()
+        self.save(key, mip, variables)
+        return mip, variables
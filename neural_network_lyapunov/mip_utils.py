@@ -86,6 +86,55 @@ def find_index_set_to_strengthen(w: torch.Tensor, lo: torch.Tensor,
     return indices
 
 
+def strengthen_relu_mip_batch(c: float, W: torch.Tensor, b: torch.Tensor,
+                              lo: torch.Tensor, up: torch.Tensor,
+                              xhat: torch.Tensor, beta_hat: torch.Tensor):
+    """
+    The batched version of find_index_set_to_strengthen() followed by
+    strengthen_relu_mip_w_indices(), for all the units in a layer
+    y = max(c*(Wx+b), Wx+b), lo <= x <= up
+    and for a batch of points (x̂, β̂). For the j'th unit and the k'th point,
+    the index set ℑ is computed from find_index_set_to_strengthen(W[j], lo,
+    up, xhat[k], beta_hat[k, j]), and the constraint is
+    y[j] <= x_coeff[k, j] * x + binary_coeff[k, j] * β[j] + constant[k, j]
+    @param c The negative slope of the leaky relu unit.
+    @param W The weight of the linear layer, of shape (num_units, nx).
+    @param b The bias of the linear layer, of shape (num_units,).
+    @param lo The lower bound of x, of shape (nx,).
+    @param up The upper bound of x, of shape (nx,).
+    @param xhat The linear layer inputs, of shape (batch_size, nx).
+    @param beta_hat The activations, of shape (batch_size, num_units).
+    @return (x_coeff, binary_coeff, constant) x_coeff has shape
+    (batch_size, num_units, nx), binary_coeff and constant have shape
+    (batch_size, num_units).
+    """
+    assert (isinstance(c, float))
+    assert (c >= 0 and c < 1)
+    assert (len(W.shape) == 2)
+    assert (b.shape == (W.shape[0], ))
+    assert (lo.shape == (W.shape[1], ))
+    assert (up.shape == lo.shape)
+    assert (len(xhat.shape) == 2 and xhat.shape[1] == W.shape[1])
+    assert (beta_hat.shape == (xhat.shape[0], W.shape[0]))
+    w_positive = W >= 0
+    # L̅ᵢ and U̅ᵢ, of shape (num_units, nx).
+    lo_bar = torch.where(w_positive, lo, up)
+    up_bar = torch.where(w_positive, up, lo)
+    # The index set ℑ, of shape (batch_size, num_units, nx).
+    beta = beta_hat.unsqueeze(-1)
+    x = xhat.unsqueeze(1)
+    in_indices = torch.where(w_positive,
+                             x <= (1 - beta) * lo_bar + beta * up_bar,
+                             x > (1 - beta) * lo_bar + beta * up_bar)
+    x_coeff = torch.where(in_indices, W, c * W)
+    constant = b * c - (1 - c) * torch.sum(
+        torch.where(in_indices, W * lo_bar, torch.zeros_like(x_coeff)),
+        dim=-1)
+    binary_coeff = b * (1 - c) + (1 - c) * torch.sum(
+        torch.where(in_indices, W * lo_bar, W * up_bar), dim=-1)
+    return x_coeff, binary_coeff, constant
+
+
 def strengthen_relu_mip_given_pts(c: float, w: torch.Tensor, b: torch.Tensor,
                                   lo: torch.Tensor, up: torch.Tensor,
                                   linear_inputs: list, relu_outputs: list,
@@ -417,6 +466,13 @@ def compute_range_by_IA(
     Given x_lb <= x <= x_ub, compute the bounds on A * x + b by interval
     arithmetics (IA). Notice that this allows the computed bounds to be
     differentiable w.r.t the input bounds x_lb, x_ub and parameter A, b.
+    We split A = A⁺ + A⁻ into its positive and non-positive entries, then the
+    lower bound is A⁺ * x_lb + A⁻ * x_ub + b, and the upper bound is
+    A⁺ * x_ub + A⁻ * x_lb + b.
+    @param x_lb, x_ub Either of shape (x_dim,) for a single box, or of shape
+    (batch_size, x_dim) for a batch of boxes.
+    @return (output_lb, output_ub) Of shape (output_dim,) or
+    (batch_size, output_dim).
     """
     assert (isinstance(A, torch.Tensor))
     assert (isinstance(b, torch.Tensor))
@@ -425,18 +481,36 @@ def compute_range_by_IA(
     assert (b.shape == (output_dim, ))
     assert (isinstance(x_lb, torch.Tensor))
     assert (isinstance(x_ub, torch.Tensor))
-    assert (x_lb.shape == (x_dim, ))
-    assert (x_ub.shape == (x_dim, ))
-    output_lb = torch.empty(b.shape, dtype=b.dtype)
-    output_ub = torch.empty(b.shape, dtype=b.dtype)
-
-    for i in range(output_dim):
-        mask1 = torch.where(A[i] > 0)[0]
-        mask2 = torch.where(A[i] <= 0)[0]
-        output_lb[i] = A[i][mask1] @ x_lb[mask1] + A[i][mask2] @ x_ub[mask2]\
-            + b[i]
-        output_ub[i] = A[i][mask1] @ x_ub[mask1] + A[i][mask2] @ x_lb[mask2]\
-            + b[i]
+    assert (len(x_lb.shape) in (1, 2))
+    assert (x_lb.shape[-1] == x_dim)
+    assert (x_ub.shape == x_lb.shape)
+    if torch.any(torch.isinf(x_lb)) or torch.any(torch.isinf(x_ub)):
+        # The zero entries in A⁺ or A⁻ would multiply with the infinite bounds.
+        # Only use the entries in the right sign for each row.
+        if len(x_lb.shape) == 2:
+            bounds = [
+                compute_range_by_IA(A, b, x_lb[i], x_ub[i])
+                for i in range(x_lb.shape[0])
+            ]
+            return torch.stack([bnd[0] for bnd in bounds]), torch.stack(
+                [bnd[1] for bnd in bounds])
+        output_lb = torch.empty(b.shape, dtype=b.dtype)
+        output_ub = torch.empty(b.shape, dtype=b.dtype)
+        for i in range(output_dim):
+            mask1 = torch.where(A[i] > 0)[0]
+            mask2 = torch.where(A[i] <= 0)[0]
+            output_lb[i] = A[i][mask1] @ x_lb[mask1] +\
+                A[i][mask2] @ x_ub[mask2] + b[i]
+            output_ub[i] = A[i][mask1] @ x_ub[mask1] +\
+                A[i][mask2] @ x_lb[mask2] + b[i]
+        return output_lb, output_ub
+    # Use torch.where (instead of clamp) such that the gradient w.r.t a zero
+    # entry in A only flows through A⁻.
+    positive = A > 0
+    A_pos = torch.where(positive, A, torch.zeros_like(A))
+    A_neg = torch.where(positive, torch.zeros_like(A), A)
+    output_lb = x_lb @ A_pos.T + x_ub @ A_neg.T + b
+    output_ub = x_ub @ A_pos.T + x_lb @ A_neg.T + b
     return output_lb, output_ub
 
 
@@ -449,6 +523,11 @@ class PropagateBoundsMethod(enum.Enum):
     # be active). Note that by computing the bounds using MIP we lose the
     # gradient of these bounds.
     IA_MIP = 4
+    # Linear relaxation based bound propagation (CROWN/DeepPoly). Each ReLU
+    # unit is bounded by two linear functions of its input, and we
+    # back-substitute these linear bounds to the network input. The bounds are
+    # tighter than IA, and still differentiable w.r.t the network parameters.
+    CROWN = 5
 
 
 def binary_var_type_per_method(method: PropagateBoundsMethod):
@@ -470,6 +549,8 @@ def binary_var_type_per_method(method: PropagateBoundsMethod):
 def propagate_bounds(layer, input_lo, input_up):
     """
     Given the bound of the layer's input, find the bound of the output.
+    @param input_lo, input_up Either of shape (input_dim,) for a single box,
+    or of shape (batch_size, input_dim) for a batch of boxes.
     """
     assert (isinstance(input_lo, torch.Tensor))
     assert (isinstance(input_up, torch.Tensor))
@@ -496,3 +577,178 @@ def propagate_bounds(layer, input_lo, input_up):
     else:
         raise Exception("progagate_bounds(): unknown layer type.")
     return output_lo, output_up
+
+
+def propagate_bounds_IA(network: torch.nn.Sequential, input_lo: torch.Tensor,
+                        input_up: torch.Tensor):
+    """
+    Propagate the bounds through all the layers of a network (with Linear,
+    ReLU and LeakyReLU layers) by interval arithmetics. The bounds are
+    differentiable w.r.t the network parameters and the input bounds.
+    @param network A torch.nn.Sequential object.
+    @param input_lo, input_up The bounds on the network input. Either of
+    shape (x_dim,) for a single box, or of shape (batch_size, x_dim) for a
+    batch of boxes. All the boxes are propagated together.
+    @return (layer_lo, layer_up) Two lists of length len(network).
+    layer_lo[i], layer_up[i] are the bounds on the output of network[i], with
+    the same batch dimension as @p input_lo. Hence layer_lo[-1] and
+    layer_up[-1] are the bounds on the network output.
+    """
+    assert (isinstance(network, torch.nn.Sequential))
+    assert (input_lo.shape == input_up.shape)
+    layer_lo = []
+    layer_up = []
+    lo = input_lo
+    up = input_up
+    for layer in network:
+        lo, up = propagate_bounds(layer, lo, up)
+        layer_lo.append(lo)
+        layer_up.append(up)
+    return layer_lo, layer_up
+
+
+def _activation_linear_relaxation(layer, input_lo, input_up):
+    """
+    Bound the output of a (leaky) ReLU unit y = σ(z) with input
+    input_lo <= z <= input_up by two linear functions
+    lower_slope * z + lower_intercept <= y <= upper_slope * z + upper_intercept
+    When the unit is always active or always inactive, both linear functions
+    are exact. Otherwise the upper bound is the chord connecting
+    (input_lo, σ(input_lo)) and (input_up, σ(input_up)), and the lower bound
+    passes through the origin, with slope 1 if input_up >= -input_lo, or
+    slope c otherwise (c being the negative slope of the leaky ReLU).
+    @return (lower_slope, lower_intercept, upper_slope, upper_intercept) Each
+    has the same shape as input_lo.
+    """
+    if isinstance(layer, torch.nn.ReLU):
+        c = 0.
+    elif isinstance(layer, torch.nn.LeakyReLU):
+        c = layer.negative_slope
+    else:
+        raise Exception("_activation_linear_relaxation(): unknown layer type.")
+    if c > 1:
+        raise Exception("_activation_linear_relaxation(): the activation " +
+                        "function is concave when negative_slope > 1.")
+    active = input_lo >= 0
+    inactive = input_up <= 0
+    unstable = torch.logical_not(torch.logical_or(active, inactive))
+    ones = torch.ones_like(input_lo)
+    zeros = torch.zeros_like(input_lo)
+    chord_slope = (input_up - c * input_lo) / torch.where(
+        unstable, input_up - input_lo, ones)
+    upper_slope = torch.where(active, ones,
+                              torch.where(inactive, c * ones, chord_slope))
+    upper_intercept = torch.where(unstable, input_lo * (c - chord_slope),
+                                  zeros)
+    lower_slope = torch.where(
+        torch.logical_or(active,
+                         torch.logical_and(unstable, input_up >= -input_lo)),
+        ones, c * ones)
+    return lower_slope, zeros, upper_slope, upper_intercept
+
+
+def _back_substitute_linear_bounds(network, layer_index, relaxations,
+                                   input_lo, input_up):
+    """
+    Compute the bounds on the output of the linear layer
+    network[layer_index], by back-substituting the linear relaxation of each
+    activation layer to the network input.
+    @param relaxations A dict mapping the index of an activation layer to its
+    linear relaxation, returned from _activation_linear_relaxation().
+    @param input_lo, input_up The bounds on the network input, of shape
+    (batch_size, x_dim).
+    @return (output_lo, output_up) of shape (batch_size, out_features).
+    """
+    layer = network[layer_index]
+    batch_size = input_lo.shape[0]
+    # The output of network[layer_index] is bounded by
+    # Λ_lo * h + c_lo <= output <= Λ_up * h + c_up, where h is the input of
+    # the layer we have back-substituted to.
+    Lambda_lo = layer.weight.expand(batch_size, -1, -1)
+    Lambda_up = Lambda_lo
+    c_lo = torch.zeros((batch_size, layer.out_features), dtype=input_lo.dtype)
+    if layer.bias is not None:
+        c_lo = c_lo + layer.bias
+    c_up = c_lo
+    for j in range(layer_index - 1, -1, -1):
+        if isinstance(network[j], torch.nn.Linear):
+            if network[j].bias is not None:
+                c_lo = c_lo + Lambda_lo @ network[j].bias
+                c_up = c_up + Lambda_up @ network[j].bias
+            Lambda_lo = Lambda_lo @ network[j].weight
+            Lambda_up = Lambda_up @ network[j].weight
+        else:
+            lower_slope, lower_intercept, upper_slope, upper_intercept = \
+                [val.unsqueeze(1) for val in relaxations[j]]
+            # For the lower bound, a positive entry in Λ_lo picks the lower
+            # linear relaxation of the activation, and a negative entry picks
+            # the upper one. Vice versa for the upper bound.
+            Lambda_lo_pos = torch.clamp(Lambda_lo, min=0.)
+            Lambda_lo_neg = torch.clamp(Lambda_lo, max=0.)
+            Lambda_up_pos = torch.clamp(Lambda_up, min=0.)
+            Lambda_up_neg = torch.clamp(Lambda_up, max=0.)
+            c_lo = c_lo + torch.sum(
+                Lambda_lo_pos * lower_intercept +
+                Lambda_lo_neg * upper_intercept, dim=-1)
+            c_up = c_up + torch.sum(
+                Lambda_up_pos * upper_intercept +
+                Lambda_up_neg * lower_intercept, dim=-1)
+            Lambda_lo = Lambda_lo_pos * lower_slope +\
+                Lambda_lo_neg * upper_slope
+            Lambda_up = Lambda_up_pos * upper_slope +\
+                Lambda_up_neg * lower_slope
+    # Finally bound the linear function of the network input over the box.
+    output_lo = c_lo + (
+        torch.clamp(Lambda_lo, min=0.) @ input_lo.unsqueeze(-1) +
+        torch.clamp(Lambda_lo, max=0.) @ input_up.unsqueeze(-1)).squeeze(-1)
+    output_up = c_up + (
+        torch.clamp(Lambda_up, min=0.) @ input_up.unsqueeze(-1) +
+        torch.clamp(Lambda_up, max=0.) @ input_lo.unsqueeze(-1)).squeeze(-1)
+    return output_lo, output_up
+
+
+def propagate_bounds_CROWN(network: torch.nn.Sequential,
+                           input_lo: torch.Tensor, input_up: torch.Tensor):
+    """
+    Propagate the bounds through all the layers of a network (with Linear,
+    ReLU and LeakyReLU layers) by linear relaxation (CROWN/DeepPoly). For
+    every linear layer, we bound its output by back-substituting the linear
+    relaxations of the preceding activation layers to the network input. We
+    also intersect these bounds with the bounds from interval arithmetics, so
+    the bounds are never looser than propagate_bounds_IA(). The bounds are
+    differentiable w.r.t the network parameters and the input bounds.
+    @param network A torch.nn.Sequential object.
+    @param input_lo, input_up The bounds on the network input. Either of
+    shape (x_dim,) for a single box, or of shape (batch_size, x_dim) for a
+    batch of boxes. The bounds have to be finite.
+    @return (layer_lo, layer_up) Same as propagate_bounds_IA(). layer_lo[i],
+    layer_up[i] are the bounds on the output of network[i].
+    """
+    assert (isinstance(network, torch.nn.Sequential))
+    assert (input_lo.shape == input_up.shape)
+    assert (torch.all(torch.isfinite(input_lo)))
+    assert (torch.all(torch.isfinite(input_up)))
+    batched = len(input_lo.shape) == 2
+    x_lo = input_lo if batched else input_lo.unsqueeze(0)
+    x_up = input_up if batched else input_up.unsqueeze(0)
+    layer_lo = []
+    layer_up = []
+    relaxations = {}
+    lo = x_lo
+    up = x_up
+    for i, layer in enumerate(network):
+        if isinstance(layer, torch.nn.Linear):
+            lo_IA, up_IA = propagate_bounds(layer, lo, up)
+            lo, up = _back_substitute_linear_bounds(network, i, relaxations,
+                                                    x_lo, x_up)
+            lo = torch.max(lo, lo_IA)
+            up = torch.min(up, up_IA)
+        else:
+            relaxations[i] = _activation_linear_relaxation(layer, lo, up)
+            lo, up = propagate_bounds(layer, lo, up)
+        layer_lo.append(lo)
+        layer_up.append(up)
+    if not batched:
+        layer_lo = [lo.squeeze(0) for lo in layer_lo]
+        layer_up = [up.squeeze(0) for up in layer_up]
+    return layer_lo, layer_up
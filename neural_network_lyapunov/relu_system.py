@@ -70,6 +70,7 @@ def _add_dynamics_constraint_autonmous(mip_cnstr_return,
     ret.from_mip_cnstr_return(mip_cnstr_return, x_var)
     if network_bound_propagate_method in (
             mip_utils.PropagateBoundsMethod.IA,
+            mip_utils.PropagateBoundsMethod.CROWN,
             mip_utils.PropagateBoundsMethod.IA_MIP):
         ret.x_next_lb_IA = x_next_lb_IA
         ret.x_next_ub_IA = x_next_ub_IA
@@ -77,7 +78,9 @@ def _add_dynamics_constraint_autonmous(mip_cnstr_return,
             mip_utils.PropagateBoundsMethod.LP,
             mip_utils.PropagateBoundsMethod.MIP,
             mip_utils.PropagateBoundsMethod.IA_MIP):
-        ret.x_next_bound_prog = gurobi_torch_mip.GurobiTorchMILP(dtype)
+        # The bound program is always solved with gurobi.
+        ret.x_next_bound_prog = gurobi_torch_mip.GurobiTorchMILP(
+            dtype, backend=gurobi_torch_mip.GurobiSolverBackend())
         ret.x_next_bound_prog.gurobi_model.setParam(
             gurobipy.GRB.Param.OutputFlag, False)
         ret.x_next_bound_var = ret.x_next_bound_prog.addVars(
@@ -168,6 +171,7 @@ class AutonomousReLUSystem:
         mip_cnstr_return = self.mixed_integer_constraints()
         if self.network_bound_propagate_method in (
                 mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN,
                 mip_utils.PropagateBoundsMethod.IA_MIP):
             x_next_lb_IA = mip_cnstr_return.nn_output_lo
             x_next_ub_IA = mip_cnstr_return.nn_output_up
@@ -272,6 +276,7 @@ class AutonomousReLUSystemGivenEquilibrium:
         mip_cnstr_return = self.mixed_integer_constraints()
         if self.network_bound_propagate_method in (
                 mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN,
                 mip_utils.PropagateBoundsMethod.IA_MIP):
             relu_at_equilibrium = self.dynamics_relu(self.x_equilibrium)
             x_next_lb_IA = mip_cnstr_return.nn_output_lo - relu_at_equilibrium\
@@ -383,6 +388,7 @@ class AutonomousResidualReLUSystemGivenEquilibrium:
         mip_cnstr_return = self.mixed_integer_constraints()
         if self.network_bound_propagate_method in (
                 mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN,
                 mip_utils.PropagateBoundsMethod.IA_MIP):
             relu_at_equilibrium = self.dynamics_relu(self.x_equilibrium)
             x_next_lb_IA = mip_cnstr_return.nn_output_lo - relu_at_equilibrium\
@@ -1026,8 +1032,9 @@ def _add_forward_dynamics_mip_constraints(
     bound_prog = None
     bound_prog_x_next_var = None
     bound_prog_x_var = None
-    if forward_system.network_bound_propagate_method ==\
-            mip_utils.PropagateBoundsMethod.IA:
+    if forward_system.network_bound_propagate_method in (
+            mip_utils.PropagateBoundsMethod.IA,
+            mip_utils.PropagateBoundsMethod.CROWN):
         x_next_lb_IA = mip_cnstr.x_next_lb
         x_next_ub_IA = mip_cnstr.x_next_ub
     else:
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 import queue
+import multiprocessing
+import collections
+import contextlib
+import threading
 
 import torch
 import torch.nn as nn
@@ -95,6 +99,36 @@ def compute_all_relu_activation_patterns(relu, x):
     return patterns_list
 
 
+def compute_all_relu_activation_patterns_batch(relu, x, zero_tol=0.):
+    """
+    The batched version of compute_all_relu_activation_patterns(). For each
+    input x[i], enumerate all the activation patterns, where a ReLU unit with
+    input in [-zero_tol, zero_tol] is regarded as both active and inactive.
+    The whole batch is propagated through each layer at once, and the
+    patterns are returned in a packed layout.
+    @param relu A (leaky) ReLU network.
+    @param x A pytorch tensor of shape (N, x_dim), the inputs to the network.
+    @param zero_tol The tolerance to consider a ReLU input as 0.
+    @return (patterns, offsets) patterns is a boolean tensor of shape
+    (num_patterns, num_relu_units), the patterns of x[i] are
+    patterns[offsets[i]:offsets[i+1]]. The ReLU units are ordered as in
+    ReLUFreePattern.relu_unit_index.
+    """
+    assert (len(x.shape) == 2)
+    patterns = torch.empty((x.shape[0], 0), dtype=torch.bool,
+                           device=x.device)
+    offsets = torch.arange(x.shape[0] + 1, device=x.device)
+    layer_x = x
+    for layer in relu:
+        if isinstance(layer, nn.ReLU) or isinstance(layer, nn.LeakyReLU):
+            source, active, offsets = \
+                utils._relu_layer_activation_variants(
+                    layer_x, offsets, zero_tol)
+            patterns = torch.cat((patterns[source], active), dim=1)
+        layer_x = layer.forward(layer_x)
+    return patterns, offsets
+
+
 def relu_activation_binary_to_pattern(relu_network, activation_binary):
     """
     Given a numpy array of 0 and 1 representing the activation of each ReLU
@@ -244,6 +278,119 @@ class ReLUGradientTimesVecMixedIntegerConstraintsReturn(
         self.Wz_up = None
 
 
+class CompressedReLUNetwork:
+    """
+    The network returned from ReLUFreePattern.compress_stable_neurons(). Only
+    the unstable ReLU units (which can be either active or inactive) are
+    kept. The stable units are folded into affine maps, so the pre-activation
+    of each kept unit, and the network output, are affine functions of the
+    network input x and the outputs of all the kept units in the previous
+    layers. Namely with the basis vector vₖ = [x; h₀; ...; hₖ₋₁], where hᵢ is
+    the output of the kept units in the i'th hidden layer
+    hₖ = σ(weight[k] * vₖ + bias[k])
+    output = output_weight * v + output_bias
+    where v = [x; h₀; ...; hₙ₋₁]. The weights and biases are computed from the
+    parameters of the original network, so the gradient flows back to the
+    original parameters.
+    """
+    def __init__(self):
+        self.x_size = None
+        # unit_index[k] contains the indices (in ReLUFreePattern.relu_unit_index
+        # numbering) of the kept units in the k'th hidden layer.
+        self.unit_index = []
+        self.weight = []
+        self.bias = []
+        # The activation layer of each hidden layer.
+        self.relu_layers = []
+        self.output_weight = None
+        self.output_bias = None
+        # The bounds on the pre-activation of the kept units, concatenated
+        # over all hidden layers.
+        self.z_pre_relu_lo = None
+        self.z_pre_relu_up = None
+
+    @property
+    def num_relu_units(self):
+        return sum([len(index) for index in self.unit_index])
+
+    @property
+    def original_unit_index(self):
+        """
+        The indices of all the kept units in the original network. The i'th
+        ReLU unit of the compressed network is the original_unit_index[i]'th
+        unit of the original network.
+        """
+        return [i for index in self.unit_index for i in index]
+
+    def forward(self, x):
+        """
+        Evaluate the network output. x can be a single input or a batch of
+        inputs.
+        """
+        v = x
+        for k in range(len(self.weight)):
+            h = self.relu_layers[k](v @ self.weight[k].T + self.bias[k])
+            v = torch.cat((v, h), dim=-1)
+        return v @ self.output_weight.T + self.output_bias
+
+    def mixed_integer_constraints(self, x_lo, x_up):
+        """
+        Formulate the compressed network as mixed-integer linear constraints,
+        similar to ReLUFreePattern.output_constraint(). The slack variables
+        are the outputs of the kept units, with one binary variable for each
+        kept unit.
+        @param x_lo, x_up The bounds on the network input, the same bounds
+        used to compute the ReLU unit bounds in the compression.
+        @return mip_constr_return A ReLUMixedIntegerConstraintsReturn object.
+        """
+        dtype = self.output_weight.dtype
+        num_units = self.num_relu_units
+        Ain_input = [
+            torch.eye(self.x_size, dtype=dtype),
+            -torch.eye(self.x_size, dtype=dtype)
+        ]
+        Ain_slack = [torch.zeros((2 * self.x_size, num_units), dtype=dtype)]
+        Ain_binary = [torch.zeros((2 * self.x_size, num_units), dtype=dtype)]
+        rhs_in = [x_up, -x_lo]
+        unit_count = 0
+        for k in range(len(self.weight)):
+            for j in range(len(self.unit_index[k])):
+                Ain_linear_input, Ain_neuron_output, Ain_neuron_binary,\
+                    rhs_in_j, _, _, _, _, _, _ = \
+                    relu_to_optimization_utils._add_constraint_by_neuron(
+                        self.weight[k][j], self.bias[k][j],
+                        self.relu_layers[k], self.z_pre_relu_lo[unit_count],
+                        self.z_pre_relu_up[unit_count])
+                num_rows = rhs_in_j.shape[0]
+                Ain_input.append(Ain_linear_input[:, :self.x_size])
+                slack_coeff = torch.zeros((num_rows, num_units), dtype=dtype)
+                # The linear input contains the outputs of the kept units in
+                # the previous layers.
+                slack_coeff[:, :Ain_linear_input.shape[1] - self.x_size] =\
+                    Ain_linear_input[:, self.x_size:]
+                slack_coeff[:, unit_count] = Ain_neuron_output.reshape((-1, ))
+                Ain_slack.append(slack_coeff)
+                binary_coeff = torch.zeros((num_rows, num_units), dtype=dtype)
+                binary_coeff[:, unit_count] = Ain_neuron_binary.reshape(
+                    (-1, ))
+                Ain_binary.append(binary_coeff)
+                rhs_in.append(rhs_in_j)
+                unit_count += 1
+        mip_constr_return = ReLUMixedIntegerConstraintsReturn()
+        mip_constr_return.Ain_input = torch.cat(Ain_input, dim=0)
+        mip_constr_return.Ain_slack = torch.cat(Ain_slack, dim=0)
+        mip_constr_return.Ain_binary = torch.cat(Ain_binary, dim=0)
+        mip_constr_return.rhs_in = torch.cat(rhs_in, dim=0)
+        mip_constr_return.Aout_input = self.output_weight[:, :self.x_size]
+        mip_constr_return.Aout_slack = self.output_weight[:, self.x_size:]
+        mip_constr_return.Cout = self.output_bias
+        mip_constr_return.nn_input_lo = x_lo
+        mip_constr_return.nn_input_up = x_up
+        mip_constr_return.relu_input_lo = self.z_pre_relu_lo
+        mip_constr_return.relu_input_up = self.z_pre_relu_up
+        return mip_constr_return
+
+
 class ReLUFreePattern:
     """
     The output of ReLU network is a piecewise linear function of the input.
@@ -287,6 +434,25 @@ class ReLUFreePattern:
         # The last linear layer is not connected to a ReLU layer.
         self.num_relu_units -= len(self.relu_unit_index[-1])
         self.relu_unit_index = self.relu_unit_index[:-1]
+        # The number of processes to compute the bounds of the neurons in the
+        # same layer with the LP/MIP/IA_MIP bound propagation methods. With a
+        # single process we build one LayerBoundTighteningSession program
+        # and append the layers to it. With more than one process, each
+        # process builds its own program for every layer (from the network
+        # input), so the incremental session is not used.
+        self.bound_tightening_num_workers = 1
+        # The process pool shared by the layers, see bound_tightening_pool().
+        self._bound_tightening_pool = None
+        # The solver backend that constructs and solves the LP/MIP/IA_MIP
+        # bound propagation programs (when create_prog_callback is None). If
+        # None, then we use gurobi (also within a
+        # gurobi_torch_mip.solver_backend() context). With
+        # gurobi_torch_mip.ScipyMILPSolverBackend() the programs don't need a
+        # gurobi license token.
+        self.bound_tightening_backend = None
+        # If not None, a ReLUBoundCache object that reuses the LP/MIP/IA_MIP
+        # bounds of the ReLU units across the calls to _compute_layer_bound().
+        self.bound_cache = None
 
     def strengthen_mip_at_point(self, pt: tuple,
                                 linear_inputs_lo: torch.Tensor,
@@ -296,17 +462,29 @@ class ReLUFreePattern:
         formulation by adding the constraints with the most violation evaluated
         at this point. Check Strong mixed-integer programming formulations for
         trained neural networks.
+        The cuts for all the units in a layer are separated at once. pt can
+        also contain a batch of points, with linear_inputs of shape
+        (batch_size, x_size + num_relu_units) and relu_activations of shape
+        (batch_size, num_relu_units).
+        @return (Ain_input, Ain_slack, Ain_binary, rhs_in) The violated cuts
+        Ain_input * x + Ain_slack * slack + Ain_binary * β <= rhs_in. Ain_input,
+        Ain_slack and Ain_binary are sparse COO tensors. Return all None if
+        no cut is violated.
         """
-        linear_inputs = pt[0]
-        relu_activations = pt[1]
-
-        Ain_input = []
-        Ain_slack = []
-        Ain_binary = []
+        linear_inputs = pt[0].reshape((-1, pt[0].shape[-1]))
+        relu_activations = pt[1].reshape((-1, pt[1].shape[-1]))
+        assert (linear_inputs.shape[0] == relu_activations.shape[0])
+
+        # The row, column and value of the non-zero entries in Ain_input,
+        # Ain_slack and Ain_binary.
+        input_entries = ([], [], [])
+        slack_entries = ([], [], [])
+        binary_entries = ([], [], [])
         rhs_in = []
+        num_cuts = 0
 
-        # Go through each layer and each unit, strengthen the big-M
-        # formulation for that unit.
+        # Go through each layer, strengthen the big-M formulation for all
+        # units in that layer.
         linear_input_count = 0
         for relu_layer_count in range(len(self.relu_unit_index)):
             linear_layer = self.model[2 * relu_layer_count]
@@ -315,60 +493,78 @@ class ReLUFreePattern:
                 relu_layer, torch.nn.LeakyReLU) else 0.
             assert (len(self.relu_unit_index[relu_layer_count]) ==
                     linear_layer.out_features)
-            linear_input_indices = np.arange(
-                linear_input_count,
-                linear_input_count + linear_layer.in_features).tolist()
+            linear_input = linear_inputs[:, linear_input_count:
+                                         linear_input_count +
+                                         linear_layer.in_features]
+            linear_input_lo = linear_inputs_lo[
+                linear_input_count:linear_input_count +
+                linear_layer.in_features]
+            linear_input_up = linear_inputs_up[
+                linear_input_count:linear_input_count +
+                linear_layer.in_features]
             linear_input_count += linear_layer.in_features
-            linear_input = linear_inputs[linear_input_indices]
-            linear_input_lo = linear_inputs_lo[linear_input_indices]
-            linear_input_up = linear_inputs_up[linear_input_indices]
-            for j in range(len(self.relu_unit_index[relu_layer_count])):
-                beta_hat = relu_activations[
-                    self.relu_unit_index[relu_layer_count][j]]
-                w = linear_layer.weight.data[j]
-                b = linear_layer.bias.data[
-                    j] if linear_layer.bias is not None else torch.tensor(
-                        0, dtype=self.dtype)
-                index_set = mip_utils.find_index_set_to_strengthen(
-                    w, linear_input_lo, linear_input_up, linear_input,
-                    beta_hat)
-                x_coeff, binary_coeff, constant = \
-                    mip_utils.strengthen_relu_mip_w_indices(
-                        negative_slope, w, b, linear_input_lo,
-                        linear_input_up, index_set)
-                assert (x_coeff.shape == (len(linear_input_indices), ))
-                relu_output = linear_inputs[linear_input_count + j]
-                if relu_output > x_coeff @ linear_input +\
-                        binary_coeff * beta_hat + constant + 1E-12:
-                    # This additional constraint is violated, append it to
-                    # existing constraints, add the constraint relu_output -
-                    # x_coeff * linear_input - binary_coeff * relu_activation
-                    # <= constant
-                    slack_coeff = torch.zeros((self.num_relu_units, ),
-                                              dtype=self.dtype)
-                    slack_coeff[self.relu_unit_index[relu_layer_count][j]] = 1.
-                    if relu_layer_count == 0:
-                        # This is the input layer.
-                        Ain_input.append(-x_coeff.reshape((1, -1)))
-                    else:
-                        # This is not the input layer.
-                        Ain_input.append(
-                            torch.zeros((1, self.model[0].in_features),
-                                        dtype=self.dtype))
-                        slack_coeff[self.relu_unit_index[relu_layer_count -
-                                                         1]] = -x_coeff
-                    Ain_slack.append(slack_coeff.reshape((1, -1)))
-                    binary_all_coeff = torch.zeros((1, self.num_relu_units),
-                                                   dtype=self.dtype)
-                    binary_all_coeff[0, self.relu_unit_index[relu_layer_count]
-                                     [j]] = -binary_coeff
-                    Ain_binary.append(binary_all_coeff)
-                    rhs_in.append(constant)
-        if len(Ain_input) == 0:
+            unit_index = torch.tensor(self.relu_unit_index[relu_layer_count])
+            beta_hat = relu_activations[:, unit_index]
+            b = linear_layer.bias.data if linear_layer.bias is not None else\
+                torch.zeros((linear_layer.out_features, ), dtype=self.dtype)
+            x_coeff, binary_coeff, constant = \
+                mip_utils.strengthen_relu_mip_batch(
+                    negative_slope, linear_layer.weight.data, b,
+                    linear_input_lo, linear_input_up, linear_input, beta_hat)
+            relu_output = linear_inputs[:, linear_input_count:
+                                        linear_input_count +
+                                        linear_layer.out_features]
+            # Find the violated constraints
+            # relu_output - x_coeff * linear_input - binary_coeff *
+            # relu_activation <= constant
+            violated = relu_output > torch.sum(
+                x_coeff * linear_input.unsqueeze(1),
+                dim=-1) + binary_coeff * beta_hat + constant + 1E-12
+            point_index, unit = torch.nonzero(violated, as_tuple=True)
+            if point_index.numel() == 0:
+                continue
+            rows = torch.arange(num_cuts, num_cuts + point_index.numel())
+            num_cuts += point_index.numel()
+            cut_x_coeff = x_coeff[point_index, unit]
+            x_rows, x_cols = torch.nonzero(cut_x_coeff, as_tuple=True)
+            if relu_layer_count == 0:
+                # This is the input layer.
+                input_entries[0].append(rows[x_rows])
+                input_entries[1].append(x_cols)
+                input_entries[2].append(-cut_x_coeff[x_rows, x_cols])
+            else:
+                # This is not the input layer.
+                slack_entries[0].append(rows[x_rows])
+                slack_entries[1].append(
+                    torch.tensor(self.relu_unit_index[relu_layer_count -
+                                                      1])[x_cols])
+                slack_entries[2].append(-cut_x_coeff[x_rows, x_cols])
+            slack_entries[0].append(rows)
+            slack_entries[1].append(unit_index[unit])
+            slack_entries[2].append(torch.ones((rows.numel(), ),
+                                               dtype=self.dtype))
+            binary_entries[0].append(rows)
+            binary_entries[1].append(unit_index[unit])
+            binary_entries[2].append(-binary_coeff[point_index, unit])
+            rhs_in.append(constant[point_index, unit])
+        if num_cuts == 0:
             return None, None, None, None
-        return torch.cat(Ain_input, dim=0), torch.cat(
-            Ain_slack, dim=0), torch.cat(Ain_binary, dim=0),\
-            torch.stack(rhs_in)
+
+        def to_sparse(entries, num_cols):
+            if len(entries[0]) == 0:
+                indices = torch.empty((2, 0), dtype=torch.int64)
+                values = torch.empty((0, ), dtype=self.dtype)
+            else:
+                indices = torch.stack(
+                    (torch.cat(entries[0]), torch.cat(entries[1])))
+                values = torch.cat(entries[2])
+            return torch.sparse_coo_tensor(indices,
+                                           values, (num_cuts, num_cols),
+                                           dtype=self.dtype).coalesce()
+
+        return to_sparse(input_entries, self.model[0].in_features),\
+            to_sparse(slack_entries, self.num_relu_units),\
+            to_sparse(binary_entries, self.num_relu_units), torch.cat(rhs_in)
 
     def strengthen_relu_mip_at_solution(
             self, prog: gurobi_torch_mip.GurobiTorchMIP, x_var: list,
@@ -384,18 +580,18 @@ class ReLUFreePattern:
            program.
         4. Go to step 2, loop for several iterations.
         This function implements step 3 of this algorithm.
+        prog can also be a gurobi_torch_mip.MIPNodeCutAdder, then the
+        constraints are added as user cuts at a branch-and-bound node.
         """
-        assert (isinstance(prog, gurobi_torch_mip.GurobiTorchMIP))
+        assert (isinstance(prog, (gurobi_torch_mip.GurobiTorchMIP,
+                                  gurobi_torch_mip.MIPNodeCutAdder)))
         assert (isinstance(x_var, list))
         assert (isinstance(slack_var, list))
         assert (isinstance(binary_var, list))
         assert (isinstance(relu_mip_cnstr_return,
                            ReLUMixedIntegerConstraintsReturn))
-        linear_inputs = torch.tensor([v.x for v in x_var] +
-                                     [v.x for v in slack_var],
-                                     dtype=prog.dtype)
-        relu_activations = torch.tensor([v.x for v in binary_var],
-                                        dtype=prog.dtype)
+        linear_inputs = prog.get_solution(x_var + slack_var)
+        relu_activations = prog.get_solution(binary_var)
         linear_inputs_lo = torch.cat((relu_mip_cnstr_return.nn_input_lo,
                                       relu_mip_cnstr_return.relu_output_lo))
         linear_inputs_up = torch.cat((relu_mip_cnstr_return.nn_input_up,
@@ -410,34 +606,20 @@ class ReLUFreePattern:
                             sense=gurobipy.GRB.LESS_EQUAL,
                             name="relu strengthened")
 
-    def _compute_linear_output_bound_by_optimization(
-            self, layer_index, linear_output_row_index,
-            previous_neuron_input_lo: np.ndarray,
+    def _create_linear_output_bound_prog(
+            self, layer_index, previous_neuron_input_lo: np.ndarray,
             previous_neuron_input_up: np.ndarray, network_input_lo: np.ndarray,
-            network_input_up: np.ndarray, create_prog_callback, binary_var_type
-    ) -> Tuple[float, float, torch.Tensor, torch.Tensor]:
+            network_input_up: np.ndarray, create_prog_callback,
+            binary_var_type):
         """
-        Compute the range of a linear layer output.
-        We could solve an optimization problem (LP or MILP) to find (relaxed)
-        bound of the linear layer output.
-        The idea is to convert the neural network to constraints. If we use
-        a binary variable for each neuron activation, then we have an MILP to
-        compute the exact bound. If we relax the binary variable to continuous
-        variable in the range [0, 1], then we have an LP to compute the relaxed
-        bound. The LP approach is explained in
-        Evaluating Robustness of Neural Networks with Mixed Integer Programming
-        by Vincent Tjeng, Kai Xiao and Russ Tedrake.
-        @param layer_index layer 0 is the first linear layer, layer 1 is the
-        second linear layer, etc.
-        @param linear_output_row_index The row of the output in that linear
-        layer.
-        @param create_prog_callback A function that returns a GurobiTorchMIP
-        object and the variable for the network input. The returned
-        GurobiTorchMIP object contains the additional constraints imposed on
-        network_input, that are not included in this function
-        _compute_linear_output_bound_by_optimization. If set to None, then we
-        create an empty GurobiTorchMIP at the beginning of this program by
-        ourselves.
+        Create the program that encodes the network up to the input of the
+        layer_index'th linear layer. The same program can be reused to bound
+        all the outputs of that linear layer, by only changing the objective.
+        Refer to _compute_linear_output_bound_by_optimization() for the
+        meaning of the arguments.
+        @return (prog, network_input, z_curr) network_input is the variable
+        for the network input, z_curr is the variable for the input of the
+        layer_index'th linear layer.
         """
         assert (isinstance(previous_neuron_input_lo, np.ndarray))
         assert (isinstance(previous_neuron_input_up, np.ndarray))
@@ -445,7 +627,11 @@ class ReLUFreePattern:
         assert (isinstance(network_input_up, np.ndarray))
         input_dim = self.model[0].in_features
         if create_prog_callback is None:
-            prog = gurobi_torch_mip.GurobiTorchMILP(self.dtype)
+            prog = gurobi_torch_mip.GurobiTorchMILP(
+                self.dtype,
+                backend=gurobi_torch_mip.GurobiSolverBackend()
+                if self.bound_tightening_backend is None else
+                self.bound_tightening_backend)
             network_input = prog.addVars(input_dim,
                                          lb=torch.from_numpy(network_input_lo),
                                          ub=torch.from_numpy(network_input_up))
@@ -476,7 +662,21 @@ class ReLUFreePattern:
                         previous_neuron_input_up[self.relu_unit_index[layer]]),
                     binary_var_type=binary_var_type)
             z_curr = z_next
+        if prog.has_gurobi_model():
+            prog.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+            prog.gurobi_model.setParam(gurobipy.GRB.Param.DualReductions, 0)
+        return prog, network_input, z_curr
 
+    def _optimize_linear_output_bound(self, prog, network_input, z_curr,
+                                      layer_index, linear_output_row_index):
+        """
+        Maximize and minimize the linear_output_row_index'th output of the
+        layer_index'th linear layer in prog, which is created by
+        _create_linear_output_bound_prog(). Only the objective of prog is
+        changed.
+        @return (linear_output_lo, linear_output_up, lo_input_val,
+        up_input_val) Same as _compute_linear_output_bound_by_optimization().
+        """
         # Now optimize the bound on the neuron input as Wij @ z_curr + bij
         Wij = self.model[2 * layer_index].weight[linear_output_row_index]
         bij = self.model[2 * layer_index].bias[
@@ -485,117 +685,285 @@ class ReLUFreePattern:
         prog.setObjective([Wij], [z_curr],
                           constant=bij,
                           sense=gurobipy.GRB.MAXIMIZE)
-        prog.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
-        prog.gurobi_model.setParam(gurobipy.GRB.Param.DualReductions, 0)
-        prog.gurobi_model.optimize()
+        result = prog.solve()
         # The value of the network input that gives the upper bound.
         up_input_val = None
-        if prog.gurobi_model.status == gurobipy.GRB.Status.OPTIMAL:
-            linear_output_up = prog.gurobi_model.ObjVal
-            up_input_val = torch.tensor([v.x for v in network_input],
-                                        dtype=self.dtype)
-        elif prog.gurobi_model.status == gurobipy.GRB.Status.UNBOUNDED:
+        if result.status == gurobipy.GRB.Status.OPTIMAL:
+            linear_output_up = result.objective
+            up_input_val = prog.get_solution(network_input).to(self.dtype)
+        elif result.status == gurobipy.GRB.Status.UNBOUNDED:
             linear_output_up = np.inf
-        elif prog.gurobi_model.status == gurobipy.GRB.Status.INFEASIBLE:
+        elif result.status == gurobipy.GRB.Status.INFEASIBLE:
             linear_output_up = -np.inf
 
         prog.setObjective([Wij], [z_curr],
                           constant=bij,
                           sense=gurobipy.GRB.MINIMIZE)
-        prog.gurobi_model.optimize()
+        result = prog.solve()
         # The value of the network input that gives the lower bound.
         lo_input_val = None
-        if prog.gurobi_model.status == gurobipy.GRB.Status.OPTIMAL:
-            linear_output_lo = prog.gurobi_model.ObjVal
-            lo_input_val = torch.tensor([v.x for v in network_input],
-                                        dtype=self.dtype)
-        elif prog.gurobi_model.status == gurobipy.GRB.Status.UNBOUNDED:
+        if result.status == gurobipy.GRB.Status.OPTIMAL:
+            linear_output_lo = result.objective
+            lo_input_val = prog.get_solution(network_input).to(self.dtype)
+        elif result.status == gurobipy.GRB.Status.UNBOUNDED:
             linear_output_lo = -np.inf
-        elif prog.gurobi_model.status == gurobipy.GRB.Status.INFEASIBLE:
+        elif result.status == gurobipy.GRB.Status.INFEASIBLE:
             linear_output_lo = np.inf
         return linear_output_lo, linear_output_up, lo_input_val, up_input_val
 
+    def _compute_linear_output_bound_by_optimization(
+            self, layer_index, linear_output_row_index,
+            previous_neuron_input_lo: np.ndarray,
+            previous_neuron_input_up: np.ndarray, network_input_lo: np.ndarray,
+            network_input_up: np.ndarray, create_prog_callback, binary_var_type
+    ) -> Tuple[float, float, torch.Tensor, torch.Tensor]:
+        """
+        Compute the range of a linear layer output.
+        We could solve an optimization problem (LP or MILP) to find (relaxed)
+        bound of the linear layer output.
+        The idea is to convert the neural network to constraints. If we use
+        a binary variable for each neuron activation, then we have an MILP to
+        compute the exact bound. If we relax the binary variable to continuous
+        variable in the range [0, 1], then we have an LP to compute the relaxed
+        bound. The LP approach is explained in
+        Evaluating Robustness of Neural Networks with Mixed Integer Programming
+        by Vincent Tjeng, Kai Xiao and Russ Tedrake.
+        @param layer_index layer 0 is the first linear layer, layer 1 is the
+        second linear layer, etc.
+        @param linear_output_row_index The row of the output in that linear
+        layer.
+        @param create_prog_callback A function that returns a GurobiTorchMIP
+        object and the variable for the network input. The returned
+        GurobiTorchMIP object contains the additional constraints imposed on
+        network_input, that are not included in this function
+        _compute_linear_output_bound_by_optimization. If set to None, then we
+        create an empty GurobiTorchMIP at the beginning of this program by
+        ourselves.
+        """
+        prog, network_input, z_curr = self._create_linear_output_bound_prog(
+            layer_index, previous_neuron_input_lo, previous_neuron_input_up,
+            network_input_lo, network_input_up, create_prog_callback,
+            binary_var_type)
+        return self._optimize_linear_output_bound(prog, network_input, z_curr,
+                                                  layer_index,
+                                                  linear_output_row_index)
+
+    def _compute_linear_output_bounds_by_optimization(
+            self, layer_index, linear_output_row_indices,
+            previous_neuron_input_lo: np.ndarray,
+            previous_neuron_input_up: np.ndarray, network_input_lo: np.ndarray,
+            network_input_up: np.ndarray, create_prog_callback,
+            binary_var_type) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as _compute_linear_output_bound_by_optimization(), but bound
+        several outputs of the same linear layer. We create the program only
+        once, and change its objective for each output.
+        @param linear_output_row_indices A list of rows of the output in that
+        linear layer.
+        @return (linear_output_lo, linear_output_up) linear_output_lo[i],
+        linear_output_up[i] are the bounds on the
+        linear_output_row_indices[i]'th output.
+        """
+        prog, network_input, z_curr = self._create_linear_output_bound_prog(
+            layer_index, previous_neuron_input_lo, previous_neuron_input_up,
+            network_input_lo, network_input_up, create_prog_callback,
+            binary_var_type)
+        linear_output_lo = np.empty((len(linear_output_row_indices), ))
+        linear_output_up = np.empty((len(linear_output_row_indices), ))
+        for i, row in enumerate(linear_output_row_indices):
+            linear_output_lo[i], linear_output_up[i], _, _ = \
+                self._optimize_linear_output_bound(prog, network_input,
+                                                   z_curr, layer_index, row)
+        return linear_output_lo, linear_output_up
+
+    @contextlib.contextmanager
+    def bound_tightening_pool(self):
+        """
+        Within this context, all the LP/MIP/IA_MIP bound computations share a
+        single pool of self.bound_tightening_num_workers processes, instead
+        of spawning a pool for each call. For example
+            with relu_free_pattern.bound_tightening_pool():
+                relu_free_pattern._compute_layer_bound(...)
+                relu_free_pattern._compute_network_output_bounds(...)
+        Nested contexts reuse the outer pool. If
+        self.bound_tightening_num_workers <= 1, then no pool is created.
+        """
+        if self._bound_tightening_pool is not None or\
+                self.bound_tightening_num_workers <= 1:
+            yield self._bound_tightening_pool
+            return
+        # Gurobi environments cannot be shared with a forked child process, so
+        # we spawn the workers.
+        pool = multiprocessing.get_context("spawn").Pool(
+            self.bound_tightening_num_workers)
+        self._bound_tightening_pool = pool
+        try:
+            yield pool
+        finally:
+            self._bound_tightening_pool = None
+            pool.close()
+            pool.join()
+
+    def _compute_layer_output_bounds_by_optimization(
+            self, layer_index, previous_neuron_input_lo: np.ndarray,
+            previous_neuron_input_up: np.ndarray, network_input_lo: np.ndarray,
+            network_input_up: np.ndarray, create_prog_callback,
+            binary_var_type) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the bounds on all the outputs of the layer_index'th linear
+        layer. The outputs are split evenly among
+        self.bound_tightening_num_workers processes. Each process creates one
+        program for this layer, and only changes the objective between
+        solves.
+        When self.bound_tightening_num_workers > 1, create_prog_callback has
+        to be picklable (for example a module level function, or a
+        functools.partial of one). Only the network, the bounds and
+        create_prog_callback are sent to the processes.
+        @return (linear_output_lo, linear_output_up) The bounds on all the
+        outputs of this linear layer.
+        """
+        num_rows = self.model[2 * layer_index].out_features
+        num_workers = min(self.bound_tightening_num_workers, num_rows)
+        if num_workers <= 1:
+            return self._compute_linear_output_bounds_by_optimization(
+                layer_index, list(range(num_rows)), previous_neuron_input_lo,
+                previous_neuron_input_up, network_input_lo, network_input_up,
+                create_prog_callback, binary_var_type)
+        row_chunks = np.array_split(np.arange(num_rows), num_workers)
+        with self.bound_tightening_pool() as pool:
+            results = pool.starmap(
+                _compute_linear_output_bounds_worker,
+                [(self.model, self.dtype, self.bound_tightening_backend,
+                  layer_index, chunk.tolist(), previous_neuron_input_lo,
+                  previous_neuron_input_up, network_input_lo,
+                  network_input_up, create_prog_callback, binary_var_type)
+                 for chunk in row_chunks])
+        return np.concatenate([result[0] for result in results]),\
+            np.concatenate([result[1] for result in results])
+
     def _compute_layer_bound(self,
                              x_lo,
                              x_up,
                              method: mip_utils.PropagateBoundsMethod,
-                             create_prog_callback=None):
+                             create_prog_callback=None,
+                             cache_tag=None):
         """
         Compute the input and output bounds of each ReLU neurons.
+        If method is IA or CROWN, then x_lo and x_up can also be a batch of
+        boxes (with shape (batch_size, x_size)), and the returned bounds have
+        shape (batch_size, num_relu_units).
+        @param cache_tag Only used with self.bound_cache, a hashable tag that
+        identifies create_prog_callback across the calls. Refer to
+        ReLUBoundCache.
+        """
+        if method in (mip_utils.PropagateBoundsMethod.IA,
+                      mip_utils.PropagateBoundsMethod.CROWN):
+            # Propagate through all the hidden layers at once.
+            propagate = mip_utils.propagate_bounds_IA if method == \
+                mip_utils.PropagateBoundsMethod.IA else \
+                mip_utils.propagate_bounds_CROWN
+            layer_lo, layer_up = propagate(self.model[:-1], x_lo, x_up)
+            return torch.cat(layer_lo[0::2], dim=-1), torch.cat(
+                layer_up[0::2], dim=-1), torch.cat(
+                    layer_lo[1::2], dim=-1), torch.cat(layer_up[1::2], dim=-1)
+        if self.bound_cache is not None:
+            return self.bound_cache.compute_layer_bound(
+                self, x_lo, x_up, method, create_prog_callback, cache_tag)
+        return self._compute_layer_bound_by_optimization(
+            x_lo, x_up, method, create_prog_callback)
+
+    def _compute_layer_bound_by_optimization(self, x_lo, x_up, method,
+                                             create_prog_callback):
+        """
+        Compute the input and output bounds of each ReLU neurons with the
+        LP/MIP/IA_MIP methods, ignoring self.bound_cache.
         """
+        # With several processes, all the layers share the same process pool.
+        with self.bound_tightening_pool():
+            return self._compute_layer_bound_by_optimization_in_pool(
+                x_lo, x_up, method, create_prog_callback)
+
+    def _compute_layer_bound_by_optimization_in_pool(self, x_lo, x_up, method,
+                                                     create_prog_callback):
         linear_layer_input_lo = x_lo.clone()
         linear_layer_input_up = x_up.clone()
         z_pre_relu_lo = torch.empty((self.num_relu_units, ), dtype=self.dtype)
         z_pre_relu_up = torch.empty((self.num_relu_units, ), dtype=self.dtype)
         z_post_relu_lo = torch.empty((self.num_relu_units, ), dtype=self.dtype)
         z_post_relu_up = torch.empty((self.num_relu_units, ), dtype=self.dtype)
+        binary_var_type = mip_utils.binary_var_type_per_method(method)
+        # When solving serially, we build a single program and append the
+        # layers to it, instead of building one program per layer. With
+        # several processes, every process builds one program per layer.
+        session = LayerBoundTighteningSession(
+            self, x_lo.detach().numpy(), x_up.detach().numpy(),
+            binary_var_type, create_prog_callback) if \
+            self.bound_tightening_num_workers <= 1 else None
         for layer_count in range(len(self.relu_unit_index)):
             z_indices = self.relu_unit_index[layer_count]
             bias = self.model[2 * layer_count].bias if self.model[
                 2 * layer_count].bias is not None else torch.zeros(
                     (self.model[2 * layer_count].out_features, ),
                     dtype=self.dtype)
-            if method == mip_utils.PropagateBoundsMethod.IA:
-                z_pre_relu_lo[z_indices], z_pre_relu_up[z_indices] = \
+            if session is None:
+                layer_lo, layer_up = \
+                    self._compute_layer_output_bounds_by_optimization(
+                        layer_count, z_pre_relu_lo.detach().numpy(),
+                        z_pre_relu_up.detach().numpy(), x_lo.detach().numpy(),
+                        x_up.detach().numpy(), create_prog_callback,
+                        binary_var_type)
+            else:
+                layer_lo, layer_up = session.compute_layer_bounds()
+            z_pre_relu_lo[z_indices] = torch.from_numpy(layer_lo).to(
+                self.dtype)
+            z_pre_relu_up[z_indices] = torch.from_numpy(layer_up).to(
+                self.dtype)
+            if method == mip_utils.PropagateBoundsMethod.IA_MIP:
+                # We also compute the bounds by IA. If the IA bound is
+                # close to the MIP bound, then we use the IA bound.
+                # Otherwise, we relax the MIP bound a little bit to make
+                # sure this relaxed bound will not be active.
+                z_pre_relu_lo_ia, z_pre_relu_up_ia = \
                     mip_utils.compute_range_by_IA(
                         self.model[2 * layer_count].weight, bias,
                         linear_layer_input_lo, linear_layer_input_up)
-            else:
-                binary_var_type = mip_utils.binary_var_type_per_method(method)
                 for j in range(self.model[2 * layer_count].out_features):
                     neuron_index = self.relu_unit_index[layer_count][j]
-                    z_pre_relu_lo[neuron_index], z_pre_relu_up[
-                        neuron_index], _, _ = \
-                        self._compute_linear_output_bound_by_optimization(
-                            layer_count, j,
-                            z_pre_relu_lo.detach().numpy(),
-                            z_pre_relu_up.detach().numpy(),
-                            x_lo.detach().numpy(),
-                            x_up.detach().numpy(),
-                            create_prog_callback, binary_var_type)
-                if method == mip_utils.PropagateBoundsMethod.IA_MIP:
-                    # We also compute the bounds by IA. If the IA bound is
-                    # close to the MIP bound, then we use the IA bound.
-                    # Otherwise, we relax the MIP bound a little bit to make
-                    # sure this relaxed bound will not be active.
-                    z_pre_relu_lo_ia, z_pre_relu_up_ia = \
-                        mip_utils.compute_range_by_IA(
-                            self.model[2 * layer_count].weight, bias,
-                            linear_layer_input_lo, linear_layer_input_up)
-                    for j in range(self.model[2 * layer_count].out_features):
-                        neuron_index = self.relu_unit_index[layer_count][j]
-                        if torch.abs(z_pre_relu_lo[neuron_index] -
-                                     z_pre_relu_lo_ia[j]) < 1E-4:
-                            z_pre_relu_lo[neuron_index] = z_pre_relu_lo_ia[j]
+                    if torch.abs(z_pre_relu_lo[neuron_index] -
+                                 z_pre_relu_lo_ia[j]) < 1E-4:
+                        z_pre_relu_lo[neuron_index] = z_pre_relu_lo_ia[j]
+                    else:
+                        if z_pre_relu_lo[neuron_index] > 0:
+                            # If the MIP lower bound is > 0, then the ReLU
+                            # unit should always be active. We reduce this
+                            # MIP lower bound a little bit (but still
+                            # remains positive)
+                            z_pre_relu_lo[neuron_index] *= 0.99
+                            z_pre_relu_lo[
+                                neuron_index] += 0.01 * torch.clamp(
+                                    z_pre_relu_lo_ia[j], max=0.).detach()
                         else:
-                            if z_pre_relu_lo[neuron_index] > 0:
-                                # If the MIP lower bound is > 0, then the ReLU
-                                # unit should always be active. We reduce this
-                                # MIP lower bound a little bit (but still
-                                # remains positive)
-                                z_pre_relu_lo[neuron_index] *= 0.99
-                                z_pre_relu_lo[
-                                    neuron_index] += 0.01 * torch.clamp(
-                                        z_pre_relu_lo_ia[j], max=0.).detach()
-                            else:
-                                z_pre_relu_lo[neuron_index] *= 0.99
-                                z_pre_relu_lo[
-                                    neuron_index] += 0.01 * z_pre_relu_lo_ia[
-                                        j].detach()
-                        if torch.abs(z_pre_relu_up[neuron_index] -
-                                     z_pre_relu_up_ia[j]) < 1E-4:
-                            z_pre_relu_up[neuron_index] = z_pre_relu_up_ia[j]
+                            z_pre_relu_lo[neuron_index] *= 0.99
+                            z_pre_relu_lo[
+                                neuron_index] += 0.01 * z_pre_relu_lo_ia[
+                                    j].detach()
+                    if torch.abs(z_pre_relu_up[neuron_index] -
+                                 z_pre_relu_up_ia[j]) < 1E-4:
+                        z_pre_relu_up[neuron_index] = z_pre_relu_up_ia[j]
+                    else:
+                        if z_pre_relu_up[neuron_index] <= 0:
+                            z_pre_relu_up[neuron_index] *= 0.99
+                            z_pre_relu_up[
+                                neuron_index] += 0.01 * torch.clamp(
+                                    z_pre_relu_up_ia[j], max=0.).detach()
                         else:
-                            if z_pre_relu_up[neuron_index] <= 0:
-                                z_pre_relu_up[neuron_index] *= 0.99
-                                z_pre_relu_up[
-                                    neuron_index] += 0.01 * torch.clamp(
-                                        z_pre_relu_up_ia[j], max=0.).detach()
-                            else:
-                                z_pre_relu_up[neuron_index] *= 0.99
-                                z_pre_relu_up[
-                                    neuron_index] += 0.01 * z_pre_relu_up_ia[
-                                        j].detach()
+                            z_pre_relu_up[neuron_index] *= 0.99
+                            z_pre_relu_up[
+                                neuron_index] += 0.01 * z_pre_relu_up_ia[
+                                    j].detach()
+            if session is not None:
+                session.append_layer(z_pre_relu_lo[z_indices].detach(),
+                                     z_pre_relu_up[z_indices].detach())
 
             z_post_relu_lo[z_indices], z_post_relu_up[
                 z_indices] = mip_utils.propagate_bounds(
@@ -615,12 +983,18 @@ class ReLUFreePattern:
         if method == mip_utils.PropagateBoundsMethod.IA:
             linear_input_lo, linear_input_up = mip_utils.propagate_bounds(
                 self.model[-2],
-                previous_neuron_input_lo[self.relu_unit_index[-1]],
-                previous_neuron_input_up[self.relu_unit_index[-1]])
+                previous_neuron_input_lo[..., self.relu_unit_index[-1]],
+                previous_neuron_input_up[..., self.relu_unit_index[-1]])
             linear_output_lo, linear_output_up = \
                 mip_utils.propagate_bounds(
                     self.model[-1], linear_input_lo, linear_input_up)
             return linear_output_lo, linear_output_up
+        elif method == mip_utils.PropagateBoundsMethod.CROWN:
+            # The linear relaxation of the last linear layer is
+            # back-substituted to the network input.
+            layer_lo, layer_up = mip_utils.propagate_bounds_CROWN(
+                self.model, network_input_lo, network_input_up)
+            return layer_lo[-1], layer_up[-1]
         else:
             binary_var_type = mip_utils.binary_var_type_per_method(method)
             linear_output_lo = torch.empty((self.model[-1].out_features, ),
@@ -633,18 +1007,17 @@ class ReLUFreePattern:
                         previous_neuron_input_lo, previous_neuron_input_up,
                         network_input_lo, network_input_up,
                         mip_utils.PropagateBoundsMethod.IA)
+            output_lo, output_up = \
+                self._compute_layer_output_bounds_by_optimization(
+                    int((len(self.model) - 1) / 2),
+                    previous_neuron_input_lo.detach().numpy(),
+                    previous_neuron_input_up.detach().numpy(),
+                    network_input_lo.detach().numpy(),
+                    network_input_up.detach().numpy(), create_prog_callback,
+                    binary_var_type)
+            linear_output_lo[:] = torch.from_numpy(output_lo)
+            linear_output_up[:] = torch.from_numpy(output_up)
             for i in range(self.model[-1].out_features):
-                linear_output_lo[i], linear_output_up[
-                    i], _, _ = \
-                        self._compute_linear_output_bound_by_optimization(
-                            int((len(self.model) - 1) / 2),
-                            i,
-                            previous_neuron_input_lo.detach().numpy(),
-                            previous_neuron_input_up.detach().numpy(),
-                            network_input_lo.detach().numpy(),
-                            network_input_up.detach().numpy(),
-                            create_prog_callback,
-                            binary_var_type)
                 if method == mip_utils.PropagateBoundsMethod.IA_MIP:
                     if torch.abs(linear_output_lo[i] -
                                  linear_output_lo_ia[i]) < 1E-4:
@@ -774,6 +1147,72 @@ class ReLUFreePattern:
         mip_constr_return.relu_input_up = z_pre_relu_up
         return mip_constr_return
 
+    def compress_stable_neurons(self, z_pre_relu_lo: torch.Tensor,
+                                z_pre_relu_up: torch.Tensor
+                                ) -> CompressedReLUNetwork:
+        """
+        Given the bounds on the input of each ReLU unit, fold the always
+        active units (z_pre_relu_lo >= 0) and the always inactive units
+        (z_pre_relu_up <= 0) into the affine maps around them. A stable unit
+        outputs either its input (always active) or c times its input (always
+        inactive, c being the negative slope), which is an affine function of
+        the previous layer outputs. Inactive ReLU units (c = 0) are dropped.
+        Consecutive affine maps (for example around a layer with only stable
+        units) are merged.
+        @param z_pre_relu_lo, z_pre_relu_up The bounds on the ReLU unit
+        inputs, for example returned from _compute_layer_bound().
+        @return compressed A CompressedReLUNetwork object, which only contains
+        the unstable units, and is equivalent to this network within the
+        bounds.
+        """
+        assert (z_pre_relu_lo.shape == (self.num_relu_units, ))
+        assert (z_pre_relu_up.shape == (self.num_relu_units, ))
+        compressed = CompressedReLUNetwork()
+        compressed.x_size = self.x_size
+        # The input of the current linear layer is P * v + p, where v is the
+        # basis vector [x; h₀; ...; hₖ₋₁].
+        P = torch.eye(self.x_size, dtype=self.dtype)
+        p = torch.zeros((self.x_size, ), dtype=self.dtype)
+        for layer_count, z_indices in enumerate(self.relu_unit_index):
+            linear_layer = self.model[2 * layer_count]
+            relu_layer = self.model[2 * layer_count + 1]
+            # The pre-activation is M * v + m.
+            M = linear_layer.weight @ P
+            m = linear_layer.weight @ p
+            if linear_layer.bias is not None:
+                m = m + linear_layer.bias
+            lo = z_pre_relu_lo[z_indices]
+            up = z_pre_relu_up[z_indices]
+            unstable = torch.logical_and(lo < 0, up > 0)
+            kept = torch.nonzero(unstable).reshape((-1, ))
+            compressed.unit_index.append(
+                [z_indices[j] for j in kept.tolist()])
+            compressed.weight.append(M[kept])
+            compressed.bias.append(m[kept])
+            compressed.relu_layers.append(relu_layer)
+            # The slope of each stable unit. Set to 0 for the unstable units,
+            # whose outputs are new entries in the basis vector.
+            c = relu_layer.negative_slope if isinstance(
+                relu_layer, nn.LeakyReLU) else 0.
+            slope = torch.where(
+                lo >= 0, torch.tensor(1., dtype=self.dtype),
+                torch.tensor(c, dtype=self.dtype)) * torch.logical_not(
+                    unstable).to(self.dtype)
+            new_basis = torch.zeros((len(z_indices), kept.numel()),
+                                    dtype=self.dtype)
+            new_basis[kept, torch.arange(kept.numel())] = 1.
+            P = torch.cat((slope.reshape((-1, 1)) * M, new_basis), dim=1)
+            p = slope * m
+        compressed.output_weight = self.model[-1].weight @ P
+        compressed.output_bias = self.model[-1].weight @ p
+        if self.model[-1].bias is not None:
+            compressed.output_bias = compressed.output_bias + \
+                self.model[-1].bias
+        original_index = compressed.original_unit_index
+        compressed.z_pre_relu_lo = z_pre_relu_lo[original_index]
+        compressed.z_pre_relu_up = z_pre_relu_up[original_index]
+        return compressed
+
     def output_constraint(self, x_lo, x_up,
                           method: mip_utils.PropagateBoundsMethod):
         """
@@ -822,8 +1261,8 @@ class ReLUFreePattern:
         @param x_up A 1-D vector, the upper bound of input x.
         @param method The method to propagate the bounds of the inputs in each
         layer. If you want to take the gradient w.r.t the parameter in this
-        network, then use PropagateBoundsMethod.IA, otherwise use
-        PropagateBoundsMethod.LP.
+        network, then use PropagateBoundsMethod.IA or
+        PropagateBoundsMethod.CROWN, otherwise use PropagateBoundsMethod.LP.
         @return (Ain1, Ain2, Ain3, rhs_in, Aeq1, Aeq2, Aeq3, rhs_eq, A_out,
         b_out, z_pre_relu_lo, z_pre_relu_up, output_lo, output_up)
         Ain1, Ain2, Ain3, Aeq1, Aeq2, Aeq3, A_out are matrices, rhs_in, rhs_eq,
@@ -840,10 +1279,11 @@ class ReLUFreePattern:
         assert (len(x_up.shape) == 1)
         assert (torch.all(torch.le(x_lo, x_up)))
 
-        z_pre_relu_lo, z_pre_relu_up, z_post_relu_lo, z_post_relu_up =\
-            self._compute_layer_bound(x_lo, x_up, method)
-        output_lo, output_up = self._compute_network_output_bounds(
-            z_pre_relu_lo, z_pre_relu_up, x_lo, x_up, method)
+        with self.bound_tightening_pool():
+            z_pre_relu_lo, z_pre_relu_up, z_post_relu_lo, z_post_relu_up =\
+                self._compute_layer_bound(x_lo, x_up, method)
+            output_lo, output_up = self._compute_network_output_bounds(
+                z_pre_relu_lo, z_pre_relu_up, x_lo, x_up, method)
         mip_constr_return = self._output_constraint_given_bounds(
             z_pre_relu_lo, z_pre_relu_up, x_lo, x_up)
         mip_constr_return.nn_input_lo = x_lo
@@ -1062,6 +1502,136 @@ class ReLUFreePattern:
 
         return (M, B1, B2, d)
 
+    def output_gradient_compact(
+            self) -> gurobi_torch_mip.MixedIntegerConstraintsReturn:
+        """
+        An alternative to output_gradient() that encodes the gradient
+        ∂ϕ/∂x with a number of variables linear in the number of ReLU units,
+        instead of introducing one α per activation path.
+        With M(β, c) = c*I + (1-c)*diag(β) as in
+        output_gradient_times_vector(), the gradient is
+        ∂ϕ/∂x = Wₙ * Gₙ₋₁
+        Gᵢ = M(βᵢ, c) * Wᵢ * Gᵢ₋₁, i = 0, ..., n-1
+        with G₋₁ = I. Each entry of Gᵢ is the product between a binary βᵢ(j)
+        and the bounded continuous variable (Wᵢ * Gᵢ₋₁)(j, k), which we replace
+        with mixed-integer linear constraints layer by layer. This is
+        output_gradient_times_vector() applied to every column of the
+        identity matrix, sharing the same β. The bounds on Wᵢ * Gᵢ₋₁ are
+        computed through interval arithmetics.
+        The slack variable is slack = [vec(G₀); ...; vec(Gₙ₋₁)] in the
+        column-major order, namely Gᵢ(j, k) is
+        slack[k * num_relu_units + relu_unit_index[i][j]], and the binary
+        variable is β.
+        @return mip_cnstr_return The output is the gradient in the row-major
+        order, namely ∂ϕ/∂x(i, k) = (Aout_slack * slack)[i * x_size + k].
+        Aout_slack, Ain_slack and Ain_binary are sparse COO tensors. We do NOT
+        require that β is the right activation pattern for the input x, this
+        constraint should be imposed in output_constraint().
+        """
+        assert (isinstance(self.model[-1], nn.Linear))
+        num_relu_layers = len(self.relu_unit_index)
+        num_slack = self.num_relu_units * self.x_size
+        column = torch.arange(self.x_size)
+        Ain_slack_entries = ([], [], [])
+        Ain_binary_entries = ([], [], [])
+        rhs = []
+        slack_lo = torch.empty(num_slack, dtype=self.dtype)
+        slack_up = torch.empty(num_slack, dtype=self.dtype)
+
+        def add_entries(entries, row, col, val):
+            row, col, val = torch.broadcast_tensors(row, col, val)
+            mask = val != 0
+            entries[0].append(row[mask])
+            entries[1].append(col[mask])
+            entries[2].append(val[mask])
+
+        # z_lo/z_up are the bounds on Gᵢ₋₁.
+        z_lo = torch.eye(self.x_size, dtype=self.dtype)
+        z_up = torch.eye(self.x_size, dtype=self.dtype)
+        ineq_count = 0
+        layer_count = 0
+        for layer in self.model:
+            if isinstance(layer, nn.Linear):
+                W = layer.weight
+                W_pos = torch.clamp(W, min=0)
+                W_neg = torch.clamp(W, max=0)
+                Wz_lo = W_pos @ z_lo + W_neg @ z_up
+                Wz_up = W_pos @ z_up + W_neg @ z_lo
+            elif isinstance(layer, nn.ReLU) or isinstance(layer, nn.LeakyReLU):
+                if isinstance(layer, nn.ReLU):
+                    A_pre, A_z_next, A_beta, rhs_i = utils.\
+                        replace_binary_continuous_product(
+                            Wz_lo, Wz_up, dtype=self.dtype)
+                    z_lo = torch.clamp(Wz_lo, max=0)
+                    z_up = torch.clamp(Wz_up, min=0)
+                else:
+                    c = layer.negative_slope
+                    A_pre, A_z_next, A_beta, rhs_i = utils.\
+                        leaky_relu_gradient_times_x(
+                            Wz_lo, Wz_up, c, dtype=self.dtype)
+                    z_lo = torch.minimum(Wz_lo, c * Wz_lo)
+                    z_up = torch.maximum(Wz_up, c * Wz_up)
+                width = W.shape[0]
+                unit = torch.tensor(self.relu_unit_index[layer_count])
+                # Constraint r on Gᵢ(j, k) is the row
+                # ineq_count + (r * width + j) * x_size + k
+                row = ineq_count + torch.arange(4 * width * self.x_size).\
+                    reshape((4, width, self.x_size))
+                slack_index = column.reshape((1, -1)) * \
+                    self.num_relu_units + unit.reshape((-1, 1))
+                add_entries(Ain_slack_entries, row, slack_index.unsqueeze(0),
+                            A_z_next.reshape((-1, 1, 1)))
+                add_entries(Ain_binary_entries, row,
+                            unit.reshape((1, -1, 1)), A_beta)
+                if layer_count == 0:
+                    # Gᵢ₋₁ = I, so Wᵢ * Gᵢ₋₁ = Wᵢ is a constant.
+                    rhs_i = rhs_i - A_pre.reshape((-1, 1, 1)) * W
+                else:
+                    prev_unit = torch.tensor(
+                        self.relu_unit_index[layer_count - 1])
+                    add_entries(
+                        Ain_slack_entries, row.unsqueeze(-1),
+                        (column.reshape((-1, 1)) * self.num_relu_units +
+                         prev_unit.reshape((1, -1))).reshape(
+                             (1, 1, self.x_size, -1)),
+                        A_pre.reshape((-1, 1, 1, 1)) *
+                        W.reshape((1, width, 1, -1)))
+                rhs.append(rhs_i.reshape((-1, )))
+                slack_lo[slack_index] = z_lo
+                slack_up[slack_index] = z_up
+                ineq_count += 4 * width * self.x_size
+                layer_count += 1
+            else:
+                raise Exception("output_gradient_compact: we currently " +
+                                "only support linear and ReLU units.")
+
+        def to_sparse(entries, shape):
+            return torch.sparse_coo_tensor(
+                torch.stack((torch.cat(entries[0]), torch.cat(entries[1]))),
+                torch.cat(entries[2]), shape).coalesce()
+
+        # ∂ϕ/∂x(i, k) = ∑ⱼ Wₙ(i, j) * Gₙ₋₁(j, k)
+        out_features = W.shape[0]
+        last_unit = torch.tensor(self.relu_unit_index[num_relu_layers - 1])
+        Aout_entries = ([], [], [])
+        add_entries(
+            Aout_entries,
+            (torch.arange(out_features).reshape((-1, 1)) * self.x_size +
+             column.reshape((1, -1))).unsqueeze(-1),
+            (column.reshape((-1, 1)) * self.num_relu_units +
+             last_unit.reshape((1, -1))).unsqueeze(0), W.unsqueeze(1))
+        result = gurobi_torch_mip.MixedIntegerConstraintsReturn()
+        result.Aout_slack = to_sparse(
+            Aout_entries, (out_features * self.x_size, num_slack))
+        result.Ain_slack = to_sparse(Ain_slack_entries,
+                                     (ineq_count, num_slack))
+        result.Ain_binary = to_sparse(Ain_binary_entries,
+                                      (ineq_count, self.num_relu_units))
+        result.rhs_in = torch.cat(rhs)
+        result.slack_lo = slack_lo
+        result.slack_up = slack_up
+        return result
+
     def output_gradient_times_vector_w_bounds(
             self, z_lo, z_up, Wz_lo,
             Wz_up) -> ReLUGradientTimesVecMixedIntegerConstraintsReturn:
@@ -1406,3 +1976,265 @@ class ReLUFreePattern:
                         "compute_Wz_bounds_IA(): this layer should be either" +
                         "ReLU or leaky ReLU")
         return z_lo, z_up, Wz_lo, Wz_up
+
+
+def _compute_linear_output_bounds_worker(
+        model, dtype, bound_tightening_backend, layer_index,
+        linear_output_row_indices, previous_neuron_input_lo,
+        previous_neuron_input_up, network_input_lo, network_input_up,
+        create_prog_callback, binary_var_type):
+    """
+    The process pool worker of
+    ReLUFreePattern._compute_layer_output_bounds_by_optimization(). It only
+    receives the network and the bounds (not the ReLUFreePattern object,
+    whose bound_cache is not picklable).
+    """
+    relu_free_pattern = ReLUFreePattern(model, dtype)
+    relu_free_pattern.bound_tightening_backend = bound_tightening_backend
+    return relu_free_pattern._compute_linear_output_bounds_by_optimization(
+        layer_index, linear_output_row_indices, previous_neuron_input_lo,
+        previous_neuron_input_up, network_input_lo, network_input_up,
+        create_prog_callback, binary_var_type)
+
+
+class LayerBoundTighteningSession:
+    """
+    Compute the bounds of the linear layer outputs with LP/MILP, layer by
+    layer, within a single program.
+    The program starts with only the network input. We bound every output of
+    the current linear layer by changing the objective of the program, so the
+    simplex solver warm starts from the previous basis. Then we append the
+    constraints of the ReLU layer, using the bounds just computed, and move to
+    the next linear layer.
+    Usage:
+        session = LayerBoundTighteningSession(relu_free_pattern, x_lo, x_up,
+                                              binary_var_type)
+        for layer in range(len(relu_free_pattern.relu_unit_index)):
+            lo, up = session.compute_layer_bounds()
+            session.append_layer(lo, up)
+        output_lo, output_up = session.compute_layer_bounds()
+    """
+    def __init__(self,
+                 relu_free_pattern: ReLUFreePattern,
+                 network_input_lo: np.ndarray,
+                 network_input_up: np.ndarray,
+                 binary_var_type,
+                 create_prog_callback=None):
+        """
+        @param relu_free_pattern The ReLU network whose bounds are computed.
+        @param network_input_lo, network_input_up The bounds on the network
+        input.
+        @param binary_var_type The type of the binary variables for each
+        ReLU unit. Check GurobiTorchMIP.addVars() for more details.
+        @param create_prog_callback Refer to
+        ReLUFreePattern._compute_linear_output_bound_by_optimization().
+        """
+        assert (isinstance(relu_free_pattern, ReLUFreePattern))
+        self.relu_free_pattern = relu_free_pattern
+        self.binary_var_type = binary_var_type
+        # Only the network input is added to the program, the neuron bounds
+        # are not used.
+        self.prog, self.network_input, self.z_curr = \
+            relu_free_pattern._create_linear_output_bound_prog(
+                0, np.empty((0, )), np.empty((0, )), network_input_lo,
+                network_input_up, create_prog_callback, binary_var_type)
+        # The index of the linear layer whose output is bounded in
+        # compute_layer_bounds().
+        self.layer_index = 0
+
+    def compute_layer_bounds(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Compute the bounds on all the outputs of the current linear layer.
+        @return (linear_output_lo, linear_output_up)
+        """
+        num_rows = self.relu_free_pattern.model[2 *
+                                                self.layer_index].out_features
+        linear_output_lo = np.empty((num_rows, ))
+        linear_output_up = np.empty((num_rows, ))
+        for j in range(num_rows):
+            linear_output_lo[j], linear_output_up[j], _, _ = \
+                self.relu_free_pattern._optimize_linear_output_bound(
+                    self.prog, self.network_input, self.z_curr,
+                    self.layer_index, j)
+        return linear_output_lo, linear_output_up
+
+    def append_layer(self, relu_input_lo, relu_input_up):
+        """
+        Add the constraints of the current linear layer and its ReLU layer to
+        the program, and move to the next linear layer.
+        @param relu_input_lo, relu_input_up The bounds on the current linear
+        layer output, typically returned from compute_layer_bounds(), and
+        possibly tightened/relaxed afterwards.
+        """
+        assert (self.layer_index < len(self.relu_free_pattern.relu_unit_index))
+        model = self.relu_free_pattern.model
+        self.z_curr, _ = \
+            relu_to_optimization_utils._add_constraint_to_program_by_layer(
+                self.prog, model[2 * self.layer_index],
+                model[2 * self.layer_index + 1], self.z_curr,
+                torch.as_tensor(relu_input_lo,
+                                dtype=self.relu_free_pattern.dtype),
+                torch.as_tensor(relu_input_up,
+                                dtype=self.relu_free_pattern.dtype),
+                binary_var_type=self.binary_var_type)
+        self.layer_index += 1
+
+
+class ReLUBoundCache:
+    """
+    Reuse the bounds on the ReLU unit inputs, computed by LP/MIP/IA_MIP,
+    across many calls to ReLUFreePattern._compute_layer_bound(), for example
+    across training iterations where the network parameters only change
+    slightly.
+    The cache is keyed by the input box, the bound propagation method and the
+    cache_tag passed by the caller. Without a cache_tag, the
+    create_prog_callback object itself is used (compared by identity), so a
+    caller that constructs a new callback in each call should pass a cache_tag
+    instead, and the same cache_tag must always mean the same additional
+    constraints in create_prog_callback. The cache keeps the max_entries most
+    recently used entries. Each entry also stores a snapshot of the network
+    parameters at which its bounds are valid. When the parameters have
+    changed, we bound how far each neuron input can move. Denote the
+    parameters in the snapshot as Wᵢ, bᵢ, and the current parameters as
+    Wᵢ + ΔWᵢ, bᵢ + Δbᵢ, then
+    |zᵢ₊₁ - zᵢ₊₁_snapshot| <= |ΔWᵢ| * |hᵢ| + |Wᵢ| * δᵢ + |Δbᵢ| = δᵢ₊₁
+    where hᵢ is the current ReLU output of layer i (bounded by interval
+    arithmetics), and δᵢ is the margin of the previous layer (δ₀ = 0 since
+    the input box is the same). The cached bounds widened by δ are still
+    valid, we further intersect them with the IA bounds. A neuron is
+    refreshed by LP/MIP when its margin exceeds refresh_tolerance times the
+    width of its cached bounds, or when the widened bound changes whether the
+    ReLU unit is always active/inactive. All the bounds are recomputed after
+    an entry has been reused max_reuse times.
+    Note that the margin δ only accounts for the change of the parameters in
+    relu_free_pattern.model. If create_prog_callback adds the constraints of
+    another network that changes between the calls (for example a controller
+    being trained), then the cached bounds are not valid any more, and the
+    caller has to pass a cache_tag that changes with these constraints (for
+    example a mip_cache.compute_fingerprint() of that network and its
+    bounds).
+    The cache can be shared by several threads.
+    """
+    def __init__(self,
+                 max_reuse: int = 10,
+                 refresh_tolerance: float = 0.1,
+                 max_entries: int = 128):
+        assert (max_reuse >= 0)
+        assert (refresh_tolerance >= 0)
+        assert (max_entries >= 1)
+        self.max_reuse = max_reuse
+        self.refresh_tolerance = refresh_tolerance
+        self.max_entries = max_entries
+        # Ordered from the least recently used to the most recently used.
+        self.entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.entries = collections.OrderedDict()
+
+    def _key(self, x_lo, x_up, method, create_prog_callback, cache_tag=None):
+        return (method, create_prog_callback if cache_tag is None else
+                ("tag", cache_tag), tuple(x_lo.detach().tolist()),
+                tuple(x_up.detach().tolist()))
+
+    def _store(self, key, relu_free_pattern, z_pre_relu_lo, z_pre_relu_up,
+               reuse_count):
+        params = [(layer.weight.detach().clone(),
+                   None if layer.bias is None else layer.bias.detach().clone())
+                  for layer in relu_free_pattern.model[:-1:2]]
+        with self._lock:
+            self.entries[key] = (params, z_pre_relu_lo.detach().clone(),
+                                 z_pre_relu_up.detach().clone(), reuse_count)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def compute_layer_bound(self, relu_free_pattern: ReLUFreePattern, x_lo,
+                            x_up, method: mip_utils.PropagateBoundsMethod,
+                            create_prog_callback, cache_tag=None):
+        """
+        Same as ReLUFreePattern._compute_layer_bound(), but reuses the cached
+        bounds if possible.
+        @param cache_tag Identifies create_prog_callback in the cache key.
+        Refer to the class documentation.
+        """
+        key = self._key(x_lo, x_up, method, create_prog_callback, cache_tag)
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[3] >= self.max_reuse:
+            z_pre_relu_lo, z_pre_relu_up, z_post_relu_lo, z_post_relu_up = \
+                relu_free_pattern._compute_layer_bound_by_optimization(
+                    x_lo, x_up, method, create_prog_callback)
+            self._store(key, relu_free_pattern, z_pre_relu_lo, z_pre_relu_up,
+                        0)
+            return z_pre_relu_lo, z_pre_relu_up, z_post_relu_lo, z_post_relu_up
+        params, cached_lo, cached_up, reuse_count = entry
+        dtype = relu_free_pattern.dtype
+        binary_var_type = mip_utils.binary_var_type_per_method(method)
+        z_pre_relu_lo = torch.empty((relu_free_pattern.num_relu_units, ),
+                                    dtype=dtype)
+        z_pre_relu_up = torch.empty((relu_free_pattern.num_relu_units, ),
+                                    dtype=dtype)
+        z_post_relu_lo = torch.empty((relu_free_pattern.num_relu_units, ),
+                                     dtype=dtype)
+        z_post_relu_up = torch.empty((relu_free_pattern.num_relu_units, ),
+                                     dtype=dtype)
+        linear_input_lo = x_lo
+        linear_input_up = x_up
+        margin = torch.zeros_like(x_lo)
+        for layer_count, z_indices in enumerate(
+                relu_free_pattern.relu_unit_index):
+            linear_layer = relu_free_pattern.model[2 * layer_count]
+            relu_layer = relu_free_pattern.model[2 * layer_count + 1]
+            W_old, b_old = params[layer_count]
+            bias = linear_layer.bias if linear_layer.bias is not None else\
+                torch.zeros((linear_layer.out_features, ), dtype=dtype)
+            linear_input_abs = torch.max(torch.abs(linear_input_lo),
+                                         torch.abs(linear_input_up))
+            margin = torch.abs(linear_layer.weight - W_old) @ \
+                linear_input_abs + torch.abs(W_old) @ margin
+            if b_old is not None:
+                margin = margin + torch.abs(bias - b_old)
+            lo_ia, up_ia = mip_utils.compute_range_by_IA(
+                linear_layer.weight, bias, linear_input_lo, linear_input_up)
+            lo = torch.max(cached_lo[z_indices] - margin, lo_ia)
+            up = torch.min(cached_up[z_indices] + margin, up_ia)
+            drifted = torch.logical_or(
+                margin > self.refresh_tolerance *
+                (cached_up[z_indices] - cached_lo[z_indices]),
+                torch.logical_or(
+                    torch.logical_and(cached_lo[z_indices] >= 0, lo < 0),
+                    torch.logical_and(cached_up[z_indices] <= 0, up > 0)))
+            z_pre_relu_lo[z_indices] = lo
+            z_pre_relu_up[z_indices] = up
+            for j in torch.nonzero(drifted).reshape((-1, )).tolist():
+                lo_j, up_j, _, _ = relu_free_pattern.\
+                    _compute_linear_output_bound_by_optimization(
+                        layer_count, j, z_pre_relu_lo.detach().numpy(),
+                        z_pre_relu_up.detach().numpy(),
+                        x_lo.detach().numpy(), x_up.detach().numpy(),
+                        create_prog_callback, binary_var_type)
+                z_pre_relu_lo[z_indices[j]] = lo_j
+                z_pre_relu_up[z_indices[j]] = up_j
+            z_post_relu_lo[z_indices], z_post_relu_up[z_indices] = \
+                mip_utils.propagate_bounds(relu_layer,
+                                           z_pre_relu_lo[z_indices],
+                                           z_pre_relu_up[z_indices])
+            linear_input_lo = z_post_relu_lo[z_indices]
+            linear_input_up = z_post_relu_up[z_indices]
+            # The leaky ReLU is max(1, |c|) Lipschitz.
+            if isinstance(relu_layer, nn.LeakyReLU):
+                margin = margin * max(1., abs(relu_layer.negative_slope))
+        self._store(key, relu_free_pattern, z_pre_relu_lo, z_pre_relu_up,
+                    reuse_count + 1)
+        return z_pre_relu_lo, z_pre_relu_up, z_post_relu_lo, z_post_relu_up
@@ -0,0 +1,118 @@
+"""
+Compare ReLUFreePattern.output_gradient() against
+ReLUFreePattern.output_gradient_compact() on networks with increasing width.
+For each width we report the size of the gradient encoding, the time to
+construct it, and the time to solve
+maxₓ ∂ϕ/∂x(0, 0) s.t x_lo <= x <= x_up
+where the binary variables β are linked to x through output_constraint().
+output_gradient() is skipped once its number of α variables exceeds
+--max_alpha.
+"""
+import neural_network_lyapunov.relu_to_optimization as relu_to_optimization
+import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
+import neural_network_lyapunov.mip_utils as mip_utils
+import neural_network_lyapunov.utils as utils
+
+import torch
+import numpy as np
+import gurobipy
+
+import argparse
+import time
+
+
+def add_network_constraint(relu_free_pattern, x_lo, x_up, dtype):
+    mip = gurobi_torch_mip.GurobiTorchMILP(dtype)
+    x = mip.addVars(relu_free_pattern.x_size,
+                    lb=-gurobipy.GRB.INFINITY,
+                    name="x")
+    mip_cnstr_return = relu_free_pattern.output_constraint(
+        x_lo, x_up, mip_utils.PropagateBoundsMethod.IA)
+    _, beta = mip.add_mixed_integer_linear_constraints(
+        mip_cnstr_return, x, None, "z", "beta", "relu_ineq", "relu_eq", "")
+    return mip, beta
+
+
+def solve(mip):
+    mip.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+    start = time.time()
+    mip.gurobi_model.optimize()
+    return mip.gurobi_model.ObjVal, time.time() - start
+
+
+def benchmark_alpha(relu_free_pattern, x_lo, x_up, dtype):
+    start = time.time()
+    (M, B1, B2, d) = relu_free_pattern.output_gradient()
+    construct_time = time.time() - start
+    mip, beta = add_network_constraint(relu_free_pattern, x_lo, x_up, dtype)
+    alpha = mip.addVars(M.shape[0],
+                        lb=0.,
+                        ub=1.,
+                        vtype=gurobipy.GRB.BINARY,
+                        name="alpha")
+    mip.addMConstr([B1, B2], [alpha, beta],
+                   sense=gurobipy.GRB.LESS_EQUAL,
+                   b=d.reshape((-1, )))
+    mip.setObjective([M[:, 0]], [alpha], 0., gurobipy.GRB.MAXIMIZE)
+    obj, solve_time = solve(mip)
+    return M.shape[0], B1.shape[0], construct_time, obj, solve_time
+
+
+def benchmark_compact(relu_free_pattern, x_lo, x_up, dtype):
+    start = time.time()
+    mip_cnstr_return = relu_free_pattern.output_gradient_compact()
+    construct_time = time.time() - start
+    mip, beta = add_network_constraint(relu_free_pattern, x_lo, x_up, dtype)
+    slack, _ = mip.add_mixed_integer_linear_constraints(
+        mip_cnstr_return, [], None, "gradient_slack", beta, "gradient_ineq",
+        "gradient_eq", "")
+    mip.setObjective([mip_cnstr_return.Aout_slack.to_dense()[0]], [slack],
+                     0., gurobipy.GRB.MAXIMIZE)
+    obj, solve_time = solve(mip)
+    return len(slack), mip_cnstr_return.rhs_in.shape[0], construct_time,\
+        obj, solve_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmark the output gradient encodings.")
+    parser.add_argument("--x_size", type=int, default=2)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument("--widths",
+                        type=int,
+                        nargs="+",
+                        default=[4, 8, 16, 32, 64])
+    parser.add_argument("--max_alpha", type=int, default=5000)
+    args = parser.parse_args()
+    dtype = torch.float64
+    torch.manual_seed(0)
+    x_lo = -torch.ones(args.x_size, dtype=dtype)
+    x_up = torch.ones(args.x_size, dtype=dtype)
+    print("width | encoding | #vars | #ineq | construct(s) | solve(s) | obj")
+    for width in args.widths:
+        # output_gradient() only supports ReLU (not leaky ReLU) units.
+        relu = torch.nn.Sequential(*[
+            torch.nn.ReLU() if isinstance(layer, torch.nn.LeakyReLU) else layer
+            for layer in utils.setup_relu((args.x_size, ) +
+                                          (width, ) * args.num_hidden_layers +
+                                          (1, ),
+                                          params=None,
+                                          bias=True,
+                                          dtype=dtype)
+        ])
+        relu_free_pattern = relu_to_optimization.ReLUFreePattern(relu, dtype)
+        num_alpha = np.prod([
+            len(layer_units)
+            for layer_units in relu_free_pattern.relu_unit_index
+        ])
+        if num_alpha <= args.max_alpha:
+            print(f"{width} | alpha | " + " | ".join([
+                f"{v:.4g}" for v in benchmark_alpha(relu_free_pattern, x_lo,
+                                                    x_up, dtype)
+            ]))
+        else:
+            print(f"{width} | alpha | {num_alpha} | skipped")
+        print(f"{width} | compact | " + " | ".join([
+            f"{v:.4g}" for v in benchmark_compact(relu_free_pattern, x_lo,
+                                                  x_up, dtype)
+        ]))
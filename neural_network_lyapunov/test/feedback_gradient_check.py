@@ -151,6 +151,14 @@ def check_lyapunov_mip_loss_grad(lyap, x_equilibrium, V_lambda, V_epsilon,
                                    atol=atol)
 
 
+def _get_mip_entry(mip, entry_name):
+    # entry_name can be a dotted path such as "Ain_r_coo.val".
+    entry = mip
+    for name in entry_name.split("."):
+        entry = getattr(entry, name)
+    return entry
+
+
 def create_mip(lyap, x_equilibrium, V_lambda, V_epsilon, R_options,
                positivity_flag, eps_type, controller_param, lyapunov_param):
     utils.update_relu_params(lyap.system.controller_network,
@@ -207,15 +215,15 @@ def check_lyapunov_mip_grad(lyap, x_equilibrium, V_lambda, V_epsilon,
                                  R_options, positivity_flag, eps_type,
                                  controller_param_torch, lyapunov_param_torch)
             if entry_index is None:
-                return getattr(mip_tmp, entry_name)
+                return _get_mip_entry(mip_tmp, entry_name)
             elif entry_index == "sum":
-                entries = getattr(mip_tmp, entry_name)
+                entries = _get_mip_entry(mip_tmp, entry_name)
                 if isinstance(entries, list):
                     return torch.stack(entries).sum()
                 elif isinstance(entries, torch.Tensor):
                     return entries.sum()
             else:
-                return getattr(mip_tmp, entry_name)[entry_index]
+                return _get_mip_entry(mip_tmp, entry_name)[entry_index]
 
         if R_options.fixed_R:
             check_lyapunov_grad(
@@ -241,27 +249,27 @@ def check_lyapunov_mip_grad(lyap, x_equilibrium, V_lambda, V_epsilon,
     mip = create_mip(lyap, x_equilibrium, V_lambda, V_epsilon, R_options,
                      positivity_flag, eps_type, controller_relu_params,
                      lyapunov_relu_params)
-    check_mip_entry_grad("Ain_r_val", "sum")
-    check_mip_entry_grad("Ain_zeta_val", "sum")
-    check_mip_entry_grad("rhs_in", "sum")
-    check_mip_entry_grad("Aeq_r_val", "sum")
-    check_mip_entry_grad("Aeq_zeta_val", "sum")
-    check_mip_entry_grad("rhs_eq", "sum")
+    check_mip_entry_grad("Ain_r_coo.val", "sum")
+    check_mip_entry_grad("Ain_zeta_coo.val", "sum")
+    check_mip_entry_grad("rhs_in.val", "sum")
+    check_mip_entry_grad("Aeq_r_coo.val", "sum")
+    check_mip_entry_grad("Aeq_zeta_coo.val", "sum")
+    check_mip_entry_grad("rhs_eq.val", "sum")
     check_mip_entry_grad("c_r", "sum")
     check_mip_entry_grad("c_zeta", "sum")
     check_mip_entry_grad("c_constant", None)
-    for i in range(len(mip.Ain_r_val)):
-        check_mip_entry_grad("Ain_r_val", i)
-    for i in range(len(mip.Ain_zeta_val)):
-        check_mip_entry_grad("Ain_zeta_val", i)
+    for i in range(len(mip.Ain_r_coo)):
+        check_mip_entry_grad("Ain_r_coo.val", i)
+    for i in range(len(mip.Ain_zeta_coo)):
+        check_mip_entry_grad("Ain_zeta_coo.val", i)
     for i in range(len(mip.rhs_in)):
-        check_mip_entry_grad("rhs_in", i)
-    for i in range(len(mip.Aeq_r_val)):
-        check_mip_entry_grad("Aeq_r_val", i)
-    for i in range(len(mip.Aeq_zeta_val)):
-        check_mip_entry_grad("Aeq_zeta_val", i)
+        check_mip_entry_grad("rhs_in.val", i)
+    for i in range(len(mip.Aeq_r_coo)):
+        check_mip_entry_grad("Aeq_r_coo.val", i)
+    for i in range(len(mip.Aeq_zeta_coo)):
+        check_mip_entry_grad("Aeq_zeta_coo.val", i)
     for i in range(len(mip.rhs_eq)):
-        check_mip_entry_grad("rhs_eq", i)
+        check_mip_entry_grad("rhs_eq.val", i)
     for i in range(len(mip.c_r)):
         check_mip_entry_grad("c_r", i)
     for i in range(len(mip.c_zeta)):
@@ -349,17 +357,9 @@ def compute_mip_loss(lyap, x_equilibrium, V_lambda, V_epsilon, R_options,
     active_ineq_row_indices = set(
         active_ineq_row_indices[np.abs(lhs_in.detach().numpy() -
                                        rhs_in.detach().numpy()) < 1E-6])
-    A_act1 = torch.sparse.DoubleTensor(
-        torch.LongTensor([mip.Aeq_r_row, mip.Aeq_r_col]),
-        torch.stack(mip.Aeq_r_val).type(torch.float64),
-        torch.Size([len(mip.rhs_eq), len(mip.r)])).type(mip.dtype).to_dense()
-    Aeq_zeta = torch.sparse.DoubleTensor(
-        torch.LongTensor([mip.Aeq_zeta_row, mip.Aeq_zeta_col]),
-        torch.stack(mip.Aeq_zeta_val).type(torch.float64),
-        torch.Size([len(mip.rhs_eq),
-                    len(mip.zeta)])).type(mip.dtype).to_dense()
-    b_act1 = torch.stack([s.squeeze()
-                          for s in mip.rhs_eq]) - Aeq_zeta @ zeta_sol
+    A_act1 = mip.Aeq_r_coo.to_dense(len(mip.rhs_eq), len(mip.r))
+    Aeq_zeta = mip.Aeq_zeta_coo.to_dense(len(mip.rhs_eq), len(mip.zeta))
+    b_act1 = mip.rhs_eq.val - Aeq_zeta @ zeta_sol
     active_ineq_row_indices_list = list(active_ineq_row_indices)
     Ain_active_r = Ain_r[active_ineq_row_indices_list]
     Ain_active_zeta = Ain_zeta[active_ineq_row_indices_list]
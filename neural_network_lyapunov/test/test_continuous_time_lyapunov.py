@@ -108,6 +108,32 @@ class TestLyapunovContinuousTimeSystem(unittest.TestCase):
                                    (dVdx @ xdot +
                                     epsilon * V).detach().numpy())
 
+    def test_lyapunov_derivative_batch(self):
+        dut = mut.LyapunovContinuousTimeSystem(self.system1,
+                                               self.lyapunov_relu1)
+        torch.manual_seed(0)
+        x_samples = torch.cat((utils.uniform_sample_in_box(
+            dut.system.x_lo, dut.system.x_up,
+            20), torch.tensor([[1, -2]], dtype=self.dtype)),
+                              dim=0)
+        V_lambda = 0.5
+        epsilon = 0.1
+        R = torch.tensor([[1, -1], [0, 2], [1, 1]], dtype=self.dtype)
+        Vdot, offsets = dut.lyapunov_derivative_batch(
+            x_samples, dut.system.x_equilibrium, V_lambda, epsilon, R=R)
+        self.assertEqual(offsets.shape, (x_samples.shape[0] + 1, ))
+        self.assertEqual(Vdot.shape, (offsets[-1].item(), ))
+        for i in range(x_samples.shape[0]):
+            Vdot_expected = dut.lyapunov_derivative(x_samples[i],
+                                                    dut.system.x_equilibrium,
+                                                    V_lambda,
+                                                    epsilon,
+                                                    R=R)
+            # The order of the values doesn't matter.
+            np.testing.assert_allclose(
+                np.sort(Vdot[offsets[i]:offsets[i + 1]].detach().numpy()),
+                np.sort(Vdot_expected.detach().numpy()))
+
     def lyapunov_derivative_as_milp_tester(self, dut, x_equilibrium, V_lambda,
                                            epsilon, eps_type, R,
                                            lyapunov_lower, lyapunov_upper):
@@ -116,5 +116,44 @@ class TestAddSystemConstraint(unittest.TestCase):
             self.assertEqual(v.vtype, gurobipy.GRB.CONTINUOUS)
 
 
+class TestRestrictSystemBox(unittest.TestCase):
+    def test(self):
+        dtype = torch.float64
+        closed_loop_system, _ = \
+            test_lyapunov.setup_relu_feedback_system_and_lyapunov(dtype)
+        for system in (test_hybrid_linear_system.
+                       setup_trecate_discrete_time_system(),
+                       relu_system.AutonomousReLUSystemGivenEquilibrium(
+                           dtype, torch.tensor([-2, -3], dtype=dtype),
+                           torch.tensor([1, -2], dtype=dtype),
+                           test_relu_system.setup_relu_dyn(dtype),
+                           torch.tensor([-1, -2.5], dtype=dtype)),
+                       closed_loop_system):
+            x_lo_all = system.x_lo_all.copy()
+            x_up_all = system.x_up_all.copy()
+            x_mid = (x_lo_all + x_up_all) / 2
+            restricted = mut._restrict_system_box(
+                system, torch.from_numpy(x_mid),
+                torch.from_numpy(x_up_all + 1))
+            np.testing.assert_allclose(restricted.x_lo_all, x_mid)
+            np.testing.assert_allclose(restricted.x_up_all, x_up_all)
+            # The original system is not changed.
+            np.testing.assert_allclose(system.x_lo_all, x_lo_all)
+            np.testing.assert_allclose(system.x_up_all, x_up_all)
+            # The dynamics constraint of the restricted system only admits
+            # the states in the smaller box.
+            milp = gurobi_torch_mip.GurobiTorchMILP(dtype)
+            x = milp.addVars(system.x_dim, lb=-gurobipy.GRB.INFINITY)
+            x_next = milp.addVars(system.x_dim, lb=-gurobipy.GRB.INFINITY)
+            mut._add_system_constraint(restricted, milp, x, x_next)
+            milp.setObjective([torch.ones((system.x_dim, ), dtype=dtype)],
+                              [x], 0., gurobipy.GRB.MINIMIZE)
+            milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+            milp.gurobi_model.optimize()
+            if milp.gurobi_model.status == gurobipy.GRB.Status.OPTIMAL:
+                np.testing.assert_array_less(
+                    x_mid - 1E-6, np.array([v.x for v in x]))
+
+
 if __name__ == "__main__":
     unittest.main()
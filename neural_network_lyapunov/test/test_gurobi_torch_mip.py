@@ -4,6 +4,8 @@ import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
 import neural_network_lyapunov.utils as utils
 import unittest
 import numpy as np
+import os
+import tempfile
 
 
 class TestMixedIntegerConstraintsReturn(unittest.TestCase):
@@ -121,6 +123,23 @@ class TestMixedIntegerConstraintsReturn(unittest.TestCase):
         dut.Cout = torch.tensor([2], dtype=dtype)
         self.transform_input_tester(dut, x_eq)
 
+        # The sparse matrices remain sparse after transforming the input.
+        dut_sparse = dut.clone()
+        for item in ("Ain_input", "Aeq_input", "Aout_input"):
+            dut_sparse.__dict__[item] = dut.__dict__[item].to_sparse()
+        A = torch.tensor([[1, 0, 2], [2, 1, 2], [3, 1, 2]], dtype=dtype)
+        b = torch.tensor([1, 3, 2], dtype=dtype)
+        dut.transform_input(A, b)
+        dut_sparse.transform_input(A, b)
+        for item in ("Ain_input", "Aeq_input", "Aout_input"):
+            self.assertTrue(dut_sparse.__dict__[item].is_sparse)
+            np.testing.assert_allclose(
+                dut_sparse.__dict__[item].to_dense().numpy(),
+                dut.__dict__[item].numpy())
+        for item in ("rhs_in", "rhs_eq", "Cout"):
+            np.testing.assert_allclose(dut_sparse.__dict__[item].numpy(),
+                                       dut.__dict__[item].numpy())
+
 
 class TestConcatenateMixedIntegerConstraints(unittest.TestCase):
     def concatenate_tester(self, cnstr1, cnstr2, same_slack, same_binary,
@@ -252,6 +271,27 @@ class TestConcatenateMixedIntegerConstraints(unittest.TestCase):
         check_bnd(cnstr1.binary_up, cnstr2.binary_up, ret.binary_up,
                   cnstr1.num_binary(), cnstr2.num_binary(), same_binary, True)
 
+        # Now store the matrices in cnstr1 as sparse matrices, the
+        # concatenated matrices should be sparse with the same value.
+        cnstr1_sparse = cnstr1.clone()
+        for item, val in cnstr1.__dict__.items():
+            if val is not None and len(val.shape) == 2:
+                cnstr1_sparse.__dict__[item] = val.to_sparse()
+        ret_sparse = gurobi_torch_mip.concatenate_mixed_integer_constraints(
+            cnstr1_sparse, cnstr2, same_slack, same_binary, stack_output)
+        for item, val in ret.__dict__.items():
+            if val is None:
+                self.assertIsNone(ret_sparse.__dict__[item])
+                continue
+            val_sparse = ret_sparse.__dict__[item]
+            if cnstr1_sparse.__dict__[item] is not None and\
+                    cnstr1_sparse.__dict__[item].is_sparse:
+                self.assertTrue(val_sparse.is_sparse)
+            if val_sparse.is_sparse:
+                val_sparse = val_sparse.to_dense()
+            np.testing.assert_allclose(val_sparse.detach().numpy(),
+                                       val.detach().numpy())
+
     def test1(self):
         cnstr1 = gurobi_torch_mip.MixedIntegerConstraintsReturn()
         cnstr2 = gurobi_torch_mip.MixedIntegerConstraintsReturn()
@@ -369,6 +409,136 @@ class TestConcatenateMixedIntegerConstraints(unittest.TestCase):
                                 stack_output=True)
 
 
+class TestCOOMatrixStorage(unittest.TestCase):
+    def test_append(self):
+        dtype = torch.float64
+        dut = gurobi_torch_mip.COOMatrixStorage(dtype)
+        self.assertEqual(len(dut), 0)
+        self.assertEqual(dut.to_dense(2, 3).shape, (2, 3))
+        val1 = torch.tensor([1., 2., 3.], dtype=dtype, requires_grad=True)
+        dut.append([0, 0, 2], [1, 2, 0], val1)
+        # Append enough entries to grow the buffers.
+        val2 = torch.arange(20, dtype=dtype, requires_grad=True)
+        dut.append(np.arange(3, 23), np.zeros(20), val2)
+        self.assertEqual(len(dut), 23)
+        np.testing.assert_array_equal(dut.row,
+                                      np.concatenate(([0, 0, 2],
+                                                      np.arange(3, 23))))
+        np.testing.assert_array_equal(dut.col,
+                                      np.concatenate(([1, 2, 0],
+                                                      np.zeros(20))))
+        np.testing.assert_allclose(
+            dut.val.detach().numpy(),
+            np.concatenate((val1.detach().numpy(), val2.detach().numpy())))
+        A = dut.to_dense(23, 3)
+        A_expected = torch.zeros((23, 3), dtype=dtype)
+        A_expected[0, 1] = 1
+        A_expected[0, 2] = 2
+        A_expected[2, 0] = 3
+        A_expected[3:, 0] = torch.arange(20, dtype=dtype)
+        np.testing.assert_allclose(A.detach().numpy(), A_expected.numpy())
+        # The gradient flows back to the appended blocks, even if the values
+        # are merged inside torch.no_grad()
+        with torch.no_grad():
+            dut.val
+        dut.to_dense(23, 3).sum().backward()
+        np.testing.assert_allclose(val1.grad.numpy(), np.ones(3))
+        np.testing.assert_allclose(val2.grad.numpy(), np.ones(20))
+
+    def test_to_dense_rows(self):
+        dtype = torch.float64
+        dut = gurobi_torch_mip.COOMatrixStorage(dtype)
+        val = torch.tensor([1., 2., 3., 4., 5.],
+                           dtype=dtype,
+                           requires_grad=True)
+        dut.append([2, 0, 2, 3, 0], [0, 1, 1, 2, 1], val)
+        A = dut.to_dense(4, 3)
+        np.testing.assert_allclose(
+            A.detach().numpy(),
+            np.array([[0, 7, 0], [0, 0, 0], [1, 3, 0], [0, 0, 4]]))
+        for rows in ([2, 0], [3], [1], [], [0, 1, 2, 3]):
+            A_rows = dut.to_dense(4, 3, rows=rows)
+            np.testing.assert_allclose(A_rows.detach().numpy(),
+                                       A.detach().numpy()[rows])
+        dut.to_dense(4, 3, rows=[2, 3]).sum().backward()
+        np.testing.assert_allclose(val.grad.numpy(), np.array([1, 0, 1, 1,
+                                                               0]))
+
+    def test_sparse(self):
+        dtype = torch.float64
+        dut = gurobi_torch_mip.COOMatrixStorage(dtype)
+        val = torch.tensor([1., 2., 3.], dtype=dtype, requires_grad=True)
+        dut.append([0, 1, 1], [1, 0, 2], val)
+        A_sparse = dut.to_sparse(3, 3)
+        self.assertTrue(A_sparse.is_sparse)
+        np.testing.assert_allclose(A_sparse.to_dense().detach().numpy(),
+                                   dut.to_dense(3, 3).detach().numpy())
+        torch.sparse.sum(A_sparse).backward()
+        np.testing.assert_allclose(val.grad.numpy(), np.ones(3))
+        A_csr = dut.to_scipy_csr(3, 3)
+        np.testing.assert_allclose(A_csr.toarray(),
+                                   dut.to_dense(3, 3).detach().numpy())
+        # The CSR matrix is cached until we append new entries.
+        self.assertIs(dut.to_scipy_csr(3, 3), A_csr)
+        dut.append([2], [2], torch.tensor([4.], dtype=dtype))
+        A_csr = dut.to_scipy_csr(3, 3)
+        np.testing.assert_allclose(
+            A_csr.toarray(), np.array([[0, 1, 0], [2, 0, 3], [0, 0, 4]]))
+
+
+class TestSparseLinearSolve(unittest.TestCase):
+    def test_factorize(self):
+        row = np.array([0, 1, 2, 0])
+        col = np.array([0, 1, 2, 2])
+        lu, rcond = gurobi_torch_mip.factorize_sparse_matrix(
+            row, col, np.array([2., 4., 1., 1.]), 3)
+        self.assertIsNotNone(lu)
+        self.assertAlmostEqual(rcond, 0.25)
+        # Singular matrix.
+        lu, rcond = gurobi_torch_mip.factorize_sparse_matrix(
+            row, col, np.array([2., 4., 0., 1.]), 3)
+        self.assertIsNone(lu)
+        self.assertEqual(rcond, 0.)
+
+    def test_gradient(self):
+        dtype = torch.float64
+        torch.manual_seed(0)
+        row = np.array([0, 0, 1, 1, 2, 2, 3, 3, 0])
+        col = np.array([0, 3, 1, 2, 0, 2, 1, 3, 0])
+        val = torch.rand((len(row), ), dtype=dtype) + 1
+        b = torch.rand((4, ), dtype=dtype)
+        M = torch.zeros((4, 4), dtype=dtype).index_put(
+            (torch.from_numpy(row), torch.from_numpy(col)),
+            val,
+            accumulate=True)
+        lu, _ = gurobi_torch_mip.factorize_sparse_matrix(row, col, val, 4)
+        x = gurobi_torch_mip.SparseLinearSolve.apply(val, b, row, col, lu)
+        np.testing.assert_allclose(x.numpy(),
+                                   torch.linalg.solve(M, b).numpy())
+
+        def solve(val_in, b_in):
+            return gurobi_torch_mip.SparseLinearSolve.apply(
+                val_in, b_in, row, col, lu)
+
+        # The factorization is fixed, so we can only check the gradient at
+        # the values used in the factorization.
+        val.requires_grad = True
+        b.requires_grad = True
+        c = torch.tensor([1., -2., 3., 0.5], dtype=dtype)
+        (c @ solve(val, b)).backward()
+        val_grad = val.grad.clone()
+        b_grad = b.grad.clone()
+        val.grad.zero_()
+        b.grad.zero_()
+        M = torch.zeros((4, 4), dtype=dtype).index_put(
+            (torch.from_numpy(row), torch.from_numpy(col)),
+            val,
+            accumulate=True)
+        (c @ torch.linalg.solve(M, b)).backward()
+        np.testing.assert_allclose(val_grad.numpy(), val.grad.numpy())
+        np.testing.assert_allclose(b_grad.numpy(), b.grad.numpy())
+
+
 def setup_mip1(dut):
     dtype = torch.float64
     # The constraints are
@@ -401,6 +571,18 @@ def setup_mip1(dut):
 
 
 class TestGurobiTorchMIP(unittest.TestCase):
+    def test_gurobi_env(self):
+        env = gurobipy.Env(empty=True)
+        env.setParam(gurobipy.GRB.Param.OutputFlag, 0)
+        env.setParam(gurobipy.GRB.Param.Threads, 1)
+        env.start()
+        with gurobi_torch_mip.gurobi_env(env):
+            dut = gurobi_torch_mip.GurobiTorchMILP(torch.float64)
+            self.assertEqual(dut.gurobi_model.Params.Threads, 1)
+        # Outside of the context, the MIP uses the default environment.
+        dut = gurobi_torch_mip.GurobiTorchMILP(torch.float64)
+        self.assertEqual(dut.gurobi_model.Params.Threads, 0)
+
     def test_add_vars1(self):
         dut = gurobi_torch_mip.GurobiTorchMIP(torch.float64)
         # Add continuous variables with no bounds
@@ -411,9 +593,9 @@ class TestGurobiTorchMIP(unittest.TestCase):
                          2)
         self.assertEqual(dut.r, [x[0], x[1]])
         self.assertEqual(len(dut.zeta), 0)
-        self.assertEqual(len(dut.Ain_r_row), 0)
-        self.assertEqual(len(dut.Ain_r_col), 0)
-        self.assertEqual(len(dut.Ain_r_val), 0)
+        self.assertEqual(len(dut.Ain_r_coo.row), 0)
+        self.assertEqual(len(dut.Ain_r_coo.col), 0)
+        self.assertEqual(len(dut.Ain_r_coo.val), 0)
         self.assertEqual(len(dut.rhs_in), 0)
         self.assertEqual(dut.r_indices, {x[0]: 0, x[1]: 1})
         self.assertEqual(len(dut.zeta_indices), 0)
@@ -427,9 +609,9 @@ class TestGurobiTorchMIP(unittest.TestCase):
                          5)
         self.assertEqual(dut.r, [x[0], x[1], y[0], y[1], y[2]])
         self.assertEqual(len(dut.zeta), 0)
-        self.assertEqual(dut.Ain_r_row, [0, 1, 2, 3, 4, 5])
-        self.assertEqual(dut.Ain_r_col, [2, 3, 4, 2, 3, 4])
-        self.assertEqual(dut.Ain_r_val, [
+        self.assertEqual(dut.Ain_r_coo.row.tolist(), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(dut.Ain_r_coo.col.tolist(), [2, 3, 4, 2, 3, 4])
+        self.assertEqual(dut.Ain_r_coo.val.tolist(), [
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-1, dtype=torch.float64),
@@ -437,7 +619,7 @@ class TestGurobiTorchMIP(unittest.TestCase):
             torch.tensor(1, dtype=torch.float64),
             torch.tensor(1, dtype=torch.float64)
         ])
-        self.assertEqual(dut.rhs_in, [
+        self.assertEqual(dut.rhs_in.val.tolist(), [
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-1, dtype=torch.float64),
@@ -461,8 +643,8 @@ class TestGurobiTorchMIP(unittest.TestCase):
         self.assertEqual(
             dut.gurobi_model.getAttr(gurobipy.GRB.Attr.NumBinVars), 2)
         self.assertEqual(dut.zeta, [alpha[0], alpha[1]])
-        self.assertEqual(len(dut.Ain_zeta_row), 0)
-        self.assertEqual(len(dut.Aeq_zeta_row), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 0)
         self.assertEqual(dut.r_indices, {
             x[0]: 0,
             x[1]: 1,
@@ -484,32 +666,34 @@ class TestGurobiTorchMIP(unittest.TestCase):
             self.assertEqual(x[i].lb, lb[i].item())
             self.assertEqual(x[i].ub, ub[i].item())
             self.assertEqual(x[i].vtype, gurobipy.GRB.CONTINUOUS)
-        self.assertListEqual(dut.Ain_r_row, [0, 1, 2, 3])
-        self.assertListEqual(dut.Ain_r_col, [0, 2, 0, 1])
-        self.assertEqual(dut.Ain_r_val, [
+        self.assertListEqual(dut.Ain_r_coo.row.tolist(), [0, 1, 2, 3])
+        self.assertListEqual(dut.Ain_r_coo.col.tolist(), [0, 2, 0, 1])
+        self.assertEqual(dut.Ain_r_coo.val.tolist(), [
             torch.tensor(-1, dtype=dtype),
             torch.tensor(-1, dtype=dtype),
             torch.tensor(1, dtype=dtype),
             torch.tensor(1, dtype=dtype)
         ])
-        self.assertEqual(dut.rhs_in, [
+        self.assertEqual(dut.rhs_in.val.tolist(), [
             torch.tensor(2, dtype=dtype),
             torch.tensor(-4, dtype=dtype),
             torch.tensor(4, dtype=dtype),
             torch.tensor(3, dtype=dtype)
         ])
-        self.assertEqual(len(dut.Ain_zeta_row), 0)
-        self.assertEqual(len(dut.Ain_zeta_col), 0)
-        self.assertEqual(len(dut.Ain_zeta_val), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.val), 0)
 
-        self.assertEqual(dut.Aeq_r_row, [0])
-        self.assertEqual(dut.Aeq_r_col, [4])
-        self.assertEqual(dut.Aeq_r_val, [torch.tensor(1, dtype=dtype)])
-        self.assertEqual(dut.rhs_eq, [torch.tensor(5, dtype=dtype)])
+        self.assertEqual(dut.Aeq_r_coo.row.tolist(), [0])
+        self.assertEqual(dut.Aeq_r_coo.col.tolist(), [4])
+        self.assertEqual(dut.Aeq_r_coo.val.tolist(),
+                         [torch.tensor(1, dtype=dtype)])
+        self.assertEqual(dut.rhs_eq.val.tolist(),
+                         [torch.tensor(5, dtype=dtype)])
 
-        self.assertEqual(len(dut.Aeq_zeta_row), 0)
-        self.assertEqual(len(dut.Aeq_zeta_col), 0)
-        self.assertEqual(len(dut.Aeq_zeta_val), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.val), 0)
 
     def test_addVars3(self):
         # addVars for binary variable with a tensor type of lb and(or) ub.
@@ -522,18 +706,18 @@ class TestGurobiTorchMIP(unittest.TestCase):
             self.assertEqual(b[i].lb, torch.clamp(lb[i], 0, 1).item())
             self.assertEqual(b[i].ub, torch.clamp(ub[i], 0, 1).item())
             self.assertEqual(b[i].vtype, gurobipy.GRB.BINARY)
-        self.assertEqual(len(dut.Ain_r_row), 0)
-        self.assertEqual(len(dut.Ain_r_col), 0)
-        self.assertEqual(len(dut.Ain_r_val), 0)
-        self.assertEqual(len(dut.Aeq_r_row), 0)
-        self.assertEqual(len(dut.Aeq_r_col), 0)
-        self.assertEqual(len(dut.Aeq_r_val), 0)
-        self.assertEqual(len(dut.Ain_zeta_row), 0)
-        self.assertEqual(len(dut.Ain_zeta_col), 0)
-        self.assertEqual(len(dut.Ain_zeta_val), 0)
-        self.assertEqual(len(dut.Aeq_zeta_row), 0)
-        self.assertEqual(len(dut.Aeq_zeta_col), 0)
-        self.assertEqual(len(dut.Aeq_zeta_val), 0)
+        self.assertEqual(len(dut.Ain_r_coo.row), 0)
+        self.assertEqual(len(dut.Ain_r_coo.col), 0)
+        self.assertEqual(len(dut.Ain_r_coo.val), 0)
+        self.assertEqual(len(dut.Aeq_r_coo.row), 0)
+        self.assertEqual(len(dut.Aeq_r_coo.col), 0)
+        self.assertEqual(len(dut.Aeq_r_coo.val), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.val), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.val), 0)
 
     def test_addVars4(self):
         # Test addVars with vtype = BINARYRELAX
@@ -577,12 +761,48 @@ class TestGurobiTorchMIP(unittest.TestCase):
              torch.ones((3, ), dtype=dtype)], [x, y],
             rhs=1.,
             sense=gurobipy.GRB.EQUAL)
-        self.assertEqual(len(dut.Aeq_r_row), 0)
-        self.assertEqual(len(dut.Aeq_r_col), 0)
-        self.assertEqual(len(dut.Aeq_r_val), 0)
-        self.assertEqual(len(dut.Aeq_zeta_row), 5)
-        self.assertEqual(len(dut.Aeq_zeta_col), 5)
-        self.assertEqual(len(dut.Aeq_zeta_val), 5)
+        self.assertEqual(len(dut.Aeq_r_coo.row), 0)
+        self.assertEqual(len(dut.Aeq_r_coo.col), 0)
+        self.assertEqual(len(dut.Aeq_r_coo.val), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 5)
+        self.assertEqual(len(dut.Aeq_zeta_coo.col), 5)
+        self.assertEqual(len(dut.Aeq_zeta_coo.val), 5)
+
+    def test_resolve_variables(self):
+        dut = gurobi_torch_mip.GurobiTorchMIP(torch.float64)
+        x = dut.addVars(3, lb=-1., ub=1.)
+        alpha = dut.addVars(2, vtype=gurobipy.GRB.BINARY)
+        y = dut.addVars(20, lb=-gurobipy.GRB.INFINITY)
+        beta = dut.addVars(1, vtype=gurobi_torch_mip.BINARYRELAX)
+        r_pos, r_cols, zeta_pos, zeta_cols = dut.resolve_variables(
+            [alpha[1], y[15], x[0], beta[0], x[2]])
+        np.testing.assert_array_equal(r_pos, [1, 2, 4])
+        np.testing.assert_array_equal(r_cols, [18, 0, 2])
+        np.testing.assert_array_equal(zeta_pos, [0, 3])
+        np.testing.assert_array_equal(zeta_cols, [1, 2])
+        for pos, col in zip(r_pos, r_cols):
+            self.assertIs(dut.r[col], [alpha[1], y[15], x[0], beta[0],
+                                       x[2]][pos])
+            self.assertEqual(dut.r_indices[dut.r[col]], col)
+        r_pos, r_cols, zeta_pos, zeta_cols = dut.resolve_variables([])
+        self.assertEqual(r_pos.shape, (0, ))
+        self.assertEqual(zeta_pos.shape, (0, ))
+
+        # A variable added directly to the gurobi model is not registered.
+        z = dut.gurobi_model.addVar()
+        dut.gurobi_model.update()
+        with self.assertRaises(Exception):
+            dut.resolve_variables([x[0], z])
+        with self.assertRaises(Exception):
+            dut.addLConstr([torch.tensor([1., 1.], dtype=torch.float64)],
+                           [[x[0], z]],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           rhs=1.)
+        with self.assertRaises(Exception):
+            dut.addMConstr([torch.tensor([[1., 1.]], dtype=torch.float64)],
+                           [[x[0], z]],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           b=torch.tensor([1.], dtype=torch.float64))
 
     def test_addLConstr(self):
         dut = gurobi_torch_mip.GurobiTorchMIP(torch.float64)
@@ -592,7 +812,7 @@ class TestGurobiTorchMIP(unittest.TestCase):
                         lb=-gurobipy.GRB.INFINITY,
                         vtype=gurobipy.GRB.CONTINUOUS)
         beta = dut.addVars(2, vtype=gurobipy.GRB.BINARY)
-        self.assertEqual(len(dut.Ain_r_row), 2)
+        self.assertEqual(len(dut.Ain_r_coo.row), 2)
         # Add an equality constraint on continuous variables.
         _ = dut.addLConstr([torch.tensor([1, 2], dtype=torch.float64)], [x],
                            sense=gurobipy.GRB.EQUAL,
@@ -600,23 +820,24 @@ class TestGurobiTorchMIP(unittest.TestCase):
         dut.gurobi_model.update()
         self.assertEqual(
             dut.gurobi_model.getAttr(gurobipy.GRB.Attr.NumConstrs), 1)
-        self.assertEqual(len(dut.Ain_r_row), 2)
-        self.assertEqual(len(dut.Ain_r_col), 2)
-        self.assertEqual(len(dut.Ain_r_val), 2)
-        self.assertEqual(len(dut.Ain_zeta_row), 0)
-        self.assertEqual(len(dut.Ain_zeta_col), 0)
-        self.assertEqual(len(dut.Ain_zeta_val), 0)
+        self.assertEqual(len(dut.Ain_r_coo.row), 2)
+        self.assertEqual(len(dut.Ain_r_coo.col), 2)
+        self.assertEqual(len(dut.Ain_r_coo.val), 2)
+        self.assertEqual(len(dut.Ain_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.val), 0)
         self.assertEqual(len(dut.rhs_in), 2)
-        self.assertEqual(dut.Aeq_r_row, [0, 0])
-        self.assertEqual(dut.Aeq_r_col, [0, 1])
-        self.assertEqual(dut.Aeq_r_val, [
+        self.assertEqual(dut.Aeq_r_coo.row.tolist(), [0, 0])
+        self.assertEqual(dut.Aeq_r_coo.col.tolist(), [0, 1])
+        self.assertEqual(dut.Aeq_r_coo.val.tolist(), [
             torch.tensor(1, dtype=torch.float64),
             torch.tensor(2, dtype=torch.float64)
         ])
-        self.assertEqual(len(dut.Aeq_zeta_row), 0)
-        self.assertEqual(len(dut.Aeq_zeta_col), 0)
-        self.assertEqual(len(dut.Aeq_zeta_val), 0)
-        self.assertEqual(dut.rhs_eq, [torch.tensor(2, dtype=torch.float64)])
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Aeq_zeta_coo.val), 0)
+        self.assertEqual(dut.rhs_eq.val.tolist(),
+                         [torch.tensor(2, dtype=torch.float64)])
 
         # Add an equality constraint on binary variables.
         _ = dut.addLConstr([
@@ -628,15 +849,15 @@ class TestGurobiTorchMIP(unittest.TestCase):
         dut.gurobi_model.update()
         self.assertEqual(
             dut.gurobi_model.getAttr(gurobipy.GRB.Attr.NumConstrs), 2)
-        self.assertEqual(dut.Aeq_zeta_row, [1, 1, 1, 1])
-        self.assertEqual(dut.Aeq_zeta_col, [2, 3, 0, 1])
-        self.assertEqual(dut.Aeq_zeta_val, [
+        self.assertEqual(dut.Aeq_zeta_coo.row.tolist(), [1, 1, 1, 1])
+        self.assertEqual(dut.Aeq_zeta_coo.col.tolist(), [2, 3, 0, 1])
+        self.assertEqual(dut.Aeq_zeta_coo.val.tolist(), [
             torch.tensor(1, dtype=torch.float64),
             torch.tensor(2, dtype=torch.float64),
             torch.tensor(3, dtype=torch.float64),
             torch.tensor(4, dtype=torch.float64)
         ])
-        self.assertEqual(dut.rhs_eq, [
+        self.assertEqual(dut.rhs_eq.val.tolist(), [
             torch.tensor(2, dtype=torch.float64),
             torch.tensor(3, dtype=torch.float64)
         ])
@@ -651,26 +872,26 @@ class TestGurobiTorchMIP(unittest.TestCase):
         dut.gurobi_model.update()
         self.assertEqual(
             dut.gurobi_model.getAttr(gurobipy.GRB.Attr.NumConstrs), 3)
-        self.assertEqual(dut.Ain_r_row, [0, 1, 2, 2])
-        self.assertEqual(dut.Ain_r_col, [0, 1, 2, 3])
-        self.assertEqual(dut.Ain_r_val, [
+        self.assertEqual(dut.Ain_r_coo.row.tolist(), [0, 1, 2, 2])
+        self.assertEqual(dut.Ain_r_coo.col.tolist(), [0, 1, 2, 3])
+        self.assertEqual(dut.Ain_r_coo.val.tolist(), [
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(5, dtype=torch.float64),
             torch.tensor(6, dtype=torch.float64)
         ])
-        self.assertEqual(dut.Ain_zeta_row, [2, 2])
-        self.assertEqual(dut.Ain_zeta_col, [0, 1])
-        self.assertEqual(dut.Ain_zeta_val, [
+        self.assertEqual(dut.Ain_zeta_coo.row.tolist(), [2, 2])
+        self.assertEqual(dut.Ain_zeta_coo.col.tolist(), [0, 1])
+        self.assertEqual(dut.Ain_zeta_coo.val.tolist(), [
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-2, dtype=torch.float64)
         ])
-        self.assertEqual(dut.rhs_in, [
+        self.assertEqual(dut.rhs_in.val.tolist(), [
             torch.tensor(0, dtype=torch.float64),
             torch.tensor(0, dtype=torch.float64),
             torch.tensor(4, dtype=torch.float64)
         ])
-        self.assertEqual(dut.rhs_eq, [
+        self.assertEqual(dut.rhs_eq.val.tolist(), [
             torch.tensor(2, dtype=torch.float64),
             torch.tensor(3, dtype=torch.float64)
         ])
@@ -685,9 +906,9 @@ class TestGurobiTorchMIP(unittest.TestCase):
         dut.gurobi_model.update()
         self.assertEqual(
             dut.gurobi_model.getAttr(gurobipy.GRB.Attr.NumConstrs), 4)
-        self.assertEqual(dut.Ain_r_row, [0, 1, 2, 2, 3, 3])
-        self.assertEqual(dut.Ain_r_col, [0, 1, 2, 3, 0, 1])
-        self.assertEqual(dut.Ain_r_val, [
+        self.assertEqual(dut.Ain_r_coo.row.tolist(), [0, 1, 2, 2, 3, 3])
+        self.assertEqual(dut.Ain_r_coo.col.tolist(), [0, 1, 2, 3, 0, 1])
+        self.assertEqual(dut.Ain_r_coo.val.tolist(), [
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(5, dtype=torch.float64),
@@ -695,21 +916,21 @@ class TestGurobiTorchMIP(unittest.TestCase):
             torch.tensor(-7, dtype=torch.float64),
             torch.tensor(-8, dtype=torch.float64)
         ])
-        self.assertEqual(dut.Ain_zeta_row, [2, 2, 3, 3])
-        self.assertEqual(dut.Ain_zeta_col, [0, 1, 2, 3])
-        self.assertEqual(dut.Ain_zeta_val, [
+        self.assertEqual(dut.Ain_zeta_coo.row.tolist(), [2, 2, 3, 3])
+        self.assertEqual(dut.Ain_zeta_coo.col.tolist(), [0, 1, 2, 3])
+        self.assertEqual(dut.Ain_zeta_coo.val.tolist(), [
             torch.tensor(-1, dtype=torch.float64),
             torch.tensor(-2, dtype=torch.float64),
             torch.tensor(3, dtype=torch.float64),
             torch.tensor(4, dtype=torch.float64)
         ])
-        self.assertEqual(dut.rhs_in, [
+        self.assertEqual(dut.rhs_in.val.tolist(), [
             torch.tensor(0, dtype=torch.float64),
             torch.tensor(0, dtype=torch.float64),
             torch.tensor(4, dtype=torch.float64),
             torch.tensor(-5, dtype=torch.float64)
         ])
-        self.assertEqual(dut.rhs_eq, [
+        self.assertEqual(dut.rhs_eq.val.tolist(), [
             torch.tensor(2, dtype=torch.float64),
             torch.tensor(3, dtype=torch.float64)
         ])
@@ -743,31 +964,31 @@ class TestGurobiTorchMIP(unittest.TestCase):
             np.array([3., 7.]))
 
         self.assertEqual(
-            dut.rhs_eq,
+            dut.rhs_eq.val.tolist(),
             [torch.tensor(3, dtype=dtype),
              torch.tensor(7, dtype=dtype)])
-        self.assertEqual(dut.Aeq_r_row, [0, 0, 1, 1])
-        self.assertEqual(dut.Aeq_r_col, [0, 1, 0, 1])
-        self.assertEqual(dut.Aeq_r_val,
+        self.assertEqual(dut.Aeq_r_coo.row.tolist(), [0, 0, 1, 1])
+        self.assertEqual(dut.Aeq_r_coo.col.tolist(), [0, 1, 0, 1])
+        self.assertEqual(dut.Aeq_r_coo.val.tolist(),
                          [A1[0][0, 0], A1[0][0, 1], A1[0][1, 0], A1[0][1, 1]])
-        self.assertEqual(dut.Aeq_zeta_row, [0, 0, 1, 1])
-        self.assertEqual(dut.Aeq_zeta_col, [2, 3, 2, 3])
-        self.assertEqual(dut.Aeq_zeta_val,
+        self.assertEqual(dut.Aeq_zeta_coo.row.tolist(), [0, 0, 1, 1])
+        self.assertEqual(dut.Aeq_zeta_coo.col.tolist(), [2, 3, 2, 3])
+        self.assertEqual(dut.Aeq_zeta_coo.val.tolist(),
                          [A1[1][0, 0], A1[1][0, 1], A1[1][1, 0], A1[1][1, 1]])
         # The inequality constraint are x >= 0
-        self.assertEqual(dut.Ain_r_row, [0, 1])
-        self.assertEqual(dut.Ain_r_col, [0, 1])
+        self.assertEqual(dut.Ain_r_coo.row.tolist(), [0, 1])
+        self.assertEqual(dut.Ain_r_coo.col.tolist(), [0, 1])
         self.assertEqual(
-            dut.Ain_r_val,
+            dut.Ain_r_coo.val.tolist(),
             [torch.tensor(-1, dtype=dtype),
              torch.tensor(-1, dtype=dtype)])
         self.assertEqual(
-            dut.rhs_in,
+            dut.rhs_in.val.tolist(),
             [torch.tensor(0, dtype=dtype),
              torch.tensor(0, dtype=dtype)])
-        self.assertEqual(len(dut.Ain_zeta_row), 0)
-        self.assertEqual(len(dut.Ain_zeta_col), 0)
-        self.assertEqual(len(dut.Ain_zeta_val), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.row), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.col), 0)
+        self.assertEqual(len(dut.Ain_zeta_coo.val), 0)
 
         # Now add <= inequality constraints
         A2 = [
@@ -782,28 +1003,29 @@ class TestGurobiTorchMIP(unittest.TestCase):
             A2[0].detach().numpy() @ np.array([y[0].x, y[1].x]) +
             A2[1].detach().numpy().squeeze() * alpha[1].x,
             np.array([2., 5.]) + 1e-6)
-        self.assertEqual(dut.Ain_r_row, [0, 1, 2, 2, 3, 3])
-        self.assertEqual(dut.Ain_r_col, [0, 1, 2, 3, 2, 3])
-        self.assertEqual(dut.Ain_r_val, [
+        self.assertEqual(dut.Ain_r_coo.row.tolist(), [0, 1, 2, 2, 3, 3])
+        self.assertEqual(dut.Ain_r_coo.col.tolist(), [0, 1, 2, 3, 2, 3])
+        self.assertEqual(dut.Ain_r_coo.val.tolist(), [
             torch.tensor(-1, dtype=dtype),
             torch.tensor(-1, dtype=dtype), A2[0][0, 0], A2[0][0, 1],
             A2[0][1, 0], A2[0][1, 1]
         ])
-        self.assertEqual(dut.rhs_in, [
+        self.assertEqual(dut.rhs_in.val.tolist(), [
             torch.tensor(0, dtype=dtype),
             torch.tensor(0, dtype=dtype),
             torch.tensor(2, dtype=dtype),
             torch.tensor(5, dtype=dtype)
         ])
-        self.assertEqual(dut.Ain_zeta_row, [2, 3])
-        self.assertEqual(dut.Ain_zeta_col, [1, 1])
-        self.assertEqual(dut.Ain_zeta_val, [A2[1][0, 0], A2[1][1, 0]])
-        self.assertEqual(len(dut.Aeq_r_row), 4)
-        self.assertEqual(len(dut.Aeq_r_col), 4)
-        self.assertEqual(len(dut.Aeq_r_val), 4)
-        self.assertEqual(len(dut.Aeq_zeta_row), 4)
-        self.assertEqual(len(dut.Aeq_zeta_col), 4)
-        self.assertEqual(len(dut.Aeq_zeta_val), 4)
+        self.assertEqual(dut.Ain_zeta_coo.row.tolist(), [2, 3])
+        self.assertEqual(dut.Ain_zeta_coo.col.tolist(), [1, 1])
+        self.assertEqual(dut.Ain_zeta_coo.val.tolist(),
+                         [A2[1][0, 0], A2[1][1, 0]])
+        self.assertEqual(len(dut.Aeq_r_coo.row), 4)
+        self.assertEqual(len(dut.Aeq_r_coo.col), 4)
+        self.assertEqual(len(dut.Aeq_r_coo.val), 4)
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 4)
+        self.assertEqual(len(dut.Aeq_zeta_coo.col), 4)
+        self.assertEqual(len(dut.Aeq_zeta_coo.val), 4)
         self.assertEqual(len(dut.rhs_eq), 2)
 
         # Now add >= inequality constraint.
@@ -819,14 +1041,14 @@ class TestGurobiTorchMIP(unittest.TestCase):
             np.array([-2., -4.]) - 1e-6,
             A3[0].squeeze().detach().numpy() * x[1].x +
             A3[1].detach().numpy() @ np.array([beta[0].x, beta[1].x]))
-        self.assertEqual(dut.Ain_r_row, [0, 1, 2, 2, 3, 3, 4, 5])
-        self.assertEqual(dut.Ain_r_col, [0, 1, 2, 3, 2, 3, 1, 1])
-        self.assertEqual(dut.Ain_r_val, [
+        self.assertEqual(dut.Ain_r_coo.row.tolist(), [0, 1, 2, 2, 3, 3, 4, 5])
+        self.assertEqual(dut.Ain_r_coo.col.tolist(), [0, 1, 2, 3, 2, 3, 1, 1])
+        self.assertEqual(dut.Ain_r_coo.val.tolist(), [
             torch.tensor(-1, dtype=dtype),
             torch.tensor(-1, dtype=dtype), A2[0][0, 0], A2[0][0, 1],
             A2[0][1, 0], A2[0][1, 1], -A3[0][0, 0], -A3[0][1, 0]
         ])
-        self.assertEqual(dut.rhs_in, [
+        self.assertEqual(dut.rhs_in.val.tolist(), [
             torch.tensor(0, dtype=dtype),
             torch.tensor(0, dtype=dtype),
             torch.tensor(2, dtype=dtype),
@@ -834,18 +1056,18 @@ class TestGurobiTorchMIP(unittest.TestCase):
             torch.tensor(2, dtype=dtype),
             torch.tensor(4, dtype=dtype)
         ])
-        self.assertEqual(dut.Ain_zeta_row, [2, 3, 4, 4, 5, 5])
-        self.assertEqual(dut.Ain_zeta_col, [1, 1, 2, 3, 2, 3])
-        self.assertEqual(dut.Ain_zeta_val, [
+        self.assertEqual(dut.Ain_zeta_coo.row.tolist(), [2, 3, 4, 4, 5, 5])
+        self.assertEqual(dut.Ain_zeta_coo.col.tolist(), [1, 1, 2, 3, 2, 3])
+        self.assertEqual(dut.Ain_zeta_coo.val.tolist(), [
             A2[1][0, 0], A2[1][1, 0], -A3[1][0, 0], -A3[1][0, 1], -A3[1][1, 0],
             -A3[1][1, 1]
         ])
-        self.assertEqual(len(dut.Aeq_r_row), 4)
-        self.assertEqual(len(dut.Aeq_r_col), 4)
-        self.assertEqual(len(dut.Aeq_r_val), 4)
-        self.assertEqual(len(dut.Aeq_zeta_row), 4)
-        self.assertEqual(len(dut.Aeq_zeta_col), 4)
-        self.assertEqual(len(dut.Aeq_zeta_val), 4)
+        self.assertEqual(len(dut.Aeq_r_coo.row), 4)
+        self.assertEqual(len(dut.Aeq_r_coo.col), 4)
+        self.assertEqual(len(dut.Aeq_r_coo.val), 4)
+        self.assertEqual(len(dut.Aeq_zeta_coo.row), 4)
+        self.assertEqual(len(dut.Aeq_zeta_coo.col), 4)
+        self.assertEqual(len(dut.Aeq_zeta_coo.val), 4)
         self.assertEqual(len(dut.rhs_eq), 2)
 
     def test_get_active_constraints1(self):
@@ -969,6 +1191,39 @@ class TestGurobiTorchMIP(unittest.TestCase):
                 dtype=dtype)))
         self.assertTrue(
             torch.all(rhs_in == torch.tensor([1, 1, 1, 3, -0.5], dtype=dtype)))
+        Ain_r_sparse, Ain_zeta_sparse, rhs_in_sparse = \
+            dut.get_inequality_constraints(sparse=True)
+        self.assertTrue(Ain_r_sparse.is_sparse)
+        self.assertTrue(Ain_zeta_sparse.is_sparse)
+        np.testing.assert_allclose(Ain_r_sparse.to_dense().numpy(),
+                                   Ain_r.numpy())
+        np.testing.assert_allclose(Ain_zeta_sparse.to_dense().numpy(),
+                                   Ain_zeta.numpy())
+        np.testing.assert_allclose(rhs_in_sparse.numpy(), rhs_in.numpy())
+
+        Aeq_r, Aeq_zeta, rhs_eq = dut.get_equality_constraints()
+        np.testing.assert_allclose(Aeq_r.numpy(),
+                                   np.array([[1, 2, 3, 0, 0]], dtype=float))
+        np.testing.assert_allclose(
+            Aeq_zeta.numpy(), np.array([[0.5, 1.5, 0, 0, 0]], dtype=float))
+        np.testing.assert_allclose(rhs_eq.numpy(), np.array([2.]))
+        Aeq_r_sparse, Aeq_zeta_sparse, _ = dut.get_equality_constraints(
+            sparse=True)
+        np.testing.assert_allclose(Aeq_r_sparse.to_dense().numpy(),
+                                   Aeq_r.numpy())
+        np.testing.assert_allclose(Aeq_zeta_sparse.to_dense().numpy(),
+                                   Aeq_zeta.numpy())
+
+        # Add another constraint, the matrices should be updated.
+        dut.addLConstr([torch.tensor([1., 2.], dtype=dtype)], [y],
+                       sense=gurobipy.GRB.LESS_EQUAL,
+                       rhs=4.)
+        Ain_r, Ain_zeta, rhs_in = dut.get_inequality_constraints()
+        self.assertEqual(Ain_r.shape, (6, 5))
+        np.testing.assert_allclose(Ain_r[-1].numpy(),
+                                   np.array([0, 0, 0, 1, 2], dtype=float))
+        np.testing.assert_allclose(Ain_zeta[-1].numpy(), np.zeros(5))
+        self.assertEqual(rhs_in[-1].item(), 4.)
 
     def test_get_active_constraint_indices_and_binary_val(self):
         dtype = torch.float64
@@ -991,31 +1246,35 @@ class TestGurobiTorchMIP(unittest.TestCase):
             self, dut, Ain_r_expected, Ain_zeta_expected, rhs_in_expected,
             Aeq_r_expected, Aeq_zeta_expected, rhs_eq_expected):
         Ain_r = torch.zeros(len(dut.rhs_in), len(dut.r), dtype=dut.dtype)
-        for i in range(len(dut.Ain_r_val)):
-            Ain_r[dut.Ain_r_row[i], dut.Ain_r_col[i]] = dut.Ain_r_val[i]
+        for i in range(len(dut.Ain_r_coo.val)):
+            Ain_r[dut.Ain_r_coo.row[i], dut.Ain_r_coo.col[i]] = \
+                dut.Ain_r_coo.val[i]
         np.testing.assert_allclose(Ain_r_expected.detach().numpy(),
                                    Ain_r.detach().numpy())
         Ain_zeta = torch.zeros(len(dut.rhs_in), len(dut.zeta), dtype=dut.dtype)
-        for i in range(len(dut.Ain_zeta_val)):
-            Ain_zeta[dut.Ain_zeta_row[i], dut.Ain_zeta_col[i]] = \
-                dut.Ain_zeta_val[i]
+        for i in range(len(dut.Ain_zeta_coo.val)):
+            Ain_zeta[dut.Ain_zeta_coo.row[i], dut.Ain_zeta_coo.col[i]] = \
+                dut.Ain_zeta_coo.val[i]
         np.testing.assert_allclose(Ain_zeta_expected.detach().numpy(),
                                    Ain_zeta.detach().numpy())
-        np.testing.assert_allclose(rhs_in_expected.detach().numpy(),
-                                   np.array(dut.rhs_in).reshape((-1, 1)))
+        np.testing.assert_allclose(
+            rhs_in_expected.detach().numpy(),
+            dut.rhs_in.val.detach().numpy().reshape((-1, 1)))
         Aeq_r = torch.zeros(len(dut.rhs_eq), len(dut.r), dtype=dut.dtype)
-        for i in range(len(dut.Aeq_r_val)):
-            Aeq_r[dut.Aeq_r_row[i], dut.Aeq_r_col[i]] = dut.Aeq_r_val[i]
+        for i in range(len(dut.Aeq_r_coo.val)):
+            Aeq_r[dut.Aeq_r_coo.row[i], dut.Aeq_r_coo.col[i]] = \
+                dut.Aeq_r_coo.val[i]
         np.testing.assert_allclose(Aeq_r_expected.detach().numpy(),
                                    Aeq_r.detach().numpy())
         Aeq_zeta = torch.zeros(len(dut.rhs_eq), len(dut.zeta), dtype=dut.dtype)
-        for i in range(len(dut.Aeq_zeta_val)):
-            Aeq_zeta[dut.Aeq_zeta_row[i], dut.Aeq_zeta_col[i]] =\
-                dut.Aeq_zeta_val[i]
+        for i in range(len(dut.Aeq_zeta_coo.val)):
+            Aeq_zeta[dut.Aeq_zeta_coo.row[i], dut.Aeq_zeta_coo.col[i]] =\
+                dut.Aeq_zeta_coo.val[i]
         np.testing.assert_allclose(Aeq_zeta_expected.detach().numpy(),
                                    Aeq_zeta.detach().numpy())
-        np.testing.assert_allclose(rhs_eq_expected.detach().numpy(),
-                                   np.array(dut.rhs_eq).reshape((-1, 1)))
+        np.testing.assert_allclose(
+            rhs_eq_expected.detach().numpy(),
+            dut.rhs_eq.val.detach().numpy().reshape((-1, 1)))
 
     def setup_mixed_integer_constraints_return(self):
         mip_constr_return = gurobi_torch_mip.MixedIntegerConstraintsReturn()
@@ -1085,6 +1344,46 @@ class TestGurobiTorchMIP(unittest.TestCase):
             dut, Ain_r_expected, Ain_zeta_expected, rhs_in_expected,
             Aeq_r_expected, Aeq_zeta_expected, rhs_eq_expected)
 
+    def test_add_mixed_integer_linear_constraints_sparse(self):
+        mip_constr_return, dtype = \
+            self.setup_mixed_integer_constraints_return()
+        mip_constr_return_sparse = mip_constr_return.clone()
+        for item in ("Aout_input", "Aout_slack", "Aout_binary", "Ain_input",
+                     "Ain_slack", "Ain_binary", "Aeq_input", "Aeq_slack",
+                     "Aeq_binary"):
+            mip_constr_return_sparse.__dict__[item] = \
+                mip_constr_return.__dict__[item].to_sparse()
+        mips = []
+        for cnstr in (mip_constr_return, mip_constr_return_sparse):
+            dut = gurobi_torch_mip.GurobiTorchMILP(dtype=dtype)
+            x = dut.addVars(2,
+                            lb=-gurobipy.GRB.INFINITY,
+                            vtype=gurobipy.GRB.CONTINUOUS,
+                            name="x")
+            y = dut.addVars(1,
+                            lb=-gurobipy.GRB.INFINITY,
+                            vtype=gurobipy.GRB.CONTINUOUS,
+                            name="y")
+            dut.add_mixed_integer_linear_constraints(cnstr, x, y, "s",
+                                                     "gamma", "ineq_constr",
+                                                     "eq_constr", "out_constr")
+            dut.gurobi_model.update()
+            mips.append(dut)
+        for get_constraints in ("get_inequality_constraints",
+                                "get_equality_constraints"):
+            for mat, mat_sparse in zip(
+                    getattr(mips[0], get_constraints)(),
+                    getattr(mips[1], get_constraints)()):
+                np.testing.assert_allclose(mat_sparse.detach().numpy(),
+                                           mat.detach().numpy())
+        # Only the nonzero entries are stored.
+        for name in ("Ain_r_coo", "Ain_zeta_coo", "Aeq_r_coo",
+                     "Aeq_zeta_coo"):
+            self.assertTrue(torch.all(getattr(mips[1], name).val != 0))
+        np.testing.assert_allclose(
+            mips[1].gurobi_model.getA().toarray(),
+            mips[0].gurobi_model.getA().toarray())
+
     def test_add_mixed_integer_linear_constraints2(self):
         """
         Test with MixedIntegerConstraintsReturn that doesn't contain any None
@@ -1183,18 +1482,18 @@ class TestGurobiTorchMIP(unittest.TestCase):
             for i in range(2):
                 self.assertEqual(binary[i].lb, lo_expected[i])
                 self.assertEqual(binary[i].ub, up_expected[i])
-            self.assertEqual(len(mip.Ain_r_row), 0)
-            self.assertEqual(len(mip.Ain_r_col), 0)
-            self.assertEqual(len(mip.Ain_r_val), 0)
-            self.assertEqual(len(mip.Aeq_r_row), 0)
-            self.assertEqual(len(mip.Aeq_r_col), 0)
-            self.assertEqual(len(mip.Aeq_r_val), 0)
-            self.assertEqual(len(mip.Ain_zeta_row), 0)
-            self.assertEqual(len(mip.Ain_zeta_col), 0)
-            self.assertEqual(len(mip.Ain_zeta_val), 0)
-            self.assertEqual(len(mip.Aeq_zeta_row), 0)
-            self.assertEqual(len(mip.Aeq_zeta_col), 0)
-            self.assertEqual(len(mip.Aeq_zeta_val), 0)
+            self.assertEqual(len(mip.Ain_r_coo.row), 0)
+            self.assertEqual(len(mip.Ain_r_coo.col), 0)
+            self.assertEqual(len(mip.Ain_r_coo.val), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.row), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.col), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.val), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.row), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.col), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.val), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.row), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.col), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.val), 0)
 
         check_binary_bounds(None, torch.tensor([0, 1], dtype=dtype), [0, 0],
                             [0, 1])
@@ -1213,9 +1512,9 @@ class TestGurobiTorchMIP(unittest.TestCase):
             mip_cnstr_return.input_up = input_up
             mip = gurobi_torch_mip.GurobiTorchMIP(dtype)
             x = mip.addVars(len(lo_expected), lb=-2, ub=3)
-            self.assertEqual(len(mip.Ain_r_row), 4)
-            self.assertEqual(len(mip.Ain_r_col), 4)
-            self.assertEqual(len(mip.Ain_r_val), 4)
+            self.assertEqual(len(mip.Ain_r_coo.row), 4)
+            self.assertEqual(len(mip.Ain_r_coo.col), 4)
+            self.assertEqual(len(mip.Ain_r_coo.val), 4)
             self.assertEqual(len(mip.rhs_in), 4)
             slack, binary = mip.add_mixed_integer_linear_constraints(
                 mip_cnstr_return, x, None, None, "binary", "ineq", "eq", "out")
@@ -1224,19 +1523,19 @@ class TestGurobiTorchMIP(unittest.TestCase):
             for i in range(len(x)):
                 self.assertEqual(x[i].lb, lo_expected[i])
                 self.assertEqual(x[i].ub, up_expected[i])
-            self.assertEqual(len(mip.Ain_r_row), 4)
-            self.assertEqual(len(mip.Ain_r_col), 4)
-            self.assertEqual(len(mip.Ain_r_val), 4)
+            self.assertEqual(len(mip.Ain_r_coo.row), 4)
+            self.assertEqual(len(mip.Ain_r_coo.col), 4)
+            self.assertEqual(len(mip.Ain_r_coo.val), 4)
             self.assertEqual(len(mip.rhs_in), 4)
-            self.assertEqual(len(mip.Aeq_r_row), 0)
-            self.assertEqual(len(mip.Aeq_r_col), 0)
-            self.assertEqual(len(mip.Aeq_r_val), 0)
-            self.assertEqual(len(mip.Ain_zeta_row), 0)
-            self.assertEqual(len(mip.Ain_zeta_col), 0)
-            self.assertEqual(len(mip.Ain_zeta_val), 0)
-            self.assertEqual(len(mip.Aeq_zeta_row), 0)
-            self.assertEqual(len(mip.Aeq_zeta_col), 0)
-            self.assertEqual(len(mip.Aeq_zeta_val), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.row), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.col), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.val), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.row), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.col), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.val), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.row), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.col), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.val), 0)
 
         check_input_bounds(None, torch.tensor([0, 5], dtype=dtype), [-2, -2],
                            [0, 3])
@@ -1262,19 +1561,19 @@ class TestGurobiTorchMIP(unittest.TestCase):
             for i in range(len(slack)):
                 self.assertEqual(slack[i].lb, lo_expected[i])
                 self.assertEqual(slack[i].ub, up_expected[i])
-            self.assertEqual(len(mip.Ain_r_row), 0)
-            self.assertEqual(len(mip.Ain_r_col), 0)
-            self.assertEqual(len(mip.Ain_r_val), 0)
+            self.assertEqual(len(mip.Ain_r_coo.row), 0)
+            self.assertEqual(len(mip.Ain_r_coo.col), 0)
+            self.assertEqual(len(mip.Ain_r_coo.val), 0)
             self.assertEqual(len(mip.rhs_in), 0)
-            self.assertEqual(len(mip.Aeq_r_row), 0)
-            self.assertEqual(len(mip.Aeq_r_col), 0)
-            self.assertEqual(len(mip.Aeq_r_val), 0)
-            self.assertEqual(len(mip.Ain_zeta_row), 0)
-            self.assertEqual(len(mip.Ain_zeta_col), 0)
-            self.assertEqual(len(mip.Ain_zeta_val), 0)
-            self.assertEqual(len(mip.Aeq_zeta_row), 0)
-            self.assertEqual(len(mip.Aeq_zeta_col), 0)
-            self.assertEqual(len(mip.Aeq_zeta_val), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.row), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.col), 0)
+            self.assertEqual(len(mip.Aeq_r_coo.val), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.row), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.col), 0)
+            self.assertEqual(len(mip.Ain_zeta_coo.val), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.row), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.col), 0)
+            self.assertEqual(len(mip.Aeq_zeta_coo.val), 0)
 
         check_slack_bounds(None, torch.tensor([0, 5], dtype=dtype),
                            [-np.inf, -np.inf], [0, 5])
@@ -1307,18 +1606,18 @@ class TestGurobiTorchMIP(unittest.TestCase):
             self.assertEqual(v.ub, 1)
         self.assertEqual(len(mip.r), 2 + 1 + 3 + 2)
         self.assertEqual(len(mip.zeta), 0)
-        self.assertEqual(len(mip.Ain_zeta_row), 0)
-        self.assertEqual(len(mip.Ain_zeta_col), 0)
-        self.assertEqual(len(mip.Ain_zeta_val), 0)
-        self.assertEqual(len(mip.Aeq_zeta_row), 0)
-        self.assertEqual(len(mip.Aeq_zeta_col), 0)
-        self.assertEqual(len(mip.Aeq_zeta_val), 0)
+        self.assertEqual(len(mip.Ain_zeta_coo.row), 0)
+        self.assertEqual(len(mip.Ain_zeta_coo.col), 0)
+        self.assertEqual(len(mip.Ain_zeta_coo.val), 0)
+        self.assertEqual(len(mip.Aeq_zeta_coo.row), 0)
+        self.assertEqual(len(mip.Aeq_zeta_coo.col), 0)
+        self.assertEqual(len(mip.Aeq_zeta_coo.val), 0)
         # First add the constraint 0 <= binary_slack <= 1.
-        self.assertEqual(mip.Ain_r_row[:4], [0, 1, 2, 3])
+        self.assertEqual(mip.Ain_r_coo.row[:4].tolist(), [0, 1, 2, 3])
         binary_relax_indices = [
             mip.r_indices[binary_relax[0]], mip.r_indices[binary_relax[1]]
         ]
-        self.assertEqual(mip.Ain_r_col[:4],
+        self.assertEqual(mip.Ain_r_coo.col[:4].tolist(),
                          binary_relax_indices + binary_relax_indices)
 
     def test_add_mixed_integer_linear_constraints8(self):
@@ -1345,15 +1644,15 @@ class TestGurobiTorchMIP(unittest.TestCase):
             self.assertEqual(v.ub, 1)
         self.assertEqual(len(mip.r), 2 + 1 + 3)
         self.assertEqual(len(mip.zeta), 2)
-        self.assertEqual(len(mip.Ain_zeta_row), 4)
-        self.assertEqual(len(mip.Ain_zeta_col), 4)
-        self.assertEqual(len(mip.Ain_zeta_val), 4)
+        self.assertEqual(len(mip.Ain_zeta_coo.row), 4)
+        self.assertEqual(len(mip.Ain_zeta_coo.col), 4)
+        self.assertEqual(len(mip.Ain_zeta_coo.val), 4)
         # Include both the equality constraint in mip_cnstr_return, and also
         # the equality constraint for output = Aout_input * input +
         # Aout_binary * binary + Aout_slack * slack
-        self.assertEqual(len(mip.Aeq_zeta_row), 4)
-        self.assertEqual(len(mip.Aeq_zeta_col), 4)
-        self.assertEqual(len(mip.Aeq_zeta_val), 4)
+        self.assertEqual(len(mip.Aeq_zeta_coo.row), 4)
+        self.assertEqual(len(mip.Aeq_zeta_coo.col), 4)
+        self.assertEqual(len(mip.Aeq_zeta_coo.val), 4)
 
     def test_add_mixed_integer_linear_constraints9(self):
         # Test with binary_var_name equals to a list of binary variables.
@@ -1472,6 +1771,85 @@ class TestGurobiTorchMILP(unittest.TestCase):
         self.assertAlmostEqual(
             dut.compute_objective_from_mip_data_and_solution(1).item(), 1.)
 
+    def test_get_pool_solutions(self):
+        dtype = torch.float64
+        dut = gurobi_torch_mip.GurobiTorchMILP(dtype)
+        x, alpha = setup_mip1(dut)
+        dut.setObjective([torch.tensor([1], dtype=dtype)], [[x[0]]], 1.,
+                         gurobipy.GRB.MAXIMIZE)
+        dut.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, 0)
+        dut.gurobi_model.setParam(gurobipy.GRB.Param.PoolSearchMode, 2)
+        dut.gurobi_model.setParam(gurobipy.GRB.Param.PoolSolutions, 2)
+        dut.gurobi_model.optimize()
+        x_sol = dut.get_solution(x)
+        self.assertEqual(x_sol.dtype, dtype)
+        np.testing.assert_allclose(x_sol.numpy(), [v.x for v in x])
+        self.assertEqual(dut.get_solution([]).shape, (0, ))
+        solutions, objectives = dut.get_pool_solutions(x + alpha)
+        self.assertEqual(solutions.shape,
+                         (dut.gurobi_model.solCount, len(x) + len(alpha)))
+        self.assertEqual(objectives.shape, (dut.gurobi_model.solCount, ))
+        for i in range(dut.gurobi_model.solCount):
+            dut.gurobi_model.setParam(gurobipy.GRB.Param.SolutionNumber, i)
+            np.testing.assert_allclose(solutions[i].numpy(),
+                                       [v.xn for v in x + alpha])
+            self.assertAlmostEqual(objectives[i].item(),
+                                   dut.gurobi_model.PoolObjVal)
+            np.testing.assert_allclose(
+                dut.get_solution(x, solution_number=i).numpy(),
+                solutions[i, :len(x)].numpy())
+        np.testing.assert_allclose(objectives.numpy(), [2., 1.])
+        solutions, objectives = dut.get_pool_solutions(x, max_solutions=1)
+        self.assertEqual(solutions.shape, (1, len(x)))
+        np.testing.assert_allclose(objectives.numpy(), [2.])
+
+    def test_compute_objective_from_mip_data_sparse(self):
+        # Compare the sparse solve against the dense pseudo-inverse
+        # (A_actᵀ * A_act)⁻¹ * A_actᵀ * b_act, including the gradient.
+        dtype = torch.float64
+        dut = gurobi_torch_mip.GurobiTorchMILP(dtype)
+        torch.manual_seed(0)
+        x = dut.addVars(3, lb=-gurobipy.GRB.INFINITY)
+        alpha = dut.addVars(1, vtype=gurobipy.GRB.BINARY)
+        A = torch.rand((4, 3), dtype=dtype, requires_grad=True)
+        b = torch.rand((4, ), dtype=dtype, requires_grad=True)
+        dut.addMConstr([A, torch.ones((4, 1), dtype=dtype)], [x, alpha],
+                       sense=gurobipy.GRB.LESS_EQUAL,
+                       b=b)
+        c = torch.tensor([1., 2., -1.], dtype=dtype, requires_grad=True)
+        dut.setObjective([c], [x], 0., gurobipy.GRB.MAXIMIZE)
+        zeta_sol = torch.tensor([1.], dtype=dtype)
+        A_act_row, A_act_col, A_act_val, b_act = \
+            dut.get_active_constraints_coo({0, 1, 2, 3}, zeta_sol)
+        A_act, b_act_dense = dut.get_active_constraints({0, 1, 2, 3},
+                                                        zeta_sol)
+        A_act_from_coo = torch.zeros((len(b_act), 3), dtype=dtype).index_put(
+            (torch.from_numpy(A_act_row), torch.from_numpy(A_act_col)),
+            A_act_val,
+            accumulate=True)
+        np.testing.assert_allclose(A_act_from_coo.detach().numpy(),
+                                   A_act.detach().numpy())
+        np.testing.assert_allclose(b_act.detach().numpy(),
+                                   b_act_dense.detach().numpy())
+
+        obj = dut.compute_objective_from_mip_data({0, 1, 2, 3}, zeta_sol)
+        obj_expected = c @ torch.inverse(A_act.T @ A_act) @ A_act.T @\
+            b_act_dense
+        self.assertAlmostEqual(obj.item(), obj_expected.item(), places=10)
+        grad = torch.autograd.grad(obj, (A, b, c), retain_graph=True)
+        grad_expected = torch.autograd.grad(obj_expected, (A, b, c))
+        for i in range(3):
+            np.testing.assert_allclose(grad[i].numpy(),
+                                       grad_expected[i].numpy(),
+                                       atol=1E-10)
+        # A_act doesn't have full column rank, we add a penalty.
+        obj = dut.compute_objective_from_mip_data({0, 1}, zeta_sol)
+        A_act, b_act = dut.get_active_constraints({0, 1}, zeta_sol)
+        obj_expected = c @ torch.inverse(
+            A_act.T @ A_act + 1E-10 * torch.eye(3, dtype=dtype)) @ A_act.T @\
+            b_act
+        self.assertAlmostEqual(obj.item(), obj_expected.item(), places=5)
+
     def test_objective_gradient(self):
         """
         Test if we can compute the gradient of the MIP objective w.r.t the
@@ -1524,6 +1902,374 @@ class TestGurobiTorchMILP(unittest.TestCase):
         compare_gradient([0.5, 1.4, 0.3])
         compare_gradient([0.2, 1.5, 0.3])
 
+    def test_compute_objective_from_mip_data_and_all_solutions(self):
+        dtype = torch.float64
+        dut = gurobi_torch_mip.GurobiTorchMILP(dtype)
+        a = torch.tensor([1., 2., 0.5], dtype=dtype, requires_grad=True)
+        x = dut.addVars(3, lb=0., vtype=gurobipy.GRB.CONTINUOUS)
+        alpha = dut.addVars(3, vtype=gurobipy.GRB.BINARY)
+        # x[i] <= a[i] * alpha[i]
+        for i in range(3):
+            dut.addLConstr([
+                torch.tensor([1.], dtype=dtype),
+                torch.stack((-a[i], ))
+            ], [[x[i]], [alpha[i]]],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           rhs=0.)
+        dut.addLConstr([torch.ones((3, ), dtype=dtype)], [alpha],
+                       sense=gurobipy.GRB.LESS_EQUAL,
+                       rhs=2.)
+        dut.setObjective([a * a], [x], 0., gurobipy.GRB.MAXIMIZE)
+        dut.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+        dut.gurobi_model.setParam(gurobipy.GRB.Param.PoolSearchMode, 2)
+        dut.gurobi_model.setParam(gurobipy.GRB.Param.PoolSolutions, 5)
+        dut.gurobi_model.optimize()
+        self.assertEqual(dut.gurobi_model.solCount, 5)
+
+        num_calls = [0]
+        compute_objective = dut.compute_objective_from_mip_data
+
+        def counted_compute_objective(*args):
+            num_calls[0] += 1
+            return compute_objective(*args)
+
+        dut.compute_objective_from_mip_data = counted_compute_objective
+        objectives = dut.compute_objective_from_mip_data_and_all_solutions()
+        self.assertEqual(objectives.shape, (5, ))
+        self.assertLessEqual(num_calls[0], 5)
+        grad = torch.autograd.grad(torch.sum(objectives), a,
+                                   retain_graph=True)[0]
+        objectives_expected = torch.stack([
+            dut.compute_objective_from_mip_data_and_solution(i)
+            for i in range(5)
+        ])
+        np.testing.assert_allclose(objectives.detach().numpy(),
+                                   objectives_expected.detach().numpy())
+        _, pool_obj = dut.get_pool_solutions([])
+        np.testing.assert_allclose(objectives.detach().numpy(),
+                                   pool_obj.numpy(),
+                                   atol=1E-6)
+        grad_expected = torch.autograd.grad(torch.sum(objectives_expected),
+                                            a)[0]
+        np.testing.assert_allclose(grad.numpy(), grad_expected.numpy())
+
+        objectives = dut.compute_objective_from_mip_data_and_all_solutions(
+            max_solutions=2)
+        self.assertEqual(objectives.shape, (2, ))
+
+    def test_update_from(self):
+        dtype = torch.float64
+
+        def construct_milp(a, backend=None):
+            dut = gurobi_torch_mip.GurobiTorchMILP(dtype, backend)
+            x = dut.addVars(3, lb=0., vtype=gurobipy.GRB.CONTINUOUS)
+            alpha = dut.addVars(2, vtype=gurobipy.GRB.BINARY)
+            dut.addLConstr([torch.stack((a[0] * a[1], a[1] + a[2], 3 * a[2]))],
+                           [x],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           rhs=a[0] + 2 * a[2] * a[1])
+            dut.addMConstr([torch.stack((a[2], -a[0], a[1])).reshape((1, -1))],
+                           [x],
+                           sense=gurobipy.GRB.GREATER_EQUAL,
+                           b=torch.stack((-a[1] - 5, )))
+            dut.addLConstr([
+                torch.stack((torch.tensor(2., dtype=dtype), a[1]**2,
+                             torch.tensor(0.5, dtype=dtype))),
+                torch.tensor([1., 1.], dtype=dtype)
+            ], [x, alpha],
+                           sense=gurobipy.GRB.EQUAL,
+                           rhs=2 * a[0] + 1)
+            dut.setObjective([
+                torch.stack((a[0] + a[1], a[0], a[2])),
+                torch.stack((a[1], torch.tensor(3, dtype=dtype)))
+            ], [x, alpha],
+                             a[0] * a[1],
+                             sense=gurobipy.GRB.MAXIMIZE)
+            if dut.has_gurobi_model():
+                dut.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                          False)
+            return dut, x, alpha
+
+        template, _, _ = construct_milp(
+            torch.tensor([1., 2., 3.], dtype=dtype))
+        template.gurobi_model.optimize()
+        for a_val in ([2., -2., 1.], [0.5, 1.4, 0.3]):
+            a = torch.tensor(a_val, dtype=dtype, requires_grad=True)
+            # Only the torch data of the new MIP is constructed.
+            other, x, alpha = construct_milp(
+                a, gurobi_torch_mip.TorchDataBackend())
+            self.assertFalse(other.has_gurobi_model())
+            incumbent = template.gurobi_model.getAttr(
+                gurobipy.GRB.Attr.X, template.gurobi_model.getVars()) if\
+                template.gurobi_model.SolCount > 0 else None
+            self.assertTrue(template.update_from(other))
+            if incumbent is not None:
+                # The previous incumbent is the MIP start.
+                np.testing.assert_allclose(
+                    template.gurobi_model.getAttr(
+                        gurobipy.GRB.Attr.Start,
+                        template.gurobi_model.getVars()), incumbent)
+            # The same MIP constructed with gurobi.
+            dut, x_dut, _ = construct_milp(a)
+            template.gurobi_model.optimize()
+            dut.gurobi_model.optimize()
+            self.assertEqual(template.gurobi_model.status,
+                             dut.gurobi_model.status)
+            self.assertAlmostEqual(template.gurobi_model.ObjVal,
+                                   dut.gurobi_model.ObjVal)
+            x_template = template.get_template_variables(x)
+            self.assertEqual([v.index for v in x_template],
+                             [v.index for v in x])
+            np.testing.assert_allclose(
+                template.get_solution(x_template).numpy(),
+                dut.get_solution(x_dut).numpy(),
+                atol=1E-6)
+            # The gurobi model of the template is the same as the one
+            # constructed with gurobi.
+            np.testing.assert_allclose(
+                template.gurobi_model.getA().toarray(),
+                dut.gurobi_model.getA().toarray())
+            for attr, get_objects in ((gurobipy.GRB.Attr.RHS, "getConstrs"),
+                                      (gurobipy.GRB.Attr.Obj, "getVars")):
+                np.testing.assert_allclose(
+                    template.gurobi_model.getAttr(
+                        attr, getattr(template.gurobi_model, get_objects)()),
+                    dut.gurobi_model.getAttr(
+                        attr, getattr(dut.gurobi_model, get_objects)()))
+            objective = template.compute_objective_from_mip_data_and_solution()
+            objective_expected = \
+                dut.compute_objective_from_mip_data_and_solution()
+            self.assertAlmostEqual(objective.item(), objective_expected.item())
+            grad = torch.autograd.grad(objective, a, retain_graph=True)[0]
+            grad_expected = torch.autograd.grad(objective_expected, a)[0]
+            np.testing.assert_allclose(grad.numpy(), grad_expected.numpy())
+
+        # A MIP with different constraint structure cannot be used to update
+        # the template.
+        a = torch.tensor([0.5, 1.4, 0.3], dtype=dtype)
+        backend = gurobi_torch_mip.TorchDataBackend()
+        dut, x, alpha = construct_milp(a, backend)
+        dut.addLConstr([torch.tensor([1.], dtype=dtype)], [[x[0]]],
+                       sense=gurobipy.GRB.LESS_EQUAL,
+                       rhs=1.)
+        self.assertFalse(template.update_from(dut))
+        dut, x, alpha = construct_milp(a, backend)
+        dut.addVars(1, lb=0., vtype=gurobipy.GRB.CONTINUOUS)
+        self.assertFalse(template.update_from(dut))
+        # The same structure but a different constraint sense.
+        dut, x, alpha = construct_milp(a, backend)
+        dut._in_row_sign[-1] = 1.
+        self.assertFalse(template.update_from(dut))
+        # A constraint only in the gurobi model of the template.
+        dut, x, alpha = construct_milp(a, backend)
+        template.gurobi_model.addLConstr(
+            template.gurobi_model.getVars()[0] <= 10)
+        self.assertFalse(template.update_from(dut))
+
+    def test_solve_backend(self):
+        dtype = torch.float64
+
+        def construct_milp(a):
+            dut = gurobi_torch_mip.GurobiTorchMILP(dtype)
+            x = dut.addVars(3, lb=-1., ub=2., vtype=gurobipy.GRB.CONTINUOUS)
+            alpha = dut.addVars(3, vtype=gurobipy.GRB.BINARY)
+            beta = dut.addVars(1, vtype=gurobi_torch_mip.BINARYRELAX)
+            # x[i] <= a[i] * alpha[i]
+            for i in range(3):
+                dut.addLConstr([
+                    torch.tensor([1.], dtype=dtype),
+                    torch.stack((-a[i], ))
+                ], [[x[i]], [alpha[i]]],
+                               sense=gurobipy.GRB.LESS_EQUAL,
+                               rhs=0.)
+            dut.addLConstr([torch.ones((3, ), dtype=dtype)], [alpha],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           rhs=2.)
+            dut.addLConstr([
+                torch.tensor([1., -1.], dtype=dtype),
+                torch.tensor([1.], dtype=dtype)
+            ], [x[:2], beta],
+                           sense=gurobipy.GRB.EQUAL,
+                           rhs=a[2] * 0.5)
+            dut.setObjective([a * a, torch.tensor([0.5], dtype=dtype)],
+                             [x, beta], a[0], gurobipy.GRB.MAXIMIZE)
+            dut.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+            return dut, x
+
+        for a_val in ([1., 2., 0.5], [0.3, 1.5, 1.2]):
+            results = []
+            for backend in (None, gurobi_torch_mip.ScipyMILPSolverBackend()):
+                a = torch.tensor(a_val, dtype=dtype, requires_grad=True)
+                dut, x = construct_milp(a)
+                # The relaxed binary variable is continuous in [0, 1].
+                result = dut.solve(backend)
+                self.assertEqual(result.status, gurobipy.GRB.Status.OPTIMAL)
+                relaxed_objective = result.objective
+                if len(results) > 0:
+                    self.assertAlmostEqual(relaxed_objective, results[0][5])
+                dut.remove_binary_relaxation()
+                result = dut.solve(backend)
+                self.assertEqual(result.status, gurobipy.GRB.Status.OPTIMAL)
+                self.assertGreaterEqual(result.num_solutions, 1)
+                objective = dut.compute_objective_from_mip_data_and_solution()
+                self.assertAlmostEqual(objective.item(), result.objective)
+                grad = torch.autograd.grad(objective, a)[0]
+                sol, pool_obj = dut.get_pool_solutions(x, 1)
+                results.append((result.objective, grad, sol, pool_obj,
+                                dut.get_solution(x), relaxed_objective))
+            self.assertAlmostEqual(results[0][0], results[1][0])
+            np.testing.assert_allclose(results[0][1].numpy(),
+                                       results[1][1].numpy())
+            np.testing.assert_allclose(results[0][2].numpy(),
+                                       results[1][2].numpy(),
+                                       atol=1E-6)
+            np.testing.assert_allclose(results[0][3].numpy(),
+                                       results[1][3].numpy())
+            np.testing.assert_allclose(results[1][2][0].numpy(),
+                                       results[1][4].numpy())
+
+        # Infeasible problem.
+        dut, x = construct_milp(torch.tensor([1., 2., 0.5], dtype=dtype))
+        dut.addLConstr([torch.tensor([1.], dtype=dtype)], [[x[0]]],
+                       sense=gurobipy.GRB.GREATER_EQUAL,
+                       rhs=3.)
+        result = dut.solve(gurobi_torch_mip.ScipyMILPSolverBackend())
+        self.assertEqual(result.status, gurobipy.GRB.Status.INFEASIBLE)
+        self.assertEqual(result.num_solutions, 0)
+        # After solving with gurobi, the solution is read from gurobi.
+        result = dut.solve(gurobi_torch_mip.GurobiSolverBackend())
+        self.assertEqual(result.status, gurobipy.GRB.Status.INFEASIBLE)
+        # Constraint only in the gurobi model.
+        dut, x = construct_milp(torch.tensor([1., 2., 0.5], dtype=dtype))
+        dut.gurobi_model.addLConstr(x[0] + x[1] <= 1)
+        with self.assertRaises(Exception):
+            dut.solve(gurobi_torch_mip.ScipyMILPSolverBackend())
+        with self.assertRaises(Exception):
+            gurobi_torch_mip.GurobiTorchMIQP(dtype).solve(
+                gurobi_torch_mip.ScipyMILPSolverBackend())
+
+    def test_construct_with_scipy_backend(self):
+        dtype = torch.float64
+        backend = gurobi_torch_mip.ScipyMILPSolverBackend()
+        results = []
+        for construct_backend in (None, backend):
+            dut = gurobi_torch_mip.GurobiTorchMILP(dtype,
+                                                   backend=construct_backend)
+            x = dut.addVars(2,
+                            lb=-1.,
+                            ub=2.,
+                            vtype=gurobipy.GRB.CONTINUOUS,
+                            name="x")
+            alpha = dut.addVars(2, vtype=gurobipy.GRB.BINARY)
+            # x[i] <= 2 * alpha[i]
+            dut.addMConstr([
+                torch.eye(2, dtype=dtype), -2 * torch.eye(2, dtype=dtype)
+            ], [x, alpha],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           b=torch.zeros((2, ), dtype=dtype))
+            dut.addLConstr([torch.ones((2, ), dtype=dtype)], [alpha],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           rhs=1.)
+            dut.setObjective([torch.tensor([1., 2.], dtype=dtype)], [x], 0.,
+                             gurobipy.GRB.MAXIMIZE)
+            if construct_backend is None:
+                dut.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                          False)
+            # Solve with the backend that constructs the MILP.
+            result = dut.solve()
+            self.assertEqual(result.status, gurobipy.GRB.Status.OPTIMAL)
+            results.append((result.objective, dut.get_solution(x)))
+        # The MILP constructed with the scipy backend has no gurobi model.
+        self.assertFalse(dut.has_gurobi_model())
+        with self.assertRaises(Exception):
+            dut.gurobi_model
+        self.assertIsInstance(x[0], gurobi_torch_mip.MIPVar)
+        self.assertEqual(x[1].VarName, "x[1]")
+        self.assertEqual(x[1].lb, -1.)
+        self.assertEqual(alpha[0].vtype, gurobipy.GRB.BINARY)
+        self.assertAlmostEqual(results[0][0], 4.)
+        self.assertAlmostEqual(results[1][0], 4.)
+        np.testing.assert_allclose(results[1][1].numpy(),
+                                   results[0][1].numpy(),
+                                   atol=1E-6)
+        with gurobi_torch_mip.solver_backend(backend):
+            dut = gurobi_torch_mip.GurobiTorchMILP(dtype)
+        self.assertIs(dut.backend, backend)
+        self.assertIsInstance(
+            gurobi_torch_mip.GurobiTorchMILP(dtype).backend,
+            gurobi_torch_mip.GurobiSolverBackend)
+
+    def test_save_load(self):
+        dtype = torch.float64
+        for mip_type in (gurobi_torch_mip.GurobiTorchMILP,
+                         gurobi_torch_mip.GurobiTorchMIQP):
+            dut = mip_type(dtype)
+            x = dut.addVars(3, lb=-2., vtype=gurobipy.GRB.CONTINUOUS, name="x")
+            alpha = dut.addVars(2, vtype=gurobipy.GRB.BINARY, name="x")
+            beta = dut.addVars(1,
+                               lb=0.,
+                               ub=1.,
+                               vtype=gurobi_torch_mip.BINARYRELAX,
+                               name="beta")
+            dut.addLConstr([
+                torch.tensor([1., 2., -1.], dtype=dtype),
+                torch.tensor([1., -3.], dtype=dtype)
+            ], [x, alpha],
+                           sense=gurobipy.GRB.LESS_EQUAL,
+                           rhs=torch.tensor(1., dtype=dtype))
+            dut.addMConstr([
+                torch.tensor([[1., 0., 1.], [0., 1., -1.]], dtype=dtype),
+                torch.tensor([[1.], [2.]], dtype=dtype)
+            ], [x, beta],
+                           sense=gurobipy.GRB.EQUAL,
+                           b=torch.tensor([0.5, 1.], dtype=dtype),
+                           name="eq")
+            if mip_type is gurobi_torch_mip.GurobiTorchMILP:
+                dut.setObjective([
+                    torch.tensor([1., -1., 2.], dtype=dtype),
+                    torch.tensor([0.5, 1.], dtype=dtype)
+                ], [x, alpha], 1., gurobipy.GRB.MAXIMIZE)
+            else:
+                dut.setObjective(
+                    [torch.tensor([[1., 0.5], [0.5, 2.]], dtype=dtype)],
+                    [(x[:2], x[:2])],
+                    [torch.tensor([1., -1., 2.], dtype=dtype)], [x], 1.,
+                    gurobipy.GRB.MINIMIZE)
+            x[0].start = 0.5
+            filename = os.path.join(tempfile.mkdtemp(), "mip.pt")
+            dut.save(filename, {"x": x, "alpha": alpha})
+            loaded, variables = gurobi_torch_mip.load_mip(filename)
+            self.assertIsInstance(loaded, mip_type)
+            self.assertEqual([v.VarName for v in variables["x"]],
+                             [v.VarName for v in x])
+            self.assertEqual([v.index for v in variables["alpha"]],
+                             [v.index for v in alpha])
+            self.assertEqual([v.index for v in loaded.zeta],
+                             [v.index for v in dut.zeta])
+            self.assertEqual(loaded.zeta[2].VType, gurobipy.GRB.CONTINUOUS)
+            self.assertEqual(variables["x"][0].Start, 0.5)
+            for get_constraints in ("get_inequality_constraints",
+                                    "get_equality_constraints"):
+                for mat, mat_loaded in zip(
+                        getattr(dut, get_constraints)(),
+                        getattr(loaded, get_constraints)()):
+                    np.testing.assert_allclose(mat_loaded.numpy(),
+                                               mat.detach().numpy())
+            loaded.remove_binary_relaxation()
+            dut.remove_binary_relaxation()
+            for mip in (dut, loaded):
+                mip.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                          False)
+                mip.gurobi_model.optimize()
+            self.assertAlmostEqual(loaded.gurobi_model.ObjVal,
+                                   dut.gurobi_model.ObjVal)
+            self.assertAlmostEqual(
+                loaded.compute_objective_from_mip_data_and_solution().item(),
+                dut.compute_objective_from_mip_data_and_solution().item())
+            np.testing.assert_allclose(
+                loaded.get_solution(variables["x"]).numpy(),
+                dut.get_solution(x).numpy())
+
 
 class TestGurobiTorchMIQP(unittest.TestCase):
     def test_setObjective(self):
@@ -1569,6 +2315,27 @@ class TestGurobiTorchMIQP(unittest.TestCase):
                     [[0, 0, 0, 6], [0, 0, 0, 7], [0, 0, 0, 0], [0, 0, 0, 0],
                      [0, 0, 0, 0], [0, 0, 0, 0]],
                     dtype=dtype)))
+        # The cross term between binary and continuous variables is stored
+        # in Q_rzeta regardless of the order of the variables.
+        dut.setObjective([torch.tensor([[2., 3.]], dtype=dtype)],
+                         [([beta[0]], [y[1], alpha[2]])], [], [], 0.,
+                         gurobipy.GRB.MINIMIZE)
+        self.assertEqual(dut.Q_rzeta[3, 3].item(), 2.)
+        self.assertEqual(dut.Q_zeta[3, 2].item(), 3.)
+        self.assertEqual(torch.sum(dut.Q_rzeta != 0).item(), 1)
+        self.assertEqual(torch.sum(dut.Q_r != 0).item(), 0)
+        # Duplicated variables.
+        with self.assertRaises(Exception):
+            dut.setObjective([], [], [
+                torch.tensor([1., 2.], dtype=dtype),
+                torch.tensor([3.], dtype=dtype)
+            ], [x, [x[1]]], 0., gurobipy.GRB.MINIMIZE)
+        with self.assertRaises(Exception):
+            dut.setObjective([
+                torch.tensor([[1.]], dtype=dtype),
+                torch.tensor([[1.]], dtype=dtype)
+            ], [([y[1]], [beta[0]]), ([beta[0]], [y[1]])], [], [], 0.,
+                             gurobipy.GRB.MINIMIZE)
 
     def test_compute_objective_from_mip_data(self):
         dut = gurobi_torch_mip.GurobiTorchMIQP(torch.float64)
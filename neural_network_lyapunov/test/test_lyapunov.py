@@ -1573,34 +1573,48 @@ class TestLyapunovDiscreteTimeHybridSystem(unittest.TestCase):
                          len(strengthened_milp.milp.r))
         self.assertEqual(len(unstrengthened_milp.milp.zeta),
                          len(strengthened_milp.milp.zeta))
-        self.assertListEqual(unstrengthened_milp.milp.Ain_r_row,
-                             strengthened_milp.milp.Ain_r_row)
-        self.assertListEqual(unstrengthened_milp.milp.Ain_r_col,
-                             strengthened_milp.milp.Ain_r_col)
-        self.assertListEqual(unstrengthened_milp.milp.Ain_r_val,
-                             strengthened_milp.milp.Ain_r_val)
-        self.assertListEqual(unstrengthened_milp.milp.Ain_zeta_row,
-                             strengthened_milp.milp.Ain_zeta_row)
-        self.assertListEqual(unstrengthened_milp.milp.Ain_zeta_col,
-                             strengthened_milp.milp.Ain_zeta_col)
-        self.assertListEqual(unstrengthened_milp.milp.Ain_zeta_val,
-                             strengthened_milp.milp.Ain_zeta_val)
-        self.assertListEqual(unstrengthened_milp.milp.rhs_in,
-                             strengthened_milp.milp.rhs_in)
-        self.assertListEqual(unstrengthened_milp.milp.Aeq_r_row,
-                             strengthened_milp.milp.Aeq_r_row)
-        self.assertListEqual(unstrengthened_milp.milp.Aeq_r_col,
-                             strengthened_milp.milp.Aeq_r_col)
-        self.assertListEqual(unstrengthened_milp.milp.Aeq_r_val,
-                             strengthened_milp.milp.Aeq_r_val)
-        self.assertListEqual(unstrengthened_milp.milp.Aeq_zeta_row,
-                             strengthened_milp.milp.Aeq_zeta_row)
-        self.assertListEqual(unstrengthened_milp.milp.Aeq_zeta_col,
-                             strengthened_milp.milp.Aeq_zeta_col)
-        self.assertListEqual(unstrengthened_milp.milp.Aeq_zeta_val,
-                             strengthened_milp.milp.Aeq_zeta_val)
-        self.assertListEqual(unstrengthened_milp.milp.rhs_eq,
-                             strengthened_milp.milp.rhs_eq)
+        self.assertListEqual(
+            unstrengthened_milp.milp.Ain_r_coo.row.tolist(),
+            strengthened_milp.milp.Ain_r_coo.row.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Ain_r_coo.col.tolist(),
+            strengthened_milp.milp.Ain_r_coo.col.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Ain_r_coo.val.tolist(),
+            strengthened_milp.milp.Ain_r_coo.val.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Ain_zeta_coo.row.tolist(),
+            strengthened_milp.milp.Ain_zeta_coo.row.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Ain_zeta_coo.col.tolist(),
+            strengthened_milp.milp.Ain_zeta_coo.col.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Ain_zeta_coo.val.tolist(),
+            strengthened_milp.milp.Ain_zeta_coo.val.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.rhs_in.val.tolist(),
+            strengthened_milp.milp.rhs_in.val.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Aeq_r_coo.row.tolist(),
+            strengthened_milp.milp.Aeq_r_coo.row.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Aeq_r_coo.col.tolist(),
+            strengthened_milp.milp.Aeq_r_coo.col.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Aeq_r_coo.val.tolist(),
+            strengthened_milp.milp.Aeq_r_coo.val.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Aeq_zeta_coo.row.tolist(),
+            strengthened_milp.milp.Aeq_zeta_coo.row.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Aeq_zeta_coo.col.tolist(),
+            strengthened_milp.milp.Aeq_zeta_coo.col.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.Aeq_zeta_coo.val.tolist(),
+            strengthened_milp.milp.Aeq_zeta_coo.val.tolist())
+        self.assertListEqual(
+            unstrengthened_milp.milp.rhs_eq.val.tolist(),
+            strengthened_milp.milp.rhs_eq.val.tolist())
         self.assertEqual(
             unstrengthened_milp.milp.gurobi_model.getAttr(
                 gurobipy.GRB.Attr.NumBinVars),
@@ -1623,6 +1637,136 @@ class TestLyapunovDiscreteTimeHybridSystem(unittest.TestCase):
         self.strengthen_lyapunov_derivative_as_milp_tester(
             dut, V_lambda, deriv_eps, eps_type, R, num_strengthen_pts=2)
 
+    def test_lyapunov_derivative_cut_callback(self):
+        dtype = torch.float64
+        closed_loop_system, lyap_relu = \
+            setup_relu_feedback_system_and_lyapunov(dtype)
+        dut = lyapunov.LyapunovDiscreteTimeHybridSystem(
+            closed_loop_system, lyap_relu)
+        V_lambda = 0.5
+        deriv_eps = 0.001
+        eps_type = lyapunov.ConvergenceEps.ExpLower
+        R = torch.tensor([[0.5, 0.1, 0, 0], [0.1, 0.2, 0, 0], [0, 0, 1, 0],
+                          [0.1, 1, 1.2, 1]],
+                         dtype=dtype)
+        milp = dut.lyapunov_derivative_as_milp(
+            closed_loop_system.x_equilibrium, V_lambda, deriv_eps, eps_type,
+            R=R)
+        milp.milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+        milp.milp.gurobi_model.optimize()
+        obj_expected = milp.milp.gurobi_model.ObjVal
+
+        # Adding the ideal constraints as user cuts gives the same optimal
+        # cost.
+        milp_cut = dut.lyapunov_derivative_as_milp(
+            closed_loop_system.x_equilibrium, V_lambda, deriv_eps, eps_type,
+            R=R)
+        milp_cut.milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                            False)
+        milp_cut.milp.gurobi_model.setParam(gurobipy.GRB.Param.PreCrush, 1)
+        milp_cut.milp.gurobi_model.optimize(
+            dut.lyapunov_derivative_cut_callback(milp_cut))
+        self.assertAlmostEqual(milp_cut.milp.gurobi_model.ObjVal,
+                               obj_expected,
+                               places=6)
+
+        # Only add the cuts at the root node, and at most 5 cuts in total.
+        milp_cut = dut.lyapunov_derivative_as_milp(
+            closed_loop_system.x_equilibrium, V_lambda, deriv_eps, eps_type,
+            R=R)
+        milp_cut.milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                            False)
+        milp_cut.milp.gurobi_model.setParam(gurobipy.GRB.Param.PreCrush, 1)
+        num_cuts = []
+
+        def add_cuts(node):
+            self.assertEqual(
+                node.model.cbGet(gurobipy.GRB.Callback.MIPNODE_NODCNT), 0)
+            dut._strengthen_lyapunov_derivative_at_solution(node, milp_cut)
+            num_cuts.append(node.num_cuts)
+
+        milp_cut.milp.gurobi_model.optimize(
+            gurobi_torch_mip.get_node_cut_callback(milp_cut.milp,
+                                                   add_cuts,
+                                                   max_node_count=1,
+                                                   max_cuts=5))
+        self.assertLessEqual(sum(num_cuts), 5)
+        self.assertAlmostEqual(milp_cut.milp.gurobi_model.ObjVal,
+                               obj_expected,
+                               places=6)
+
+    def test_lyapunov_derivative_milp_starts(self):
+        dtype = torch.float64
+        closed_loop_system, lyap_relu = \
+            setup_relu_feedback_system_and_lyapunov(dtype)
+        dut = lyapunov.LyapunovDiscreteTimeHybridSystem(
+            closed_loop_system, lyap_relu)
+        V_lambda = 0.5
+        deriv_eps = 0.001
+        eps_type = lyapunov.ConvergenceEps.ExpLower
+        R = torch.tensor([[0.5, 0.1, 0, 0], [0.1, 0.2, 0, 0], [0, 0, 1, 0],
+                          [0.1, 1, 1.2, 1]],
+                         dtype=dtype)
+        milp_return = dut.lyapunov_derivative_as_milp(
+            closed_loop_system.x_equilibrium, V_lambda, deriv_eps, eps_type,
+            R=R)
+        torch.manual_seed(0)
+        x_starts = utils.uniform_sample_in_box(
+            torch.from_numpy(closed_loop_system.x_lo_all),
+            torch.from_numpy(closed_loop_system.x_up_all), 10)
+        starts = dut.lyapunov_derivative_milp_starts(milp_return, x_starts)
+        self.assertGreater(len(starts), 0)
+        milp_return.milp.gurobi_model.update()
+        all_vars = milp_return.milp.gurobi_model.getVars()
+        x_indices = [v.index for v in milp_return.x]
+        for start in starts:
+            # Each start is a feasible assignment of all the variables, whose
+            # objective is the Lyapunov derivative condition at x.
+            x_start = torch.tensor([start[i] for i in x_indices],
+                                   dtype=dtype)
+            model = milp_return.milp.gurobi_model.copy()
+            model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+            model_vars = model.getVars()
+            model.setAttr(gurobipy.GRB.Attr.LB, model_vars, start)
+            model.setAttr(gurobipy.GRB.Attr.UB, model_vars, start)
+            model.optimize()
+            self.assertEqual(model.status, gurobipy.GRB.Status.OPTIMAL)
+            with torch.no_grad():
+                self.assertAlmostEqual(
+                    model.ObjVal,
+                    dut.lyapunov_derivative(
+                        x_start,
+                        closed_loop_system.x_equilibrium,
+                        V_lambda,
+                        deriv_eps,
+                        R=R)[0].item(),
+                    places=5)
+        # Solving with the MIP starts gives the same optimal cost.
+        milp_return.milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                               False)
+        milp_return.milp.gurobi_model.optimize()
+        obj_expected = milp_return.milp.gurobi_model.ObjVal
+        milp_start = dut.lyapunov_derivative_as_milp(
+            closed_loop_system.x_equilibrium, V_lambda, deriv_eps, eps_type,
+            R=R)
+        milp_start.milp.set_mip_starts(starts)
+        self.assertEqual(milp_start.milp.gurobi_model.NumStart, len(starts))
+        self.assertEqual(milp_start.milp.gurobi_model.Params.StartNumber, 0)
+        self.assertEqual(len(starts[0]), len(all_vars))
+        milp_start.milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                              False)
+        milp_start.milp.gurobi_model.optimize()
+        self.assertAlmostEqual(milp_start.milp.gurobi_model.ObjVal,
+                               obj_expected,
+                               places=6)
+        # Updating the MIP as a template discards the previous MIP starts.
+        self.assertTrue(milp_start.milp.update_from(milp_return.milp))
+        self.assertEqual(milp_start.milp.gurobi_model.NumStart, 1)
+        milp_start.milp.gurobi_model.optimize()
+        self.assertAlmostEqual(milp_start.milp.gurobi_model.ObjVal,
+                               obj_expected,
+                               places=6)
+
     def compute_milp_cost_given_relu(self, system, weight_all, bias_all,
                                      requires_grad, eps_type, R, fixed_R):
         # Construct a simple ReLU model with 2 hidden layers
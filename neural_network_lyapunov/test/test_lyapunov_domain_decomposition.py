@@ -0,0 +1,230 @@
+import neural_network_lyapunov.lyapunov_domain_decomposition as mut
+
+import unittest
+import os
+import tempfile
+import torch
+import numpy as np
+import gurobipy
+
+import neural_network_lyapunov.lyapunov as lyapunov
+import neural_network_lyapunov.relu_system as relu_system
+import neural_network_lyapunov.utils as utils
+import neural_network_lyapunov.test.test_lyapunov as test_lyapunov
+
+
+class TestLyapunovDomainDecomposition(unittest.TestCase):
+    def setUp(self):
+        self.dtype = torch.float64
+        x_lo = torch.tensor([-3, -3], dtype=self.dtype)
+        x_up = torch.tensor([3, 3], dtype=self.dtype)
+        system = relu_system.AutonomousReLUSystem(
+            self.dtype, x_lo, x_up, test_lyapunov.setup_relu_dyn(self.dtype))
+        self.dut = lyapunov.LyapunovDiscreteTimeHybridSystem(
+            system, test_lyapunov.setup_relu(self.dtype))
+        self.x_equilibrium = torch.tensor([0., 0.], dtype=self.dtype)
+        self.V_lambda = 0.5
+        self.R = torch.tensor([[1., 1.], [-1., 1.], [0., 1.]],
+                              dtype=self.dtype)
+
+    def solve_milp(self, milp):
+        milp.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+        milp.gurobi_model.optimize()
+        self.assertEqual(milp.gurobi_model.status,
+                         gurobipy.GRB.Status.OPTIMAL)
+        return milp.gurobi_model.ObjVal
+
+    def test_derivative_milp_on_box(self):
+        # The MILP restricted to a sub-box should find the maximal objective
+        # within that sub-box.
+        epsilon = 0.1
+        eps_type = lyapunov.ConvergenceEps.ExpLower
+        obj_full = self.solve_milp(
+            self.dut.lyapunov_derivative_as_milp(self.x_equilibrium,
+                                                 self.V_lambda,
+                                                 epsilon,
+                                                 eps_type,
+                                                 R=self.R).milp)
+        x_lo = torch.tensor([-1., 0.5], dtype=self.dtype)
+        x_up = torch.tensor([0., 2.], dtype=self.dtype)
+        milp_return = self.dut.lyapunov_derivative_as_milp(self.x_equilibrium,
+                                                           self.V_lambda,
+                                                           epsilon,
+                                                           eps_type,
+                                                           R=self.R,
+                                                           x_lo=x_lo,
+                                                           x_up=x_up)
+        obj_box = self.solve_milp(milp_return.milp)
+        self.assertLessEqual(obj_box, obj_full + 1E-6)
+        x_sol = np.array([v.x for v in milp_return.x])
+        np.testing.assert_array_less(x_lo.detach().numpy() - 1E-6, x_sol)
+        np.testing.assert_array_less(x_sol, x_up.detach().numpy() + 1E-6)
+        torch.manual_seed(0)
+        x_samples = utils.uniform_sample_in_box(x_lo, x_up, 100)
+        with torch.no_grad():
+            for i in range(x_samples.shape[0]):
+                dV = self.dut.lyapunov_derivative(x_samples[i],
+                                                  self.x_equilibrium,
+                                                  self.V_lambda,
+                                                  epsilon,
+                                                  R=self.R)
+                self.assertLessEqual(dV[0].item(), obj_box + 1E-6)
+
+    def test_bisect(self):
+        dut = mut.LyapunovDomainDecomposition(self.dut)
+        x_lo = torch.tensor([-3., 0.], dtype=self.dtype)
+        x_up = torch.tensor([-2., 3.], dtype=self.dtype)
+        boxes = dut._bisect(x_lo, x_up)
+        self.assertEqual(len(boxes), 2)
+        np.testing.assert_allclose(boxes[0][0].detach().numpy(), [-3., 0.])
+        np.testing.assert_allclose(boxes[0][1].detach().numpy(), [-2., 1.5])
+        np.testing.assert_allclose(boxes[1][0].detach().numpy(), [-3., 1.5])
+        np.testing.assert_allclose(boxes[1][1].detach().numpy(), [-2., 3.])
+
+    def test_bisect_zero_width(self):
+        # A dimension in which the system box has zero width is never split.
+        x_lo = torch.tensor([-3, 1], dtype=self.dtype)
+        x_up = torch.tensor([3, 1], dtype=self.dtype)
+        system = relu_system.AutonomousReLUSystem(
+            self.dtype, x_lo, x_up, test_lyapunov.setup_relu_dyn(self.dtype))
+        dut = mut.LyapunovDomainDecomposition(
+            lyapunov.LyapunovDiscreteTimeHybridSystem(
+                system, test_lyapunov.setup_relu(self.dtype)))
+        boxes = dut._bisect(x_lo, x_up)
+        self.assertEqual(len(boxes), 2)
+        np.testing.assert_allclose(boxes[0][1].detach().numpy(), [0., 1.])
+        np.testing.assert_allclose(boxes[1][0].detach().numpy(), [0., 1.])
+
+    def check_result(self, result, obj_full, tolerance):
+        if obj_full <= tolerance:
+            self.assertTrue(result.verified)
+        else:
+            self.assertFalse(result.verified)
+            self.assertGreater(len(result.counterexamples), 0)
+        for x, obj in result.counterexamples:
+            self.assertGreater(obj, tolerance)
+            self.assertLessEqual(obj, obj_full + 1E-6)
+        self.assertEqual(len(result.unknown_boxes), 0)
+
+    def test_verify_derivative(self):
+        epsilon = 0.1
+        eps_type = lyapunov.ConvergenceEps.ExpLower
+        obj_full = self.solve_milp(
+            self.dut.lyapunov_derivative_as_milp(self.x_equilibrium,
+                                                 self.V_lambda,
+                                                 epsilon,
+                                                 eps_type,
+                                                 R=self.R).milp)
+        for tolerance in (obj_full - 0.5, obj_full + 0.5):
+            results = []
+            for num_workers in (1, 2):
+                dut = mut.LyapunovDomainDecomposition(self.dut,
+                                                      num_workers=num_workers,
+                                                      tolerance=tolerance)
+                results.append(
+                    dut.verify_derivative(self.x_equilibrium,
+                                          self.V_lambda,
+                                          epsilon,
+                                          eps_type,
+                                          R=self.R))
+                self.check_result(results[-1], obj_full, tolerance)
+            self.assertEqual(len(results[0].certified_boxes),
+                             len(results[1].certified_boxes))
+            self.assertEqual(len(results[0].counterexamples),
+                             len(results[1].counterexamples))
+
+    def test_verify_derivative_sublevel_set(self):
+        # The boxes outside of the set lyapunov_lower <= V(x) <= upper are
+        # certified by the bounds, without solving the MILP.
+        epsilon = 0.1
+        eps_type = lyapunov.ConvergenceEps.ExpLower
+        dut = mut.LyapunovDomainDecomposition(self.dut,
+                                              tolerance=float("inf"))
+        result = dut.verify_derivative(self.x_equilibrium,
+                                       self.V_lambda,
+                                       epsilon,
+                                       eps_type,
+                                       R=self.R,
+                                       lyapunov_lower=1E4)
+        self.assertTrue(result.verified)
+        self.assertEqual(result.num_milps, 0)
+
+    def test_verify_positivity(self):
+        V_epsilon = 0.1
+        milp, _ = self.dut.lyapunov_positivity_as_milp(self.x_equilibrium,
+                                                       self.V_lambda,
+                                                       V_epsilon,
+                                                       R=self.R)
+        obj_full = self.solve_milp(milp)
+        for tolerance in (obj_full - 0.5, obj_full + 0.5):
+            dut = mut.LyapunovDomainDecomposition(self.dut,
+                                                  tolerance=tolerance)
+            result = dut.verify_positivity(self.x_equilibrium,
+                                           self.V_lambda,
+                                           V_epsilon,
+                                           R=self.R)
+            self.check_result(result, obj_full, tolerance)
+
+    def test_mip_cache(self):
+        # The second verification loads the box MILPs from the cache, and
+        # gets the same result.
+        epsilon = 0.1
+        eps_type = lyapunov.ConvergenceEps.ExpLower
+        mip_cache_dir = os.path.join(tempfile.mkdtemp(), "cache")
+        results = []
+        for _ in range(2):
+            dut = mut.LyapunovDomainDecomposition(self.dut,
+                                                  tolerance=0.,
+                                                  mip_cache_dir=mip_cache_dir)
+            results.append(
+                dut.verify_derivative(self.x_equilibrium,
+                                      self.V_lambda,
+                                      epsilon,
+                                      eps_type,
+                                      R=self.R))
+            num_cached = len(os.listdir(mip_cache_dir))
+            self.assertGreater(num_cached, 0)
+        self.assertEqual(len(os.listdir(mip_cache_dir)), num_cached)
+        self.assertEqual(results[0].verified, results[1].verified)
+        self.assertEqual(len(results[0].certified_boxes),
+                         len(results[1].certified_boxes))
+        self.assertEqual(len(results[0].counterexamples),
+                         len(results[1].counterexamples))
+        for (x0, obj0), (x1, obj1) in zip(results[0].counterexamples,
+                                          results[1].counterexamples):
+            self.assertAlmostEqual(obj0, obj1, places=5)
+
+    def test_refine_on_timeout(self):
+        # With a zero time limit, the MILP of a box either returns an
+        # incumbent (which violates the condition since tolerance = -inf), or
+        # times out, in which case the box is bisected until max_depth.
+        max_depth = 2
+        dut = mut.LyapunovDomainDecomposition(self.dut,
+                                              box_time_limit=0.,
+                                              max_depth=max_depth,
+                                              tolerance=-float("inf"),
+                                              lp_relaxation_first=False)
+        result = dut.verify_positivity(self.x_equilibrium,
+                                       self.V_lambda,
+                                       0.1,
+                                       R=self.R)
+        self.assertEqual(len(result.certified_boxes), 0)
+        self.assertGreater(
+            len(result.unknown_boxes) + len(result.counterexamples), 0)
+        self.assertLessEqual(
+            len(result.unknown_boxes) + len(result.counterexamples),
+            2**max_depth)
+        system = self.dut.system
+        system_volume = np.prod(system.x_up_all - system.x_lo_all)
+        for x_lo, x_up in result.unknown_boxes:
+            self.assertAlmostEqual(
+                torch.prod(x_up - x_lo).item() * 2**max_depth, system_volume)
+        for x, _ in result.counterexamples:
+            np.testing.assert_array_less(system.x_lo_all - 1E-6,
+                                         x.detach().numpy())
+            np.testing.assert_array_less(x.detach().numpy(),
+                                         system.x_up_all + 1E-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
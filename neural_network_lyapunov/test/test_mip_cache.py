@@ -0,0 +1,157 @@
+import neural_network_lyapunov.mip_cache as mip_cache
+import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
+import neural_network_lyapunov.relu_to_optimization as relu_to_optimization
+import neural_network_lyapunov.mip_utils as mip_utils
+import neural_network_lyapunov.utils as utils
+import neural_network_lyapunov.lyapunov as lyapunov
+import neural_network_lyapunov.relu_system as relu_system
+import neural_network_lyapunov.test.test_lyapunov as test_lyapunov
+
+import unittest
+import tempfile
+import os
+import torch
+import numpy as np
+import gurobipy
+
+
+class TestMIPCache(unittest.TestCase):
+    def setUp(self):
+        self.dtype = torch.float64
+        torch.manual_seed(0)
+        self.relu = utils.setup_relu((2, 4, 3, 1),
+                                     params=None,
+                                     negative_slope=0.1,
+                                     bias=True,
+                                     dtype=self.dtype)
+        self.x_lo = torch.tensor([-1., -2.], dtype=self.dtype)
+        self.x_up = torch.tensor([2., 1.], dtype=self.dtype)
+
+    def build_mip(self):
+        relu_free_pattern = relu_to_optimization.ReLUFreePattern(
+            self.relu, self.dtype)
+        mip_cnstr_return = relu_free_pattern.output_constraint(
+            self.x_lo, self.x_up, mip_utils.PropagateBoundsMethod.IA)
+        mip = gurobi_torch_mip.GurobiTorchMILP(self.dtype)
+        x = mip.addVars(2,
+                        lb=-gurobipy.GRB.INFINITY,
+                        vtype=gurobipy.GRB.CONTINUOUS,
+                        name="x")
+        y = mip.addVars(1,
+                        lb=-gurobipy.GRB.INFINITY,
+                        vtype=gurobipy.GRB.CONTINUOUS,
+                        name="y")
+        mip.add_mixed_integer_linear_constraints(mip_cnstr_return, x, y, "s",
+                                                 "beta", "ineq", "eq", "out")
+        mip.setObjective([torch.tensor([1.], dtype=self.dtype)], [y], 0.,
+                         gurobipy.GRB.MAXIMIZE)
+        return mip, {"x": x}
+
+    def test_compute_fingerprint(self):
+        key = mip_cache.compute_fingerprint(self.relu, self.x_lo, self.x_up,
+                                            mip_utils.PropagateBoundsMethod.IA)
+        self.assertEqual(
+            key,
+            mip_cache.compute_fingerprint(self.relu, self.x_lo.clone(),
+                                          self.x_up,
+                                          mip_utils.PropagateBoundsMethod.IA))
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_fingerprint(self.relu, self.x_lo, self.x_up,
+                                          mip_utils.PropagateBoundsMethod.LP))
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_fingerprint(self.relu, self.x_lo, self.x_up * 2,
+                                          mip_utils.PropagateBoundsMethod.IA))
+        self.assertNotEqual(
+            key, mip_cache.compute_fingerprint(self.relu, self.x_lo))
+        with torch.no_grad():
+            self.relu[0].weight[0, 0] += 1E-10
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_fingerprint(self.relu, self.x_lo, self.x_up,
+                                          mip_utils.PropagateBoundsMethod.IA))
+        # 1 and 1. are different.
+        self.assertNotEqual(mip_cache.compute_fingerprint(1),
+                            mip_cache.compute_fingerprint(1.))
+        with self.assertRaises(Exception):
+            mip_cache.compute_fingerprint(object())
+
+    def test_get_or_build(self):
+        dut = mip_cache.MIPCache(os.path.join(tempfile.mkdtemp(), "cache"))
+        key = mip_cache.compute_fingerprint(self.relu, self.x_lo, self.x_up)
+        self.assertIsNone(dut.load(key))
+        num_builds = [0]
+
+        def build_mip():
+            num_builds[0] += 1
+            return self.build_mip()
+
+        mip, variables = dut.get_or_build(key, build_mip)
+        self.assertEqual(num_builds[0], 1)
+        self.assertTrue(dut.contains(key))
+        self.assertEqual(os.listdir(dut.directory), [key + ".mip"])
+        mip_loaded, variables_loaded = dut.get_or_build(key, build_mip)
+        self.assertEqual(num_builds[0], 1)
+        for prog in (mip, mip_loaded):
+            prog.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+            prog.gurobi_model.optimize()
+        self.assertAlmostEqual(mip_loaded.gurobi_model.ObjVal,
+                               mip.gurobi_model.ObjVal)
+        x_sol = mip_loaded.get_solution(variables_loaded["x"])
+        np.testing.assert_allclose(
+            self.relu(x_sol).item(), mip_loaded.gurobi_model.ObjVal)
+        self.assertAlmostEqual(
+            mip_loaded.compute_objective_from_mip_data_and_solution().item(),
+            mip.gurobi_model.ObjVal)
+
+    def test_compute_lyapunov_fingerprint(self):
+        def construct(x_up, method=mip_utils.PropagateBoundsMethod.IA):
+            system = relu_system.AutonomousReLUSystem(
+                self.dtype, self.x_lo, x_up,
+                test_lyapunov.setup_relu_dyn(self.dtype))
+            dut = lyapunov.LyapunovDiscreteTimeHybridSystem(
+                system, self.relu)
+            dut.network_bound_propagate_method = method
+            return dut
+
+        key = mip_cache.compute_lyapunov_fingerprint(construct(self.x_up),
+                                                     "derivative", 0.5)
+        dut = construct(self.x_up)
+        self.assertEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(dut, "derivative", 0.5))
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(dut, "derivative", 0.4))
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(construct(self.x_up * 2),
+                                                   "derivative", 0.5))
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(
+                construct(self.x_up, mip_utils.PropagateBoundsMethod.LP),
+                "derivative", 0.5))
+        # The bound cache doesn't change the fingerprint.
+        dut.lyapunov_relu_free_pattern.bound_cache = \
+            relu_to_optimization.ReLUBoundCache()
+        self.assertEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(dut, "derivative", 0.5))
+        # Both the Lyapunov network and the dynamics network are hashed.
+        with torch.no_grad():
+            dut.system.dynamics_relu[0].bias[0] += 1E-10
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(dut, "derivative", 0.5))
+        with torch.no_grad():
+            self.relu[0].weight[0, 0] += 1E-10
+        self.assertNotEqual(
+            key,
+            mip_cache.compute_lyapunov_fingerprint(construct(self.x_up),
+                                                   "derivative", 0.5))
+
+
+if __name__ == "__main__":
+    unittest.main()
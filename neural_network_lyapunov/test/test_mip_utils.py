@@ -243,6 +243,43 @@ class TestStrengthenReLUMipGivenPts(unittest.TestCase):
         self.assertIsNone(constants)
 
 
+class TestStrengthenReLUMipBatch(unittest.TestCase):
+    def test(self):
+        dtype = torch.float64
+        torch.manual_seed(0)
+        W = torch.tensor([[1., -2., 0.5], [-1., 0., 3.], [2., 1., -1.5],
+                          [0., -0.5, 1.]],
+                         dtype=dtype)
+        b = torch.tensor([0.5, -1., 0.2, 0.], dtype=dtype)
+        lo = torch.tensor([-1., -2., 0.5], dtype=dtype)
+        up = torch.tensor([2., 1., 1.5], dtype=dtype)
+        xhat = utils.uniform_sample_in_box(lo, up, 10)
+        beta_hat = torch.rand((10, W.shape[0]), dtype=dtype)
+        for c in (0., 0.1):
+            x_coeff, binary_coeff, constant = \
+                mip_utils.strengthen_relu_mip_batch(c, W, b, lo, up, xhat,
+                                                    beta_hat)
+            self.assertEqual(x_coeff.shape, (10, W.shape[0], W.shape[1]))
+            self.assertEqual(binary_coeff.shape, (10, W.shape[0]))
+            self.assertEqual(constant.shape, (10, W.shape[0]))
+            # Same as computing the constraint for each unit and each point.
+            for k in range(xhat.shape[0]):
+                for j in range(W.shape[0]):
+                    x_coeff_expected, binary_coeff_expected,\
+                        constant_expected = \
+                        mip_utils.strengthen_relu_mip_w_indices(
+                            c, W[j], b[j], lo, up,
+                            mip_utils.find_index_set_to_strengthen(
+                                W[j], lo, up, xhat[k], beta_hat[k, j]))
+                    np.testing.assert_allclose(
+                        x_coeff[k, j].detach().numpy(),
+                        x_coeff_expected.detach().numpy())
+                    self.assertAlmostEqual(binary_coeff[k, j].item(),
+                                           binary_coeff_expected.item())
+                    self.assertAlmostEqual(constant[k, j].item(),
+                                           constant_expected.item())
+
+
 class TestComputeBetaRange(unittest.TestCase):
     def empty_constraint_tester(self, c):
         # Test when x_coeffs = beta_coeffs = constants = None
@@ -861,6 +898,160 @@ class TestComputeRangeByIA(unittest.TestCase):
         np.testing.assert_allclose(x_lb_grad, x_lb_grad_numerical, atol=1E-6)
         np.testing.assert_allclose(x_ub_grad, x_ub_grad_numerical, atol=1E-6)
 
+    def test_batch(self):
+        dtype = torch.float64
+        torch.manual_seed(0)
+        A = torch.tensor([[1., 0., -3.], [2., -1., -4.]], dtype=dtype)
+        b = torch.tensor([2., 3.], dtype=dtype)
+        x_lb = torch.rand((5, 3), dtype=dtype) - 1
+        x_ub = x_lb + torch.rand((5, 3), dtype=dtype)
+        # Also test the box with infinite bounds.
+        x_lb[3, 1] = -np.inf
+        for x_lb_i, x_ub_i in ((x_lb, x_ub), (x_lb[:3], x_ub[:3])):
+            output_lb, output_ub = mip_utils.compute_range_by_IA(
+                A, b, x_lb_i, x_ub_i)
+            self.assertEqual(output_lb.shape, (x_lb_i.shape[0], 2))
+            self.assertEqual(output_ub.shape, (x_lb_i.shape[0], 2))
+            for i in range(x_lb_i.shape[0]):
+                output_lb_i, output_ub_i = mip_utils.compute_range_by_IA(
+                    A, b, x_lb_i[i], x_ub_i[i])
+                np.testing.assert_allclose(output_lb[i].detach().numpy(),
+                                           output_lb_i.detach().numpy())
+                np.testing.assert_allclose(output_ub[i].detach().numpy(),
+                                           output_ub_i.detach().numpy())
+
+
+class TestPropagateBoundsIA(unittest.TestCase):
+    def setUp(self):
+        self.dtype = torch.float64
+        torch.manual_seed(0)
+        self.network = torch.nn.Sequential(
+            torch.nn.Linear(2, 4), torch.nn.LeakyReLU(0.1),
+            torch.nn.Linear(4, 3), torch.nn.ReLU(),
+            torch.nn.Linear(3, 2)).type(self.dtype)
+        self.input_lo = torch.tensor([[-1., -2.], [0.5, 0.], [-3., 1.]],
+                                     dtype=self.dtype)
+        self.input_up = self.input_lo + torch.tensor(
+            [[2., 3.], [0.1, 0.2], [1., 1.]], dtype=self.dtype)
+
+    def test(self):
+        layer_lo, layer_up = mip_utils.propagate_bounds_IA(
+            self.network, self.input_lo, self.input_up)
+        self.assertEqual(len(layer_lo), len(self.network))
+        self.assertEqual(len(layer_up), len(self.network))
+        for i in range(self.input_lo.shape[0]):
+            # Compare with propagating the bounds of a single box layer by
+            # layer.
+            lo = self.input_lo[i]
+            up = self.input_up[i]
+            for j, layer in enumerate(self.network):
+                lo, up = mip_utils.propagate_bounds(layer, lo, up)
+                np.testing.assert_allclose(layer_lo[j][i].detach().numpy(),
+                                           lo.detach().numpy())
+                np.testing.assert_allclose(layer_up[j][i].detach().numpy(),
+                                           up.detach().numpy())
+            # The network output of sampled inputs are within the bounds.
+            x_samples = utils.uniform_sample_in_box(self.input_lo[i],
+                                                    self.input_up[i], 100)
+            y_samples = self.network(x_samples).detach().numpy()
+            self.assertTrue(
+                np.all(y_samples <= layer_up[-1][i].detach().numpy() + 1E-10))
+            self.assertTrue(
+                np.all(y_samples >= layer_lo[-1][i].detach().numpy() - 1E-10))
+
+    def test_gradient(self):
+        # The gradient of the batched bounds w.r.t the network weights should
+        # equal to the sum of the gradient of each box.
+        layer_lo, layer_up = mip_utils.propagate_bounds_IA(
+            self.network, self.input_lo, self.input_up)
+        (layer_up[-1] - layer_lo[-1]).sum().backward()
+        grad_batch = [p.grad.clone() for p in self.network.parameters()]
+        self.network.zero_grad()
+        for i in range(self.input_lo.shape[0]):
+            layer_lo, layer_up = mip_utils.propagate_bounds_IA(
+                self.network, self.input_lo[i], self.input_up[i])
+            (layer_up[-1] - layer_lo[-1]).sum().backward()
+        for p, grad in zip(self.network.parameters(), grad_batch):
+            np.testing.assert_allclose(p.grad.detach().numpy(),
+                                       grad.detach().numpy())
+
+
+class TestPropagateBoundsCROWN(unittest.TestCase):
+    def setUp(self):
+        self.dtype = torch.float64
+        torch.manual_seed(0)
+        self.input_lo = torch.tensor([[-1., -2.], [0.5, 0.], [-3., 1.]],
+                                     dtype=self.dtype)
+        self.input_up = self.input_lo + torch.tensor(
+            [[2., 3.], [0.1, 0.2], [1., 1.]], dtype=self.dtype)
+
+    def construct_network(self, activation):
+        return torch.nn.Sequential(torch.nn.Linear(2, 6), activation,
+                                   torch.nn.Linear(6, 5), activation,
+                                   torch.nn.Linear(5, 2)).type(self.dtype)
+
+    def test(self):
+        for activation in (torch.nn.ReLU(), torch.nn.LeakyReLU(0.1),
+                           torch.nn.LeakyReLU(-0.2)):
+            network = self.construct_network(activation)
+            layer_lo, layer_up = mip_utils.propagate_bounds_CROWN(
+                network, self.input_lo, self.input_up)
+            layer_lo_IA, layer_up_IA = mip_utils.propagate_bounds_IA(
+                network, self.input_lo, self.input_up)
+            self.assertEqual(len(layer_lo), len(network))
+            for j in range(len(network)):
+                # The CROWN bounds are no looser than the IA bounds.
+                self.assertTrue(torch.all(layer_lo[j] >= layer_lo_IA[j]))
+                self.assertTrue(torch.all(layer_up[j] <= layer_up_IA[j]))
+            # On this network, CROWN is strictly tighter than IA.
+            self.assertLess(
+                torch.sum(layer_up[-1] - layer_lo[-1]).item(),
+                torch.sum(layer_up_IA[-1] - layer_lo_IA[-1]).item())
+            for i in range(self.input_lo.shape[0]):
+                # Same as propagating a single box.
+                layer_lo_i, layer_up_i = mip_utils.propagate_bounds_CROWN(
+                    network, self.input_lo[i], self.input_up[i])
+                # The value of each layer at the sampled inputs are within
+                # the bounds.
+                x_samples = utils.uniform_sample_in_box(
+                    self.input_lo[i], self.input_up[i], 1000)
+                for j, layer in enumerate(network):
+                    np.testing.assert_allclose(
+                        layer_lo_i[j].detach().numpy(),
+                        layer_lo[j][i].detach().numpy())
+                    np.testing.assert_allclose(
+                        layer_up_i[j].detach().numpy(),
+                        layer_up[j][i].detach().numpy())
+                    x_samples = layer(x_samples)
+                    self.assertTrue(
+                        torch.all(x_samples <= layer_up[j][i] + 1E-10))
+                    self.assertTrue(
+                        torch.all(x_samples >= layer_lo[j][i] - 1E-10))
+
+    def test_gradient(self):
+        network = self.construct_network(torch.nn.LeakyReLU(0.1))
+        shapes = [p.shape for p in network.parameters()]
+
+        def test_fun(*params_np):
+            for p, val, shape in zip(network.parameters(), params_np, shapes):
+                p.data = torch.from_numpy(val.reshape(shape))
+            layer_lo, layer_up = mip_utils.propagate_bounds_CROWN(
+                network, self.input_lo, self.input_up)
+            return torch.sum(layer_up[-1] - layer_lo[-1])
+
+        params_np = [
+            p.detach().numpy().reshape((-1, )).copy()
+            for p in network.parameters()
+        ]
+        test_fun(*params_np).backward()
+        grad = [p.grad.detach().numpy().copy() for p in network.parameters()]
+        grad_numerical = utils.compute_numerical_gradient(
+            lambda *x: np.array([test_fun(*x).item()]), *params_np)
+        for i in range(len(grad)):
+            np.testing.assert_allclose(grad[i].reshape((-1, )),
+                                       grad_numerical[i].reshape((-1, )),
+                                       atol=1E-5)
+
 
 class TestPropagateBounds(unittest.TestCase):
     def test_relu(self):
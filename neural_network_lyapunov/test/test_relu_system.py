@@ -66,6 +66,7 @@ def add_dynamics_constraint_tester(tester, dut):
             dut.step_forward(x_samples[i]).detach().numpy())
         if dut.network_bound_propagate_method in (
                 mip_utils.PropagateBoundsMethod.IA,
+                mip_utils.PropagateBoundsMethod.CROWN,
                 mip_utils.PropagateBoundsMethod.IA_MIP):
             np.testing.assert_array_less(
                 x_next_val,
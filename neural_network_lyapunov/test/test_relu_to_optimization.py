@@ -3,6 +3,8 @@ import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
 import neural_network_lyapunov.utils as utils
 import neural_network_lyapunov.mip_utils as mip_utils
 import unittest
+import copy
+import pickle
 import numpy as np
 import torch
 import torch.nn as nn
@@ -194,6 +196,35 @@ class TestReLU(unittest.TestCase):
         self.assertEqual(patterns[3],
                          [[False, True, True], [False, False, False]])
 
+    def test_compute_all_relu_activation_patterns_batch(self):
+        linear1 = nn.Linear(2, 3)
+        linear1.weight.data = torch.tensor([[1, 2], [3, 4], [5, 6]],
+                                           dtype=self.dtype)
+        linear1.bias.data = torch.tensor([-11, 13, 4], dtype=self.dtype)
+        linear2 = nn.Linear(3, 3)
+        linear2.weight.data = torch.tensor(
+            [[3, -2, -1], [1, -4, 0], [0, 1, -2]], dtype=self.dtype)
+        linear2.bias.data = torch.tensor([-11, 13, 48], dtype=self.dtype)
+        relu = nn.Sequential(linear1, nn.ReLU(), linear2, nn.ReLU())
+        x = torch.tensor([[1, 2], [1, 5], [-35, 23], [3, 4]],
+                         dtype=self.dtype)
+        patterns, offsets = \
+            relu_to_optimization.compute_all_relu_activation_patterns_batch(
+                relu, x)
+        self.assertEqual(offsets.tolist(), [0, 1, 3, 7, 11])
+        self.assertEqual(patterns.shape, (11, 6))
+        for i in range(x.shape[0]):
+            patterns_expected = [
+                p[0] + p[1] for p in
+                relu_to_optimization.compute_all_relu_activation_patterns(
+                    relu, x[i])
+            ]
+            patterns_i = patterns[offsets[i]:offsets[i + 1]].tolist()
+            # The order of the patterns doesn't matter.
+            self.assertEqual(len(patterns_i), len(patterns_expected))
+            for pattern in patterns_i:
+                self.assertIn(pattern, patterns_expected)
+
     def test_relu_activation_binary_to_pattern(self):
         for model in (self.model2, self.model4):
             activation_pattern = \
@@ -601,6 +632,61 @@ class TestReLU(unittest.TestCase):
 
         test_model(self.model2)
 
+    def test_output_gradient_compact(self):
+        gradient_times_vec_with_beta = \
+            compute_output_gradient_times_vec_intermediate_with_beta
+
+        def test_model(model):
+            relu_free_pattern = relu_to_optimization.ReLUFreePattern(
+                model, self.dtype)
+            mip_cnstr_return = relu_free_pattern.output_gradient_compact()
+            x_size = relu_free_pattern.x_size
+            out_size = model[-1].out_features
+            num_slack = relu_free_pattern.num_relu_units * x_size
+            # The number of slack variables and constraints grows linearly
+            # with the number of ReLU units.
+            self.assertEqual(mip_cnstr_return.Aout_slack.shape,
+                             (out_size * x_size, num_slack))
+            self.assertEqual(mip_cnstr_return.Ain_slack.shape,
+                             (4 * num_slack, num_slack))
+            self.assertEqual(
+                mip_cnstr_return.Ain_binary.shape,
+                (4 * num_slack, relu_free_pattern.num_relu_units))
+            for beta_val in ([1, 1, 0, 0, 1, 0, 0], [0, 1, 1, 1, 0, 1, 0],
+                             [1, 1, 1, 1, 1, 1, 1], [0, 0, 0, 0, 0, 0, 0]):
+                beta_val = beta_val[:relu_free_pattern.num_relu_units]
+                beta = torch.tensor(beta_val, dtype=self.dtype)
+                grad_expected = torch.empty((out_size, x_size),
+                                            dtype=self.dtype)
+                for k in range(x_size):
+                    _, Wz = gradient_times_vec_with_beta(
+                        model, beta,
+                        torch.eye(x_size, dtype=self.dtype)[k])
+                    grad_expected[:, k] = Wz[-1]
+                mip = gurobi_torch_mip.GurobiTorchMILP(self.dtype)
+                grad = mip.addVars(out_size * x_size,
+                                   lb=-gurobipy.GRB.INFINITY)
+                _, binary = mip.add_mixed_integer_linear_constraints(
+                    mip_cnstr_return, [], grad, "slack", "beta", "ineq", "eq",
+                    "out")
+                for i in range(len(binary)):
+                    binary[i].lb = beta_val[i]
+                    binary[i].ub = beta_val[i]
+                mip.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag,
+                                          False)
+                mip.gurobi_model.optimize()
+                self.assertEqual(mip.gurobi_model.status,
+                                 gurobipy.GRB.Status.OPTIMAL)
+                np.testing.assert_allclose(
+                    np.array([v.x for v in grad]).reshape(
+                        (out_size, x_size)),
+                    grad_expected.detach().numpy(),
+                    atol=1E-10)
+
+        test_model(self.model2)
+        test_model(self.model4)
+        test_model(self.model6)
+
     def test_output_gradient_times_vector(self):
         def test_model(model, x, y, y_lo, y_up):
             assert (x.shape == (2, ))
@@ -1056,6 +1142,23 @@ class TestReLU(unittest.TestCase):
         self.assertIsNotNone(Ain_slack)
         self.assertIsNotNone(Ain_binary)
         self.assertIsNotNone(rhs_in)
+        # Strengthening at a batch of the same point twice duplicates the
+        # cuts of each layer.
+        Ain_input_batch, Ain_slack_batch, Ain_binary_batch, rhs_in_batch = \
+            dut.strengthen_mip_at_point(
+                (torch.stack((pt[0], pt[0])), torch.stack((pt[1], pt[1]))),
+                linear_inputs_lo, linear_inputs_up)
+        self.assertEqual(Ain_input_batch.shape[0], 2 * Ain_input.shape[0])
+        for val, val_batch in ((Ain_input, Ain_input_batch),
+                               (Ain_slack, Ain_slack_batch),
+                               (Ain_binary, Ain_binary_batch),
+                               (rhs_in, rhs_in_batch)):
+            val_batch = val_batch.to_dense() if val_batch.is_sparse else\
+                val_batch
+            val = val.to_dense() if val.is_sparse else val
+            np.testing.assert_allclose(
+                np.sort(val_batch.detach().numpy(), axis=0),
+                np.sort(torch.cat((val, val)).detach().numpy(), axis=0))
         # I "think" the number of strengthend constraints equal to the number
         # of non-integral activations at the LP solution, this should be true
         # at least for LP constructed with bounds from interval arithmetics.
@@ -1653,6 +1756,22 @@ class TestComputeLayerBound(TestComputeLinearOutputBoundByOptimization):
                                      z_post_relu_up_ia.detach().numpy() + 1E-6)
         np.testing.assert_array_less(z_pre_relu_lo_lp.detach().numpy(),
                                      z_pre_relu_lo_mip.detach().numpy() + 1E-6)
+        # The bounds from CROWN are between the IA and LP bounds.
+        z_pre_relu_lo_crown, z_pre_relu_up_crown, _, _ =\
+            dut._compute_layer_bound(x_lo, x_up,
+                                     mip_utils.PropagateBoundsMethod.CROWN)
+        np.testing.assert_array_less(
+            z_pre_relu_lo_ia.detach().numpy(),
+            z_pre_relu_lo_crown.detach().numpy() + 1E-6)
+        np.testing.assert_array_less(
+            z_pre_relu_lo_crown.detach().numpy(),
+            z_pre_relu_lo_lp.detach().numpy() + 1E-6)
+        np.testing.assert_array_less(
+            z_pre_relu_up_crown.detach().numpy(),
+            z_pre_relu_up_ia.detach().numpy() + 1E-6)
+        np.testing.assert_array_less(
+            z_pre_relu_up_lp.detach().numpy(),
+            z_pre_relu_up_crown.detach().numpy() + 1E-6)
         np.testing.assert_array_less(z_pre_relu_up_mip.detach().numpy(),
                                      z_pre_relu_up_lp.detach().numpy() + 1E-6)
         np.testing.assert_array_less(
@@ -1795,6 +1914,239 @@ class TestComputeLayerBound(TestComputeLinearOutputBoundByOptimization):
             self.compute_network_output_bounds_tester(self.relu_no_bias, x_lo,
                                                       x_up, method)
 
+    def test_bound_tightening_num_workers(self):
+        # Computing the bounds in parallel gives the same result as computing
+        # them serially.
+        x_lo = torch.tensor([-2., -1.], dtype=self.dtype)
+        x_up = torch.tensor([-1., 2.], dtype=self.dtype)
+        dut = relu_to_optimization.ReLUFreePattern(self.relu_with_bias,
+                                                   self.dtype)
+        for method in (mip_utils.PropagateBoundsMethod.LP,
+                       mip_utils.PropagateBoundsMethod.MIP):
+            dut.bound_tightening_num_workers = 1
+            bounds = dut._compute_layer_bound(x_lo, x_up, method)
+            output_bounds = dut._compute_network_output_bounds(
+                bounds[0], bounds[1], x_lo, x_up, method)
+            dut.bound_tightening_num_workers = 2
+            # The workers don't receive dut, so its bound_cache doesn't have
+            # to be picklable.
+            dut.bound_cache = relu_to_optimization.ReLUBoundCache()
+            with dut.bound_tightening_pool() as pool:
+                self.assertIsNotNone(pool)
+                bounds_parallel = dut._compute_layer_bound(x_lo, x_up, method)
+                output_bounds_parallel = dut._compute_network_output_bounds(
+                    bounds_parallel[0], bounds_parallel[1], x_lo, x_up,
+                    method)
+                self.assertIs(dut._bound_tightening_pool, pool)
+            self.assertIsNone(dut._bound_tightening_pool)
+            dut.bound_cache = None
+            for val, val_parallel in zip(bounds + output_bounds,
+                                         bounds_parallel +
+                                         output_bounds_parallel):
+                np.testing.assert_allclose(val.detach().numpy(),
+                                           val_parallel.detach().numpy())
+
+    def test_bound_tightening_backend(self):
+        # The bounds computed by the programs without a gurobi model are the
+        # same as the bounds computed by gurobi.
+        x_lo = torch.tensor([-2., -1.], dtype=self.dtype)
+        x_up = torch.tensor([-1., 2.], dtype=self.dtype)
+        dut = relu_to_optimization.ReLUFreePattern(self.relu_with_bias,
+                                                   self.dtype)
+        for method in (mip_utils.PropagateBoundsMethod.LP,
+                       mip_utils.PropagateBoundsMethod.MIP):
+            dut.bound_tightening_backend = None
+            bounds = dut._compute_layer_bound(x_lo, x_up, method)
+            dut.bound_tightening_backend = \
+                gurobi_torch_mip.ScipyMILPSolverBackend()
+            prog, _, _ = dut._create_linear_output_bound_prog(
+                1, np.zeros((dut.num_relu_units, )),
+                np.ones((dut.num_relu_units, )), x_lo.detach().numpy(),
+                x_up.detach().numpy(), None,
+                mip_utils.binary_var_type_per_method(method))
+            self.assertFalse(prog.has_gurobi_model())
+            bounds_scipy = dut._compute_layer_bound(x_lo, x_up, method)
+            for val, val_scipy in zip(bounds, bounds_scipy):
+                np.testing.assert_allclose(val.detach().numpy(),
+                                           val_scipy.detach().numpy(),
+                                           atol=1E-6)
+
+    def test_layer_bound_tightening_session(self):
+        x_lo = np.array([-2., -1.])
+        x_up = np.array([-1., 2.])
+        for network in (self.relu_with_bias, self.relu_no_bias):
+            dut = relu_to_optimization.ReLUFreePattern(network, self.dtype)
+            for binary_var_type in (gurobi_torch_mip.BINARYRELAX,
+                                    gurobipy.GRB.BINARY):
+                session = relu_to_optimization.LayerBoundTighteningSession(
+                    dut, x_lo, x_up, binary_var_type)
+                neuron_lo = np.zeros((dut.num_relu_units, ))
+                neuron_up = np.zeros((dut.num_relu_units, ))
+                for layer in range(len(dut.relu_unit_index) + 1):
+                    layer_lo, layer_up = session.compute_layer_bounds()
+                    # Same as building a new program for each neuron.
+                    for j in range(layer_lo.shape[0]):
+                        lo_expected, up_expected, _, _ = dut.\
+                            _compute_linear_output_bound_by_optimization(
+                                layer, j, neuron_lo, neuron_up, x_lo, x_up,
+                                None, binary_var_type)
+                        self.assertAlmostEqual(layer_lo[j], lo_expected)
+                        self.assertAlmostEqual(layer_up[j], up_expected)
+                    if layer < len(dut.relu_unit_index):
+                        neuron_lo[dut.relu_unit_index[layer]] = layer_lo
+                        neuron_up[dut.relu_unit_index[layer]] = layer_up
+                        session.append_layer(layer_lo, layer_up)
+
+    def test_bound_cache(self):
+        x_lo = torch.tensor([-2., -1.], dtype=self.dtype)
+        x_up = torch.tensor([-1., 2.], dtype=self.dtype)
+        network = copy.deepcopy(self.relu_with_bias)
+        dut = relu_to_optimization.ReLUFreePattern(network, self.dtype)
+        dut.bound_cache = relu_to_optimization.ReLUBoundCache(max_reuse=2)
+        method = mip_utils.PropagateBoundsMethod.MIP
+        bounds = dut._compute_layer_bound(x_lo, x_up, method)
+        self.assertEqual(len(dut.bound_cache.entries), 1)
+        # With the same parameters, the cached bounds are reused.
+        bounds_cached = dut._compute_layer_bound(x_lo, x_up, method)
+        for val, val_cached in zip(bounds, bounds_cached):
+            np.testing.assert_allclose(val.detach().numpy(),
+                                       val_cached.detach().numpy())
+        # Perturb the parameters. The cached bounds should contain the exact
+        # MIP bounds.
+        with torch.no_grad():
+            for p in network.parameters():
+                p.add_(1E-3 * torch.ones_like(p))
+        bounds_cached = dut._compute_layer_bound(x_lo, x_up, method)
+        bounds_mip = dut._compute_layer_bound_by_optimization(
+            x_lo, x_up, method, None)
+        np.testing.assert_array_less(bounds_cached[0].detach().numpy(),
+                                     bounds_mip[0].detach().numpy() + 1E-6)
+        np.testing.assert_array_less(bounds_mip[1].detach().numpy(),
+                                     bounds_cached[1].detach().numpy() + 1E-6)
+        self.assertEqual(dut.bound_cache.entries[dut.bound_cache._key(
+            x_lo, x_up, method, None)][3], 2)
+        # The entry has been reused max_reuse times, so all the bounds are
+        # recomputed.
+        bounds_refreshed = dut._compute_layer_bound(x_lo, x_up, method)
+        for val, val_mip in zip(bounds_refreshed, bounds_mip):
+            np.testing.assert_allclose(val.detach().numpy(),
+                                       val_mip.detach().numpy())
+
+    def test_bound_cache_tag_and_eviction(self):
+        x_lo = torch.tensor([-2., -1.], dtype=self.dtype)
+        x_up = torch.tensor([-1., 2.], dtype=self.dtype)
+        dut = relu_to_optimization.ReLUFreePattern(self.relu_with_bias,
+                                                   self.dtype)
+        dut.bound_cache = relu_to_optimization.ReLUBoundCache(max_entries=2)
+        method = mip_utils.PropagateBoundsMethod.LP
+
+        def create_prog_callback():
+            prog = gurobi_torch_mip.GurobiTorchMILP(self.dtype)
+            input_var = prog.addVars(2,
+                                     lb=-gurobipy.GRB.INFINITY,
+                                     ub=gurobipy.GRB.INFINITY)
+            return prog, input_var
+
+        # A new callback in each call shares the entry through the tag.
+        for _ in range(2):
+            dut._compute_layer_bound(
+                x_lo,
+                x_up,
+                method,
+                create_prog_callback=lambda: create_prog_callback(),
+                cache_tag="tag")
+        self.assertEqual(len(dut.bound_cache.entries), 1)
+        key_tag = dut.bound_cache._key(x_lo, x_up, method, None, "tag")
+        self.assertEqual(dut.bound_cache.entries[key_tag][3], 1)
+        # Only the most recently used max_entries entries are kept.
+        dut._compute_layer_bound(x_lo, x_up, method)
+        dut._compute_layer_bound(x_lo, x_up, method)
+        dut._compute_layer_bound(x_lo - 1, x_up, method)
+        self.assertEqual(len(dut.bound_cache.entries), 2)
+        self.assertNotIn(key_tag, dut.bound_cache.entries)
+        self.assertIn(dut.bound_cache._key(x_lo, x_up, method, None),
+                      dut.bound_cache.entries)
+        # The cache (with its lock) can be pickled, for example with the
+        # system sent to the domain decomposition processes.
+        bound_cache = pickle.loads(pickle.dumps(dut.bound_cache))
+        self.assertEqual(list(bound_cache.entries.keys()),
+                         list(dut.bound_cache.entries.keys()))
+        bound_cache.clear()
+        self.assertEqual(len(bound_cache.entries), 0)
+
+
+class TestCompressStableNeurons(unittest.TestCase):
+    def setUp(self):
+        self.dtype = torch.float64
+        torch.manual_seed(0)
+
+    def compress_tester(self, network, x_lo, x_up):
+        dut = relu_to_optimization.ReLUFreePattern(network, self.dtype)
+        z_pre_relu_lo, z_pre_relu_up, _, _ = dut._compute_layer_bound(
+            x_lo, x_up, mip_utils.PropagateBoundsMethod.IA)
+        compressed = dut.compress_stable_neurons(z_pre_relu_lo, z_pre_relu_up)
+        num_unstable = torch.sum(
+            torch.logical_and(z_pre_relu_lo < 0, z_pre_relu_up > 0)).item()
+        self.assertEqual(compressed.num_relu_units, num_unstable)
+        for i, unit in enumerate(compressed.original_unit_index):
+            self.assertLess(z_pre_relu_lo[unit].item(), 0)
+            self.assertGreater(z_pre_relu_up[unit].item(), 0)
+            self.assertEqual(compressed.z_pre_relu_lo[i].item(),
+                             z_pre_relu_lo[unit].item())
+        x_samples = utils.uniform_sample_in_box(x_lo, x_up, 100)
+        # The compressed network is equivalent to the original network within
+        # the box.
+        np.testing.assert_allclose(
+            compressed.forward(x_samples).detach().numpy(),
+            network(x_samples).detach().numpy())
+        # The gradient flows back to the original parameters.
+        for p in network.parameters():
+            p.grad = None
+        torch.sum(network(x_samples)).backward()
+        grad_expected = [p.grad.clone() for p in network.parameters()]
+        for p in network.parameters():
+            p.grad = None
+        torch.sum(compressed.forward(x_samples)).backward()
+        for p, grad in zip(network.parameters(), grad_expected):
+            np.testing.assert_allclose(p.grad.detach().numpy(),
+                                       grad.detach().numpy())
+        # Solve the MIP with the input fixed to the samples, the output
+        # should match the network output.
+        mip_cnstr_return = compressed.mixed_integer_constraints(x_lo, x_up)
+        prog = gurobi_torch_mip.GurobiTorchMILP(self.dtype)
+        x = prog.addVars(dut.x_size, lb=-gurobipy.GRB.INFINITY)
+        y = prog.addVars(network[-1].out_features, lb=-gurobipy.GRB.INFINITY)
+        _, binary = prog.add_mixed_integer_linear_constraints(
+            mip_cnstr_return, x, y, "s", "beta", "", "", "")
+        self.assertEqual(len(binary), num_unstable)
+        prog.gurobi_model.setParam(gurobipy.GRB.Param.OutputFlag, False)
+        for i in range(10):
+            for j in range(dut.x_size):
+                x[j].lb = x_samples[i, j].item()
+                x[j].ub = x_samples[i, j].item()
+            prog.gurobi_model.optimize()
+            self.assertEqual(prog.gurobi_model.status,
+                             gurobipy.GRB.Status.OPTIMAL)
+            np.testing.assert_allclose(
+                prog.get_solution(y).detach().numpy(),
+                network(x_samples[i]).detach().numpy(),
+                atol=1E-6)
+
+    def test(self):
+        for negative_slope in (0., 0.1):
+            network = utils.setup_relu((2, 6, 8, 4, 3),
+                                       params=None,
+                                       negative_slope=negative_slope,
+                                       bias=True,
+                                       dtype=self.dtype)
+            # A small box has many stable units, a large box has many
+            # unstable units.
+            for x_lo, x_up in ((torch.tensor([0.2, -0.3], dtype=self.dtype),
+                                torch.tensor([0.25, -0.2], dtype=self.dtype)),
+                               (torch.tensor([-2., -1.], dtype=self.dtype),
+                                torch.tensor([1., 2.], dtype=self.dtype))):
+                self.compress_tester(network, x_lo, x_up)
+
 
 if __name__ == "__main__":
     unittest.main()
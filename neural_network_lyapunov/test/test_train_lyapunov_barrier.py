@@ -1,4 +1,6 @@
 import neural_network_lyapunov.lyapunov as lyapunov
+import neural_network_lyapunov.continuous_time_lyapunov as\
+    continuous_time_lyapunov
 import neural_network_lyapunov.barrier as barrier
 import neural_network_lyapunov.train_lyapunov_barrier as train_lyapunov_barrier
 import neural_network_lyapunov.hybrid_linear_system as hybrid_linear_system
@@ -8,11 +10,15 @@ import neural_network_lyapunov.r_options as r_options
 import neural_network_lyapunov.utils as utils
 import neural_network_lyapunov.relu_system as relu_system
 import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
+import neural_network_lyapunov.mip_utils as mip_utils
 import torch
 import torch.nn as nn
 import unittest
 import gurobipy
 import numpy as np
+import copy
+import io
+import contextlib
 
 
 def setup_lyapunov_relu():
@@ -162,6 +168,296 @@ class TestTrainerMIP(unittest.TestCase):
                         np.array([v.xn for v in derivative_return.x]),
                         derivative_mip_adversarial[i].detach().numpy())
 
+    def test_falsify_lyap_derivative(self):
+        torch.manual_seed(0)
+        self.dut.lyapunov_derivative_falsifier_num_samples = 100
+        lyap_relu_params = copy.deepcopy(
+            self.lyap.lyapunov_relu.state_dict())
+        adversarial, adversarial_next, obj = \
+            self.dut.falsify_lyap_derivative()
+        # The falsifier shouldn't change the network.
+        for key, val in self.lyap.lyapunov_relu.state_dict().items():
+            np.testing.assert_allclose(val.detach().numpy(),
+                                       lyap_relu_params[key].detach().numpy())
+            self.assertIsNone(
+                dict(self.lyap.lyapunov_relu.named_parameters())[key].grad)
+        _, derivative_mip_obj, _, _ = self.dut.solve_lyap_derivative_mip()
+        # The falsifier objective is a lower bound of the MIP objective.
+        self.assertLessEqual(obj, derivative_mip_obj + 1E-6)
+        self.assertGreater(adversarial.shape[0], 0)
+        np.testing.assert_array_less(self.lyap.system.x_lo_all - 1E-10,
+                                     adversarial.detach().numpy())
+        np.testing.assert_array_less(adversarial.detach().numpy(),
+                                     self.lyap.system.x_up_all + 1E-10)
+        np.testing.assert_allclose(
+            adversarial_next.detach().numpy(),
+            self.lyap.system.step_forward(adversarial).detach().numpy())
+        with torch.no_grad():
+            violation = self.lyap.\
+                lyapunov_derivative_loss_at_samples_and_next_states(
+                    self.dut.V_lambda,
+                    self.dut.lyapunov_derivative_epsilon,
+                    adversarial,
+                    adversarial_next,
+                    self.dut.x_equilibrium,
+                    self.dut.lyapunov_derivative_eps_type,
+                    R=self.R_options.R(),
+                    reduction="none")
+        np.testing.assert_array_less(
+            self.dut.lyapunov_derivative_convergence_tol,
+            violation.detach().numpy())
+        self.assertAlmostEqual(violation[0].item(), obj)
+        # Sorted in the descending order.
+        np.testing.assert_array_less(
+            violation[1:].detach().numpy(),
+            violation[:-1].detach().numpy() + 1E-10)
+
+    def test_lyapunov_derivative_mip_starts(self):
+        self.dut.lyapunov_derivative_mip_pool_solutions = 5
+        self.dut.lyapunov_derivative_mip_num_starts = 3
+        _, obj_expected, adversarial, _ = self.dut.solve_lyap_derivative_mip()
+        self.assertGreater(adversarial.shape[0], 0)
+        np.testing.assert_allclose(
+            self.dut._lyapunov_derivative_start_states.detach().numpy(),
+            adversarial[:3].detach().numpy())
+        # The second MIP starts from the counterexamples of the first one.
+        derivative_mip, obj, _, _ = self.dut.solve_lyap_derivative_mip()
+        self.assertEqual(derivative_mip.gurobi_model.NumStart,
+                         min(adversarial.shape[0], 3))
+        self.assertAlmostEqual(obj, obj_expected, places=6)
+
+    def test_stream_counterexamples(self):
+        _, derivative_mip_obj_optimal, _, _ = \
+            self.dut.solve_lyap_derivative_mip()
+        self.assertGreater(derivative_mip_obj_optimal, 0)
+        self.dut.lyapunov_derivative_mip_stream_counterexamples = 2
+        derivative_mip, derivative_mip_obj, derivative_mip_adversarial, _ = \
+            self.dut.solve_lyap_derivative_mip()
+        # The objective of a terminated solve is an upper bound, and never
+        # under-estimates the violation.
+        self.assertGreaterEqual(derivative_mip_obj,
+                                derivative_mip_obj_optimal - 1E-6)
+        if derivative_mip.gurobi_model.status ==\
+                gurobipy.GRB.Status.INTERRUPTED:
+            self.assertEqual(derivative_mip_obj,
+                             derivative_mip.gurobi_model.ObjBound)
+        self.assertEqual(
+            self.dut.lyapunov_derivative_counterexample_queue.maxsize, 2)
+        counterexamples = []
+        while not self.dut.lyapunov_derivative_counterexample_queue.empty():
+            counterexamples.append(
+                self.dut.lyapunov_derivative_counterexample_queue.get())
+        self.assertGreater(len(counterexamples), 0)
+        self.assertLessEqual(len(counterexamples), 2)
+        self.assertLessEqual(len(counterexamples),
+                             derivative_mip_adversarial.shape[0])
+        for i, (x, obj) in enumerate(counterexamples):
+            self.assertGreater(obj, 0)
+            self.assertLessEqual(obj, derivative_mip_obj_optimal + 1E-6)
+            with torch.no_grad():
+                dV = self.lyap.lyapunov_derivative(
+                    x,
+                    self.dut.x_equilibrium,
+                    self.dut.V_lambda,
+                    self.dut.lyapunov_derivative_epsilon,
+                    R=self.R_options.R())
+            self.assertAlmostEqual(dV[0].item(), obj, places=5)
+            for j in range(i):
+                self.assertGreater(
+                    torch.max(torch.abs(x - counterexamples[j][0])).item(),
+                    1E-6)
+        # Each solve streams into a new queue.
+        queue_first = self.dut.lyapunov_derivative_counterexample_queue
+        self.dut.solve_lyap_derivative_mip()
+        self.assertIsNot(self.dut.lyapunov_derivative_counterexample_queue,
+                         queue_first)
+        counterexamples = self.dut.drain_derivative_counterexamples()
+        self.assertGreater(counterexamples.shape[0], 0)
+        self.assertLessEqual(counterexamples.shape[0], 2)
+        self.assertTrue(
+            self.dut.lyapunov_derivative_counterexample_queue.empty())
+        self.assertEqual(self.dut.drain_derivative_counterexamples().shape,
+                         (0, self.dut.lyapunov_hybrid_system.system.x_dim))
+
+    def test_derivative_mip_term_threshold(self):
+        # Without streaming, a solve terminated by the threshold returns the
+        # incumbent objective.
+        self.dut.lyapunov_derivative_mip_term_threshold = 1E-6
+        derivative_mip, derivative_mip_obj, _, _ = \
+            self.dut.solve_lyap_derivative_mip()
+        self.assertEqual(derivative_mip_obj,
+                         derivative_mip.gurobi_model.ObjVal)
+
+    def test_split_mip_threads(self):
+        self.dut.mip_threads_budget = 32
+        self.assertEqual(
+            self.dut._split_mip_threads(
+                ["lyap_positivity", "lyap_derivative", "boundary_gap"]), {
+                    "lyap_positivity": 5,
+                    "lyap_derivative": 22,
+                    "boundary_gap": 5
+                })
+        # Each MIP gets at least one thread, and the total doesn't exceed the
+        # budget.
+        for budget in range(3, 33):
+            self.dut.mip_threads_budget = budget
+            threads = self.dut._split_mip_threads(
+                ["lyap_positivity", "lyap_derivative", "boundary_gap"])
+            self.assertEqual(sum(threads.values()), budget)
+            self.assertGreaterEqual(min(threads.values()), 1)
+        self.dut.mip_threads_budget = 4
+        self.assertEqual(
+            self.dut._split_mip_threads(
+                ["lyap_positivity", "lyap_derivative", "boundary_gap"]), {
+                    "lyap_positivity": 1,
+                    "lyap_derivative": 2,
+                    "boundary_gap": 1
+                })
+        # With fewer threads than MIPs, each MIP gets one thread, and
+        # _solve_mips() solves at most budget MIPs at a time.
+        self.dut.mip_threads_budget = 2
+        self.assertEqual(
+            self.dut._split_mip_threads(
+                ["lyap_positivity", "lyap_derivative", "boundary_gap"]), {
+                    "lyap_positivity": 1,
+                    "lyap_derivative": 1,
+                    "boundary_gap": 1
+                })
+
+    def test_solve_mips(self):
+        solvers = {
+            "lyap_positivity": self.dut.solve_positivity_mip,
+            "lyap_derivative": self.dut.solve_lyap_derivative_mip,
+            "boundary_gap": self.dut.solve_boundary_gap_mip
+        }
+        self.dut.mip_solve_workers = 1
+        results_sequential = self.dut._solve_mips(solvers)
+        self.dut.mip_solve_workers = 3
+        self.dut.mip_threads_budget = 3
+        results_concurrent = self.dut._solve_mips(solvers)
+        self.assertEqual(list(results_concurrent.keys()), list(solvers.keys()))
+        for name in ("lyap_positivity", "lyap_derivative"):
+            self.assertAlmostEqual(results_sequential[name][1],
+                                   results_concurrent[name][1])
+            self.assertEqual(
+                results_concurrent[name][0].gurobi_model.Params.Threads, 1)
+        np.testing.assert_allclose(
+            results_sequential["boundary_gap"][0].item(),
+            results_concurrent["boundary_gap"][0].item())
+        # The worker threads and their gurobi environments are reused.
+        self.assertEqual(len(self.dut._mip_workers), 3)
+        executor = self.dut._mip_executor
+        self.dut._solve_mips(solvers)
+        self.assertIs(self.dut._mip_executor, executor)
+        self.assertEqual(len(self.dut._mip_workers), 3)
+        self.dut.shutdown_mip_workers()
+        self.assertIsNone(self.dut._mip_executor)
+        self.assertEqual(len(self.dut._mip_workers), 0)
+        # At most mip_threads_budget MIPs are solved at a time.
+        self.dut.mip_threads_budget = 2
+        self.dut._solve_mips(solvers)
+        self.assertLessEqual(len(self.dut._mip_workers), 2)
+        self.dut.shutdown_mip_workers()
+
+    def test_solve_mips_template_threads(self):
+        # The MIP templates kept by the worker threads are solved with the
+        # number of threads of the current split.
+        solvers = {
+            "lyap_positivity": self.dut.solve_positivity_mip,
+            "lyap_derivative": self.dut.solve_lyap_derivative_mip
+        }
+        self.dut.lyapunov_mip_template = True
+        self.dut.mip_solve_workers = 2
+        for budget in (6, 2):
+            self.dut.mip_threads_budget = budget
+            threads = self.dut._split_mip_threads(list(solvers.keys()))
+            results = self.dut._solve_mips(solvers)
+            for name in solvers:
+                self.assertEqual(results[name][0].gurobi_model.Params.Threads,
+                                 threads[name])
+        self.dut.shutdown_mip_workers()
+
+    def test_lyapunov_mip_pool_loss(self):
+        self.dut.lyapunov_positivity_mip_pool_solutions = 10
+        positivity_mip, _, _ = self.dut.solve_positivity_mip()
+        self.dut.lyapunov_mip_pool_loss = False
+        self.assertAlmostEqual(
+            self.dut._lyapunov_mip_loss_objective(positivity_mip).item(),
+            positivity_mip.gurobi_model.ObjVal,
+            places=5)
+        self.dut.lyapunov_mip_pool_loss = True
+        _, pool_obj = positivity_mip.get_pool_solutions([])
+        self.assertGreater(pool_obj.shape[0], 1)
+        self.assertAlmostEqual(
+            self.dut._lyapunov_mip_loss_objective(positivity_mip).item(),
+            torch.mean(pool_obj).item(),
+            places=5)
+
+    def test_lyapunov_mip_template(self):
+        self.dut.lyapunov_mip_template = True
+        self.dut.lyapunov_derivative_mip_pool_solutions = 1
+        positivity_mip, _, _ = self.dut.solve_positivity_mip()
+        derivative_mip, _, _, _ = self.dut.solve_lyap_derivative_mip()
+        with torch.no_grad():
+            for layer in self.lyap.lyapunov_relu:
+                if isinstance(layer, nn.Linear):
+                    layer.weight.mul_(1.01)
+        positivity_template, positivity_obj, _ = \
+            self.dut.solve_positivity_mip()
+        derivative_template, derivative_obj, derivative_adversarial, \
+            derivative_adversarial_next = self.dut.solve_lyap_derivative_mip()
+        self.assertIs(positivity_template, positivity_mip)
+        self.assertIs(derivative_template, derivative_mip)
+
+        self.dut.lyapunov_mip_template = False
+        positivity_mip, positivity_obj_expected, _ = \
+            self.dut.solve_positivity_mip()
+        derivative_mip, derivative_obj_expected, _, _ = \
+            self.dut.solve_lyap_derivative_mip()
+        self.assertAlmostEqual(positivity_obj, positivity_obj_expected)
+        self.assertAlmostEqual(derivative_obj, derivative_obj_expected)
+        self.assertAlmostEqual(
+            positivity_template.compute_objective_from_mip_data_and_solution(
+                penalty=1e-13).item(),
+            positivity_obj_expected,
+            places=5)
+        self.assertAlmostEqual(
+            derivative_template.compute_objective_from_mip_data_and_solution(
+                penalty=1e-13).item(),
+            derivative_obj_expected,
+            places=5)
+        np.testing.assert_allclose(
+            derivative_adversarial_next.detach().numpy(),
+            self.lyap.system.step_forward(
+                derivative_adversarial).detach().numpy())
+
+    def test_reuse_relu_bounds(self):
+        # The MIPs with the cached ReLU bounds have the same optimal cost as
+        # the MIPs with the recomputed bounds.
+        self.lyap.network_bound_propagate_method = \
+            mip_utils.PropagateBoundsMethod.LP
+        self.dut.reuse_relu_bounds = True
+        self.dut._setup_relu_bound_caches()
+        bound_cache = self.lyap.lyapunov_relu_free_pattern.bound_cache
+        self.assertIsNotNone(bound_cache)
+        self.dut.solve_lyap_derivative_mip()
+        self.assertEqual(len(bound_cache.entries), 1)
+        with torch.no_grad():
+            for layer in self.lyap.lyapunov_relu:
+                if isinstance(layer, nn.Linear):
+                    layer.weight.mul_(1.01)
+        _, derivative_obj, _, _ = self.dut.solve_lyap_derivative_mip()
+        self.assertEqual(list(bound_cache.entries.values())[0][3], 1)
+        # Setting up again keeps the same cache.
+        self.dut._setup_relu_bound_caches()
+        self.assertIs(self.lyap.lyapunov_relu_free_pattern.bound_cache,
+                      bound_cache)
+        self.lyap.lyapunov_relu_free_pattern.bound_cache = None
+        _, derivative_obj_expected, _, _ = \
+            self.dut.solve_lyap_derivative_mip()
+        self.assertAlmostEqual(derivative_obj, derivative_obj_expected,
+                               places=5)
+
 
 class TestTrainerAdversarial(TestTrainerMIP):
     """
@@ -203,6 +499,37 @@ class TestTrainerAdversarial(TestTrainerMIP):
         self.assertEqual(derivative_state_repeatition.shape,
                          (derivative_state_samples.shape[0], ))
 
+    def test_train_adversarial_falsifier(self):
+        # When the falsifier finds the violating states, they are added to the
+        # derivative samples instead of the MIP solutions.
+        torch.manual_seed(0)
+        positivity_state_samples_init = utils.get_meshgrid_samples(
+            torch.from_numpy(self.lyap.system.x_lo_all),
+            torch.from_numpy(self.lyap.system.x_up_all), (3, 3), torch.float64)
+        derivative_state_samples_init = utils.get_meshgrid_samples(
+            torch.from_numpy(self.lyap.system.x_lo_all),
+            torch.from_numpy(self.lyap.system.x_up_all), (3, 3), torch.float64)
+        options = train_lyapunov_barrier.Trainer.AdversarialTrainingOptions()
+        options.num_epochs_per_mip = 1
+        self.dut.add_positivity_adversarial_state = True
+        self.dut.add_derivative_adversarial_state = True
+        self.dut.lyapunov_derivative_mip_pool_solutions = 1
+        self.dut.lyapunov_derivative_falsifier_num_samples = 100
+        self.dut.max_iterations = 1
+        self.dut.output_flag = True
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            _, _, derivative_state_samples, _, _ = self.dut.train_adversarial(
+                positivity_state_samples_init, derivative_state_samples_init,
+                options)
+        # The falsifier cost is not reported as the derivative MIP cost.
+        self.assertIn("derivative falsifier cost", output.getvalue())
+        self.assertNotIn("derivative_cost", output.getvalue())
+        self.assertGreater(
+            derivative_state_samples.shape[0],
+            derivative_state_samples_init.shape[0] +
+            self.dut.lyapunov_derivative_mip_pool_solutions)
+
 
 class TestTrainer(unittest.TestCase):
     def test_total_loss(self):
@@ -370,6 +697,22 @@ class TestTrainer(unittest.TestCase):
                                       np.array([v.x for v in x]))
         self.assertAlmostEqual(loss.item(), V_max_milp - V_min_milp)
 
+    def test_lyapunov_derivative_mip_starts_continuous_time(self):
+        # The MIP starts are only supported for the discrete time system.
+        system = test_hybrid_linear_system.\
+            setup_johansson_continuous_time_system1()
+        lyapunov_hybrid_system = \
+            continuous_time_lyapunov.LyapunovContinuousTimeHybridSystem(
+                system, setup_lyapunov_relu())
+        R_options = r_options.FixedROptions(
+            torch.tensor([[1, 1], [-1, 1], [0, 1]], dtype=system.dtype))
+        dut = train_lyapunov_barrier.Trainer()
+        dut.add_lyapunov(lyapunov_hybrid_system, 0.1,
+                         torch.tensor([0, 0], dtype=system.dtype), R_options)
+        dut.lyapunov_derivative_mip_num_starts = 1
+        with self.assertRaises(AssertionError):
+            dut.solve_lyap_derivative_mip()
+
     def test_solve_boundary_gap_mip(self):
         system = test_hybrid_linear_system.setup_trecate_discrete_time_system()
         V_lambda = 0.1
@@ -1174,6 +1174,29 @@ class TestReluNetworkGradient(unittest.TestCase):
         self.nonunique_gradient_tester(zero_tol=0.)
         self.nonunique_gradient_tester(zero_tol=1E-10)
 
+    def test_batch(self):
+        # The batched gradients should match relu_network_gradient() for
+        # each state, including the states with non-unique gradient.
+        for zero_tol in (0., 1E-10):
+            x = torch.tensor(
+                [[2, 4], [1 + 0.1 * zero_tol, -2], [1, -3],
+                 [2 + 0.1 * zero_tol, -1.5 - 0.1 * zero_tol]],
+                dtype=self.dtype)
+            for network in (self.network1, self.network2):
+                dphi_dx, offsets = utils.relu_network_gradient_batch(
+                    network, x, zero_tol=zero_tol)
+                self.assertEqual(offsets.shape, (x.shape[0] + 1, ))
+                self.assertEqual(offsets[-1].item(), dphi_dx.shape[0])
+                for i in range(x.shape[0]):
+                    dphi_dx_i = utils.relu_network_gradient(network,
+                                                            x[i],
+                                                            zero_tol=zero_tol)
+                    np.testing.assert_allclose(
+                        dphi_dx[offsets[i]:offsets[i + 1]].detach().numpy(),
+                        dphi_dx_i.detach().numpy())
+            self.assertEqual(
+                (offsets[1:] - offsets[:-1]).tolist(), [1, 2, 1, 4])
+
 
 class TestL1Gradient(unittest.TestCase):
     def test1(self):
@@ -1283,6 +1306,26 @@ class TestL1Gradient(unittest.TestCase):
                       [1., -1., -1., -0.5], [1., -1., -1., -1.]]))
 
 
+class TestL1GradientBatch(unittest.TestCase):
+    def test(self):
+        dtype = torch.float64
+        x = torch.tensor([[0.5, 1, -2], [0., 1, -2], [1., 0, 0], [0, 0, 0]],
+                         dtype=dtype)
+        grad, offsets = utils.l1_gradient_batch(x)
+        self.assertEqual((offsets[1:] - offsets[:-1]).tolist(), [1, 2, 4, 8])
+        for i in range(x.shape[0]):
+            grad_i = grad[offsets[i]:offsets[i + 1]]
+            grad_expected = utils.l1_gradient(x[i])
+            # The exact order of the gradient rows don't matter.
+            self.assertEqual(grad_i.shape, grad_expected.shape)
+            for j in range(grad_i.shape[0]):
+                self.assertTrue(
+                    torch.any(
+                        torch.all(grad_expected == grad_i[j], dim=1)))
+            self.assertEqual(torch.unique(grad_i, dim=0).shape[0],
+                             grad_i.shape[0])
+
+
 class TestLinfinityGradient(unittest.TestCase):
     def test1(self):
         dtype = torch.float64
@@ -1418,6 +1461,22 @@ class TestMinkowskiSum(unittest.TestCase):
             torch.tensor([[1, 2], [3, 4], [5, 6]], dtype=dtype),
             torch.tensor([[3, 4], [5, 6]], dtype=dtype))
 
+    def test_batch(self):
+        dtype = torch.float64
+        x = torch.tensor([[1, 2], [3, 4], [5, 6], [7, 8]], dtype=dtype)
+        x_offsets = torch.tensor([0, 1, 4])
+        y = torch.tensor([[1, 0], [0, 1], [2, 2]], dtype=dtype)
+        y_offsets = torch.tensor([0, 2, 3])
+        result, offsets = utils.minkowski_sum_batch(x, x_offsets, y,
+                                                    y_offsets)
+        self.assertEqual(offsets.tolist(), [0, 2, 5])
+        for i in range(2):
+            np.testing.assert_allclose(
+                result[offsets[i]:offsets[i + 1]].detach().numpy(),
+                utils.minkowski_sum(
+                    x[x_offsets[i]:x_offsets[i + 1]],
+                    y[y_offsets[i]:y_offsets[i + 1]]).detach().numpy())
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,6 +5,10 @@ import copy
 import wandb
 import inspect
 import time
+import os
+import concurrent.futures
+import queue
+import threading
 import neural_network_lyapunov.hybrid_linear_system as hybrid_linear_system
 import neural_network_lyapunov.lyapunov as lyapunov
 import neural_network_lyapunov.barrier as barrier
@@ -12,6 +16,7 @@ import neural_network_lyapunov.feedback_system as feedback_system
 import neural_network_lyapunov.utils as utils
 import neural_network_lyapunov.r_options as r_options
 import neural_network_lyapunov.gurobi_torch_mip as gurobi_torch_mip
+import neural_network_lyapunov.relu_to_optimization as relu_to_optimization
 
 
 class Trainer:
@@ -130,7 +135,8 @@ class Trainer:
         # Early termination: if None, will
         # find the most adversarial state, otherwise will terminate the search
         # as soon as it finds a state that violates the positivity or
-        # derivative condition by at least the given parameter
+        # derivative condition by at least the given parameter (the returned
+        # MIP objective is then the objective of that state).
         self.lyapunov_positivity_mip_term_threshold = None
         self.lyapunov_derivative_mip_term_threshold = None
 
@@ -150,17 +156,126 @@ class Trainer:
         # loss across all samples if sample_loss_reduction="max".
         self.sample_loss_reduction = "mean"
 
+        # If set to true, then the Lyapunov MIP losses are the mean of the
+        # (differentiable) objectives over all the solutions in the MIP
+        # solution pool, instead of the objective of the optimal solution.
+        self.lyapunov_mip_pool_loss = False
+
+        # If set to true, then the Lyapunov MIPs solved in the previous
+        # iteration are kept as templates. In the next iteration, we only
+        # construct the torch data of the MIP with the updated network
+        # (without a gurobi model), and copy it into the gurobi model of the
+        # template (see GurobiTorchMIP.update_from()), so that Gurobi can
+        # reuse the information from the previous solve, such as the previous
+        # incumbent. If the new MIP has a different structure (for example the
+        # bounds on some ReLU units changed sign), then the MIP is constructed
+        # again with gurobi, and becomes the template.
+        self.lyapunov_mip_template = False
+        self._mip_templates = {}
+
         # Number of strengthening points in the Lyapunov derivative MILP. We
         # can strengthen the big-M formulation of this MILP, using the idea
         # in "Strong mixed-integer programming formulations for trained neural
         # networks" by Ross Anderson et.al.
         self.derivative_mip_num_strengthen_pts = 0
 
+        # Whether to add the same strengthening constraints as user cuts at the
+        # branch-and-bound nodes of the Lyapunov derivative MILP, through a
+        # gurobi callback during the solve.
+        self.derivative_mip_cut_callback = False
+        # The cuts are only added at the nodes explored before this many
+        # nodes (1 means only at the root node), and at most
+        # derivative_mip_cut_callback_max_cuts cuts are added in each solve.
+        # None means no limit.
+        self.derivative_mip_cut_callback_max_node_count = 1
+        self.derivative_mip_cut_callback_max_cuts = 1000
+
         # Whether to add strengthening constraints for binary variables. Doing
         # this strengthening might be computational expensive (it could
         # require solving some MIPs).
         self.derivative_mip_strengthen_binary = False
 
+        # In train_adversarial(), before solving the Lyapunov derivative MIP,
+        # we first search for states violating the derivative condition by
+        # projected gradient ascent from this many random states in the box
+        # (refer to falsify_lyap_derivative()). If the search finds violating
+        # states, then they are used as the adversarial states and the MIP is
+        # skipped. Set to 0 to always solve the MIP.
+        self.lyapunov_derivative_falsifier_num_samples = 0
+        # The number of projected gradient ascent steps in the falsifier.
+        self.lyapunov_derivative_falsifier_iterations = 20
+        # The step size of the gradient ascent, as a fraction of the box
+        # width.
+        self.lyapunov_derivative_falsifier_step_size = 0.05
+        # The falsifier ascends the hinge loss max(l(x) + margin, 0), where
+        # l(x) is the violation of the derivative condition. States with
+        # l(x) < -margin have zero gradient and don't move.
+        self.lyapunov_derivative_falsifier_margin = 1.
+
+        # The number of threads to construct and solve the independent MIPs
+        # (positivity, derivative, boundary gap and barrier MIPs) in
+        # total_loss(), compute_barrier_loss() and train_adversarial()
+        # concurrently. Each thread has its own gurobi environment, and gurobi
+        # releases the GIL during the solve. Set to 1 to solve the MIPs
+        # sequentially.
+        self.mip_solve_workers = 1
+        # The total number of gurobi threads shared by the concurrent MIPs.
+        # None means all the cores.
+        self.mip_threads_budget = None
+        # mip_threads_budget is split among the concurrent MIPs in proportion
+        # to these weights (1 for the MIPs not in this dict). The MIPs are
+        # named lyap_positivity, lyap_derivative, boundary_gap, barrier_safe,
+        # barrier_unsafe and barrier_derivative.
+        self.mip_threads_weight = {"lyap_derivative": 4.}
+        self._mip_executor = None
+        self._mip_executor_workers = None
+        self._mip_thread_local = threading.local()
+        # A list of (env, mip_templates) of the worker threads.
+        self._mip_workers = []
+
+        # If set to a positive number, then solve_lyap_derivative_mip()
+        # streams the counterexamples: every new incumbent with a positive
+        # objective is pushed into lyapunov_derivative_counterexample_queue as
+        # soon as gurobi finds it, and the solve terminates after this many
+        # distinct counterexamples (without proving optimality). The returned
+        # MIP objective of a terminated solve is gurobi's upper bound
+        # ObjBound, so that it never reports convergence.
+        self.lyapunov_derivative_mip_stream_counterexamples = 0
+        # The time budget (in seconds) of the streaming solve. Once it is
+        # exceeded, the solve terminates as soon as it has streamed a
+        # counterexample. None means no limit.
+        self.lyapunov_derivative_mip_stream_time_limit = None
+        # Each solve_lyap_derivative_mip() with streaming creates a new queue
+        # (bounded by lyapunov_derivative_mip_stream_counterexamples). Each
+        # item is (x, obj), a counterexample state x of the derivative
+        # condition and its MIP objective. Another thread (for example the
+        # one that takes the gradient steps) can consume the counterexamples
+        # while the MIP is being solved; train_adversarial() drains the
+        # remaining ones after the solve.
+        self.lyapunov_derivative_counterexample_queue = None
+
+        # If set to a positive number, then up to this many counterexamples
+        # of the last derivative MIP are kept, and the next derivative MIP
+        # starts from complete feasible assignments (of all the continuous and
+        # binary variables) constructed at these states, loaded as multiple
+        # MIP starts (refer to
+        # LyapunovDiscreteTimeHybridSystem.lyapunov_derivative_milp_starts()).
+        # Unlike lyapunov_derivative_mip_warmstart, which only initializes the
+        # binary variables of the networks, each start is a feasible
+        # incumbent. Only supported for the discrete time system.
+        self.lyapunov_derivative_mip_num_starts = 0
+        self._lyapunov_derivative_start_states = None
+
+        # If set to true, then train() and train_adversarial() attach a
+        # relu_to_optimization.ReLUBoundCache to the Lyapunov network, the
+        # barrier network and the controller network (of a feedback system),
+        # so that their LP/MIP/IA_MIP bounds on the ReLU unit inputs are
+        # reused across the iterations, and only the bounds of the units whose
+        # parameters drifted are recomputed. The bounds of these networks
+        # don't depend on the other networks being trained. Has no effect
+        # with the IA or CROWN bound propagation methods.
+        self.reuse_relu_bounds = False
+
     def add_lyapunov(
             self, lyapunov_hybrid_system: lyapunov.LyapunovHybridLinearSystem,
             V_lambda, x_equilibrium, R_options):
@@ -321,14 +436,198 @@ class Trainer:
             derivative_sample_loss = torch.tensor(0, dtype=dtype)
         return safe_sample_loss, unsafe_sample_loss, derivative_sample_loss
 
+    def _lyapunov_mip_loss_objective(self, mip):
+        """
+        Return the differentiable objective of a solved Lyapunov MIP, that
+        is used in the loss. Refer to self.lyapunov_mip_pool_loss.
+        """
+        if self.lyapunov_mip_pool_loss:
+            return torch.mean(
+                mip.compute_objective_from_mip_data_and_all_solutions(
+                    penalty=1e-13))
+        return mip.compute_objective_from_mip_data_and_solution(
+            solution_number=0, penalty=1e-13)
+
+    def _apply_mip_template(self,
+                            key,
+                            construct,
+                            mip_and_variables,
+                            torch_data_only=True):
+        """
+        Construct a MIP, refer to self.lyapunov_mip_template.
+        @param key The name of the MIP template.
+        @param construct A function (without arguments) that constructs the
+        MIP.
+        @param mip_and_variables A function that maps the return of @p
+        construct to (mip, variables), where variables is a list of variable
+        lists in mip.
+        @param torch_data_only If the template exists and torch_data_only is
+        True, then @p construct is called within a
+        gurobi_torch_mip.solver_backend(TorchDataBackend()) context, namely
+        the gurobi model of the new MIP is not built. Set to False if @p
+        construct uses the gurobi model of the MIP it constructs.
+        @return (construct_return, mip_to_solve, variables_to_solve)
+        construct_return is the return of @p construct. mip_to_solve is
+        either the updated template or the newly constructed MIP.
+        variables_to_solve are the variables in mip_to_solve corresponding to
+        the variables of the constructed MIP. Within a worker thread of
+        _solve_mips(), the Threads parameter of mip_to_solve is set to the
+        number of threads of this MIP in the current call.
+        """
+        # A gurobi environment can't be shared between threads, hence each
+        # worker thread of _solve_mips() keeps its own templates.
+        mip_templates = getattr(self._mip_thread_local, "mip_templates",
+                                self._mip_templates)
+        template = mip_templates.get(key) if self.lyapunov_mip_template\
+            else None
+        if template is not None:
+            if torch_data_only:
+                with gurobi_torch_mip.solver_backend(
+                        gurobi_torch_mip.TorchDataBackend()):
+                    construct_return = construct()
+            else:
+                construct_return = construct()
+            mip, variables = mip_and_variables(construct_return)
+            if template.update_from(mip):
+                self._set_mip_threads(template)
+                return construct_return, template, [
+                    template.get_template_variables(v) for v in variables
+                ]
+        if template is None or torch_data_only:
+            construct_return = construct()
+        mip, variables = mip_and_variables(construct_return)
+        if self.lyapunov_mip_template:
+            mip_templates[key] = mip
+        self._set_mip_threads(mip)
+        return construct_return, mip, variables
+
+    def _set_mip_threads(self, mip):
+        """
+        Within a worker thread of _solve_mips(), set the Threads parameter of
+        @p mip to the number of threads assigned to the MIP being solved. A
+        template constructed in an earlier call keeps the Threads parameter
+        of the environment at that time, which can be stale.
+        """
+        threads = getattr(self._mip_thread_local, "threads", None)
+        if threads is not None:
+            mip.gurobi_model.setParam(gurobipy.GRB.Param.Threads, threads)
+
+    def _mip_threads_budget(self):
+        return self.mip_threads_budget if self.mip_threads_budget is not\
+            None else os.cpu_count()
+
+    def _split_mip_threads(self, names):
+        """
+        Split self.mip_threads_budget among the MIPs in @p names, in
+        proportion to self.mip_threads_weight. Each MIP gets at least one
+        thread, and the total number of threads doesn't exceed the budget
+        unless there are more MIPs than threads in the budget (in which case
+        _solve_mips() solves at most budget MIPs at a time). The split only
+        depends on @p names.
+        @return threads A dict mapping the MIP name to its number of threads.
+        """
+        budget = self._mip_threads_budget()
+        weights = np.array(
+            [self.mip_threads_weight.get(name, 1.) for name in names])
+        threads = np.maximum(
+            np.floor(budget * weights / np.sum(weights)).astype(int), 1)
+        # Giving each MIP at least one thread can exceed the budget, take the
+        # extra threads back from the MIPs with the most threads.
+        while np.sum(threads) > max(budget, len(names)):
+            threads[np.argmax(threads)] -= 1
+        # Give the leftover threads to the MIPs with the largest weights.
+        num_remaining = max(budget - int(np.sum(threads)), 0)
+        for i in np.argsort(-weights, kind="stable")[:num_remaining]:
+            threads[i] += 1
+        return dict(zip(names, threads.tolist()))
+
+    def _start_mip_worker(self):
+        """
+        The initializer of each worker thread in the thread pool of
+        _solve_mips(). Creates the gurobi environment (and the MIP templates)
+        of this thread, which are reused by all the MIPs solved in this
+        thread.
+        """
+        env = gurobipy.Env(empty=True)
+        env.setParam(gurobipy.GRB.Param.OutputFlag, 0)
+        env.start()
+        self._mip_thread_local.env = env
+        self._mip_thread_local.mip_templates = {}
+        self._mip_workers.append(
+            (env, self._mip_thread_local.mip_templates))
+
+    def shutdown_mip_workers(self):
+        """
+        Shut down the thread pool of _solve_mips(), and dispose the gurobi
+        environments of its worker threads. The MIPs constructed in these
+        threads (including the returned ones) can't be used afterwards. The
+        thread pool is started again by the next concurrent _solve_mips().
+        """
+        if self._mip_executor is None:
+            return
+        self._mip_executor.shutdown(wait=True)
+        self._mip_executor = None
+        for env, mip_templates in self._mip_workers:
+            mip_templates.clear()
+            env.dispose()
+        self._mip_workers = []
+
+    def _solve_mips(self, solvers: dict) -> dict:
+        """
+        Call the functions that construct and solve the independent MIPs.
+        When self.mip_solve_workers > 1, the functions are called concurrently
+        in a thread pool (of at most mip_threads_budget workers). Each worker
+        thread has its own gurobi environment, whose Threads parameter is set
+        by _split_mip_threads() before calling each function (the MIP
+        templates reused in this thread are set in _apply_mip_template()).
+        The thread pool is kept until shutdown_mip_workers().
+        @param solvers A dict mapping the MIP name to the function (without
+        arguments) that constructs and solves the MIP.
+        @return results A dict mapping the MIP name to the return of its
+        function, in the same order as @p solvers regardless of the order in
+        which the MIPs finish.
+        """
+        if self.mip_solve_workers <= 1 or len(solvers) <= 1:
+            return {name: solve() for name, solve in solvers.items()}
+        threads = self._split_mip_threads(list(solvers.keys()))
+        num_workers = min(self.mip_solve_workers, self._mip_threads_budget())
+        if self._mip_executor is not None and\
+                self._mip_executor_workers != num_workers:
+            self.shutdown_mip_workers()
+        if self._mip_executor is None:
+            self._mip_executor = concurrent.futures.ThreadPoolExecutor(
+                num_workers, initializer=self._start_mip_worker)
+            self._mip_executor_workers = num_workers
+
+        def solve_in_env(name):
+            env = self._mip_thread_local.env
+            # The models constructed afterwards in this thread inherit the
+            # parameter.
+            env.setParam(gurobipy.GRB.Param.Threads, threads[name])
+            self._mip_thread_local.threads = threads[name]
+            try:
+                with gurobi_torch_mip.gurobi_env(env):
+                    return solvers[name]()
+            finally:
+                self._mip_thread_local.threads = None
+
+        futures = {
+            name: self._mip_executor.submit(solve_in_env, name)
+            for name in solvers
+        }
+        return {name: future.result() for name, future in futures.items()}
+
     def solve_positivity_mip(self):
         dtype = self.lyapunov_hybrid_system.system.dtype
-        lyapunov_positivity_as_milp_return = self.lyapunov_hybrid_system.\
-            lyapunov_positivity_as_milp(
-                self.x_equilibrium, self.V_lambda,
-                self.lyapunov_positivity_epsilon, R=self.R_options.R(),
-                x_warmstart=self.lyapunov_positivity_last_x_adv)
-        lyapunov_positivity_mip = lyapunov_positivity_as_milp_return[0]
+        _, lyapunov_positivity_mip, (positivity_mip_x, ) = \
+            self._apply_mip_template(
+                "positivity",
+                lambda: self.lyapunov_hybrid_system.
+                lyapunov_positivity_as_milp(
+                    self.x_equilibrium, self.V_lambda,
+                    self.lyapunov_positivity_epsilon, R=self.R_options.R(),
+                    x_warmstart=self.lyapunov_positivity_last_x_adv),
+                lambda ret: (ret[0], [ret[1]]))
         lyapunov_positivity_mip.gurobi_model.setParam(
             gurobipy.GRB.Param.OutputFlag, False)
         if self.lyapunov_positivity_mip_pool_solutions > 1:
@@ -346,32 +645,21 @@ class Trainer:
         lyapunov_positivity_mip_obj = \
             lyapunov_positivity_mip.gurobi_model.ObjVal
         if self.lyapunov_positivity_mip_warmstart:
-            self.lyapunov_positivity_last_x_adv = torch.tensor(
-                [v.x for v in lyapunov_positivity_as_milp_return[1]],
-                dtype=dtype)
+            self.lyapunov_positivity_last_x_adv = \
+                lyapunov_positivity_mip.get_solution(
+                    positivity_mip_x).to(dtype)
         # Now get all the solution as adversarial states.
-        positivity_mip_adversarial = []
-        for solution_number in range(
-                np.min((self.lyapunov_positivity_mip_pool_solutions,
-                        lyapunov_positivity_mip.gurobi_model.solCount))):
-            lyapunov_positivity_mip.gurobi_model.setParam(
-                gurobipy.GRB.Param.SolutionNumber, solution_number)
-            if not self.add_adversarial_state_only or \
-                (self.add_adversarial_state_only and
-                 lyapunov_positivity_mip.gurobi_model.PoolObjVal > 0):
-                positivity_mip_adversarial.append(
-                    [v.xn for v in lyapunov_positivity_as_milp_return[1]])
-        if (len(positivity_mip_adversarial) > 0):
-            positivity_mip_adversarial = torch.tensor(
-                positivity_mip_adversarial, dtype=dtype)
-        else:
-            positivity_mip_adversarial = torch.empty(
-                (0, self.lyapunov_hybrid_system.system.x_dim), dtype=dtype)
+        positivity_mip_adversarial, positivity_pool_obj = \
+            lyapunov_positivity_mip.get_pool_solutions(
+                positivity_mip_x, self.lyapunov_positivity_mip_pool_solutions)
+        if self.add_adversarial_state_only:
+            positivity_mip_adversarial = positivity_mip_adversarial[
+                positivity_pool_obj > 0]
+        positivity_mip_adversarial = positivity_mip_adversarial.to(dtype)
         return lyapunov_positivity_mip, lyapunov_positivity_mip_obj,\
             positivity_mip_adversarial
 
-    def solve_lyap_derivative_mip(self):
-        dtype = self.lyapunov_hybrid_system.system.dtype
+    def _construct_lyap_derivative_mip(self):
         if self.derivative_mip_num_strengthen_pts == 0:
             lyapunov_derivative_as_milp_return = self.lyapunov_hybrid_system.\
                 lyapunov_derivative_as_milp(
@@ -394,79 +682,217 @@ class Trainer:
             self.lyapunov_hybrid_system.\
                 strengthen_lyapunov_derivative_milp_binary(
                     lyapunov_derivative_as_milp_return, {"TimeLimit": 60})
-        lyapunov_derivative_mip = lyapunov_derivative_as_milp_return.milp
+        return lyapunov_derivative_as_milp_return
+
+    def solve_lyap_derivative_mip(self):
+        if self.lyapunov_derivative_mip_num_starts > 0:
+            # Only the discrete time system constructs the MIP starts.
+            assert (isinstance(self.lyapunov_hybrid_system,
+                               lyapunov.LyapunovDiscreteTimeHybridSystem))
+        dtype = self.lyapunov_hybrid_system.system.dtype
+        # The strengthening solves the gurobi model of the constructed MIP.
+        lyapunov_derivative_as_milp_return, lyapunov_derivative_mip, (
+            derivative_mip_x, derivative_mip_gamma) = \
+            self._apply_mip_template(
+                "derivative", self._construct_lyap_derivative_mip,
+                lambda ret: (ret.milp, [ret.x, ret.gamma]),
+                torch_data_only=self.derivative_mip_num_strengthen_pts == 0
+                and not self.derivative_mip_strengthen_binary)
+        # The other variables in lyapunov_derivative_as_milp_return are
+        # looked up by their index in lyapunov_derivative_mip.
+        lyapunov_derivative_as_milp_return = \
+            lyapunov_derivative_as_milp_return._replace(
+                milp=lyapunov_derivative_mip,
+                x=derivative_mip_x,
+                gamma=derivative_mip_gamma)
+        if self.lyapunov_derivative_mip_num_starts > 0 and\
+                self._lyapunov_derivative_start_states is not None:
+            lyapunov_derivative_mip.set_mip_starts(
+                self.lyapunov_hybrid_system.lyapunov_derivative_milp_starts(
+                    lyapunov_derivative_as_milp_return,
+                    self._lyapunov_derivative_start_states))
         for param, val in self.lyapunov_derivative_mip_params.items():
             lyapunov_derivative_mip.gurobi_model.setParam(param, val)
         if (self.lyapunov_derivative_mip_pool_solutions > 1):
             lyapunov_derivative_mip.gurobi_model.setParam(
                 gurobipy.GRB.Param.PoolSolutions,
                 self.lyapunov_derivative_mip_pool_solutions)
+        callbacks = []
         if self.lyapunov_derivative_mip_term_threshold is not None:
-            lyapunov_derivative_mip.gurobi_model.optimize(
+            callbacks.append(
                 utils.get_gurobi_terminate_if_callback(
                     threshold=self.lyapunov_derivative_mip_term_threshold))
+        if self.lyapunov_derivative_mip_stream_counterexamples > 0:
+            self.lyapunov_derivative_counterexample_queue = queue.Queue(
+                maxsize=self.lyapunov_derivative_mip_stream_counterexamples)
+            # Keep the streamed counterexamples in the solution pool.
+            lyapunov_derivative_mip.gurobi_model.setParam(
+                gurobipy.GRB.Param.PoolSolutions,
+                max(self.lyapunov_derivative_mip_pool_solutions,
+                    self.lyapunov_derivative_mip_stream_counterexamples))
+            callbacks.append(
+                utils.get_gurobi_stream_incumbent_callback(
+                    lyapunov_derivative_as_milp_return.x,
+                    self.lyapunov_derivative_counterexample_queue,
+                    threshold=0.,
+                    max_solutions=self.
+                    lyapunov_derivative_mip_stream_counterexamples,
+                    time_limit=self.lyapunov_derivative_mip_stream_time_limit))
+        if self.derivative_mip_cut_callback:
+            lyapunov_derivative_mip.gurobi_model.setParam(
+                gurobipy.GRB.Param.PreCrush, 1)
+            callbacks.append(
+                self.lyapunov_hybrid_system.lyapunov_derivative_cut_callback(
+                    lyapunov_derivative_as_milp_return,
+                    lyapunov_derivative_mip,
+                    max_node_count=self.
+                    derivative_mip_cut_callback_max_node_count,
+                    max_cuts=self.derivative_mip_cut_callback_max_cuts))
+        if len(callbacks) > 0:
+            lyapunov_derivative_mip.gurobi_model.optimize(
+                utils.combine_gurobi_callbacks(callbacks))
         else:
             lyapunov_derivative_mip.gurobi_model.optimize()
-        lyapunov_derivative_mip_obj = \
-            lyapunov_derivative_mip.gurobi_model.ObjVal
+        if self.lyapunov_derivative_mip_stream_counterexamples > 0 and\
+                lyapunov_derivative_mip.gurobi_model.status ==\
+                gurobipy.GRB.Status.INTERRUPTED:
+            # The streaming solve is terminated before proving optimality,
+            # the incumbent objective can under-estimate the violation. A
+            # solve terminated only by lyapunov_derivative_mip_term_threshold
+            # still returns the incumbent objective.
+            lyapunov_derivative_mip_obj = \
+                lyapunov_derivative_mip.gurobi_model.ObjBound
+        else:
+            lyapunov_derivative_mip_obj = \
+                lyapunov_derivative_mip.gurobi_model.ObjVal
 
         if self.output_flag:
-            print("adversarial x " +
-                  f"{[v.x for v in lyapunov_derivative_as_milp_return.x]}")
+            print("adversarial x " + str(
+                lyapunov_derivative_mip.get_solution(
+                    lyapunov_derivative_as_milp_return.x).tolist()))
         if self.lyapunov_derivative_mip_warmstart:
-            self.lyapunov_derivative_last_x_adv = torch.tensor(
-                [v.x for v in lyapunov_derivative_as_milp_return.x],
-                dtype=dtype)
+            self.lyapunov_derivative_last_x_adv = \
+                lyapunov_derivative_mip.get_solution(
+                    lyapunov_derivative_as_milp_return.x).to(dtype)
         # Return the solution of the MILP as adversarial states.
-        derivative_mip_adversarial = []
-        if (isinstance(self.lyapunov_hybrid_system.system,
-                       hybrid_linear_system.AutonomousHybridLinearSystem)):
-            derivative_mip_adversarial_next = []
-        for solution_number in range(
-                np.min((self.lyapunov_derivative_mip_pool_solutions,
-                        lyapunov_derivative_mip.gurobi_model.solCount))):
-            lyapunov_derivative_mip.gurobi_model.setParam(
-                gurobipy.GRB.Param.SolutionNumber, solution_number)
-            if not self.add_adversarial_state_only or (
-                    self.add_adversarial_state_only
-                    and lyapunov_derivative_mip.gurobi_model.PoolObjVal > 0):
-                derivative_mip_adversarial.append(
-                    [v.xn for v in lyapunov_derivative_as_milp_return.x])
-
-                if (isinstance(
-                        self.lyapunov_hybrid_system.system,
-                        hybrid_linear_system.AutonomousHybridLinearSystem)):
-                    derivative_mip_adversarial_mode = np.argwhere(
-                        np.array([
-                            v.xn
-                            for v in lyapunov_derivative_as_milp_return.gamma
-                        ]) > 0.99)[0][0]
-                    derivative_mip_adversarial_next.append(
-                        self.lyapunov_hybrid_system.system.step_forward(
-                            torch.tensor(derivative_mip_adversarial[-1],
-                                         dtype=dtype),
-                            derivative_mip_adversarial_mode))
-
-        if len(derivative_mip_adversarial) > 0:
-            derivative_mip_adversarial = torch.tensor(
-                derivative_mip_adversarial, dtype=dtype)
-            if (isinstance(self.lyapunov_hybrid_system.system,
-                           hybrid_linear_system.AutonomousHybridLinearSystem)):
-                derivative_mip_adversarial_next = torch.stack(
-                    derivative_mip_adversarial_next)
-            else:
-                derivative_mip_adversarial_next = \
-                    self.lyapunov_hybrid_system.system.step_forward(
-                        derivative_mip_adversarial)
+        is_autonomous_hybrid_linear = isinstance(
+            self.lyapunov_hybrid_system.system,
+            hybrid_linear_system.AutonomousHybridLinearSystem)
+        x_dim = self.lyapunov_hybrid_system.system.x_dim
+        pool_vars = lyapunov_derivative_as_milp_return.x
+        if is_autonomous_hybrid_linear:
+            pool_vars = pool_vars + lyapunov_derivative_as_milp_return.gamma
+        pool_sol, pool_obj = lyapunov_derivative_mip.get_pool_solutions(
+            pool_vars,
+            max(self.lyapunov_derivative_mip_pool_solutions,
+                self.lyapunov_derivative_mip_stream_counterexamples))
+        if self.add_adversarial_state_only:
+            pool_sol = pool_sol[pool_obj > 0]
+        derivative_mip_adversarial = pool_sol[:, :x_dim].to(dtype)
+        if self.lyapunov_derivative_mip_num_starts > 0 and\
+                derivative_mip_adversarial.shape[0] > 0:
+            self._lyapunov_derivative_start_states = \
+                derivative_mip_adversarial[:self.
+                                           lyapunov_derivative_mip_num_starts]
+        if derivative_mip_adversarial.shape[0] == 0:
+            derivative_mip_adversarial_next = torch.empty((0, x_dim),
+                                                          dtype=dtype)
+        elif is_autonomous_hybrid_linear:
+            derivative_mip_adversarial_mode = torch.argmax(
+                (pool_sol[:, x_dim:] > 0.99).to(torch.int64), dim=1)
+            derivative_mip_adversarial_next = torch.stack([
+                self.lyapunov_hybrid_system.system.step_forward(
+                    derivative_mip_adversarial[i],
+                    derivative_mip_adversarial_mode[i].item())
+                for i in range(derivative_mip_adversarial.shape[0])
+            ])
         else:
-            derivative_mip_adversarial = torch.empty(
-                (0, self.lyapunov_hybrid_system.system.x_dim), dtype=dtype)
-            derivative_mip_adversarial_next = torch.empty(
-                (0, self.lyapunov_hybrid_system.system.x_dim), dtype=dtype)
+            derivative_mip_adversarial_next = \
+                self.lyapunov_hybrid_system.system.step_forward(
+                    derivative_mip_adversarial)
 
         return lyapunov_derivative_mip, lyapunov_derivative_mip_obj,\
             derivative_mip_adversarial, derivative_mip_adversarial_next
 
+    def drain_derivative_counterexamples(self):
+        """
+        Remove the counterexamples that are left in
+        lyapunov_derivative_counterexample_queue by the last streaming
+        derivative MIP.
+        @return counterexamples A tensor of shape (num_counterexamples, x_dim)
+        """
+        dtype = self.lyapunov_hybrid_system.system.dtype
+        x_dim = self.lyapunov_hybrid_system.system.x_dim
+        counterexamples = []
+        if self.lyapunov_derivative_counterexample_queue is not None:
+            while True:
+                try:
+                    x, _ = self.lyapunov_derivative_counterexample_queue.\
+                        get_nowait()
+                except queue.Empty:
+                    break
+                counterexamples.append(x.to(dtype))
+        if len(counterexamples) == 0:
+            return torch.empty((0, x_dim), dtype=dtype)
+        return torch.stack(counterexamples)
+
+    def falsify_lyap_derivative(self):
+        """
+        Search for the states that violate the Lyapunov derivative condition
+        by projected gradient ascent. We take
+        lyapunov_derivative_falsifier_num_samples random states in the box
+        x_lo_all <= x <= x_up_all, and update them all in one batch as
+        x ← clamp(x + step_size * (x_up_all - x_lo_all) * sign(∂loss/∂x))
+        where loss is the per-sample hinge loss
+        lyapunov_derivative_loss_at_samples_and_next_states() with
+        lyapunov_derivative_falsifier_margin.
+        This is much cheaper than solving the derivative MIP, and finds the
+        violations during the early iterations of the training.
+        @return (adversarial, adversarial_next, obj) adversarial are the
+        states whose violation l(x) is larger than
+        lyapunov_derivative_convergence_tol, sorted in the descending order of
+        l(x). adversarial_next are their next states (or their state
+        derivatives for continuous time systems). obj is the largest l(x)
+        among all states (a lower bound of the derivative MIP objective).
+        """
+        system = self.lyapunov_hybrid_system.system
+        dtype = system.dtype
+        x_lo = torch.from_numpy(system.x_lo_all).to(dtype)
+        x_up = torch.from_numpy(system.x_up_all).to(dtype)
+        step_size = self.lyapunov_derivative_falsifier_step_size * (x_up -
+                                                                    x_lo)
+        margin = self.lyapunov_derivative_falsifier_margin
+
+        def violation(x):
+            return self.lyapunov_hybrid_system.\
+                lyapunov_derivative_loss_at_samples_and_next_states(
+                    self.V_lambda, self.lyapunov_derivative_epsilon, x,
+                    system.step_forward(x), self.x_equilibrium,
+                    self.lyapunov_derivative_eps_type, R=self.R_options.R(),
+                    margin=margin, reduction="none")
+
+        x = utils.uniform_sample_in_box(
+            x_lo, x_up,
+            self.lyapunov_derivative_falsifier_num_samples).to(dtype)
+        for _ in range(self.lyapunov_derivative_falsifier_iterations):
+            x.requires_grad_(True)
+            # Use autograd.grad instead of backward() so as not to accumulate
+            # the gradient on the network parameters.
+            dloss_dx = torch.autograd.grad(torch.sum(violation(x)), x)[0]
+            with torch.no_grad():
+                x = torch.max(torch.min(x + step_size * torch.sign(dloss_dx),
+                                        x_up),
+                              x_lo)
+        with torch.no_grad():
+            obj, order = torch.sort(violation(x) - margin, descending=True)
+            x = x[order]
+            is_adversarial = obj > self.lyapunov_derivative_convergence_tol
+            adversarial = x[is_adversarial]
+            adversarial_next = system.step_forward(adversarial) if\
+                adversarial.shape[0] > 0 else torch.empty(
+                    (0, system.x_dim), dtype=dtype)
+        return adversarial, adversarial_next, obj[0].item()
+
     def solve_boundary_gap_mip(self):
         """
         Solve the problem
@@ -510,7 +936,7 @@ class Trainer:
             solution_number=0, penalty=1E-13)
         V_max_milp = milp.gurobi_model.ObjVal
         dtype = self.lyapunov_hybrid_system.system.dtype
-        x_max = torch.tensor([v.x for v in x], dtype=dtype)
+        x_max = milp.get_solution(x).to(dtype)
         # Second find minimize V(x)
         milp.setObjective(V_coeff,
                           V_vars,
@@ -521,7 +947,7 @@ class Trainer:
         V_min = milp.compute_objective_from_mip_data_and_solution(
             solution_number=0, penalty=1E-13)
         V_min_milp = milp.gurobi_model.ObjVal
-        x_min = torch.tensor([v.x for v in x], dtype=dtype)
+        x_min = milp.get_solution(x).to(dtype)
         return V_max - V_min, V_min_milp, V_max_milp, x_min, x_max
 
     def solve_barrier_value_mip(self, safe_flag):
@@ -544,16 +970,9 @@ class Trainer:
                     self.barrier_value_mip_pool_solutions)
             mip[region_count].gurobi_model.optimize()
             mip_obj[region_count] = mip[region_count].gurobi_model.ObjVal
-            num_adversarial = np.min((self.barrier_value_mip_pool_solutions,
-                                      mip[region_count].gurobi_model.solCount))
-            mip_adversarial[region_count] = torch.empty(
-                (num_adversarial, self.barrier_system.system.x_dim),
-                dtype=dtype)
-            for solution_number in range(num_adversarial):
-                mip[region_count].gurobi_model.setParam(
-                    gurobipy.GRB.Param.SolutionNumber, solution_number)
-                mip_adversarial[region_count][solution_number] = torch.tensor(
-                    [v.xn for v in x], dtype=dtype)
+            mip_adversarial[region_count] = mip[
+                region_count].get_pool_solutions(
+                    x, self.barrier_value_mip_pool_solutions)[0].to(dtype)
         return mip, mip_obj, mip_adversarial
 
     def solve_barrier_derivative_mip(self):
@@ -570,20 +989,13 @@ class Trainer:
             barrier_deriv_return.milp.gurobi_model.setParam(param, val)
         barrier_deriv_return.milp.gurobi_model.optimize()
         barrier_deriv_mip_obj = barrier_deriv_return.milp.gurobi_model.ObjVal
-        num_adversarial = np.min(
-            (self.barrier_derivative_mip_pool_solutions,
-             barrier_deriv_return.milp.gurobi_model.solCount))
-        mip_adversarial = []
-        for solution_number in range(num_adversarial):
-            barrier_deriv_return.milp.gurobi_model.setParam(
-                gurobipy.GRB.Param.SolutionNumber, solution_number)
-            if not self.add_adversarial_state_only or (
-                    self.add_adversarial_state_only
-                    and barrier_deriv_return.milp.gurobi_model.PoolObjVal > 0):
-                mip_adversarial.append(
-                    torch.tensor([v.xn for v in barrier_deriv_return.x],
-                                 dtype=dtype))
-        mip_adversarial = torch.stack(mip_adversarial)
+        mip_adversarial, pool_obj = \
+            barrier_deriv_return.milp.get_pool_solutions(
+                barrier_deriv_return.x,
+                self.barrier_derivative_mip_pool_solutions)
+        if self.add_adversarial_state_only:
+            mip_adversarial = mip_adversarial[pool_obj > 0]
+        mip_adversarial = mip_adversarial.to(dtype)
         return barrier_deriv_return.milp, barrier_deriv_mip_obj,\
             mip_adversarial
 
@@ -631,9 +1043,20 @@ class Trainer:
                              derivative_mip_cost_weight) -> BarrierLoss:
         barrier_loss = Trainer.BarrierLoss()
 
+        solvers = {}
+        if safe_mip_cost_weight is not None:
+            solvers["barrier_safe"] = lambda: self.solve_barrier_value_mip(
+                safe_flag=True)
+        if unsafe_mip_cost_weight is not None:
+            solvers["barrier_unsafe"] = lambda: self.solve_barrier_value_mip(
+                safe_flag=False)
+        if derivative_mip_cost_weight is not None:
+            solvers["barrier_derivative"] = self.solve_barrier_derivative_mip
+        mip_results = self._solve_mips(solvers)
+
         if safe_mip_cost_weight is not None:
             safe_mip, barrier_loss.safe_mip_obj, safe_mip_adversarial = \
-                self.solve_barrier_value_mip(safe_flag=True)
+                mip_results["barrier_safe"]
             if safe_mip_cost_weight != 0:
                 barrier_loss.safe_mip_loss = [
                     safe_mip_cost_weight *
@@ -647,7 +1070,7 @@ class Trainer:
 
         if unsafe_mip_cost_weight is not None:
             unsafe_mip, barrier_loss.unsafe_mip_obj, unsafe_mip_adversarial = \
-                self.solve_barrier_value_mip(safe_flag=False)
+                mip_results["barrier_unsafe"]
             if unsafe_mip_cost_weight != 0:
                 barrier_loss.unsafe_mip_loss = [
                     unsafe_mip_cost_weight *
@@ -661,8 +1084,7 @@ class Trainer:
 
         if derivative_mip_cost_weight is not None:
             derivative_mip, barrier_loss.derivative_mip_obj, \
-                derivative_mip_adversarial = self.solve_barrier_derivative_mip(
-                )
+                derivative_mip_adversarial = mip_results["barrier_derivative"]
             if derivative_mip_cost_weight != 0:
                 barrier_loss.derivative_mip_loss = derivative_mip_cost_weight \
                     * derivative_mip.\
@@ -743,9 +1165,17 @@ class Trainer:
         dtype = self.lyapunov_hybrid_system.system.dtype
         lyap_loss = Trainer.LyapLoss()
         barrier_loss = Trainer.BarrierLoss()
+        solvers = {}
+        if lyap_positivity_mip_cost_weight is not None:
+            solvers["lyap_positivity"] = self.solve_positivity_mip
+        if lyap_derivative_mip_cost_weight is not None:
+            solvers["lyap_derivative"] = self.solve_lyap_derivative_mip
+        if boundary_value_gap_mip_cost_weight != 0:
+            solvers["boundary_gap"] = self.solve_boundary_gap_mip
+        mip_results = self._solve_mips(solvers)
         if lyap_positivity_mip_cost_weight is not None:
             lyap_positivity_mip, lyap_loss.positivity_mip_obj,\
-                positivity_mip_adversarial = self.solve_positivity_mip()
+                positivity_mip_adversarial = mip_results["lyap_positivity"]
         else:
             lyap_positivity_mip = None
             lyap_loss.positivity_mip_obj = None
@@ -754,7 +1184,7 @@ class Trainer:
             lyap_derivative_mip, lyap_loss.derivative_mip_obj,\
                 lyap_derivative_mip_adversarial,\
                 lyap_derivative_mip_adversarial_next =\
-                self.solve_lyap_derivative_mip()
+                mip_results["lyap_derivative"]
         else:
             lyap_derivative_mip = None
             lyap_loss.derivative_mip_obj = None
@@ -768,21 +1198,18 @@ class Trainer:
                 lyap_positivity_mip_cost_weight is not None:
             lyap_loss.positivity_mip_loss = \
                 lyap_positivity_mip_cost_weight * \
-                lyap_positivity_mip.\
-                compute_objective_from_mip_data_and_solution(
-                    solution_number=0, penalty=1e-13)
+                self._lyapunov_mip_loss_objective(lyap_positivity_mip)
         lyap_loss.derivative_mip_loss = torch.tensor(0, dtype=dtype)
         if lyap_derivative_mip_cost_weight != 0\
                 and lyap_derivative_mip_cost_weight is not None:
-            mip_cost = lyap_derivative_mip.\
-                compute_objective_from_mip_data_and_solution(
-                    solution_number=0, penalty=1e-13)
+            mip_cost = self._lyapunov_mip_loss_objective(
+                lyap_derivative_mip)
             lyap_loss.derivative_mip_loss = \
                 lyap_derivative_mip_cost_weight * mip_cost
         lyap_loss.gap_mip_loss = 0
         if boundary_value_gap_mip_cost_weight != 0:
             boundary_value_gap, V_min_milp, V_max_milp, x_min, x_max = \
-                self.solve_boundary_gap_mip()
+                mip_results["boundary_gap"]
             print(f"boundary_value_gap: {V_max_milp - V_min_milp}")
             lyap_loss.gap_mip_loss = \
                 boundary_value_gap_mip_cost_weight * boundary_value_gap
@@ -886,10 +1313,37 @@ class Trainer:
                 self.R_options.variables()
         return training_params
 
+    def _setup_relu_bound_caches(self):
+        """
+        If self.reuse_relu_bounds is true, attach a ReLUBoundCache to the
+        networks whose bounds are recomputed in every iteration (unless they
+        already have one).
+        """
+        if not self.reuse_relu_bounds:
+            return
+        relu_free_patterns = []
+        system = None
+        if self.lyapunov_hybrid_system is not None:
+            relu_free_patterns.append(
+                self.lyapunov_hybrid_system.lyapunov_relu_free_pattern)
+            system = self.lyapunov_hybrid_system.system
+        if self.barrier_system is not None:
+            relu_free_patterns.append(
+                self.barrier_system.barrier_relu_free_pattern)
+            system = self.barrier_system.system
+        if isinstance(system, feedback_system.FeedbackSystem) and hasattr(
+                system, "controller_relu_free_pattern"):
+            relu_free_patterns.append(system.controller_relu_free_pattern)
+        for relu_free_pattern in relu_free_patterns:
+            if relu_free_pattern.bound_cache is None:
+                relu_free_pattern.bound_cache = \
+                    relu_to_optimization.ReLUBoundCache()
+
     def train(self, state_samples_all):
         train_start_time = time.time()
         if self.output_flag:
             self.print()
+        self._setup_relu_bound_caches()
         assert (isinstance(state_samples_all, torch.Tensor))
         assert (state_samples_all.shape[1] ==
                 self.lyapunov_hybrid_system.system.x_dim)
@@ -970,6 +1424,7 @@ class Trainer:
                 self.lyapunov_positivity_convergence_tol and\
                 total_loss_return.lyap_loss.derivative_mip_obj <= \
                     self.lyapunov_derivative_convergence_tol:
+                self.shutdown_mip_workers()
                 return (True, total_loss_return.loss.item(),
                         total_loss_return.lyap_loss.positivity_mip_obj,
                         total_loss_return.lyap_loss.derivative_mip_obj)
@@ -985,6 +1440,7 @@ class Trainer:
             total_loss_return.loss.backward()
             optimizer.step()
             iter_count += 1
+        self.shutdown_mip_workers()
         return (False, total_loss_return.loss.item(),
                 total_loss_return.lyap_loss.positivity_mip_obj,
                 total_loss_return.lyap_loss.derivative_mip_obj)
@@ -1245,6 +1701,7 @@ class Trainer:
         assert (self.add_positivity_adversarial_state)
         if self.output_flag:
             self.print()
+        self._setup_relu_bound_caches()
         if self.enable_wandb:
             options.wandb_config()
 
@@ -1260,12 +1717,43 @@ class Trainer:
         iter_count = 0
         training_params = self._training_params()
         while iter_count < self.max_iterations:
+            derivative_mip_adversarial = None
+            # The derivative MIP cost is None when the MIP is skipped, the
+            # falsifier cost is None when the falsifier finds no violation.
+            lyapunov_derivative_mip_obj = None
+            lyapunov_derivative_falsifier_obj = None
+            if self.lyapunov_derivative_falsifier_num_samples > 0:
+                falsifier_adversarial, _, falsifier_obj = \
+                    self.falsify_lyap_derivative()
+                if falsifier_adversarial.shape[0] > 0:
+                    # The falsifier already found violations, skip the MIP.
+                    derivative_mip_adversarial = falsifier_adversarial
+                    lyapunov_derivative_falsifier_obj = falsifier_obj
             # Now solve MIP to find adversarial states.
+            solvers = {"lyap_positivity": self.solve_positivity_mip}
+            if derivative_mip_adversarial is None:
+                solvers["lyap_derivative"] = self.solve_lyap_derivative_mip
+            mip_results = self._solve_mips(solvers)
             lyapunov_positivity_mip, lyapunov_positivity_mip_obj,\
-                positivity_mip_adversarial = self.solve_positivity_mip()
-            lyapunov_derivative_mip, lyapunov_derivative_mip_obj,\
-                derivative_mip_adversarial, _ = \
-                self.solve_lyap_derivative_mip()
+                positivity_mip_adversarial = mip_results["lyap_positivity"]
+            if derivative_mip_adversarial is None:
+                lyapunov_derivative_mip, lyapunov_derivative_mip_obj,\
+                    derivative_mip_adversarial, _ = \
+                    mip_results["lyap_derivative"]
+                # The solution pool can drop some of the streamed
+                # counterexamples, add them back.
+                streamed_adversarial = \
+                    self.drain_derivative_counterexamples()
+                if streamed_adversarial.shape[0] > 0:
+                    distance = torch.amax(torch.abs(
+                        streamed_adversarial.unsqueeze(1) -
+                        derivative_mip_adversarial.unsqueeze(0)),
+                                          dim=2)
+                    is_new = torch.all(distance > 1E-6, dim=1)
+                    derivative_mip_adversarial = torch.cat(
+                        (derivative_mip_adversarial,
+                         streamed_adversarial[is_new]),
+                        dim=0)
             if not np.isinf(options.adversarial_cluster_radius):
                 positivity_mip_adversarial,\
                     positivity_mip_adversarial_repeatition =\
@@ -1327,19 +1815,32 @@ class Trainer:
                 derivative_state_repeatition = derivative_state_repeatition[
                     -options.derivative_samples_pool_size:]
             if self.output_flag:
+                if lyapunov_derivative_mip_obj is None:
+                    derivative_msg = "derivative falsifier cost " +\
+                        f"{lyapunov_derivative_falsifier_obj}, "
+                else:
+                    derivative_msg = "derivative_cost " +\
+                        f"{lyapunov_derivative_mip_obj}, "
                 print(f"Iter {iter_count}, positivity cost " +
-                      f"{lyapunov_positivity_mip_obj}, " + "derivative_cost " +
-                      f"{lyapunov_derivative_mip_obj}" + f"time{time.time() - train_start_time}")
+                      f"{lyapunov_positivity_mip_obj}, " + derivative_msg +
+                      f"time {time.time() - train_start_time}")
             if self.enable_wandb:
-                wandb.log({
+                log = {
                     "positivity MIP cost": lyapunov_positivity_mip_obj,
-                    "derivative MIP cost": lyapunov_derivative_mip_obj,
                     "time": time.time() - train_start_time
-                })
-            if lyapunov_positivity_mip_obj < \
+                }
+                if lyapunov_derivative_mip_obj is not None:
+                    log["derivative MIP cost"] = lyapunov_derivative_mip_obj
+                if lyapunov_derivative_falsifier_obj is not None:
+                    log["derivative falsifier cost"] = \
+                        lyapunov_derivative_falsifier_obj
+                wandb.log(log)
+            if lyapunov_derivative_mip_obj is not None and\
+                lyapunov_positivity_mip_obj < \
                 self.lyapunov_positivity_convergence_tol and\
                 lyapunov_derivative_mip_obj < \
                     self.lyapunov_derivative_convergence_tol:
+                self.shutdown_mip_workers()
                 return True, positivity_state_samples_all,\
                     derivative_state_samples_all
             # Now do gradient descent on the adversarial states.
@@ -1357,6 +1858,7 @@ class Trainer:
                                            derivative_state_repeatition,
                                            options)
             iter_count += 1
+        self.shutdown_mip_workers()
         return False, positivity_state_samples_all,\
             derivative_state_samples_all, positivity_state_repeatition,\
             derivative_state_repeatition
@@ -52,21 +52,21 @@ def replace_binary_continuous_product(x_lo, x_up, dtype=torch.float64):
     @param x_lo The lower bound of x.
     @param x_up The upper bound of x.
     @param (A_x, A_s, A_alpha, rhs) A_x, A_s, A_alpha, rhs are all arrays of
-    length 4.
+    length 4. x_lo and x_up can also be tensors of the same shape (one
+    product per entry), in which case A_alpha and rhs have shape
+    (4, *x_lo.shape), while A_x and A_s are still of length 4.
     """
     if isinstance(x_lo, float):
         x_lo = torch.tensor(x_lo, dtype=dtype)
     if isinstance(x_up, float):
         x_up = torch.tensor(x_up, dtype=dtype)
     assert (isinstance(x_lo, torch.Tensor))
-    assert (x_lo <= x_up)
+    assert (torch.all(x_lo <= x_up))
     A_x = torch.tensor([0, 0, 1, -1], dtype=dtype)
     A_s = torch.tensor([-1, 1, -1, 1], dtype=dtype)
     A_alpha = torch.stack((x_lo, -x_up, x_up, -x_lo))
-    rhs = torch.zeros(4, dtype=dtype)
-    rhs = torch.stack(
-        (torch.tensor(0, dtype=dtype), torch.tensor(0,
-                                                    dtype=dtype), x_up, -x_lo))
+    rhs = torch.stack((torch.zeros_like(x_lo), torch.zeros_like(x_lo), x_up,
+                       -x_lo))
     return (A_x, A_s, A_alpha, rhs)
 
 
@@ -137,13 +137,16 @@ def leaky_relu_gradient_times_x(x_lo,
     A_x * x + A_y * y + A_alpha * alpha <= rhs
     @param x_lo The lower bound of x.
     @param x_up The upper bound of x.
+    x_lo and x_up can also be tensors of the same shape, in which case
+    A_alpha and rhs have shape (4, *x_lo.shape), while A_x and A_y are still
+    of length 4.
     """
     if isinstance(x_lo, float):
         x_lo = torch.tensor(x_lo, dtype=dtype)
     if isinstance(x_up, float):
         x_up = torch.tensor(x_up, dtype=dtype)
     assert (isinstance(x_lo, torch.Tensor))
-    assert (x_up >= x_lo)
+    assert (torch.all(x_up >= x_lo))
     dtype = x_up.dtype
     A_x = torch.tensor([-1, 1, negative_slope, -negative_slope], dtype=dtype)
     A_y = torch.tensor([1, -1, -1, 1], dtype=dtype)
@@ -152,7 +155,7 @@ def leaky_relu_gradient_times_x(x_lo,
          (1. - negative_slope) * x_lo, (negative_slope - 1.) * x_up))
     rhs = torch.stack(
         ((negative_slope - 1.) * x_lo, (1. - negative_slope) * x_up,
-         torch.tensor(0, dtype=dtype), torch.tensor(0, dtype=dtype)))
+         torch.zeros_like(x_lo), torch.zeros_like(x_lo)))
     if negative_slope < 1.:
         return (A_x, A_y, A_alpha, rhs)
     else:
@@ -481,8 +484,8 @@ def add_saturation_as_mixed_integer_constraint(mip, input_var, output_var,
     input_lower_bound <= x <= input_upper_bound.
     """
     assert (isinstance(mip, gurobi_torch_mip.GurobiTorchMIP))
-    assert (isinstance(input_var, gurobipy.Var))
-    assert (isinstance(output_var, gurobipy.Var))
+    assert (isinstance(input_var, (gurobipy.Var, gurobi_torch_mip.MIPVar)))
+    assert (isinstance(output_var, (gurobipy.Var, gurobi_torch_mip.MIPVar)))
     if input_upper_bound <= lower_limit:
         # The input x will always be <= lower_limit, the output will always be
         # lower_limit.
@@ -1187,6 +1190,75 @@ def get_gurobi_terminate_if_callback(threshold=0.):
     return gurobi_terminate_if
 
 
+def get_gurobi_stream_incumbent_callback(variables,
+                                         solution_queue,
+                                         *,
+                                         threshold=0.,
+                                         max_solutions=None,
+                                         time_limit=None,
+                                         distinct_tol=1E-6):
+    """
+    helper function that returns a callback, which pushes every new incumbent
+    solution with objective > threshold into @p solution_queue as soon as
+    gurobi finds it, instead of waiting for gurobi to prove optimality.
+    @param variables The gurobi variables whose values are pushed.
+    @param solution_queue A thread safe queue (such as queue.Queue). Each
+    item is (value, obj), where value is a torch.float64 tensor of the
+    variable values, and obj is the objective of the incumbent. At most
+    max_solutions items are pushed, so a queue with maxsize=max_solutions
+    never blocks the solve.
+    @param threshold Only push the incumbents with objective > threshold.
+    @param max_solutions Terminate gurobi after pushing this many distinct
+    solutions. None means no limit.
+    @param time_limit Terminate gurobi after this many seconds, once it has
+    pushed at least one solution (with objective > threshold). Before that,
+    gurobi keeps solving, so that a terminated solve always has a solution
+    with objective > threshold. None means no limit.
+    @param distinct_tol An incumbent is not pushed if its infinity-norm
+    distance to a pushed solution is within distinct_tol.
+    """
+    pushed = []
+
+    def gurobi_stream_incumbent(model, where):
+        """
+        callback
+        @param model, where see Gurobi callback documentation
+        """
+        if where == gurobipy.GRB.Callback.MIPSOL:
+            if max_solutions is not None and len(pushed) >= max_solutions:
+                return
+            obj = model.cbGet(gurobipy.GRB.Callback.MIPSOL_OBJ)
+            if obj > threshold:
+                value = torch.tensor(model.cbGetSolution(variables),
+                                     dtype=torch.float64)
+                if all(
+                        torch.max(torch.abs(value - v)).item() > distinct_tol
+                        for v in pushed):
+                    pushed.append(value)
+                    solution_queue.put((value, obj))
+                    if max_solutions is not None and\
+                            len(pushed) >= max_solutions:
+                        model.terminate()
+        elif where == gurobipy.GRB.Callback.MIP and time_limit is not None:
+            if len(pushed) > 0 and\
+                    model.cbGet(gurobipy.GRB.Callback.RUNTIME) > time_limit:
+                model.terminate()
+
+    return gurobi_stream_incumbent
+
+
+def combine_gurobi_callbacks(callbacks):
+    """
+    helper function that returns a gurobi callback, which calls each callback
+    in @p callbacks in order.
+    """
+    def combined_callback(model, where):
+        for callback in callbacks:
+            callback(model, where)
+
+    return combined_callback
+
+
 def network_zero_grad(network):
     """
     Set the gradient of all parameters in the network to zero.
@@ -1417,9 +1489,93 @@ def relu_network_gradient(relu_network,
       where phi_dim is the dimension of the network output ϕ(x).
     """
     assert (x.shape == (relu_network[0].in_features, ))
+    dphi_dx, _ = relu_network_gradient_batch(relu_network,
+                                             x.unsqueeze(0),
+                                             zero_tol=zero_tol)
+    return dphi_dx
+
+
+def _relu_layer_activation_variants(layer_input: torch.Tensor,
+                                    offsets: torch.Tensor, zero_tol: float):
+    """
+    Expand the packed variants of a batch of states through one (leaky) ReLU
+    layer. Sample i currently owns the variants offsets[i]:offsets[i+1]. Each
+    ReLU unit with |input| <= zero_tol can be either active or inactive, so
+    every variant of sample i is copied power(2, number of such units) times.
+    The new variants of sample i are ordered as k * num_old_variants + m,
+    where m indexes the old variant, and the j'th bit of k being 1 means the
+    j'th ambiguous unit of this layer is inactive.
+
+    Args:
+      layer_input: A tensor of shape (N, layer_dim), the ReLU layer input.
+      offsets: A tensor of shape (N+1,), the packed layout of the variants
+      before this layer.
+      zero_tol: The tolerance to consider a ReLU input as 0.
+    Return:
+      source: A tensor of shape (num_new_variants,). source[j] is the index
+      of the old variant that the new variant j is copied from.
+      active: A boolean tensor of shape (num_new_variants, layer_dim).
+      active[j, k] is True if the k'th unit is active in variant j.
+      new_offsets: A tensor of shape (N+1,), the packed layout after this
+      layer.
+    """
+    device = layer_input.device
+    ambiguous = torch.abs(layer_input) <= zero_tol
+    num_ambiguous = torch.sum(ambiguous, dim=1)
+    counts = offsets[1:] - offsets[:-1]
+    new_counts = counts * torch.pow(2, num_ambiguous)
+    new_offsets = torch.cat((torch.zeros(
+        (1, ), dtype=torch.int64,
+        device=device), torch.cumsum(new_counts, dim=0)))
+    owner = torch.repeat_interleave(
+        torch.arange(layer_input.shape[0], device=device), new_counts)
+    local_index = torch.arange(owner.shape[0],
+                               device=device) - new_offsets[owner]
+    old_index = local_index % counts[owner]
+    branch = torch.div(local_index, counts[owner], rounding_mode="floor")
+    source = offsets[owner] + old_index
+    # ambiguous_rank[i, k] is the number of ambiguous units before unit k in
+    # sample i.
+    ambiguous_rank = torch.clamp(torch.cumsum(ambiguous, dim=1) - 1, min=0)
+    take_left = torch.div(branch.unsqueeze(1),
+                          torch.pow(2, ambiguous_rank[owner]),
+                          rounding_mode="floor") % 2 == 1
+    active = torch.where(ambiguous[owner], torch.logical_not(take_left),
+                         layer_input[owner] > zero_tol)
+    return source, active, new_offsets
+
+
+def relu_network_gradient_batch(relu_network,
+                                x: torch.Tensor,
+                                *,
+                                zero_tol: float = 0.):
+    """
+    The batched version of relu_network_gradient(). For a batch of states
+    x[i], compute all the possible gradient ∂ϕ/∂x at each x[i], where the
+    (leaky) ReLU units with zero input take both the left and the right
+    gradient. The whole batch is propagated through each layer at once.
+    Since different states can have different number of gradients, the result
+    is returned in a packed layout, the gradients at x[i] are
+    dphi_dx[offsets[i]:offsets[i+1]].
+
+    Args:
+      relu_network: A fully connected neural network with (leaky) ReLU units.
+      x: The network input, of shape (N, x_dim).
+      zero_tol: When the absolute value of the ReLU unit input is less than
+      zero_tol, we consider both the left and right derivative of the ReLU
+      unit.
+    Return:
+      dphi_dx: A tensor of shape (num_possible_gradients, phi_dim, x_dim).
+      offsets: A tensor of shape (N+1,).
+    """
+    assert (len(x.shape) == 2)
+    assert (x.shape[1] == relu_network[0].in_features)
     assert (zero_tol >= 0)
     dphi_dx = torch.eye(relu_network[0].in_features,
-                        dtype=x.dtype).unsqueeze(0)
+                        dtype=x.dtype,
+                        device=x.device).unsqueeze(0).repeat(
+                            (x.shape[0], 1, 1))
+    offsets = torch.arange(x.shape[0] + 1, device=x.device)
     layer_input = x
     for layer in relu_network:
         if (isinstance(layer, torch.nn.Linear)):
@@ -1431,22 +1587,18 @@ def relu_network_gradient(relu_network,
                 c = layer.negative_slope
             else:
                 raise Exception(
-                    "relu_network_gradient(): We only accept linear layer, " +
-                    "relu layer or leaky ReLU layer")
-            for i in range(layer_input.shape[0]):
-                if layer_input[i] > zero_tol:
-                    pass
-                elif layer_input[i] < -zero_tol:
-                    dphi_dx[:, i, :] *= c
-                else:
-                    # (leaky) ReLU unit has input 0. We need to consider both
-                    # the left and the right gradient.
-                    dphi_dx = torch.cat((dphi_dx, dphi_dx), dim=0)
-                    dphi_dx[int(dphi_dx.shape[0] / 2):, i, :] *= c
+                    "relu_network_gradient_batch(): We only accept linear " +
+                    "layer, relu layer or leaky ReLU layer")
+            source, active, offsets = _relu_layer_activation_variants(
+                layer_input, offsets, zero_tol)
+            slope = torch.where(
+                active, torch.tensor(1, dtype=x.dtype, device=x.device),
+                torch.tensor(c, dtype=x.dtype, device=x.device))
+            dphi_dx = dphi_dx[source] * slope.unsqueeze(2)
         # Propagate the layer value.
         layer_input = layer(layer_input)
 
-    return dphi_dx
+    return dphi_dx, offsets
 
 
 def l1_gradient(x: torch.Tensor,
@@ -1603,6 +1755,63 @@ def minkowski_sum(x: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
     return result
 
 
+def l1_gradient_batch(x: torch.Tensor, *, zero_tol: float = 0.):
+    """
+    The batched version of l1_gradient() without subgradient samples. Compute
+    all the possible gradient of |x[i]|₁ for each x[i] in the batch. When
+    abs(x[i, j]) <= zero_tol we consider both the gradient 1 and -1. The
+    result is in a packed layout, the gradients at x[i] are
+    grad[offsets[i]:offsets[i+1]].
+
+    Args:
+      x: A tensor of shape (N, x_dim).
+      zero_tol: The tolerance to consider x[i, j] as 0.
+    Return:
+      grad: A tensor of shape (num_possible_gradient, x_dim).
+      offsets: A tensor of shape (N+1,).
+    """
+    assert (len(x.shape) == 2)
+    assert (zero_tol >= 0)
+    _, positive, offsets = _relu_layer_activation_variants(
+        x, torch.arange(x.shape[0] + 1, device=x.device), zero_tol)
+    grad = torch.where(positive, torch.tensor(1, dtype=x.dtype,
+                                              device=x.device),
+                       torch.tensor(-1, dtype=x.dtype, device=x.device))
+    return grad, offsets
+
+
+def minkowski_sum_batch(x: torch.Tensor, x_offsets: torch.Tensor,
+                        y: torch.Tensor, y_offsets: torch.Tensor):
+    """
+    The batched version of minkowski_sum() on the packed layout. For each
+    sample i, compute the Minkowski sum of x[x_offsets[i]:x_offsets[i+1]]
+    and y[y_offsets[i]:y_offsets[i+1]], with the same ordering as
+    minkowski_sum().
+
+    Return:
+      sum: The packed Minkowski sums.
+      offsets: A tensor of shape (N+1,), the sum for sample i is
+      sum[offsets[i]:offsets[i+1]].
+    """
+    assert (x.shape[1:] == y.shape[1:])
+    assert (x_offsets.shape == y_offsets.shape)
+    x_counts = x_offsets[1:] - x_offsets[:-1]
+    y_counts = y_offsets[1:] - y_offsets[:-1]
+    counts = x_counts * y_counts
+    offsets = torch.cat((torch.zeros((1, ),
+                                     dtype=torch.int64,
+                                     device=x.device),
+                         torch.cumsum(counts, dim=0)))
+    owner = torch.repeat_interleave(
+        torch.arange(counts.shape[0], device=x.device), counts)
+    local_index = torch.arange(owner.shape[0],
+                               device=x.device) - offsets[owner]
+    x_index = x_offsets[owner] + torch.div(
+        local_index, y_counts[owner], rounding_mode="floor")
+    y_index = y_offsets[owner] + local_index % y_counts[owner]
+    return x[x_index] + y[y_index], offsets
+
+
 def loss_reduction(sample_loss, reduction):
     if reduction == "mean":
         return torch.mean(sample_loss)